@@ -32,7 +32,8 @@ int findseqID(char seqName[],SeqIDMap seqidmap[],int r)
   return -1;
 }
 
-int save_interval(IntervalMap *im,int start,int stop,int iseq,int istart,int istop)
+int save_interval(IntervalMap *im,IntervalInt start,IntervalInt stop,int iseq,
+		  IntervalInt istart,IntervalInt istop)
 {
   im->start=start;
   im->end=stop;
@@ -45,20 +46,22 @@ int save_interval(IntervalMap *im,int start,int stop,int iseq,int istart,int ist
 
 
 int readMAFrecord(IntervalMap im[],int n,SeqIDMap seqidmap[],int nseq,
-		  int lpoStart,int *p_block_len,FILE *ifile,int maxseq,
+		  IntervalInt lpoStart,int *p_block_len,gzFile ifile,int maxseq,
 		  long long linecode_count[],int *p_has_continuation)
 {
-  int i,start,seqStart,junk,iseq= -1,max_len=0,seqLength,newline=1,l,extend=0;
+  int i,start,iseq= -1,max_len=0,newline=1,l,extend=0;
+  IntervalInt seqStart,junk,seqLength;
   unsigned char tmp[32768]; /* MUST USE UNSIGNED ARITHMETIC FOR linecode_count[] INDEXING! */
   char *p,seq[32768],prefix[8],seqName[64],oriFlag[8];
   if (p_has_continuation) /* DEFAULT: NO CONTINUATION */
     *p_has_continuation = 0;
-  while ((p=fgets(tmp,32767,ifile))) {
+  while ((p=gzgets(ifile,tmp,32767))) {
     l=strlen(tmp);
     if (newline ) {
       if ('s'==tmp[0] && isspace(tmp[1])) { /* READ SEQUENCE ALIGNMENT LINE */
-	if (7==sscanf(tmp,"%2s %63s %d %d %2s %d %s",prefix,seqName,&seqStart,&junk,
-		      oriFlag,&seqLength,seq)) {
+	if (7==sscanf(tmp,"%2s %63s " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		      " %2s " INTERVAL_INT_FORMAT " %s",prefix,seqName,&seqStart,
+		      &junk,oriFlag,&seqLength,seq)) {
 /*printf("%s,%d,%s,%d\n",seqName,seqStart,oriFlag,seqLength);*/ 
 	  iseq=findseqID(seqName,seqidmap,nseq); /* LOOK UP INDEX FOR SEQ */
 	  if (iseq<0) 
@@ -124,17 +127,20 @@ int readMAFrecord(IntervalMap im[],int n,SeqIDMap seqidmap[],int nseq,
 }
 
 int read_axtnet(IntervalMap im[], SeqIDMap seqidmap[], int nseq,
-                FILE *ifile, int maxseq, int *isrc, char *src_prefix,
+                gzFile ifile, int maxseq, int *isrc, char *src_prefix,
                 char *dest_prefix)
 {
-  int i,srcStart,srcEnd,destStart,destEnd,junk,junk2,idest=-1;
-  int n=0,ivalSrc= -1,ivalDest= -1,lineMax,lineAlloc=0;
-  int srcLength, destLength;
+  int i,junk,junk2,idest=-1;
+  int n=0,lineMax,lineAlloc=0;
+  IntervalInt srcStart,srcEnd,destStart,destEnd,ivalSrc= -1,ivalDest= -1;
+  IntervalInt destLength;
   unsigned char tmp[32768];
   char *p, *src_seq=NULL, *dest_seq=NULL, srcName[64], destName[64], oriFlag[8], srcChr[64], destChr[64];
-  while ((p=fgets(tmp,32767,ifile))) {
+  while ((p=gzgets(ifile,tmp,32767))) {
     if (isdigit(tmp[0])) { /* READ SUMMARY LINE */
-      if (9==sscanf(tmp,"%d %63s %d %d %63s %d %d %2s %d",&junk,srcChr,&srcStart,&srcEnd,
+      if (9==sscanf(tmp,"%d %63s " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		    " %63s " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT " %2s %d",
+		    &junk,srcChr,&srcStart,&srcEnd,
 		    destChr,&destStart,&destEnd,oriFlag,&junk2)) {
 	strcpy(srcName, src_prefix);
 	strcpy(destName, dest_prefix);
@@ -169,7 +175,7 @@ int read_axtnet(IntervalMap im[], SeqIDMap seqidmap[], int nseq,
 	  srcStart= srcStart -1;
 	}
 
-	if (fgets(src_seq,lineMax-1,ifile)==NULL || fgets(dest_seq,lineMax-1,ifile)==NULL)
+	if (gzgets(ifile,src_seq,lineMax-1)==NULL || gzgets(ifile,dest_seq,lineMax-1)==NULL)
 	  break; /* NO DATA READ, SO NOTHING TO PROCESS */
 	for (i=0;src_seq[i] && dest_seq[i];i++) {
 	  if (src_seq[i]=='-' || dest_seq[i]=='-') { /* GAP */
@@ -1,3 +1,4 @@
+#include <zlib.h>
      
 typedef struct {
   char *p;
@@ -6,9 +7,9 @@ typedef struct {
 
 typedef struct {
   char *id;
-  int length;
+  IntervalInt length;
   int ns_id;
-  int offset;
+  IntervalInt offset;
   int nlmsa_id;
 } SeqIDMap;
 
@@ -16,12 +17,12 @@ typedef struct {
 
 
 extern int readMAFrecord(IntervalMap im[],int n,SeqIDMap seqidmap[],int nseq,
-			 int lpoStart,int *p_block_len,FILE *ifile,int maxseq,
+			 IntervalInt lpoStart,int *p_block_len,gzFile ifile,int maxseq,
 			 long long linecode_count[],int *p_has_continuation)
      ;
 
 extern int read_axtnet(IntervalMap im[], SeqIDMap seqidmap[], int nseq,
-                FILE *ifile, int maxseq, int *isrc, char *src_prefix,
+                gzFile ifile, int maxseq, int *isrc, char *src_prefix,
                 char *dest_prefix)
      ;
 
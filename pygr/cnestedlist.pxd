@@ -6,10 +6,10 @@ cdef extern from "string.h":
   void *memset(void *b,int c,size_t len)
 
 cdef extern from "stdlib.h":
-  void free(void *)
-  void *malloc(size_t)
-  void *calloc(size_t,size_t)
-  void *realloc(void *,size_t)
+  void free(void *) nogil
+  void *malloc(size_t) nogil
+  void *calloc(size_t,size_t) nogil
+  void *realloc(void *,size_t) nogil
   int c_abs "abs" (int)
   void qsort(void *base, size_t nmemb, size_t size,
              int (*compar)(void *,void *))
@@ -23,6 +23,28 @@ cdef extern from "stdio.h":
   int sprintf(char *str,char *fmt,...)
   int fprintf(FILE *ifile,char *fmt,...)
   char *fgets(char *str,int size,FILE *ifile)
+  FILE *fdopen(int fd,char *mode)
+  size_t fread(void *ptr,size_t size,size_t n,FILE *ifile) nogil
+  size_t fwrite(void *ptr,size_t size,size_t n,FILE *ifile) nogil
+  int fseek(FILE *ifile,long offset,int whence)
+  long ftell(FILE *ifile)
+  enum: SEEK_SET
+
+cdef extern from "unistd.h":
+  int dup(int fd)
+  int close(int fd)
+
+cdef extern from "zlib.h":
+  ctypedef void *gzFile
+  gzFile gzopen(char *path,char *mode)
+  gzFile gzdopen(int fd,char *mode)
+  int gzbuffer(gzFile ifile,unsigned size)
+  char *gzgets(gzFile ifile,char *buf,int len) nogil
+  long gzseek(gzFile ifile,long offset,int whence)
+  long gztell(gzFile ifile)
+  int gzclose(gzFile ifile)
+  char *gzerror(gzFile ifile,int *errnum)
+  enum: Z_OK
 
 cdef extern from "string.h":
   int strcmp(char *s1, char *s2)
@@ -31,40 +53,82 @@ cdef extern from "string.h":
   char *strdup(char *)
   char *strcat(char *,char *)
 
+cdef extern from "Python.h":
+  int PyObject_AsReadBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
+  int PyObject_AsWriteBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
+
 cdef extern from "intervaldb.h":
+  ctypedef int IntervalInt # int OR long long, DEPENDING ON PYGR_64BIT_INTERVALS
+
   ctypedef struct IntervalMap:
-    int start
-    int end
-    int target_id
-    int target_start
-    int target_end
-    int sublist
+    IntervalInt start
+    IntervalInt end
+    IntervalInt target_id
+    IntervalInt target_start
+    IntervalInt target_end
+    IntervalInt sublist
 
   ctypedef struct IntervalIndex:
-    int start
-    int end
+    IntervalInt start
+    IntervalInt end
 
   ctypedef struct SublistHeader:
-    int start
-    int len
+    IntervalInt start
+    IntervalInt len
 
   ctypedef struct SubheaderFile:
     pass
+
+  ctypedef struct CompressedBlocks:
+    IntervalInt nblock
+    unsigned char *map
   
+  ctypedef struct BlockCache:
+    long long max_bytes
+    long long nbytes
+    long long hits
+    long long misses
+    long long evictions
+
   ctypedef struct IntervalDBFile:
-    int n
-    int ntop
-    int nlists
+    IntervalInt n
+    IntervalInt ntop
+    IntervalInt nlists
     int div
-    int nii
+    IntervalInt nii
     IntervalIndex *ii
     SublistHeader *subheader
     SubheaderFile subheader_file
     FILE *ifile_idb
+    int isize
+    IntervalMap *im_map
+    CompressedBlocks *blocks
+    BlockCache *cache
 
   ctypedef struct IntervalIterator:
     pass
 
+  ctypedef struct NestedListWalk:
+    pass
+
+  ctypedef struct IntervalJoin:
+    pass
+
+  ctypedef struct IntervalScan:
+    pass
+
+  ctypedef struct SeqBound:
+    IntervalInt ipos
+    int is_start
+    int iseq
+    int islot
+    int is_indel
+    int ival
+    IntervalInt start
+    IntervalInt end
+    IntervalInt target_start
+    IntervalInt target_end
+
   ctypedef struct FilePtrRecord:
     FILE *ifile
     int left
@@ -76,23 +140,49 @@ cdef extern from "intervaldb.h":
 
   int imstart_qsort_cmp(void *void_a,void *void_b)
   int target_qsort_cmp(void *void_a,void *void_b)
-  IntervalMap *read_intervals(int n,FILE *ifile) except NULL
-  SublistHeader *build_nested_list(IntervalMap im[],int n,int *p_n,int *p_nlists) except NULL
-  SublistHeader *build_nested_list_inplace(IntervalMap im[],int n,int *p_n,int *p_nlists) except NULL
-  IntervalMap *interval_map_alloc(int n) except NULL
+  IntervalMap *read_intervals(IntervalInt n,FILE *ifile) except NULL
+  SublistHeader *build_nested_list(IntervalMap im[],IntervalInt n,IntervalInt *p_n,IntervalInt *p_nlists) except NULL nogil
+  SublistHeader *build_nested_list_inplace(IntervalMap im[],IntervalInt n,IntervalInt *p_n,IntervalInt *p_nlists) except NULL nogil
+  IntervalMap *interval_map_alloc(IntervalInt n) except NULL
   IntervalIterator *interval_iterator_alloc() except NULL
   int free_interval_iterator(IntervalIterator *it)
   IntervalIterator *reset_interval_iterator(IntervalIterator *it)
-  int find_intervals(IntervalIterator *it0,int start,int end,IntervalMap im[],int n,SublistHeader subheader[],int nlists,IntervalMap buf[],int nbuf,int *p_nreturn,IntervalIterator **it_return) except -1
-  char *write_binary_files(IntervalMap im[],int n,int ntop,int div,SublistHeader *subheader,int nlists,char filestem[])
-  IntervalDBFile *read_binary_files(char filestem[],char err_msg[],int subheader_nblock) except NULL
+  IntervalIterator *rewind_interval_iterator(IntervalIterator *it) nogil
+  int find_intervals(IntervalIterator *it0,IntervalInt start,IntervalInt end,IntervalMap im[],IntervalInt n,SublistHeader subheader[],IntervalInt nlists,IntervalMap buf[],int nbuf,int *p_nreturn,IntervalIterator **it_return) except -1 nogil
+  char *write_binary_files(IntervalMap im[],IntervalInt n,IntervalInt ntop,int div,SublistHeader *subheader,IntervalInt nlists,char filestem[])
+  char *write_binary_files_r(IntervalMap im[],IntervalInt n,IntervalInt ntop,int div,SublistHeader *subheader,IntervalInt nlists,char filestem[],char err_msg[]) nogil
+  char *build_binary_files_external(FILE *ifile,IntervalInt n,int div,long long max_memory,char filestem[],char err_msg[]) nogil
+  IntervalDBFile *read_binary_files(char filestem[],char err_msg[],int subheader_nblock)
+  int map_binary_files(IntervalDBFile *db_file)
+  IntervalDBFile *acquire_interval_dbfile(IntervalDBFile *db_file)
   int free_interval_dbfile(IntervalDBFile *db_file)
-  int find_file_intervals(IntervalIterator *it0,int start,int end,IntervalIndex ii[],int nii,SublistHeader subheader[],int nlists,SubheaderFile *subheader_file,int ntop,int div,FILE *ifile,IntervalMap buf[],int nbuf,int *p_nreturn,IntervalIterator **it_return) except -1
-  int write_padded_binary(IntervalMap im[],int n,int div,FILE *ifile)
-  int read_imdiv(FILE *ifile,IntervalMap imdiv[],int div,int i_div,int ntop)
+  int find_file_intervals(IntervalIterator *it0,IntervalInt start,IntervalInt end,IntervalIndex ii[],IntervalInt nii,SublistHeader subheader[],IntervalInt nlists,SubheaderFile *subheader_file,IntervalInt ntop,int div,FILE *ifile,int isize,IntervalMap *im_map,CompressedBlocks *blocks,BlockCache *cache,IntervalMap buf[],int nbuf,int *p_nreturn,IntervalIterator **it_return) except -1 nogil
+  int advise_sequential_scan(IntervalDBFile *db_file)
+  IntervalInt prefetch_file_blocks(IntervalDBFile *db_file,IntervalInt start,IntervalInt end,IntervalInt nblock,IntervalInt prefetched)
+  BlockCache *block_cache_alloc(long long max_bytes) except NULL
+  int block_cache_purge(BlockCache *cache,FILE *ifile)
+  int free_block_cache(BlockCache *cache)
+  int set_dbfile_cache(IntervalDBFile *db_file,BlockCache *cache)
+  NestedListWalk *nested_list_walk_alloc(IntervalMap im[],IntervalInt ntop,SublistHeader subheader[],IntervalInt nlists,IntervalDBFile *db_file)
+  int free_nested_list_walk(NestedListWalk *w)
+  IntervalJoin *interval_join_alloc(NestedListWalk *a,NestedListWalk *b)
+  int interval_join_next(IntervalJoin *ij,IntervalMap buf_a[],IntervalMap buf_b[],int nbuf) nogil
+  int free_interval_join(IntervalJoin *ij)
+  int target_order_qsort_cmp(void *void_a,void *void_b)
+  int seqbound_qsort_cmp(void *void_a,void *void_b)
+  int merge_aligned_intervals(IntervalMap im[],int n,int maxgap,int maxinsert,int mininsert,long long maxsize,int merge_all,IntervalMap ival[],int sub_start[],int sub_count[])
+  int group_seq_bounds(SeqBound b[],int n,int nseq,int count[],double min_aligned,double p_min_aligned,int source_only,int indel_cut,IntervalMap out[],int *p_ibad)
+  IntervalScan *interval_scan_alloc(IntervalDBFile *db_file,int chunk_size,int padded)
+  int interval_scan_next(IntervalScan *scan,IntervalMap buf[],int nbuf) nogil
+  int free_interval_scan(IntervalScan *scan)
+  IntervalInt write_padded_binary(IntervalMap im[],IntervalInt n,int div,FILE *ifile)
+  int read_imdiv(FILE *ifile,IntervalMap imdiv[],int div,IntervalInt i_div,IntervalInt ntop) nogil
   int save_text_file(char filestem[],char basestem[],char err_msg[],FILE *ofile)
   int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
-  int C_int_max
+  int save_bundle_file(char filestem[],char basestem[],char err_msg[],FILE *ofile) nogil
+  int bundle_file_to_binaries(FILE *infile,char buildpath[],char err_msg[]) nogil
+  char *compress_binary_files(char filestem[],char err_msg[]) nogil
+  IntervalInt C_int_max
 
 
 
@@ -102,62 +192,105 @@ cdef extern from "apps/maf2nclist.h":
     int id
   ctypedef struct SeqIDMap:
     char *id
-    int length
+    IntervalInt length
     int ns_id
-    int offset
+    IntervalInt offset
     int nlmsa_id
 
   int readMAFrecord(IntervalMap im[],int n,SeqIDMap seqidmap[],int nseq,
-                    int lpoStart,int *p_block_len,FILE *ifile,int maxseq,
-                    long long linecode_count[],int *p_has_continuation)
+                    IntervalInt lpoStart,int *p_block_len,gzFile ifile,int maxseq,
+                    long long linecode_count[],int *p_has_continuation) nogil
   int read_axtnet(IntervalMap im[], SeqIDMap seqidmap[], int nseq,
-                  FILE *ifile, int maxseq, int *isrc, char *src_prefix,
-                  char *dest_prefix)
+                  gzFile ifile, int maxseq, int *isrc, char *src_prefix,
+                  char *dest_prefix) nogil
   int seqnameID_qsort_cmp(void *void_a,void *void_b)
   int seqidmap_qsort_cmp(void *void_a,void *void_b)
 
 
 
 
-cdef class IntervalDB:
+cdef class IntervalMapArray:
+  cdef IntervalMap *im
   cdef int n
-  cdef int ntop
-  cdef int nlists
+
+
+cdef class IntervalDB:
+  cdef IntervalInt n
+  cdef IntervalInt ntop
+  cdef IntervalInt nlists
   cdef IntervalMap *im
   cdef SublistHeader *subheader
+  cdef int generation
 
 
 cdef class IntervalDBIterator:
   cdef IntervalIterator *it,*it_alloc
   cdef IntervalMap im_buf[1024]
-  cdef int ihit,nhit,start,end
+  cdef int ihit,nhit
+  cdef IntervalInt start,end
   cdef IntervalDB db
 
   cdef int cnext(self)
 
+cdef class IntervalBlockCache:
+  cdef BlockCache *cache
+
 cdef class IntervalFileDB:
   cdef IntervalDBFile *db
+  cdef readonly IntervalBlockCache blockCache
+  cdef int generation
+
+cdef class IntervalScanIterator:
+  cdef IntervalScan *scan
+  cdef IntervalDBFile *dbfile
+  cdef readonly IntervalFileDB db
+  cdef int chunkSize,generation
+
+cdef class IntervalFileDBCursor:
+  cdef IntervalIterator *it
+  cdef IntervalDBFile *dbfile
+  cdef readonly IntervalFileDB db
+  cdef IntervalInt start,prefetched
+  cdef readonly int readahead
+  cdef int generation
+
+  cdef int advance(self,IntervalInt start,IntervalInt end) except -1
 
 cdef class NLMSASequence
 
+cdef class IntervalJoinIterator:
+  cdef IntervalJoin *ij
+  cdef IntervalDB idb1,idb2
+  cdef int generation1,generation2
+  cdef int chunkSize
+
 cdef class IntervalFileDBIterator:
   cdef IntervalIterator *it,*it_alloc
   cdef IntervalMap *im_buf
-  cdef int ihit,nhit,start,end,nbuf
-  cdef IntervalFileDB db
+  cdef int ihit,nhit,nbuf
+  cdef IntervalInt start,end
+  cdef IntervalFileDB db,deltaDB
   cdef IntervalDB idb
 
-  cdef int restart(self,int start,int end,IntervalFileDB db,NLMSASequence ns) except -2
+  cdef int restart(self,IntervalInt start,IntervalInt end,IntervalFileDB db,NLMSASequence ns) except -2
   cdef int reset(self) except -2
   cdef int cnext(self,int *pkeep)
   cdef int extend(self,int ikeep)
-  cdef int saveInterval(self,int start,int end,int target_id,
-                        int target_start,int target_end)
+  cdef int saveInterval(self,IntervalInt start,IntervalInt end,int target_id,
+                        IntervalInt target_start,IntervalInt target_end)
   cdef int nextBlock(self,int *pkeep) except -2
+  cdef int next_db(self) except -1
   cdef IntervalMap *getIntervalMap(self)
   cdef int loadAll(self) except -1
   cdef int copy(self,IntervalFileDBIterator src)
 
+cdef class AlignmentInputStream:
+  cdef gzFile ifile
+  cdef readonly object name
+  cdef object feeder
+
+  cdef char *gets(self,char *buf,int size)
+  cdef int close(self) except -1
 
 
 cdef class NLMSA:
@@ -169,56 +302,110 @@ cdef class NLMSA:
   cdef int do_build
   cdef readonly object lpoList,maxLPOcoord
   cdef int lpo_id
-  cdef readonly int maxlen,inlmsa,is_bidirectional,pairwiseMode,in_memory_mode
+  cdef readonly IntervalInt maxlen
+  cdef readonly int inlmsa,is_bidirectional,pairwiseMode,in_memory_mode
+  cdef readonly int append_mode
   cdef public object _persistent_id,_ignoreShadowAttr,__doc__,_saveLocalBuild
   cdef public object inverseDB
+  cdef readonly object blockCache,sliceCache,buildID
+  cdef public int lazySlices
 
   cdef void free_seqidmap(self,int nseq0,SeqIDMap *seqidmap)
-  cdef void save_nbuild(self,int nbuild[])
+  cdef void save_nbuild(self,IntervalInt nbuild[])
   cdef NLMSASequence add_seqidmap_to_union(self,int j,SeqIDMap seqidmap[],
                                            NLMSASequence ns,FILE *build_ifile[],
-                                           int nbuild[])
+                                           IntervalInt nbuild[])
+  cdef NLMSASequence append_seqidmap(self,int nseq0,SeqIDMap seqidmap[],
+                                     FILE *build_ifile[],IntervalInt nbuild[])
+  cdef NLMSASequence save_maf_block(self,IntervalMap im[],int n,int block_len,
+                                    IntervalInt maxint,SeqIDMap seqidmap[],
+                                    NLMSASequence ns,FILE *build_ifile[],
+                                    IntervalInt nbuild[])
+  cdef NLMSASequence read_maf_parse(self,filename,IntervalInt maxint,
+                                    SeqIDMap seqidmap[],NLMSASequence ns,
+                                    FILE *build_ifile[],IntervalInt nbuild[],
+                                    long long linecode_count[])
 
 cdef class NLMSASequence:
-  cdef readonly int id,length,nbuild,is_lpo,is_union
+  cdef readonly int id,is_lpo,is_union
+  cdef readonly IntervalInt length,nbuild
   cdef readonly object offset
   cdef readonly object seq
   cdef readonly object name
-  cdef IntervalFileDB db
+  cdef IntervalFileDB db,deltaDB
   cdef IntervalDB idb
   cdef FILE *build_ifile
-  cdef readonly object filestem
+  cdef int append_mode
+  cdef readonly object filestem,deltastem
   cdef readonly NLMSA nlmsaLetters
   cdef readonly object buildList
   
+  cdef FILE *open_build_file(self) except NULL
   cdef int saveInterval(self,IntervalMap im[],int n,int expand_self,FILE *ifile)
 
 cdef class NLMSASlice:
-  cdef readonly int start,stop,id
-  cdef int n,nseqBounds,nrealseq,offset
+  cdef readonly IntervalInt start,stop
+  cdef readonly int id
+  cdef int n,nseqBounds,nrealseq
+  cdef IntervalInt offset
   cdef IntervalMap *im
   cdef IntervalMap *seqBounds
   cdef readonly NLMSASequence nlmsaSequence
   cdef readonly NLMSA nlmsa
   cdef readonly object seq
   cdef object weakestLink
+  cdef int loaded
+  cdef IntervalFileDBIterator lpoIvals
 
   cdef int findSeqBounds(self,int id,int ori)
-  cdef object get_seq_interval(self, NLMSA nl, int targetID, int start, int stop)
+  cdef int save_join(self,IntervalFileDBIterator it,IntervalFileDBIterator it2) except -1
+  cdef int count_real_seqs(self) except -1
+  cdef object pack_result(self)
+  cdef int load_result(self,object s) except -1
+  cdef int save_cache_hints(self) except -1
+  cdef int load(self,int level) except -1
+  cdef IntervalFileDBIterator join_target(self,int targetID)
+  cdef object get_seq_interval(self, NLMSA nl, int targetID, IntervalInt start, IntervalInt stop)
 
 cdef class NLMSASliceLetters:
   cdef readonly NLMSASlice nlmsaSlice
 
 
 cdef class NLMSANode:
-  cdef readonly int id,ipos
+  cdef readonly int id
+  cdef readonly IntervalInt ipos
   cdef int istart,istop,n
   cdef readonly NLMSASlice nlmsaSlice
 
-  cdef int check_edge(self,int iseq,int ipos)
+  cdef int check_edge(self,int iseq,IntervalInt ipos)
 
 
 cdef class NLMSASliceIterator:
   cdef int ipos,istart,istop
   cdef NLMSASlice nlmsaSlice
 
+
+cdef class NLMSAEdgeScanIterator:
+  cdef readonly NLMSA nlmsa
+  cdef int chunkSize,raw,pairwise,nseq
+  cdef IntervalInt ipos
+  cdef object nsList,seqCache
+  cdef IntervalFileDB db
+  cdef IntervalDB idb
+  cdef IntervalDBFile *dbfile
+  cdef IntervalScan *scan
+  cdef int generation
+  cdef IntervalFileDBIterator it
+  cdef IntervalInt *offsets
+  cdef int *seqIDs,*qid
+
+  cdef int next_sequence(self) except -1
+  cdef int read_chunk(self) except -1
+
+
+cdef class NLMSASliceBatchIterator:
+  cdef readonly NLMSA nlmsa
+  cdef int raw,nival
+  cdef object chunks,results
+
+  cdef int query_chunk(self,NLMSASequence ns,object l) except -1
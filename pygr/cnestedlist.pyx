@@ -1,11 +1,336 @@
+import array
 import sequence
 import nlmsa_utils
 import logger
 
 
+cdef object get_interval_typecode():
+  'array.array typecode whose items are the size of IntervalInt'
+  for c in 'il':
+    if array.array(c).itemsize == sizeof(IntervalInt):
+      return c
+  raise ImportError('no array typecode matches IntervalInt size %d'
+                    % sizeof(IntervalInt))
+
+interval_typecode = get_interval_typecode()
+
+
+cdef object int_array(object a):
+  'return a as array.array of IntervalInt, without copying if it already is one'
+  if isinstance(a, array.array) and a.typecode == interval_typecode:
+    return a
+  return array.array(interval_typecode, a)
+
+
+cdef int pack_intervals(IntervalMap *im, int n, IntervalInt *p):
+  'copy (start,end,target_id,target_start,target_end) of n intervals to p'
+  cdef int i
+  for i from 0 <= i < n:
+    p[5 * i] = im[i].start
+    p[5 * i + 1] = im[i].end
+    p[5 * i + 2] = im[i].target_id
+    p[5 * i + 3] = im[i].target_start
+    p[5 * i + 4] = im[i].target_end
+  return 5 * n
+
+cdef int find_bound_slot(IntervalMap bounds[], int n, int slot[],
+                         IntervalInt target_id):
+  'return slot[i] of target_id in bounds[] sorted by target_id, or -1'
+  cdef int lo, hi, mid
+  lo = 0
+  hi = n
+  while lo < hi: # BINARY SEARCH FOR ITS FIRST ENTRY
+    mid = (lo + hi) / 2
+    if bounds[mid].target_id < target_id:
+      lo = mid + 1
+    else:
+      hi = mid
+  if lo < n and bounds[lo].target_id == target_id:
+    return slot[lo]
+  return -1
+
+
+cdef IntervalMap *unpack_intervals(IntervalInt *p, int n) except NULL:
+  'return a new IntervalMap array of the n intervals packed at p'
+  cdef int i
+  cdef IntervalMap *im
+  im = <IntervalMap *>calloc(n + 1, sizeof(IntervalMap))
+  if im == NULL:
+    raise MemoryError('out of memory')
+  for i from 0 <= i < n:
+    im[i].start = p[5 * i]
+    im[i].end = p[5 * i + 1]
+    im[i].target_id = p[5 * i + 2]
+    im[i].target_start = p[5 * i + 3]
+    im[i].target_end = p[5 * i + 4]
+  return im
+
+
+cdef class IntervalMapArray:
+  '''array of interval hits stored in one contiguous IntervalMap buffer.
+  Indexing returns (start, end, target_id, target_start, target_end)
+  tuples; the buffer interface and asarray() give zero-copy access'''
+
+  def __len__(self):
+    return self.n
+
+  def __getitem__(self, int i):
+    if i < 0:
+      i = i + self.n
+    if i < 0 or i >= self.n:
+      raise IndexError('IntervalMapArray index out of range')
+    return (self.im[i].start, self.im[i].end, self.im[i].target_id,
+            self.im[i].target_start, self.im[i].target_end)
+
+  def __getsegcount__(self, Py_ssize_t *p):
+    if p != NULL:
+      p[0] = self.n * sizeof(IntervalMap)
+    return 1
+
+  def __getreadbuffer__(self, Py_ssize_t i, void **p):
+    if i != 0:
+      raise SystemError('accessing non-existent buffer segment')
+    p[0] = <void *>self.im
+    return self.n * sizeof(IntervalMap)
+
+  def asarray(self):
+    '''return a NumPy structured array viewing our buffer, with fields
+    start, end, target_id, target_start, target_end.  Requires NumPy'''
+    import numpy
+    dtype = numpy.dtype({'names': ['start', 'end', 'target_id',
+                                   'target_start', 'target_end'],
+                         'formats': ['i%d' % sizeof(IntervalInt)] * 5,
+                         'offsets': [0, sizeof(IntervalInt),
+                                     2 * sizeof(IntervalInt),
+                                     3 * sizeof(IntervalInt),
+                                     4 * sizeof(IntervalInt)],
+                         'itemsize': sizeof(IntervalMap)})
+    if self.n == 0:
+      return numpy.zeros(0, dtype)
+    return numpy.frombuffer(self, dtype)
+
+  def __dealloc__(self):
+    'remember: dealloc cannot call other methods!'
+    if self.im:
+      free(self.im)
+
+
+cdef IntervalMapArray new_interval_map_array(IntervalMap *im, int n):
+  'wrap im[0:n] as IntervalMapArray, which takes ownership of im'
+  cdef IntervalMapArray a
+  a = IntervalMapArray()
+  a.im = im
+  a.n = n
+  return a
+
+
+cdef object find_overlap_array_c(IntervalInt start, IntervalInt end,
+                                 IntervalMap *im, IntervalInt ntop,
+                                 SublistHeader *subheader, IntervalInt nlists,
+                                 IntervalDBFile *dbfile, IntervalIterator *it0):
+  '''find all overlaps with start:end in an in-memory (im) or on-disk
+  (dbfile) nested list, returned as an IntervalMapArray.  Reuses
+  iterator it0 (keeping the blocks it already read) if not NULL'''
+  cdef int nhit, nalloc, nreturn, failed
+  cdef IntervalMap *hits, *new_hits
+  cdef IntervalIterator *it, *it_alloc
+  nalloc = 1024
+  hits = interval_map_alloc(nalloc)
+  if it0 != NULL:
+    it_alloc = NULL # CALLER OWNS it0
+    it = rewind_interval_iterator(it0)
+  else:
+    it_alloc = interval_iterator_alloc()
+    it = it_alloc
+  if hits == NULL or it == NULL:
+    free(hits)
+    free_interval_iterator(it_alloc)
+    raise MemoryError('out of memory')
+  nhit = 0
+  failed = 0
+  acquire_interval_dbfile(dbfile) # KEEP IT OPEN EVEN IF close()d MEANWHILE
+  try:
+    while it:
+      if nalloc - nhit < 256: # MAKE ROOM FOR ANOTHER CHUNK OF HITS
+        new_hits = <IntervalMap *>realloc(hits, 2 * nalloc * sizeof(IntervalMap))
+        if new_hits == NULL:
+          failed = 1
+          break
+        hits = new_hits
+        nalloc = 2 * nalloc
+      with nogil:
+        if dbfile != NULL: # ON-DISK DATABASE
+          find_file_intervals(it, start, end, dbfile[0].ii, dbfile[0].nii,
+                              dbfile[0].subheader, dbfile[0].nlists,
+                              &(dbfile[0].subheader_file),
+                              dbfile[0].ntop, dbfile[0].div, dbfile[0].ifile_idb,
+                              dbfile[0].isize,
+                              dbfile[0].im_map, dbfile[0].blocks, dbfile[0].cache,
+                              hits + nhit, nalloc - nhit, &nreturn, &it)
+        else: # IN-MEMORY DATABASE
+          find_intervals(it, start, end, im, ntop, subheader, nlists,
+                         hits + nhit, nalloc - nhit, &nreturn, &it)
+      nhit = nhit + nreturn
+  finally:
+    free_interval_dbfile(dbfile) # RELEASE OUR REFERENCE
+  free_interval_iterator(it_alloc)
+  if failed:
+    free(hits)
+    raise MemoryError('out of memory')
+  if nhit < nalloc: # COMPACT TO FINAL SIZE
+    new_hits = <IntervalMap *>realloc(hits, (nhit + 1) * sizeof(IntervalMap))
+    if new_hits != NULL:
+      hits = new_hits
+  return new_interval_map_array(hits, nhit)
+
+
+cdef inline int bad_ival_coords(IntervalInt start, IntervalInt end,
+                                IntervalInt length):
+  'true unless start:end is a non-empty interval of a sequence of this length'
+  if start >= 0:
+    return not (start < end and end <= length)
+  return not (-length <= start and start < end and end <= 0)
+
+cdef inline IntervalInt union_offset(IntervalInt start, IntervalInt offset):
+  'offset to add to an interval starting at start, keeping orientation sign'
+  if start < 0: # NEGATIVE ORIENTATION
+    return -offset
+  return offset
+
+cdef int save_lpo_interval(IntervalMap *im, FILE **lpoFile,
+                           IntervalInt *lpoInfo, int j) except -1:
+  'write one interval to LPO j .build file, expanding its length as needed'
+  if im.start >= 0:
+    if im.end > lpoInfo[2 * j]:
+      lpoInfo[2 * j] = im.end
+  elif -(im.start) > lpoInfo[2 * j]:
+    lpoInfo[2 * j] = -(im.start) # THIS HANDLES NEGATIVE ORI CASE
+  if write_padded_binary(im, 1, 1, lpoFile[j]) != 1:
+    raise IOError('write_padded_binary failed???')
+  lpoInfo[2 * j + 1] = lpoInfo[2 * j + 1] + 1
+  return 0
+
+
+cdef object find_overlap_batch_c(object starts, object ends, IntervalMap *im,
+                                 IntervalInt ntop, SublistHeader *subheader,
+                                 IntervalInt nlists, IntervalDBFile *dbfile,
+                                 int asArray):
+  '''run all queries starts[i]:ends[i] against one nested list, either
+  in-memory (im) or on-disk (dbfile), returning (hits, offsets)'''
+  cdef int i, k, n, nhit, nalloc, nreturn, failed
+  cdef int *qstart, *qcount, *poffset
+  cdef IntervalInt *pstart, *pend, *out
+  cdef Py_ssize_t buflen
+  cdef IntervalMap *queries, *hits, *new_hits, *ordered
+  cdef IntervalIterator *it, *it_alloc
+  starts = int_array(starts)
+  ends = int_array(ends)
+  n = len(starts)
+  if len(ends) != n:
+    raise ValueError('starts and ends must have the same length')
+  offsets = array.array('i', [0]) * (n + 1)
+  if n == 0:
+    if asArray:
+      return new_interval_map_array(NULL, 0), offsets
+    return array.array(interval_typecode), offsets
+  PyObject_AsReadBuffer(starts, <void **>&pstart, &buflen)
+  PyObject_AsReadBuffer(ends, <void **>&pend, &buflen)
+  queries = interval_map_alloc(n)
+  qstart = <int *>malloc(2 * n * sizeof(int))
+  nalloc = 1024
+  hits = interval_map_alloc(nalloc)
+  it_alloc = interval_iterator_alloc()
+  if queries == NULL or qstart == NULL or hits == NULL or it_alloc == NULL:
+    free(queries)
+    free(qstart)
+    free(hits)
+    free_interval_iterator(it_alloc)
+    raise MemoryError('out of memory')
+  for i from 0 <= i < n: # SORT QUERIES IN POSITIVE ORIENTATION ORDER
+    if pstart[i] < 0:
+      queries[i].start = -pend[i]
+      queries[i].end = -pstart[i]
+    else:
+      queries[i].start = pstart[i]
+      queries[i].end = pend[i]
+    queries[i].target_id = i
+  qsort(queries, n, sizeof(IntervalMap), imstart_qsort_cmp)
+  qcount = qstart + n
+  nhit = 0
+  failed = 0
+  acquire_interval_dbfile(dbfile) # KEEP IT OPEN EVEN IF close()d MEANWHILE
+  try:
+    with nogil: # ONE C LOOP OVER ALL THE QUERIES
+      for k from 0 <= k < n:
+        i = queries[k].target_id # ORIGINAL INDEX OF THIS QUERY
+        qstart[i] = nhit
+        it = rewind_interval_iterator(it_alloc) # KEEP BLOCKS ALREADY READ
+        while it:
+          if nalloc - nhit < 1024: # MAKE ROOM FOR ANOTHER CHUNK OF HITS
+            new_hits = <IntervalMap *>realloc(hits, 2 * nalloc * sizeof(IntervalMap))
+            if new_hits == NULL:
+              failed = 1
+              break
+            hits = new_hits
+            nalloc = 2 * nalloc
+          if dbfile != NULL: # ON-DISK DATABASE
+            find_file_intervals(it, pstart[i], pend[i], dbfile[0].ii, dbfile[0].nii,
+                                dbfile[0].subheader, dbfile[0].nlists,
+                                &(dbfile[0].subheader_file),
+                                dbfile[0].ntop, dbfile[0].div, dbfile[0].ifile_idb,
+                                dbfile[0].isize,
+                                dbfile[0].im_map, dbfile[0].blocks, dbfile[0].cache,
+                                hits + nhit, nalloc - nhit, &nreturn, &it)
+          else: # IN-MEMORY DATABASE
+            find_intervals(it, pstart[i], pend[i], im, ntop, subheader, nlists,
+                           hits + nhit, nalloc - nhit, &nreturn, &it)
+          nhit = nhit + nreturn
+        if failed:
+          break
+        qcount[i] = nhit - qstart[i]
+  finally:
+    free_interval_dbfile(dbfile) # RELEASE OUR REFERENCE
+  free(queries)
+  free_interval_iterator(it_alloc)
+  if failed:
+    free(qstart)
+    free(hits)
+    raise MemoryError('out of memory')
+  ordered = <IntervalMap *>malloc((nhit + 1) * sizeof(IntervalMap))
+  if ordered == NULL:
+    free(qstart)
+    free(hits)
+    raise MemoryError('out of memory')
+  PyObject_AsWriteBuffer(offsets, <void **>&poffset, &buflen)
+  nhit = 0
+  for i from 0 <= i < n: # SAVE HITS IN QUERY ORDER
+    poffset[i] = nhit
+    if qcount[i] > 0:
+      memcpy(ordered + nhit, hits + qstart[i], qcount[i] * sizeof(IntervalMap))
+    nhit = nhit + qcount[i]
+  poffset[n] = nhit
+  free(qstart)
+  free(hits)
+  if asArray:
+    return new_interval_map_array(ordered, nhit), offsets
+  result = array.array(interval_typecode, [0]) * (5 * nhit) # 5 INTS PER HIT
+  if nhit > 0:
+    PyObject_AsWriteBuffer(result, <void **>&out, &buflen)
+  for k from 0 <= k < nhit:
+    out[0] = ordered[k].start
+    out[1] = ordered[k].end
+    out[2] = ordered[k].target_id
+    out[3] = ordered[k].target_start
+    out[4] = ordered[k].target_end
+    out = out + 5
+  free(ordered)
+  return result, offsets
+
+
 cdef class IntervalDBIterator:
 
-  def __cinit__(self, int start, int end, IntervalDB db not None):
+  def __cinit__(self, IntervalInt start, IntervalInt end,
+                IntervalDB db not None):
     self.it = interval_iterator_alloc()
     self.it_alloc = self.it
     self.start = start
@@ -16,13 +341,27 @@ cdef class IntervalDBIterator:
     return self
 
   cdef int cnext(self): # C VERSION OF ITERATOR next METHOD RETURNS INDEX
-    cdef int i
+    cdef int i, nhit
+    cdef IntervalInt start, end, ntop, nlists
+    cdef IntervalIterator *it
+    cdef IntervalMap *im, *im_buf
+    cdef SublistHeader *subheader
     if self.ihit >= self.nhit: # TRY TO GET ONE MORE BUFFER CHUNK OF HITS
       if self.it == NULL: # ITERATOR IS EXHAUSTED
         return -1
-      find_intervals(self.it, self.start, self.end, self.db.im, self.db.ntop,
-                     self.db.subheader, self.db.nlists, self.im_buf, 1024,
-                     &(self.nhit), &(self.it)) # GET NEXT BUFFER CHUNK
+      it = self.it # COPY TO C LOCALS SO WE CAN RELEASE THE GIL
+      start = self.start
+      end = self.end
+      im = self.db.im
+      ntop = self.db.ntop
+      subheader = self.db.subheader
+      nlists = self.db.nlists
+      im_buf = self.im_buf
+      with nogil:
+        find_intervals(it, start, end, im, ntop, subheader, nlists,
+                       im_buf, 1024, &nhit, &it) # GET NEXT BUFFER CHUNK
+      self.nhit = nhit
+      self.it = it
       self.ihit = 0 # START ITERATING FROM START OF BUFFER
     if self.ihit < self.nhit: # RETURN NEXT ITEM FROM BUFFER
       i = self.ihit
@@ -65,7 +404,7 @@ cdef class IntervalDB:
 
   def save_tuples(self, l, **kwargs):
     'build in-memory NLMSA from list of alignment tuples'
-    cdef int i
+    cdef IntervalInt i
     self.close() # DUMP OUR EXISTING MEMORY
     self.n = len(l)
     self.im = interval_map_alloc(self.n)
@@ -84,12 +423,22 @@ cdef class IntervalDB:
 
   def runBuildMethod(self, buildInPlace=True):
     'build either in-place or using older build method'
+    cdef IntervalInt n, ntop, nlists
+    cdef IntervalMap *im
+    cdef SublistHeader *subheader
+    im = self.im # COPY TO C LOCALS SO WE CAN RELEASE THE GIL
+    n = self.n
     if buildInPlace:
-      self.subheader = build_nested_list_inplace(self.im, self.n, &(self.ntop), &(self.nlists))
+      with nogil:
+        subheader = build_nested_list_inplace(im, n, &ntop, &nlists)
     else:
-      self.subheader = build_nested_list(self.im, self.n, &(self.ntop), &(self.nlists))
+      with nogil:
+        subheader = build_nested_list(im, n, &ntop, &nlists)
+    self.subheader = subheader
+    self.ntop = ntop
+    self.nlists = nlists
 
-  def buildFromUnsortedFile(self, filename, int n, **kwargs):
+  def buildFromUnsortedFile(self, filename, IntervalInt n, **kwargs):
     'load unsorted binary data, and build nested list'
     cdef FILE *ifile
     cdef int i
@@ -101,7 +450,8 @@ cdef class IntervalDB:
     im_new = interval_map_alloc(n)
     if im_new == NULL:
       raise MemoryError('unable to allocate IntervalMap[%d]' % n)
-    i = read_imdiv(ifile, im_new, n, 0, n)
+    with nogil:
+      i = read_imdiv(ifile, im_new, n, 0, n)
     fclose(ifile)
     if i != n:
       raise IOError('IntervalMap file corrupted?')
@@ -109,27 +459,57 @@ cdef class IntervalDB:
     self.im = im_new
     self.runBuildMethod(**kwargs)
 
-  def find_overlap(self, int start, int end):
+  def find_overlap(self, IntervalInt start, IntervalInt end):
     self.check_nonempty() # RAISE EXCEPTION IF NO DATA
     return IntervalDBIterator(start, end, self)
 
-  def find_overlap_list(self, int start, int end):
+  def find_overlap_list(self, IntervalInt start, IntervalInt end):
     cdef int i, nhit
     cdef IntervalIterator *it, *it_alloc
     cdef IntervalMap im_buf[1024]
+    cdef IntervalMap *im
+    cdef SublistHeader *subheader
+    cdef IntervalInt ntop, nlists
     self.check_nonempty() # RAISE EXCEPTION IF NO DATA
     it = interval_iterator_alloc()
     it_alloc = it
+    im = self.im # COPY TO C LOCALS SO WE CAN RELEASE THE GIL
+    subheader = self.subheader
+    ntop = self.ntop
+    nlists = self.nlists
     l = [] # LIST OF RESULTS TO HAND BACK
     while it:
-      find_intervals(it, start, end, self.im, self.ntop,
-                     self.subheader, self.nlists, im_buf, 1024,
-                     &(nhit), &(it)) # GET NEXT BUFFER CHUNK
+      with nogil:
+        find_intervals(it, start, end, im, ntop, subheader, nlists,
+                       im_buf, 1024, &nhit, &it) # GET NEXT BUFFER CHUNK
       for i from 0 <= i < nhit:
         l.append((im_buf[i].start, im_buf[i].end, im_buf[i].target_id, im_buf[i].target_start, im_buf[i].target_end))
     free_interval_iterator(it_alloc)
     return l
 
+  def join(self, other, int chunkSize=1024):
+    '''iterate over all overlapping pairs between this and other
+    (an IntervalDB or IntervalFileDB), as chunks (a, b) of
+    IntervalMapArray, where a[k] overlaps b[k]'''
+    return IntervalJoinIterator(self, other, chunkSize)
+
+  def find_overlap_array(self, IntervalInt start, IntervalInt end):
+    '''like find_overlap_list(), but returns the hits as an
+    IntervalMapArray instead of building a tuple per hit'''
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_overlap_array_c(start, end, self.im, self.ntop,
+                                self.subheader, self.nlists, NULL, NULL)
+
+  def find_overlap_batch(self, starts, ends, asArray=False):
+    '''find overlaps for many queries starts[i]:ends[i] in one call.
+    Returns (hits, offsets): hits is a flat array of 5 ints
+    (start, end, target_id, target_start, target_end) per hit, or an
+    IntervalMapArray if asArray is True;
+    hits for query i are records offsets[i] to offsets[i+1]'''
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_overlap_batch_c(starts, ends, self.im, self.ntop,
+                                self.subheader, self.nlists, NULL, asArray)
+
   def check_nonempty(self):
     if self.im:
       return True
@@ -137,12 +517,27 @@ cdef class IntervalDB:
       msg = 'empty IntervalDB, not searchable!'
       raise IndexError(msg)
 
-  def write_binaries(self, filestem, div=256):
-    cdef char *err_msg
-    err_msg = write_binary_files(self.im, self.n, self.ntop, div,
-                                 self.subheader, self.nlists, filestem)
+  def write_binaries(self, filestem, int div=256, compress=False):
+    '''save as on-disk IntervalFileDB filestem.  compress=True stores
+    its intervals as compressed blocks; see compress_binaries()'''
+    cdef IntervalInt n, ntop, nlists
+    cdef char *err_msg, *path
+    cdef char err_buf[1024]
+    cdef IntervalMap *im
+    cdef SublistHeader *subheader
+    im = self.im # COPY TO C LOCALS SO WE CAN RELEASE THE GIL
+    n = self.n
+    ntop = self.ntop
+    subheader = self.subheader
+    nlists = self.nlists
+    path = filestem
+    with nogil:
+      err_msg = write_binary_files_r(im, n, ntop, div, subheader, nlists,
+                                     path, err_buf)
     if err_msg:
       raise IOError(err_msg)
+    if compress:
+      compress_binaries(filestem)
 
   def __dealloc__(self):
     'remember: dealloc cannot call other methods!'
@@ -158,13 +553,14 @@ cdef class IntervalDB:
       free(self.im)
     self.subheader = NULL
     self.im = NULL
+    self.generation = self.generation + 1 # E.G. FOR IntervalJoinIterator
 
     return None
 
 
 cdef class IntervalFileDBIterator:
 
-  def __cinit__(self, int start, int end, IntervalFileDB db=None,
+  def __cinit__(self, IntervalInt start, IntervalInt end, IntervalFileDB db=None,
               NLMSASequence ns=None,
               int nbuffer=1024, rawIvals=None):
     cdef int i
@@ -185,23 +581,34 @@ cdef class IntervalFileDBIterator:
         i = i + 1
       self.nhit = i # TOTAL NUMBER OF INTERVALS STORED
 
-  cdef int restart(self, int start, int end, IntervalFileDB db,
+  cdef int restart(self, IntervalInt start, IntervalInt end, IntervalFileDB db,
                    NLMSASequence ns) except -2:
     'reuse this iterator for another search without reallocing memory'
     self.nhit = 0 # FLUSH ANY EXISTING DATA
     self.start = start
     self.end = end
     self.db = db
+    self.deltaDB = None
     if ns is not None:
       if ns.idb is not None:
         self.idb = ns.idb
       elif ns.db is None:
         ns.forceLoad()
       self.db = ns.db
+      self.deltaDB = ns.deltaDB # ALSO SEARCH INTERVALS ADDED IN APPEND MODE
     self.it = self.it_alloc # REUSE OUR CURRENT ITERATOR
     reset_interval_iterator(self.it) # RESET IT FOR REUSE
     return 0
 
+  cdef int next_db(self) except -1:
+    'go on to search our delta database once the main one is exhausted'
+    if self.deltaDB is None or self.db is self.deltaDB:
+      return 0 # NOTHING LEFT TO SEARCH
+    self.db = self.deltaDB
+    self.it = self.it_alloc # REUSE OUR CURRENT ITERATOR
+    reset_interval_iterator(self.it)
+    return 1
+
   cdef int reset(self) except -2:
     'flush the buffer so we can reuse this iterator'
     self.nhit = 0
@@ -224,8 +631,8 @@ cdef class IntervalFileDBIterator:
       self.nbuf = 2 * self.nbuf
     return istart # RETURN START OF EMPTY BLOCK WHERE WE CAN ADD NEW DATA
 
-  cdef int saveInterval(self, int start, int end, int target_id,
-                        int target_start, int target_end):
+  cdef int saveInterval(self, IntervalInt start, IntervalInt end, int target_id,
+                        IntervalInt target_start, IntervalInt target_end):
     'save an interval, expanding array if necessary'
     cdef int i
     if self.nhit >= self.nbuf: # EXPAND ARRAY IF NECESSARY
@@ -241,29 +648,53 @@ cdef class IntervalFileDBIterator:
 
   cdef int nextBlock(self, int *pkeep) except -2:
     'load one more block of overlapping intervals'
-    cdef int i
-    if self.it == NULL: # ITERATOR IS EXHAUSTED
+    cdef int i, nbuf, nhit
+    cdef IntervalInt start, end, ntop, nlists
+    cdef IntervalIterator *it
+    cdef IntervalMap *im_buf, *im
+    cdef IntervalDBFile *dbfile
+    cdef SublistHeader *subheader
+    if self.it == NULL and not self.next_db(): # ITERATOR IS EXHAUSTED
       return -1
     if pkeep and pkeep[0] >= 0 and pkeep[0] < self.nhit: #MUST KEEP [ikeep:] SLICE
       i = self.extend(pkeep[0]) # MOVE SLICE TO THE FRONT
     else: # WE CAN USE THE WHOLE BUFFER
       i = 0
+    it = self.it # COPY TO C LOCALS SO WE CAN RELEASE THE GIL
+    start = self.start
+    end = self.end
+    im_buf = self.im_buf + i
+    nbuf = self.nbuf - i
     if self.db is not None: # ON-DISK DATABASE
-      find_file_intervals(self.it, self.start, self.end,
-                          self.db.db[0].ii, self.db.db[0].nii,
-                          self.db.db[0].subheader, self.db.db[0].nlists,
-                          &(self.db.db[0].subheader_file),
-                          self.db.db[0].ntop, self.db.db[0].div,
-                          self.db.db[0].ifile_idb,
-                          self.im_buf + i, self.nbuf - i,
-                          &(self.nhit), &(self.it)) # GET NEXT BUFFER CHUNK
+      while True:
+        self.db.check_nonempty() # RAISE EXCEPTION IF CLOSED
+        dbfile = acquire_interval_dbfile(self.db.db) # KEEP IT OPEN
+        try:
+          with nogil:
+            find_file_intervals(it, start, end, dbfile[0].ii, dbfile[0].nii,
+                                dbfile[0].subheader, dbfile[0].nlists,
+                                &(dbfile[0].subheader_file),
+                                dbfile[0].ntop, dbfile[0].div, dbfile[0].ifile_idb,
+                                dbfile[0].isize,
+                                dbfile[0].im_map, dbfile[0].blocks, dbfile[0].cache,
+                                im_buf, nbuf, &nhit, &it) # GET NEXT BUFFER CHUNK
+        finally:
+          free_interval_dbfile(dbfile) # RELEASE OUR REFERENCE
+        if nhit > 0 or it != NULL or not self.next_db():
+          break
+        it = self.it # NO HITS LEFT IN MAIN DATABASE, SO SEARCH THE DELTA
     elif self.idb is not None: # IN-MEMORY DATABASE
-      find_intervals(self.it, self.start, self.end, self.idb.im, self.idb.ntop,
-                     self.idb.subheader, self.idb.nlists, self.im_buf + i, self.nbuf - i,
-                     &(self.nhit), &(self.it)) # GET NEXT BUFFER CHUNK
+      im = self.idb.im
+      ntop = self.idb.ntop
+      subheader = self.idb.subheader
+      nlists = self.idb.nlists
+      with nogil:
+        find_intervals(it, start, end, im, ntop, subheader, nlists,
+                       im_buf, nbuf, &nhit, &it) # GET NEXT BUFFER CHUNK
     else:
       raise IOError('Iterator has no database!  Please provide a db argument.')
-    self.nhit = self.nhit + i # TOTAL #HITS IN THE BUFFER
+    self.it = it
+    self.nhit = nhit + i # TOTAL #HITS IN THE BUFFER
     self.ihit = i # START ITERATING FROM START OF NEW HITS
     if pkeep and pkeep[0] >= 0: # RESET ikeep INDEX TO START OF BUFFER
       pkeep[0] = 0
@@ -366,43 +797,164 @@ cdef class IntervalFileDBIterator:
       free(self.im_buf)
 
 
+cdef class IntervalBlockCache:
+  '''LRU cache of up to cacheBytes of blocks read from on-disk nested
+  lists.  Pass it to several IntervalFileDB (e.g. all the indexes of
+  an NLMSA) to share one memory budget between them'''
+
+  def __cinit__(self, long long cacheBytes):
+    if cacheBytes < 0:
+      raise ValueError('cacheBytes must be >= 0')
+    self.cache = block_cache_alloc(cacheBytes)
+
+  property cacheBytes:
+    'maximum bytes of blocks to cache'
+
+    def __get__(self):
+      return self.cache[0].max_bytes
+
+  property nbytes:
+    'bytes currently cached'
+
+    def __get__(self):
+      return self.cache[0].nbytes
+
+  property hits:
+    def __get__(self):
+      return self.cache[0].hits
+
+  property misses:
+    def __get__(self):
+      return self.cache[0].misses
+
+  property evictions:
+    def __get__(self):
+      return self.cache[0].evictions
+
+  property hitRate:
+    'fraction of block reads served from the cache'
+
+    def __get__(self):
+      if self.cache[0].hits + self.cache[0].misses == 0:
+        return 0.
+      return float(self.cache[0].hits) / (self.cache[0].hits +
+                                          self.cache[0].misses)
+
+  def clear(self):
+    'empty the cache, and reset its hits, misses and evictions counts'
+    block_cache_purge(self.cache, NULL)
+    self.cache[0].hits = 0
+    self.cache[0].misses = 0
+    self.cache[0].evictions = 0
+
+  def __dealloc__(self):
+    'remember: dealloc cannot call other methods!'
+    if self.cache:
+      free_block_cache(self.cache) # DATABASES STILL USING IT KEEP IT ALIVE
+
+
 cdef class IntervalFileDB:
 
-  def __cinit__(self, filestem=None, mode='r'):
+  def __cinit__(self, filestem=None, mode='r', useMmap=True, cacheBytes=None,
+                blockCache=None):
     if filestem is not None and mode == 'r':
-      self.open(filestem)
-
-  def open(self, filestem):
+      self.open(filestem, useMmap, cacheBytes, blockCache)
+
+  def open(self, filestem, useMmap=True, cacheBytes=None, blockCache=None):
+    '''open the on-disk nested list filestem.  By default its files are
+    memory-mapped if the platform allows; useMmap=False forces
+    ordinary file reads.  Blocks that must be read from the file, or
+    decoded, are kept in blockCache (an IntervalBlockCache) if given,
+    or in a new cache of cacheBytes for this database'''
     cdef char err_msg[1024]
     self.db = read_binary_files(filestem, err_msg, 1024)
+    self.generation = self.generation + 1 # E.G. FOR IntervalFileDBCursor
     if self.db == NULL:
       raise IOError(err_msg)
+    if useMmap:
+      map_binary_files(self.db) # FALLS BACK TO FILE READS IF MMAP FAILS
+    if blockCache is None and cacheBytes is not None:
+      blockCache = IntervalBlockCache(cacheBytes)
+    if blockCache is not None:
+      self.blockCache = blockCache
+      set_dbfile_cache(self.db, self.blockCache.cache)
 
-  def find_overlap(self, int start, int end):
+  property is_mapped:
+    'True if this database is read via mmap'
+
+    def __get__(self):
+      return self.db != NULL and (self.db[0].im_map != NULL or
+                                  (self.db[0].blocks != NULL and
+                                   self.db[0].blocks[0].map != NULL))
+
+  property is_compressed:
+    'True if this database stores its intervals as compressed blocks'
+
+    def __get__(self):
+      return self.db != NULL and self.db[0].blocks != NULL
+
+  def find_overlap(self, IntervalInt start, IntervalInt end):
     self.check_nonempty() # RAISE EXCEPTION IF NO DATA
     return IntervalFileDBIterator(start, end, self)
 
-  def find_overlap_list(self, int start, int end):
+  def find_overlap_list(self, IntervalInt start, IntervalInt end):
     cdef int i, nhit
     cdef IntervalIterator *it, *it_alloc
     cdef IntervalMap im_buf[1024]
+    cdef IntervalDBFile *dbfile
     self.check_nonempty() # RAISE EXCEPTION IF NO DATA
     it = interval_iterator_alloc()
     it_alloc = it
+    dbfile = acquire_interval_dbfile(self.db) # KEEP IT OPEN EVEN IF close()d
     l = [] # LIST OF RESULTS TO HAND BACK
-    while it:
-      find_file_intervals(it, start, end, self.db[0].ii, self.db[0].nii,
-                          self.db[0].subheader, self.db[0].nlists,
-                          &(self.db[0].subheader_file),
-                          self.db[0].ntop, self.db[0].div,
-                          self.db[0].ifile_idb, im_buf, 1024,
-                          &(nhit), &(it)) # GET NEXT BUFFER CHUNK
-      for i from 0 <= i < nhit:
-        l.append((im_buf[i].start, im_buf[i].end, im_buf[i].target_id,
-                  im_buf[i].target_start, im_buf[i].target_end))
-    free_interval_iterator(it_alloc)
+    try:
+      while it:
+        with nogil:
+          find_file_intervals(it, start, end, dbfile[0].ii, dbfile[0].nii,
+                              dbfile[0].subheader, dbfile[0].nlists,
+                              &(dbfile[0].subheader_file),
+                              dbfile[0].ntop, dbfile[0].div, dbfile[0].ifile_idb,
+                              dbfile[0].isize,
+                              dbfile[0].im_map, dbfile[0].blocks, dbfile[0].cache,
+                              im_buf, 1024, &nhit, &it) # GET NEXT BUFFER CHUNK
+        for i from 0 <= i < nhit:
+          l.append((im_buf[i].start, im_buf[i].end, im_buf[i].target_id,
+                    im_buf[i].target_start, im_buf[i].target_end))
+    finally:
+      free_interval_dbfile(dbfile) # RELEASE OUR REFERENCE
+      free_interval_iterator(it_alloc)
     return l
 
+  def join(self, other, int chunkSize=1024):
+    '''iterate over all overlapping pairs between this and other;
+    see IntervalDB.join()'''
+    return IntervalJoinIterator(self, other, chunkSize)
+
+  def find_overlap_array(self, IntervalInt start, IntervalInt end):
+    '''like find_overlap_list(), but returns the hits as an
+    IntervalMapArray instead of building a tuple per hit'''
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_overlap_array_c(start, end, NULL, 0, NULL, 0, self.db, NULL)
+
+  def find_overlap_batch(self, starts, ends, asArray=False):
+    '''find overlaps for many queries starts[i]:ends[i] in one call;
+    see IntervalDB.find_overlap_batch()'''
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_overlap_batch_c(starts, ends, NULL, 0, NULL, 0, self.db,
+                                asArray)
+
+  def scan(self, int chunkSize=65536):
+    '''iterate over all intervals in the database, in file order, as
+    IntervalMapArray chunks of up to chunkSize intervals.  Reads the
+    file sequentially, so is much faster than a query covering every
+    interval'''
+    return IntervalScanIterator(self, chunkSize)
+
+  def cursor(self, int readahead=64):
+    '''get an IntervalFileDBCursor for querying a series of windows
+    in left to right order, e.g. to scan a whole chromosome'''
+    return IntervalFileDBCursor(self, readahead)
+
   def check_nonempty(self):
     if self.db == NULL:
       raise IndexError('empty IntervalFileDB, not searchable!')
@@ -411,6 +963,7 @@ cdef class IntervalFileDB:
     if self.db:
       free_interval_dbfile(self.db)
     self.db = NULL
+    self.generation = self.generation + 1 # ITS ITERATORS MUST NOT USE db
 
   def __dealloc__(self):
     'remember: dealloc cannot call other methods!'
@@ -418,10 +971,227 @@ cdef class IntervalFileDB:
       free_interval_dbfile(self.db)
 
 
+cdef class IntervalScanIterator:
+  'iterator over all intervals of an IntervalFileDB; see IntervalFileDB.scan()'
+
+  def __cinit__(self, IntervalFileDB db not None, int chunkSize=65536):
+    if chunkSize <= 0:
+      raise ValueError('chunkSize must be > 0')
+    db.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    self.db = db
+    self.dbfile = db.db
+    self.generation = db.generation
+    self.chunkSize = chunkSize
+    self.scan = interval_scan_alloc(self.dbfile, chunkSize, 0)
+    if self.scan == NULL:
+      raise MemoryError('out of memory')
+
+  def __iter__(self):
+    return self
+
+  def __next__(self): # PYREX USES THIS NON-STANDARD NAME INSTEAD OF next()!!!
+    cdef int n, chunkSize
+    cdef IntervalMap *im, *new_im
+    cdef IntervalScan *scan
+    if self.scan == NULL:
+      raise StopIteration
+    if self.db.generation != self.generation:
+      raise IOError('IntervalFileDB was closed during scan')
+    im = interval_map_alloc(self.chunkSize)
+    scan = self.scan
+    chunkSize = self.chunkSize
+    acquire_interval_dbfile(self.dbfile) # KEEP IT OPEN EVEN IF close()d
+    with nogil:
+      n = interval_scan_next(scan, im, chunkSize)
+    free_interval_dbfile(self.dbfile) # RELEASE OUR REFERENCE
+    if n <= 0:
+      free(im)
+      free_interval_scan(self.scan)
+      self.scan = NULL
+      if n < 0:
+        raise IOError('error reading IntervalFileDB')
+      raise StopIteration
+    if n < chunkSize: # COMPACT TO FINAL SIZE
+      new_im = <IntervalMap *>realloc(im, n * sizeof(IntervalMap))
+      if new_im != NULL:
+        im = new_im
+    return new_interval_map_array(im, n)
+
+  def __dealloc__(self):
+    'remember: dealloc cannot call other methods!'
+    if self.scan:
+      free_interval_scan(self.scan)
+
+
+cdef class IntervalFileDBCursor:
+  '''streaming queries of an IntervalFileDB for windows whose starts
+  never decrease, e.g. consecutive windows along a chromosome.  It
+  keeps its iterators (and the blocks they read, at every sublist
+  depth) from one window to the next, so consecutive windows never
+  read a block twice, and asks the OS to read ahead the next
+  readahead blocks of the top-level list'''
+
+  def __cinit__(self, IntervalFileDB db not None, int readahead=64):
+    db.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    self.db = db
+    self.readahead = readahead
+    self.it = interval_iterator_alloc()
+    self.dbfile = NULL
+
+  cdef int advance(self, IntervalInt start, IntervalInt end) except -1:
+    'check that start:end continues the scan, and read ahead of it'
+    self.db.check_nonempty() # RAISE EXCEPTION IF CLOSED
+    if start < 0: # SCAN ORDER IS IN POSITIVE ORIENTATION
+      start, end = -end, -start
+    # FIRST QUERY, OR DATABASE WAS REOPENED (PERHAPS AT THE SAME ADDRESS)
+    if self.dbfile == NULL or self.db.generation != self.generation:
+      reset_interval_iterator(self.it) # FORGET BLOCKS OF ANY OLD DATABASE
+      self.dbfile = self.db.db
+      self.generation = self.db.generation
+      self.prefetched = 0
+      advise_sequential_scan(self.dbfile)
+    elif start < self.start:
+      raise ValueError('cursor query windows must be in increasing order')
+    self.start = start
+    self.prefetched = prefetch_file_blocks(self.dbfile, start, end,
+                                           self.readahead, self.prefetched)
+    return 0
+
+  def find_overlap_list(self, IntervalInt start, IntervalInt end):
+    '''get list of tuples for intervals overlapping start:end;
+    see IntervalFileDB.find_overlap_list()'''
+    cdef int i, nhit
+    cdef IntervalIterator *it
+    cdef IntervalMap im_buf[1024]
+    cdef IntervalDBFile *dbfile
+    self.advance(start, end)
+    it = rewind_interval_iterator(self.it) # KEEP BLOCKS ALREADY READ
+    dbfile = acquire_interval_dbfile(self.dbfile) # KEEP IT OPEN EVEN IF close()d
+    l = [] # LIST OF RESULTS TO HAND BACK
+    try:
+      while it:
+        with nogil:
+          find_file_intervals(it, start, end, dbfile[0].ii, dbfile[0].nii,
+                              dbfile[0].subheader, dbfile[0].nlists,
+                              &(dbfile[0].subheader_file),
+                              dbfile[0].ntop, dbfile[0].div, dbfile[0].ifile_idb,
+                              dbfile[0].isize,
+                              dbfile[0].im_map, dbfile[0].blocks, dbfile[0].cache,
+                              im_buf, 1024, &nhit, &it) # GET NEXT BUFFER CHUNK
+        for i from 0 <= i < nhit:
+          l.append((im_buf[i].start, im_buf[i].end, im_buf[i].target_id,
+                    im_buf[i].target_start, im_buf[i].target_end))
+    finally:
+      free_interval_dbfile(dbfile) # RELEASE OUR REFERENCE
+    return l
+
+  def find_overlap_array(self, IntervalInt start, IntervalInt end):
+    '''like find_overlap_list(), but returns the hits as an
+    IntervalMapArray'''
+    self.advance(start, end)
+    return find_overlap_array_c(start, end, NULL, 0, NULL, 0, self.dbfile,
+                                self.it)
+
+  def __dealloc__(self):
+    'remember: dealloc cannot call other methods!'
+    if self.it:
+      free_interval_iterator(self.it)
+
+
+cdef NestedListWalk *new_nested_list_walk(object db) except NULL:
+  'read an IntervalDB or IntervalFileDB in start order, in place'
+  cdef IntervalDB idb
+  cdef IntervalFileDB fdb
+  cdef NestedListWalk *w
+  if isinstance(db, IntervalDB):
+    idb = db
+    idb.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    w = nested_list_walk_alloc(idb.im, idb.ntop, idb.subheader, idb.nlists,
+                               NULL)
+  elif isinstance(db, IntervalFileDB):
+    fdb = db
+    fdb.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    w = nested_list_walk_alloc(NULL, 0, NULL, 0, fdb.db) # HOLDS ITS OWN REF
+  else:
+    raise TypeError('join requires an IntervalDB or IntervalFileDB')
+  if w == NULL:
+    raise MemoryError('out of memory')
+  return w
+
+
+cdef class IntervalJoinIterator:
+  '''sweep-line overlap join of two nested lists: iterates over chunks
+  (a, b) of IntervalMapArray in which a[k] overlaps b[k].  Both lists are
+  read once in start order, in place (an IntervalFileDB from its file,
+  block by block), so memory use is bounded by the intervals open at
+  the sweep position, not by the size of either list'''
+
+  def __cinit__(self, db1, db2, int chunkSize=1024):
+    cdef NestedListWalk *a, *b
+    if chunkSize <= 0:
+      raise ValueError('chunkSize must be positive')
+    self.chunkSize = chunkSize
+    if isinstance(db1, IntervalDB): # WE READ ITS MEMORY: CHECK IT'S NOT CLOSED
+      self.idb1 = db1
+      self.generation1 = self.idb1.generation
+    if isinstance(db2, IntervalDB):
+      self.idb2 = db2
+      self.generation2 = self.idb2.generation
+    a = new_nested_list_walk(db1)
+    try:
+      b = new_nested_list_walk(db2)
+    except:
+      free_nested_list_walk(a)
+      raise
+    self.ij = interval_join_alloc(a, b)
+    if self.ij == NULL:
+      free_nested_list_walk(a)
+      free_nested_list_walk(b)
+      raise IOError('error reading nested list')
+
+  def __iter__(self):
+    return self
+
+  def __next__(self): # PYREX USES THIS NON-STANDARD NAME INSTEAD OF next()!!!
+    cdef int n, nbuf
+    cdef IntervalJoin *ij
+    cdef IntervalMap *buf_a, *buf_b
+    if self.ij == NULL: # ALREADY EXHAUSTED
+      raise StopIteration
+    if (self.idb1 is not None and self.idb1.generation != self.generation1) \
+       or (self.idb2 is not None and self.idb2.generation != self.generation2):
+      raise IOError('IntervalDB was closed during join')
+    ij = self.ij
+    nbuf = self.chunkSize
+    buf_a = interval_map_alloc(nbuf)
+    buf_b = <IntervalMap *>malloc(nbuf * sizeof(IntervalMap))
+    if buf_a == NULL or buf_b == NULL:
+      free(buf_a)
+      free(buf_b)
+      raise MemoryError('out of memory')
+    with nogil:
+      n = interval_join_next(ij, buf_a, buf_b, nbuf)
+    if n <= 0: # JOIN FINISHED, SO RELEASE ITS MEMORY NOW
+      free(buf_a)
+      free(buf_b)
+      free_interval_join(self.ij)
+      self.ij = NULL
+      if n < 0:
+        raise IOError('error reading nested list')
+      raise StopIteration
+    return new_interval_map_array(buf_a, n), new_interval_map_array(buf_b, n)
+
+  def __dealloc__(self):
+    'remember: dealloc cannot call other methods!'
+    if self.ij:
+      free_interval_join(self.ij)
+
+
 cdef class NLMSASliceLetters:
   'graph interface to letter graph within this region'
 
-  def __cinit__(self, NLMSASlice nlmsaSlice):
+  def __cinit__(self, NLMSASlice nlmsaSlice not None):
+    nlmsaSlice.load(2)
     self.nlmsaSlice = nlmsaSlice
 
   def __iter__(self):
@@ -441,16 +1211,189 @@ cdef class NLMSASliceLetters:
     return iter(self.items())
 
 
+_serialLPOJoin = False # True: OLD ONE LPO QUERY PER INTERVAL, FOR BENCHMARKS
+
+cdef int join_lpo_intervals(IntervalFileDBIterator results, int n, NLMSA nl,
+                            int id, int targetID, int checkLPO) except -1:
+  '''map the first n seq -> LPO intervals saved in results through their
+  LPO databases to the aligned intervals of other sequences (only of
+  sequence targetID, if >= 0), appending those to results.  Each LPO is
+  queried in one sorted C pass, reusing one iterator so that adjacent
+  queries don't re-read its blocks; the joined intervals are saved in the
+  same order as one query per interval would give.
+  checkLPO=0 allows targets that are not LPOs, e.g. union -> LPO indexes'''
+  cdef int i, j, k, m, d, ndb, nhit, nout, nalloc, nreturn, failed, pairwise
+  cdef int lpo_id
+  cdef int *qstart, *qcount
+  cdef IntervalInt start_max, end_min, ntop, nlists
+  cdef IntervalMap hit
+  cdef IntervalMap *src, *q, *queries, *out, *new_out, *im
+  cdef IntervalIterator *it, *it_alloc[2]
+  cdef IntervalDBFile *dbfile, *dbfiles[2]
+  cdef SublistHeader *subheader
+  cdef NLMSASequence ns_lpo
+  cdef IntervalDB idb
+  cdef IntervalFileDB db, deltaDB
+  if n <= 0:
+    return 0
+  src = results.im_buf
+  nalloc = 1024 + 4 * n # TYPICALLY A FEW HITS PER LPO INTERVAL
+  queries = interval_map_alloc(n)
+  qstart = <int *>malloc(2 * n * sizeof(int))
+  out = interval_map_alloc(nalloc)
+  it_alloc[0] = interval_iterator_alloc()
+  it_alloc[1] = interval_iterator_alloc() # FOR ITS APPEND MODE DELTA, IF ANY
+  if queries == NULL or qstart == NULL or out == NULL or it_alloc[0] == NULL \
+         or it_alloc[1] == NULL:
+    free(queries)
+    free(qstart)
+    free(out)
+    free_interval_iterator(it_alloc[0])
+    free_interval_iterator(it_alloc[1])
+    raise MemoryError('out of memory')
+  qcount = qstart + n
+  for i from 0 <= i < n: # SORT BY LPO, THEN POSITIVE ORIENTATION POSITION
+    queries[i] = src[i]
+    if src[i].target_start < 0:
+      queries[i].target_start = -src[i].target_end
+    queries[i].sublist = i # REMEMBER ITS ORIGINAL ORDER
+  qsort(queries, n, sizeof(IntervalMap), target_qsort_cmp)
+  pairwise = nl.pairwiseMode == 1
+  nout = 0
+  failed = 0
+  try:
+    i = 0
+    while i < n: # ONE PASS PER LPO
+      lpo_id = queries[i].target_id
+      j = i + 1
+      while j < n and queries[j].target_id == lpo_id:
+        j = j + 1
+      ns_lpo = nl.seqlist[lpo_id]
+      if checkLPO and not ns_lpo.is_lpo:
+        raise ValueError('sequence mapped to non-LPO target??')
+      if ns_lpo.idb is None and ns_lpo.db is None:
+        ns_lpo.forceLoad()
+      dbfiles[0] = NULL
+      ndb = 1
+      if ns_lpo.db is not None: # ON-DISK DATABASE
+        db = ns_lpo.db # KEEP REFERENCES WHILE WE RELEASE THE GIL
+        dbfiles[0] = db.db
+        if ns_lpo.deltaDB is not None: # ALSO SEARCH ITS APPEND MODE DELTA
+          deltaDB = ns_lpo.deltaDB
+          dbfiles[1] = deltaDB.db
+          ndb = 2
+      else: # IN-MEMORY DATABASE
+        idb = ns_lpo.idb
+        im = idb.im
+        ntop = idb.ntop
+        subheader = idb.subheader
+        nlists = idb.nlists
+      reset_interval_iterator(it_alloc[0]) # FORGET THE LAST LPO'S BLOCKS
+      reset_interval_iterator(it_alloc[1])
+      acquire_interval_dbfile(dbfiles[0]) # KEEP THEM OPEN EVEN IF close()d
+      if ndb > 1:
+        acquire_interval_dbfile(dbfiles[1])
+      try:
+        with nogil:
+          for k from i <= k < j:
+            q = src + queries[k].sublist # THE ORIGINAL seq -> LPO INTERVAL
+            qstart[queries[k].sublist] = nout
+            for d from 0 <= d < ndb:
+              dbfile = dbfiles[d]
+              it = rewind_interval_iterator(it_alloc[d]) # KEEP BLOCKS ALREADY READ
+              while it:
+                if nalloc - nout < 1024: # MAKE ROOM FOR ANOTHER CHUNK OF HITS
+                  new_out = <IntervalMap *>realloc(out, 2 * nalloc * sizeof(IntervalMap))
+                  if new_out == NULL:
+                    failed = 1
+                    break
+                  out = new_out
+                  nalloc = 2 * nalloc
+                if dbfile != NULL:
+                  find_file_intervals(it, q.target_start, q.target_end,
+                                      dbfile[0].ii, dbfile[0].nii,
+                                      dbfile[0].subheader, dbfile[0].nlists,
+                                      &(dbfile[0].subheader_file),
+                                      dbfile[0].ntop, dbfile[0].div,
+                                      dbfile[0].ifile_idb, dbfile[0].isize,
+                                      dbfile[0].im_map,
+                                      dbfile[0].blocks, dbfile[0].cache,
+                                      out + nout, nalloc - nout, &nreturn, &it)
+                else:
+                  find_intervals(it, q.target_start, q.target_end, im, ntop,
+                                 subheader, nlists, out + nout, nalloc - nout,
+                                 &nreturn, &it)
+                nhit = nout # THE NEW HITS START HERE
+                for m from 0 <= m < nreturn: # MAP EACH HIT BACK TO THE SOURCE SEQ
+                  hit = out[nhit + m] # COPY: WE OVERWRITE HITS AS WE GO
+                  if hit.target_id == lpo_id:
+                    failed = 2
+                  if q.target_start > hit.start: # GET INTERSECTION INTERVAL
+                    start_max = q.target_start
+                  else:
+                    start_max = hit.start
+                  if q.target_end < hit.end:
+                    end_min = q.target_end
+                  else:
+                    end_min = hit.end
+                  out[nout].start = q.start + start_max - q.target_start # SRC COORDS
+                  out[nout].end = q.start + end_min - q.target_start
+                  out[nout].target_id = hit.target_id
+                  out[nout].target_start = hit.target_start + start_max - hit.start
+                  out[nout].target_end = hit.target_start + end_min - hit.start
+                  out[nout].sublist = queries[k].sublist # ITS QUERY
+                  if (hit.target_id != id or pairwise or
+                      out[nout].start != out[nout].target_start) and \
+                     (targetID < 0 or hit.target_id == targetID): # DISCARD SELF-MATCH
+                    nout = nout + 1
+              if failed == 1:
+                break
+            if failed == 1:
+              break
+            qcount[queries[k].sublist] = nout - qstart[queries[k].sublist]
+      finally:
+        free_interval_dbfile(dbfiles[0]) # RELEASE OUR REFERENCES
+        if ndb > 1:
+          free_interval_dbfile(dbfiles[1])
+      if failed == 1:
+        raise MemoryError('out of memory')
+      assert failed == 0, 'LPO mapped to itself??'
+      i = j
+    if results.nbuf < n + nout: # SAVE THE HITS IN QUERY ORDER
+      new_out = <IntervalMap *>realloc(results.im_buf,
+                                       (n + nout) * sizeof(IntervalMap))
+      if new_out == NULL:
+        raise MemoryError('out of memory')
+      results.im_buf = new_out
+      results.nbuf = n + nout
+    nout = n
+    for i from 0 <= i < n:
+      if qcount[i] > 0:
+        memcpy(results.im_buf + nout, out + qstart[i],
+               qcount[i] * sizeof(IntervalMap))
+      nout = nout + qcount[i]
+    results.nhit = nout
+  finally:
+    free(queries)
+    free(qstart)
+    free(out)
+    free_interval_iterator(it_alloc[0])
+    free_interval_iterator(it_alloc[1])
+  return nout - n
+
+
 cdef class NLMSASlice:
 
-  def __cinit__(self, NLMSASequence ns not None, int start, int stop,
-              int id=-1, int offset=0, seq=None):
-    cdef int i, j, n, start_max, end_min, start2, stop2, nseq, istart, istop, localQuery
+  def __cinit__(self, NLMSASequence ns not None, IntervalInt start,
+                IntervalInt stop, int id=-1, IntervalInt offset=0, seq=None,
+                lazy=False, IntervalFileDBIterator ivals=None):
+    cdef int i, j, n, localQuery
+    cdef IntervalInt start_max, end_min, start2, stop2, istart, istop
     cdef NLMSASequence ns_lpo
     cdef IntervalFileDBIterator it, it2
-    cdef IntervalMap *im, *im2
-    cdef int cacheMax
+    cdef IntervalMap *im2
 
+    cache = None
     if seq is None: # GET FROM NLMSASequence
       seq = ns.seq
     self.nlmsaSequence = ns # SAVE BASIC INFO
@@ -459,19 +1402,34 @@ cdef class NLMSASlice:
     self.stop = stop
     self.offset = offset # ALWAYS STORE offset IN POSITIVE ORIENTATION
     self.seq = seq
-    try: # USE PYTHON METHOD TO DO QUERY
-      id, ivals = ns.nlmsaLetters.doSlice(seq) # doSlice() RETURNS RAW INTERVALS
-      self.id = id # SAVE OUR SEQUENCE'S nlmsa_id
-      it = IntervalFileDBIterator(start, stop, rawIvals=ivals) # STORE IN BINARY FMT
+    if ivals is not None: # ALREADY JOINED BY NLMSA.get_slices()
+      self.id = id
+      it = ivals
       it2 = IntervalFileDBIterator(start, stop) # HOLDER FOR SUBSEQUENT MERGE
-      localQuery = 0 # DO NOT PERFORM LOCAL QUERY CODE BELOW!!
-    except AttributeError:
-      localQuery = 1
+      localQuery = 0
+    else:
+      try: # USE PYTHON METHOD TO DO QUERY
+        id, rawIvals = ns.nlmsaLetters.doSlice(seq) # doSlice() RETURNS RAW INTERVALS
+        self.id = id # SAVE OUR SEQUENCE'S nlmsa_id
+        it = IntervalFileDBIterator(start, stop, rawIvals=rawIvals) # STORE IN BINARY FMT
+        it2 = IntervalFileDBIterator(start, stop) # HOLDER FOR SUBSEQUENT MERGE
+        localQuery = 0 # DO NOT PERFORM LOCAL QUERY CODE BELOW!!
+      except AttributeError:
+        localQuery = 1
     if localQuery: ################################## PERFORM LOCAL QUERY
       if id < 0:
         id = ns.id
       self.id = id
       it2 = None
+      if not ns.is_lpo: # LPO SLICES HAVE NO JOIN WORTH CACHING
+        cache = ns.nlmsaLetters.sliceCache
+      if cache is not None:
+        s = cache.get(id, start, stop)
+        if s is not None: # REUSE SAVED RESULTS, SKIP QUERY AND JOIN
+          self.load_result(s)
+          if not lazy: # OTHERWISE load(2) WILL SAVE THEM
+            self.save_cache_hints()
+          return
       if start < 0: # NEED TO TRANSLATE OFFSETS TO MINUS ORIENTATION
         offset = -offset
       if ns.nlmsaLetters.pairwiseMode == 1: # TRANSLATE SEQ DIRECTLY TO LPO
@@ -482,6 +1440,8 @@ cdef class NLMSASlice:
         it = IntervalFileDBIterator(start + offset, stop + offset, ns=ns)
         n = it.loadAll() # GET ALL OVERLAPPING INTERVALS
         if n <= 0:
+          if cache is not None:
+            cache.put(id, start, stop, '')
           raise nlmsa_utils.EmptySliceError('this interval is not aligned!')
         for i from 0 <= i < n: # CLIP INTERVALS TO FIT [start:stop]
           it.im_buf[i].start = it.im_buf[i].start - offset # XLATE TO SRC SEQ COORDS
@@ -497,6 +1457,12 @@ cdef class NLMSASlice:
 
       if ns.is_lpo: # TARGET INTERVALS MUST BE LPO, MUST MAP TO REAL SEQUENCES
         it2 = IntervalFileDBIterator(start, stop) # HOLDER FOR SUBSEQUENT MERGE
+      elif lazy: # DEFER THE LPO JOIN UNTIL ITS RESULTS ARE NEEDED
+        self.lpoIvals = it
+        return
+      elif not _serialLPOJoin: # MAP THROUGH THE LPOS IN ONE BATCHED PASS
+        it2 = IntervalFileDBIterator(start, stop) # HOLDER FOR SUBSEQUENT MERGE
+        join_lpo_intervals(it, n, ns.nlmsaLetters, id, -1, 1)
       else:
         ns_lpo =ns.nlmsaLetters.seqlist[ns.nlmsaLetters.lpo_id] # DEFAULT LPO
         for i from 0 <= i < n:
@@ -533,7 +1499,17 @@ cdef class NLMSASlice:
             assert ns_lpo.id != im2[j].target_id
 
     if it.nhit <= 0:
+      if cache is not None:
+        cache.put(id, start, stop, '')
       raise nlmsa_utils.EmptySliceError('this interval is not aligned!')
+    self.save_join(it, it2)
+    if cache is not None: # SAVE RESULTS FOR REUSE
+      cache.put(id, start, stop, self.pack_result())
+    self.save_cache_hints()
+
+  cdef int save_join(self, IntervalFileDBIterator it,
+                     IntervalFileDBIterator it2) except -1:
+    'save the joined intervals from it, using it2 to merge their bounds'
     it2.copy(it) # COPY FULL SET OF SAVED INTERVALS
     self.nseqBounds = it2.mergeSeq() # MERGE TO ONE INTERVAL PER SEQUENCE ORIENTATION
     self.seqBounds = it2.getIntervalMap() # SAVE SORTED ARRAY & DETACH FROM ITERATOR
@@ -541,36 +1517,106 @@ cdef class NLMSASlice:
     self.im = it.getIntervalMap() # RELEASE THIS ARRAY FROM THE ITERATOR
     self.n = it.nhit # TOTAL #INTERVALS SAVED FROM JOIN
     qsort(self.im, self.n, sizeof(IntervalMap), imstart_qsort_cmp) # ORDER BY start
+    return self.count_real_seqs()
 
+  cdef int count_real_seqs(self) except -1:
+    'count the non-LPO sequences in our seqBounds, finishing our load'
+    cdef int i, n
+    cdef NLMSA nl
+    nl = self.nlmsa
     n = 0
     for i from 0 <= i < self.nseqBounds: # COUNT NON-LPO SEQUENCES
-      if not ns.nlmsaLetters.seqlist.is_lpo(self.seqBounds[i].target_id):
+      if not nl.seqlist.is_lpo(self.seqBounds[i].target_id):
         n = n + 1
     self.nrealseq = n # SAVE THE COUNT
+    self.loaded = 1
+    return 0
 
+  cdef object pack_result(self):
+    '''pack our joined intervals and sequence bounds as a string of
+    IntervalInt, e.g. to save in a SliceCache'''
+    cdef IntervalInt *p
+    cdef Py_ssize_t buflen
+    a = array.array(interval_typecode, [0]) * (2 + 5 * (self.n + self.nseqBounds))
+    PyObject_AsWriteBuffer(a, <void **>&p, &buflen)
+    p[0] = self.n
+    p[1] = self.nseqBounds
+    p = p + 2 + pack_intervals(self.im, self.n, p + 2)
+    pack_intervals(self.seqBounds, self.nseqBounds, p)
+    return a.tostring()
+
+  cdef int load_result(self, object s) except -1:
+    'restore the joined intervals and sequence bounds saved by pack_result()'
+    cdef IntervalInt *p
+    cdef Py_ssize_t buflen
+    a = array.array(interval_typecode)
+    a.fromstring(s)
+    if len(a) == 0: # SAVED AS UNALIGNED
+      raise nlmsa_utils.EmptySliceError('this interval is not aligned!')
+    PyObject_AsReadBuffer(a, <void **>&p, &buflen)
+    if len(a) < 2 or p[0] < 0 or p[1] < 0 or len(a) != 2 + 5 * (p[0] + p[1]):
+      raise ValueError('corrupted slice cache entry')
+    self.n = p[0]
+    self.nseqBounds = p[1]
+    self.im = unpack_intervals(p + 2, self.n)
+    self.seqBounds = unpack_intervals(p + 2 + 5 * self.n, self.nseqBounds)
+    return self.count_real_seqs()
+
+  cdef int save_cache_hints(self) except -1:
+    'save the covering interval of each aligned sequence as a cache hint'
+    cdef int i, cacheMax
+    cdef NLMSA nl
+    nl = self.nlmsa
+    self.loaded = 2
     try: # _cache_max=0 TURNS OFF CACHING...
-      cacheMax = ns.nlmsaLetters.seqDict._cache_max
+      cacheMax = nl.seqDict._cache_max
     except AttributeError:
       cacheMax = 1 # ALLOW CACHING...
     try:  # SAVE OUR COVERING INTERVALS AS CACHE HINTS IF POSSIBLE...
-      saveCache = ns.nlmsaLetters.seqDict.cacheHint
+      saveCache = nl.seqDict.cacheHint
     except AttributeError:
       cacheMax = 0 # TURN OFF CACHING
     if cacheMax > 0: # CONSTRUCT & SAVE DICT OF CACHE HINTS: COVERING INTERVALS
       cacheDict = {}
-      if seq is not None:
+      if self.seq is not None:
         try: # ADD A CACHE HINT FOR QUERY SEQ IVAL
-          seqID = ns.nlmsaLetters.seqs.getSeqID(seq) # GET FULL-LENGTH ID
+          seqID = nl.seqs.getSeqID(self.seq) # GET FULL-LENGTH ID
           cacheDict[seqID] = (self.start, self.stop)
         except KeyError:
           pass
       for i from 0 <= i < self.nseqBounds: # ONLY SAVE NON-LPO SEQUENCES
-        if not ns.nlmsaLetters.seqlist.is_lpo(self.seqBounds[i].target_id):
-          cacheDict[ns.nlmsaLetters.seqlist.getSeqID(self.seqBounds[i].target_id)] = (self.seqBounds[i].target_start, self.seqBounds[i].target_end)
+        if not nl.seqlist.is_lpo(self.seqBounds[i].target_id):
+          cacheDict[nl.seqlist.getSeqID(self.seqBounds[i].target_id)] = (self.seqBounds[i].target_start, self.seqBounds[i].target_end)
 
       if cacheDict:
         self.weakestLink = nlmsa_utils.SeqCacheOwner()
         saveCache(cacheDict, self.weakestLink) # SAVE COVERING IVALS AS CACHE HINT
+    return 0
+
+  cdef int load(self, int level) except -1:
+    '''run the LPO join deferred by a lazy slice: level 1 saves the joined
+    intervals, level 2 also saves the sequence cache hints'''
+    cdef IntervalFileDBIterator it
+    if self.loaded < 1:
+      it = self.lpoIvals
+      join_lpo_intervals(it, it.nhit, self.nlmsa, self.id, -1, 1)
+      self.save_join(it, IntervalFileDBIterator(self.start, self.stop))
+      self.lpoIvals = None
+      if self.nlmsa.sliceCache is not None: # SAVE RESULTS FOR REUSE
+        self.nlmsa.sliceCache.put(self.id, self.start, self.stop,
+                                  self.pack_result())
+    if level > 1 and self.loaded < 2:
+      self.save_cache_hints()
+    return 0
+
+  cdef IntervalFileDBIterator join_target(self, int targetID):
+    '''join a lazy slice to sequence targetID only, without saving it.
+    Its intervals follow the self.lpoIvals.nhit LPO intervals'''
+    cdef IntervalFileDBIterator it
+    it = IntervalFileDBIterator(self.start, self.stop)
+    it.copy(self.lpoIvals)
+    join_lpo_intervals(it, self.lpoIvals.nhit, self.nlmsa, self.id, targetID, 1)
+    return it
 
   def __hash__(self):
     return id(self)
@@ -588,7 +1634,7 @@ cdef class NLMSASlice:
       self.seqBounds = NULL
 
   cdef object get_seq_interval(self, NLMSA nl, int targetID,
-                               int start, int stop):
+                               IntervalInt start, IntervalInt stop):
     'get seq interval and ensure cache owner keeps it in the cache'
     if start < stop:
       ival = nl.seqInterval(targetID, start, stop)
@@ -640,6 +1686,7 @@ cdef class NLMSASlice:
 alignment intervals to an NLMSA after calling its build() method.''')
 
   def __len__(self):
+    self.load(1)
     return self.nrealseq # NUMBER OF NON-LPO SEQUENCE/ORIS ALIGNED HERE
 
   ##################################### 1:1 INTERVAL METHODS
@@ -647,22 +1694,32 @@ alignment intervals to an NLMSA after calling its build() method.''')
     '''get all 1:1 match intervals in this region of alignment
     as list of tuples.  if seq argument not None, only match intervals
     for that sequence will be included.  No clipping is performed.'''
-    cdef int i, target_id
+    cdef int i, n, target_id
+    cdef IntervalMap *im
+    cdef IntervalFileDBIterator it
     cdef NLMSA nl
     nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
     if seq is not None:
       target_id = nl.seqs.getID(seq) # CHECK IF IN OUR ALIGNMENT
     else:
       target_id = -1
+    if target_id >= 0 and self.loaded < 1: # LAZY: JOIN TO THIS SEQ ONLY
+      it = self.join_target(target_id)
+      im = it.im_buf
+      n = it.nhit
+      qsort(im, n, sizeof(IntervalMap), imstart_qsort_cmp) # ORDER BY start
+    else:
+      self.load(2)
+      im = self.im
+      n = self.n
     l = []
-    for i from 0 <= i < self.n: # GET ALL STORED INTERVALS
-      if not nl.seqlist.is_lpo(self.im[i].target_id) and \
-               (target_id < 0 or self.im[i].target_id == target_id):
-        ival2 = nl.seqInterval(self.im[i].target_id, self.im[i].target_start,
-                               self.im[i].target_end)
+    for i from 0 <= i < n: # GET ALL STORED INTERVALS
+      if not nl.seqlist.is_lpo(im[i].target_id) and \
+               (target_id < 0 or im[i].target_id == target_id):
+        ival2 = nl.seqInterval(im[i].target_id, im[i].target_start,
+                               im[i].target_end)
         if seq is None or ival2.orientation == seq.orientation:
-          ival1 = sequence.absoluteSlice(self.seq,
-                                        self.im[i].start, self.im[i].end)
+          ival1 = sequence.absoluteSlice(self.seq, im[i].start, im[i].end)
           l.append((ival1, ival2)) # SAVE THE INTERVAL MATCH
     return l
 
@@ -688,11 +1745,31 @@ alignment intervals to an NLMSA after calling its build() method.''')
 
   def findSeqEnds(self, seq):
     'get maximum interval of seq aligned in this interval'
-    cdef int i, id
+    cdef int i, id, ori, found
+    cdef IntervalInt start, end
+    cdef IntervalFileDBIterator it
     cdef NLMSA nl
     nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
     id = nl.seqs.getID(seq) # CHECK IF IN OUR ALIGNMENT
-    i = self.findSeqBounds(id, seq.orientation) # FIND THIS id,ORIENTATION
+    ori = seq.orientation
+    if self.loaded < 1: # LAZY: JOIN TO THIS SEQ ONLY, MERGE ITS INTERVALS
+      it = self.join_target(id)
+      found = 0
+      start = 0
+      end = 0
+      for i from self.lpoIvals.nhit <= i < it.nhit:
+        if (ori > 0 and it.im_buf[i].target_start < 0) or \
+           (ori < 0 and it.im_buf[i].target_start >= 0):
+          continue # WRONG ORIENTATION
+        if not found or it.im_buf[i].target_start < start:
+          start = it.im_buf[i].target_start
+        if not found or it.im_buf[i].target_end > end:
+          end = it.im_buf[i].target_end
+        found = 1
+      if not found:
+        raise KeyError('seq not aligned in this interval')
+      return self.get_seq_interval(nl, id, start, end)
+    i = self.findSeqBounds(id, ori) # FIND THIS id,ORIENTATION
     if i < 0: # NOT FOUND!
       raise KeyError('seq not aligned in this interval')
     return self.get_seq_interval(nl, self.seqBounds[i].target_id,
@@ -704,6 +1781,7 @@ alignment intervals to an NLMSA after calling its build() method.''')
     cdef int i
     cdef NLMSA nl
     nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
+    self.load(2)
     l = []
     for i from 0 <= i < self.nseqBounds:
       if nl.seqlist.is_lpo(self.seqBounds[i].target_id):
@@ -745,9 +1823,14 @@ alignment intervals to an NLMSA after calling its build() method.''')
       - pAlignedMin: a fractional minimum alignment threshold e.g. (0.9)
       - pIdentityMin: a fractional minimum identity threshold e.g. (0.9)
       '''
-    cdef int i, j, n, gap, insert, targetStart, targetEnd, start, end, maskStart, maskEnd
+    cdef int i, j, k, m, n, ngroup, doMerge
+    cdef long long maxsize0
+    cdef IntervalInt targetStart, targetEnd, start, end, maskStart, maskEnd
+    cdef IntervalMap *ivals, *sub
+    cdef int *subStart, *subCount
     cdef NLMSA nl
     nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
+    self.load(2)
     if mergeMost: # BE REASONABLE: DON'T MERGE A WHOLE CHROMOSOME
       maxgap = 10000
       maxinsert = 10000
@@ -758,86 +1841,106 @@ alignment intervals to an NLMSA after calling its build() method.''')
       for seq in filterList: # CREATE AN INDEX OF SEQUENCE IDs TO KEEP
         t = nl.seqs.getIDcoords(seq)
         targetDict[t[0]] = t[1:] # SAVE START,STOP
+    maxsize0 = maxsize
+    doMerge = 0
+    if mergeAll:
+      doMerge = 1
+    n = self.n
+    ivals = interval_map_alloc(2 * n + 1) # SORTED INTERVALS, THEN 1:1 LISTS
+    if ivals == NULL:
+      raise MemoryError('out of memory')
+    subStart = <int *>malloc((2 * n + 1) * sizeof(int))
+    if subStart == NULL:
+      free(ivals)
+      raise MemoryError('out of memory')
+    sub = ivals + n
+    subCount = subStart + n
     seqIntervals = {}
-    for i from 0 <= i < self.n: # LIST INTERVALS FOR EACH TARGET
-      if nl.seqlist.is_lpo(self.im[i].target_id):
-        continue # IT IS AN LPO, SO SKIP IT
-      start = self.im[i].start
-      end = self.im[i].end
-      targetStart = self.im[i].target_start
-      targetEnd = self.im[i].target_end
-      if filterList is not None:
-        try: # CHECK IF SEQUENCE IS IN MASKING DICTIONARY
-          maskStart, maskEnd = targetDict[self.im[i].target_id]
-        except KeyError:
-          continue # FILTER THIS SEQUENCE OUT OF THE RESULT SET
-        if start >= maskEnd or end <= maskStart: # NO OVERLAP
-          continue
-        if start < maskStart: # CLIP START TO MASKED REGION
-          targetStart = targetStart+maskStart-start
-          start = maskStart
-        if end > maskEnd:# CLIP END TO MASKED REGION
-          targetEnd = targetEnd+maskEnd-end
-          end = maskEnd
-      elif filterSeqs is not None: # CLIP TARGET SEQ INTERVAL
-        target = self.get_seq_interval(nl, self.im[i].target_id,
-                                       targetStart, targetEnd)
-        try:
-          target = filterSeqs[target] # PERFORM CLIPPING
-        except KeyError: # NO OVERLAP IN filterSeqs, SO SKIP
-          continue
-        start = start + target.start - targetStart # CLIP SOURCE SEQUENCE
-        end = end + target.stop - targetEnd
-        targetStart = target.start  # GET COORDS OF CLIPPED TARGET
-        targetEnd = target.stop
-      try: # ADD INTERVAL TO EXISTING LIST
-        seqIntervals[self.im[i].target_id] \
-             .append([start, end, targetStart, targetEnd, None])
-      except KeyError: # CREATE A NEW LIST FOR THIS TARGET
-        seqIntervals[self.im[i].target_id] = \
-           [[start, end, targetStart, targetEnd, None]]
-
-    for i, l in seqIntervals.iteritems(): # MERGE INTERVALS FOR EACH SEQ
-      if ivalMethod is not None: # USER-SUPPLIED GROUPING FUNCTION
+    try:
+      for i from 0 <= i < n: # GROUP INTERVALS BY TARGET, IN ORIGINAL ORDER
+        ivals[i] = self.im[i]
+        ivals[i].sublist = i
+      qsort(ivals, n, sizeof(IntervalMap), target_order_qsort_cmp)
+      groups = []
+      i = 0
+      while i < n: # FILTER THE INTERVALS OF EACH TARGET, ivals[i:j]
+        j = i + 1
+        while j < n and ivals[j].target_id == ivals[i].target_id:
+          j = j + 1
+        if nl.seqlist.is_lpo(ivals[i].target_id):
+          i = j
+          continue # IT IS AN LPO, SO SKIP IT
+        m = 0
+        if filterList is not None:
+          try: # CHECK IF SEQUENCE IS IN MASKING DICTIONARY
+            maskStart, maskEnd = targetDict[ivals[i].target_id]
+          except KeyError:
+            i = j
+            continue # FILTER THIS SEQUENCE OUT OF THE RESULT SET
+          for k from i <= k < j:
+            start = ivals[k].start
+            end = ivals[k].end
+            if start >= maskEnd or end <= maskStart: # NO OVERLAP
+              continue
+            ivals[i + m] = ivals[k]
+            if start < maskStart: # CLIP START TO MASKED REGION
+              ivals[i + m].target_start = ivals[k].target_start + maskStart - start
+              ivals[i + m].start = maskStart
+            if end > maskEnd: # CLIP END TO MASKED REGION
+              ivals[i + m].target_end = ivals[k].target_end + maskEnd - end
+              ivals[i + m].end = maskEnd
+            m = m + 1
+        elif filterSeqs is not None: # CLIP TARGET SEQ INTERVAL
+          for k from i <= k < j:
+            targetStart = ivals[k].target_start
+            targetEnd = ivals[k].target_end
+            target = self.get_seq_interval(nl, ivals[k].target_id,
+                                           targetStart, targetEnd)
+            try:
+              target = filterSeqs[target] # PERFORM CLIPPING
+            except KeyError: # NO OVERLAP IN filterSeqs, SO SKIP
+              continue
+            ivals[i + m] = ivals[k]
+            ivals[i + m].start = ivals[k].start + target.start - targetStart
+            ivals[i + m].end = ivals[k].end + target.stop - targetEnd
+            ivals[i + m].target_start = target.start
+            ivals[i + m].target_end = target.stop
+            m = m + 1
+        else:
+          m = j - i
+        if m > 0: # SAVE IN ORDER OF FIRST APPEARANCE, AS DICT KEY ORDER
+          groups.append((ivals[i].sublist, i, m))
+        i = j
+      groups.sort()
+      for t in groups: # MERGE INTERVALS FOR EACH SEQ
+        i = t[1]
+        m = t[2]
+        if ivalMethod is None:
+          ngroup = merge_aligned_intervals(ivals + i, m, maxgap, maxinsert,
+                                           mininsert, maxsize0, doMerge,
+                                           sub + i, subStart + i,
+                                           subCount + i)
+        else: # USER-SUPPLIED GROUPING FUNCTION WILL MERGE THEM
+          ngroup = m
+        l = []
+        for k from i <= k < i + ngroup:
+          mergeIntervals = None
+          if ivalMethod is None and subCount[k] > 0: # ORIGINAL 1:1 IVALS
+            mergeIntervals = []
+            for j from i + subStart[k] <= j < i + subStart[k] + subCount[k]:
+              mergeIntervals.append((sub[j].start, sub[j].end,
+                                     sub[j].target_start, sub[j].target_end))
+          l.append([ivals[k].start, ivals[k].end, ivals[k].target_start,
+                    ivals[k].target_end, mergeIntervals])
+        seqIntervals[ivals[i].target_id] = l
+    finally:
+      free(ivals)
+      free(subStart)
+    if ivalMethod is not None:
+      for i, l in seqIntervals.iteritems():
         ivalMethod(l, nl.seqlist.getSeq(i), msaSlice=self, maxgap=maxgap,
                    maxinsert=maxinsert, mininsert=mininsert,
                    filterSeqs=filterSeqs, mergeAll=mergeAll, **kwargs)
-        continue # NO NEED TO APPLY GENERIC MERGING OPERATION BELOW
-      n = 0
-      for j from 1 <= j < len(l): # MERGE BY INDEL LENGTH RULES
-        gap = l[j][0] - l[n][1] # current.start - last.end
-        insert = l[j][2] - l[n][3] # current.target_start - last.target_end
-        if not mergeAll and \
-               (gap > maxgap or insert > maxinsert or insert < mininsert or
-                l[j][1] - l[n][0] > maxsize or
-                l[j][3] - l[n][2] > maxsize):
-          n = n + 1 # SPLIT, SO START A NEW INTERVAL
-          if n < j: # COPY START COORDS TO NEW SLOT
-            l[n][0] = l[j][0]
-            l[n][2] = l[j][2]
-        else: # INTERVALS MERGED: SAVE ORIGINAL 1:1 INTERVAL LIST
-          try:
-            lastIval = l[n][4][-1] # GET LAST 1:1 INTERVAL
-          except TypeError: # EMPTY LIST: CREATE ONE
-            if l[n][1] == l[j][0] and l[n][3] == l[j][2]: # NO GAP, SO MERGE
-              l[n][4] = [(l[n][0], l[j][1], l[n][2], l[j][3])]
-            else: # TWO SEPARATE 1:1 INTERVALS
-              l[n][4] = [tuple(l[n][:4]), tuple(l[j][:4])]
-          else: # SEE IF WE CAN FUSE TO LAST 1:1 INTERVAL
-            if lastIval[1] == l[j][0] and lastIval[3] == l[j][2]:
-              l[n][4][-1] = (lastIval[0], l[j][1], lastIval[2], l[j][3])
-            else: # GAP, SO JUST APPEND THIS 1:1 INTERVAL
-              l[n][4].append(tuple(l[j][:4]))
-        if n < j: # COPY END COORDS TO CURRENT SLOT
-          l[n][1] = l[j][1]
-          l[n][3] = l[j][3]
-      del l[n+1:] # DELETE REMAINING UNMERGED INTERVALS
-      for m in l: # CULL SINGLETON 1:1 INTERVAL LISTS (DUE TO FUSION)
-        try:
-          if len(m[4]) == 1: # TWO INTERVALS MUST HAVE BEEN FUSED
-            m[4] = None # NO NEED TO KEEP SINGLETON!
-        except TypeError:
-          pass
     # SEQUENCE MASKING BY CONSERVATION OR %ALIGNED CONSTRAINT
     if 'pAlignedMin' in kwargs or 'pIdentityMin' in kwargs or \
            'minAlignSize' in kwargs or 'maxAlignSize' in kwargs:
@@ -924,7 +2027,106 @@ alignment intervals to an NLMSA after calling its build() method.''')
       seqs is a list of sequences in the group.
       Must return a list of (sourceIval,targetIval).  See the docs.
     '''
-    cdef int i, j, start, end, targetStart, targetEnd, ipos, id
+    cdef int i, j, k, n, nout, ibad, id
+    cdef SeqBound *bounds
+    cdef IntervalMap *out
+    cdef int *count
+    cdef NLMSA nl
+    if seqMethod is not None or \
+       not (sourceOnly or (minAligned <= 1 and pMinAligned <= 0)):
+      # seqMethod, OR MASKING THAT MUST REPORT OPEN TARGET IVALS
+      return self._groupBySequencesPy(seqIntervals, sourceOnly=sourceOnly,
+                                      indelCut=indelCut, seqGroups=seqGroups,
+                                      minAligned=minAligned,
+                                      pMinAligned=pMinAligned,
+                                      seqMethod=seqMethod, **kwargs)
+    nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
+    if seqGroups is None:
+      seqGroups = [seqIntervals] # JUST USE THE WHOLE SET
+    result = []
+    for seqs in seqGroups: # PROCESS EACH SEQ GROUP
+      ivalList = []
+      seqSlot = {} # OPEN INTERVAL COUNTER FOR EACH SEQ
+      j = 0
+      for seq in seqs: # CONSTRUCT INTERVAL LIST
+        if isinstance(seq, int): # seqIntervals USES INT INDEX VALUES
+          id = seq # SAVE THE ID
+          seq = self.get_seq_interval(nl, id, 0, 0) # GET THE SEQUENCE OBJECT
+        else: # EXPECT USER TO SUPPLY ACTUAL SEQUENCE OBJECTS
+          id = nl.seqs.getID(seq)
+          seq = seq.pathForward # ENSURE WE HAVE TOP-LEVEL SEQ OBJECT
+        try:
+          ivals = seqIntervals[id]
+        except KeyError: # SEQUENCE NOT IN THIS ALIGNMENT REGION, SO SKIP
+          continue
+        try:
+          k = seqSlot[seq]
+        except KeyError:
+          k = len(seqSlot)
+          seqSlot[seq] = k
+        isIndel = 0
+        for ival in ivals:
+          ivalList.append((j, k, isIndel, seq, ival))
+          isIndel = 1
+        j = j + 1 # SEQUENCE COUNTER ENSURES ORDER OF SEQS IN SORTED LIST
+      n = 2 * len(ivalList)
+      if n == 0:
+        continue
+      out = interval_map_alloc(2 * n)
+      bounds = <SeqBound *>malloc(n * sizeof(SeqBound))
+      count = <int *>calloc(len(seqSlot), sizeof(int))
+      try:
+        if out == NULL or bounds == NULL or count == NULL:
+          raise MemoryError('out of memory')
+        for i from 0 <= i < n by 2: # START AND STOP OF EACH INTERVAL
+          t = ivalList[i / 2]
+          bounds[i].iseq = t[0]
+          bounds[i].islot = t[1]
+          bounds[i].is_indel = t[2]
+          bounds[i].ival = i / 2
+          ival = t[4]
+          bounds[i].start = ival[0]
+          bounds[i].end = ival[1]
+          bounds[i].target_start = ival[2]
+          bounds[i].target_end = ival[3]
+          bounds[i + 1] = bounds[i]
+          bounds[i].ipos = bounds[i].end
+          bounds[i].is_start = 0
+          bounds[i + 1].ipos = bounds[i + 1].start
+          bounds[i + 1].is_start = 1
+        # ASCENDING ORDER OF source_pos, SORT stop B4 start
+        qsort(bounds, n, sizeof(SeqBound), seqbound_qsort_cmp)
+        nout = group_seq_bounds(bounds, n, len(seqs), count, minAligned,
+                                pMinAligned, sourceOnly, indelCut, out, &ibad)
+        if nout < 0: # STOP WITHOUT A START
+          raise KeyError(ivalList[bounds[ibad].ival][3])
+        for i from 0 <= i < nout:
+          if out[i].target_id < 0: # JUST SAVE MERGED SOURCE INTERVAL
+            result.append(sequence.absoluteSlice(self.seq, out[i].start,
+                                                 out[i].end))
+            continue
+          t = ivalList[out[i].target_id]
+          mergeIntervals = t[4][4]
+          if out[i].sublist: # TARGET IVAL START WAS TRUNCATED
+            mergeIntervals = self.clip_interval_list(out[i].start, None,
+                                                     mergeIntervals)
+          result.append((sequence.absoluteSlice(self.seq, out[i].start,
+                                                out[i].end),
+                         sequence.relativeSlice(t[3], out[i].target_start,
+                                                out[i].target_end),
+                         mergeIntervals))
+      finally:
+        free(bounds)
+        free(out)
+        free(count)
+    return result
+
+  def _groupBySequencesPy(self, seqIntervals, sourceOnly=False,
+                          indelCut=False, seqGroups=None, minAligned=1,
+                          pMinAligned=0., seqMethod=None, **kwargs):
+    'pure Python groupBySequences(), for seqMethod and masking reports'
+    cdef int i, j, id
+    cdef IntervalInt start, end, targetStart, targetEnd, ipos
     cdef float f
     cdef NLMSA nl
     nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
@@ -1055,6 +2257,7 @@ alignment intervals to an NLMSA after calling its build() method.''')
     if self.nlmsaSequence.is_lpo: # ALREADY AN LPO REGION!
       return self.split(**kwargs) # JUST APPLY GROUP-BY RULES TO  self
     nl = self.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
+    self.load(1)
     l = []
     for i from 0 <= i < self.nseqBounds:
       ns_lpo = nl.seqlist[self.seqBounds[i].target_id]
@@ -1083,14 +2286,89 @@ alignment intervals to an NLMSA after calling its build() method.''')
   def rawIvals(self):
     'return list of raw numeric intervals in this slice'
     cdef int i
+    self.load(2)
     l = []
     for i from 0 <= i < self.n:
       l.append((self.im[i].start, self.im[i].end, self.im[i].target_id,
                 self.im[i].target_start, self.im[i].target_end))
     return l
 
+  def summarize(self, binSize=None):
+    '''count aligned sequences, aligned bases and alignment intervals in
+    each bin of binSize positions of this slice (default: one bin), from
+    its interval arrays without creating any sequence objects.  Returns
+    an nlmsa_utils.AlignmentSummary'''
+    cdef int i, j, k, b, nbins, nseq
+    cdef IntervalInt size, s, e, binStart, binEnd
+    cdef int *slot, *pnseqs, *pblocks
+    cdef long *pbases, *ptotal
+    cdef Py_ssize_t buflen
+    cdef NLMSA nl
+    self.load(1) # JOINED INTERVALS ONLY, NO CACHE HINTS
+    nl = self.nlmsa
+    seqIDs = []
+    idSlot = {}
+    slot = <int *>malloc((self.nseqBounds + 1) * sizeof(int))
+    if slot == NULL:
+      raise MemoryError('out of memory')
+    try:
+      for i from 0 <= i < self.nseqBounds: # ONE SLOT PER NON-LPO SEQUENCE
+        k = self.seqBounds[i].target_id
+        if nl.seqlist.is_lpo(k):
+          slot[i] = -1
+        elif k in idSlot: # ITS OTHER ORIENTATION
+          slot[i] = idSlot[k]
+        else:
+          slot[i] = len(seqIDs)
+          idSlot[k] = slot[i]
+          seqIDs.append(nl.seqlist.getSeqID(k))
+      summary = nlmsa_utils.AlignmentSummary(self.start, self.stop, binSize,
+                                             seqIDs)
+      nseq = len(seqIDs)
+      if nseq == 0:
+        return summary
+      size = summary.binSize
+      nbins = len(summary)
+      PyObject_AsWriteBuffer(summary.nseqs, <void **>&pnseqs, &buflen)
+      PyObject_AsWriteBuffer(summary.alignedBases, <void **>&ptotal, &buflen)
+      PyObject_AsWriteBuffer(summary.seqBases, <void **>&pbases, &buflen)
+      PyObject_AsWriteBuffer(summary.seqBlocks, <void **>&pblocks, &buflen)
+      for i from 0 <= i < self.n: # ADD EACH INTERVAL TO THE BINS IT OVERLAPS
+        j = find_bound_slot(self.seqBounds, self.nseqBounds, slot,
+                            self.im[i].target_id)
+        if j < 0: # AN LPO INTERVAL
+          continue
+        s = self.im[i].start
+        if s < self.start:
+          s = self.start
+        e = self.im[i].end
+        if e > self.stop:
+          e = self.stop
+        if s >= e:
+          continue
+        b = (s - self.start) / size
+        binStart = self.start + b * size
+        while b < nbins and binStart < e:
+          binEnd = binStart + size
+          if binEnd > e:
+            binEnd = e
+          if binStart < s:
+            binStart = s
+          pbases[b * nseq + j] = pbases[b * nseq + j] + binEnd - binStart
+          pblocks[b * nseq + j] = pblocks[b * nseq + j] + 1
+          b = b + 1
+          binStart = self.start + b * size
+      for b from 0 <= b < nbins: # SEQUENCE COUNTS AND BASE TOTALS PER BIN
+        for j from 0 <= j < nseq:
+          if pblocks[b * nseq + j] > 0:
+            pnseqs[b] = pnseqs[b] + 1
+            ptotal[b] = ptotal[b] + pbases[b * nseq + j]
+      return summary
+    finally:
+      free(slot)
+
 
-def advanceStartStop(int ipos, NLMSASlice nlmsaSlice not None,
+def advanceStartStop(IntervalInt ipos, NLMSASlice nlmsaSlice not None,
                      int istart, int istop):
   cdef int i
   if istop >= nlmsaSlice.n:
@@ -1110,6 +2388,7 @@ cdef class NLMSASliceIterator:
   'generate letters (nodes) in this LPO slice'
 
   def __cinit__(self, NLMSASlice nlmsaSlice not None):
+    nlmsaSlice.load(2)
     self.nlmsaSlice = nlmsaSlice
     self.ipos = nlmsaSlice.start - 1
 
@@ -1135,10 +2414,11 @@ cdef class NLMSASliceIterator:
 cdef class NLMSANode:
   'interface to a node in NLMSA storage of LPO alignment'
 
-  def __cinit__(self, int ipos, NLMSASlice nlmsaSlice not None,
+  def __cinit__(self, IntervalInt ipos, NLMSASlice nlmsaSlice not None,
               int istart=0, int istop=-1):
     cdef int i, n
     cdef NLMSA nl
+    nlmsaSlice.load(2)
     self.nlmsaSlice = nlmsaSlice
     nl = nlmsaSlice.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
     self.ipos = ipos
@@ -1160,7 +2440,8 @@ cdef class NLMSANode:
     return self.n
 
   def __iter__(self):
-    cdef int i, j
+    cdef int i
+    cdef IntervalInt j
     cdef NLMSA nl
     nl = self.nlmsaSlice.nlmsaSequence.nlmsaLetters # GET TOPLEVEL LETTERS OBJECT
     l = []
@@ -1174,7 +2455,8 @@ cdef class NLMSANode:
 
   def getSeqPos(self, seq):
     'return seqpos for this seq at this node'
-    cdef int i, j, id
+    cdef int i, id
+    cdef IntervalInt j
     try:
       id = self.nlmsaSlice.nlmsaSequence.nlmsaLetters.seqs.getID(seq)
     except KeyError:
@@ -1212,7 +2494,7 @@ cdef class NLMSANode:
       return -1
 
   ########################################## NODE-TO-NODE EDGE METHODS
-  cdef int check_edge(self, int iseq, int ipos):
+  cdef int check_edge(self, int iseq, IntervalInt ipos):
     cdef int i
     for i from self.istart <= i < self.istop:
       if self.nlmsaSlice.im[i].start <= self.ipos and \
@@ -1278,53 +2560,459 @@ cdef class NLMSANode:
     return result
 
 
-cdef class NLMSASequence:
-  'sequence interface to NLMSA storage of an LPO alignment'
+cdef class NLMSAEdgeScanIterator:
+  '''iterate over all 1:1 aligned intervals of an NLMSA in chunks, by
+  scanning each sequence index in file order; see NLMSA.scan_edges()'''
 
-  def __init__(self, NLMSA nl not None, filestem, seq, mode='r', is_union=0,
-               length=None):
-    self.nlmsaLetters = nl
-    self.filestem = filestem
-    self.is_union = is_union
-    self.is_lpo = 0 # DEFAULT: NOT AN LPO
-    self.seq = seq
-    if length is not None: # ALLOW USER TO SUPPLY A LENGTH FOR THIS COORD SYSTEM
-      self.length = length
-    import types
-    if isinstance(seq, types.StringType):
-      self.name = seq # ALLOW USER TO BUILD INDEXES WITH A STRING NAME
-    elif seq is not None: # REGULAR SEQUENCE
-      seq = seq.pathForward # GET THE WHOLE SEQUENCE, IN FORWARD ORIENTATION
-      try: # MAKE SURE seq HAS A UNIQUE NAME FOR INDEXING IT...
-        self.name = str(seq.path.name)
-      except AttributeError:
-        try:
-          self.name = str(seq.path.id)
-        except AttributeError:
-          raise AttributeError('NLMSASequence: seq must have name or id attribute')
-    else:
-      self.length = 0 # LPO AND UNION SEQUENCES EXPAND AUTOMATICALLY
-      if not is_union:
-        self.is_lpo = 1
-        if len(nl.lpoList) > 0:  # CALCULATE OFFSET OF NEW LPO, BASED ON LAST LPO
-          lastLPO = nl.lpoList[-1]
-          self.offset = lastLPO.offset + lastLPO.length
-        else:
-          self.offset = 0
-        nl.lpoList.append(self) # ADD TO THE LPO LIST
-    self.idb = None # DEFAULT: NOT USING IN-MEMORY DATABASE.
-    self.db = None # DEFAULT: WAIT TO OPEN DB UNTIL ACTUALLY NEEDED
-    if mode == 'r': # IMMEDIATELY OPEN DATABASE, UNLIKE onDemand MODE
-      self.db = IntervalFileDB(filestem, mode)
-    elif mode == 'memory': # OPEN IN-MEMORY DATABASE
-      self.idb = IntervalDB()
-    elif mode == 'w': # WRITE .build FILE
-      filename = filestem + '.build'
-      self.build_ifile = fopen(filename, 'wb') # binary file
-      if self.build_ifile == NULL:
-        errmsg = 'unable to open in write mode: ' + filename
-        raise IOError(errmsg)
-      self.nbuild = 0
+  def __cinit__(self, NLMSA nl not None, raw=False, int chunkSize=65536):
+    cdef NLMSASequence ns
+    if chunkSize <= 0:
+      raise ValueError('chunkSize must be > 0')
+    self.nlmsa = nl
+    self.chunkSize = chunkSize
+    if raw:
+      self.raw = 1
+    self.pairwise = nl.pairwiseMode == 1
+    members = {}
+    for seqID in nl.seqs.seqIDdict: # GROUP SEQUENCES BY THEIR UNION
+      nlmsaID, nsID, offset = nl.seqs.seqIDdict[seqID]
+      try:
+        members[nsID].append((offset, nlmsaID))
+      except KeyError:
+        members[nsID] = [(offset, nlmsaID)]
+    self.nsList = []
+    for ns in nl.seqlist:
+      if not ns.is_lpo and ns.id in members:
+        l = members[ns.id]
+        l.sort() # ORDER BY offset FOR BINARY SEARCH
+        self.nsList.append((ns, l))
+    self.nsList.reverse() # SO WE CAN pop() THEM IN ORDER
+    self.seqCache = {}
+    self.it = IntervalFileDBIterator(0, 0, nbuffer=chunkSize)
+    self.qid = <int *>malloc(chunkSize * sizeof(int))
+    if self.qid == NULL:
+      raise MemoryError('out of memory')
+
+  cdef int next_sequence(self) except -1:
+    'start scanning the next sequence index, return 0 if none left'
+    cdef int i
+    cdef NLMSASequence ns
+    cdef IntervalFileDB db
+    if self.scan:
+      free_interval_scan(self.scan)
+      self.scan = NULL
+    self.db = None
+    self.idb = None
+    while self.nsList:
+      o, l = self.nsList.pop()
+      if isinstance(o, IntervalFileDB): # APPEND MODE DELTA OF THE LAST INDEX
+        db = o
+      else:
+        ns = o
+        if self.pairwise: # ITS VIRTUAL LPO MAPS IT DIRECTLY TO OTHER SEQS
+          ns = self.nlmsa.seqlist[ns.id - 1]
+        if ns.idb is not None: # IN-MEMORY INDEX
+          if ns.idb.n <= 0:
+            continue
+          self.idb = ns.idb
+          self.ipos = 0
+          db = None
+        else: # ON-DISK INDEX
+          if ns.db is None:
+            ns.forceLoad()
+          db = ns.db
+          if ns.deltaDB is not None: # SCAN IT NEXT, WITH THE SAME SEQUENCES
+            self.nsList.append((ns.deltaDB, l))
+      if db is not None:
+        if db.db == NULL:
+          continue
+        self.db = db
+        self.dbfile = db.db
+        self.generation = db.generation
+        self.scan = interval_scan_alloc(self.dbfile, self.chunkSize, 0)
+        if self.scan == NULL:
+          raise MemoryError('out of memory')
+      free(self.offsets)
+      free(self.seqIDs)
+      self.nseq = len(l)
+      self.offsets = <IntervalInt *>malloc(self.nseq * sizeof(IntervalInt))
+      self.seqIDs = <int *>malloc(self.nseq * sizeof(int))
+      if self.offsets == NULL or self.seqIDs == NULL:
+        raise MemoryError('out of memory')
+      for i from 0 <= i < self.nseq:
+        self.offsets[i], self.seqIDs[i] = l[i]
+      return 1
+    return 0
+
+  cdef int read_chunk(self) except -1:
+    'read the next chunk of the current index into self.it, return its size'
+    cdef int n
+    cdef IntervalScan *scan
+    cdef IntervalMap *buf
+    n = 0
+    if self.idb is not None:
+      n = self.chunkSize
+      if n > self.idb.n - self.ipos:
+        n = self.idb.n - self.ipos
+      if n > 0:
+        memcpy(self.it.im_buf, self.idb.im + self.ipos, n * sizeof(IntervalMap))
+        self.ipos = self.ipos + n
+    elif self.scan != NULL:
+      if self.db.generation != self.generation:
+        raise IOError('IntervalFileDB was closed during scan')
+      scan = self.scan
+      buf = self.it.im_buf
+      n = self.chunkSize
+      acquire_interval_dbfile(self.dbfile) # KEEP IT OPEN EVEN IF close()d
+      with nogil:
+        n = interval_scan_next(scan, buf, n)
+      free_interval_dbfile(self.dbfile) # RELEASE OUR REFERENCE
+      if n < 0:
+        raise IOError('error reading IntervalFileDB')
+    self.it.nhit = n
+    return n
+
+  def __iter__(self):
+    return self
+
+  def __next__(self): # PYREX USES THIS NON-STANDARD NAME INSTEAD OF next()!!!
+    cdef int i, n, left, right, mid, src_id
+    cdef IntervalInt pos, offset
+    cdef IntervalMap *im
+    cdef NLMSA nl
+    nl = self.nlmsa
+    while True:
+      n = self.read_chunk()
+      if n == 0: # THIS INDEX IS DONE
+        if not self.next_sequence():
+          raise StopIteration
+        continue
+      im = self.it.im_buf
+      for i from 0 <= i < n: # XLATE UNION COORDS TO SEQUENCE ID & COORDS
+        if im[i].start >= 0:
+          pos = im[i].start
+        else:
+          pos = -im[i].end
+        left = 0
+        right = self.nseq
+        while right - left > 1: # LAST SEQUENCE STARTING AT OR BEFORE pos
+          mid = (left + right) / 2
+          if self.offsets[mid] <= pos:
+            left = mid
+          else:
+            right = mid
+        self.qid[i] = self.seqIDs[left]
+        if im[i].start >= 0:
+          offset = self.offsets[left]
+        else:
+          offset = -self.offsets[left]
+        im[i].start = im[i].start - offset
+        im[i].end = im[i].end - offset
+        im[i].sublist = i
+      if self.pairwise: # INDEX ALREADY MAPS TO THE ALIGNED SEQUENCES
+        n = 0
+      else: # MAP THROUGH THE LPOS, HITS FOLLOW THE n QUERIES
+        join_lpo_intervals(self.it, n, nl, -1, -1, 1)
+        im = self.it.im_buf
+      l = []
+      for i from n <= i < self.it.nhit:
+        src_id = self.qid[im[i].sublist]
+        if not self.pairwise and im[i].target_id == src_id and \
+           im[i].start == im[i].target_start: # DISCARD SELF-MATCH
+          continue
+        if self.raw:
+          try:
+            srcID = self.seqCache[src_id]
+          except KeyError:
+            srcID = self.seqCache[src_id] = nl.seqlist.getSeqID(src_id)
+          try:
+            destID = self.seqCache[im[i].target_id]
+          except KeyError:
+            destID = self.seqCache[im[i].target_id] = \
+                     nl.seqlist.getSeqID(im[i].target_id)
+          l.append((srcID, im[i].start, im[i].end, destID,
+                    im[i].target_start, im[i].target_end))
+        else:
+          try:
+            srcSeq = self.seqCache[src_id]
+          except KeyError:
+            srcSeq = self.seqCache[src_id] = nl.seqlist.getSeq(src_id)
+          try:
+            destSeq = self.seqCache[im[i].target_id]
+          except KeyError:
+            destSeq = self.seqCache[im[i].target_id] = \
+                      nl.seqlist.getSeq(im[i].target_id)
+          srcIval = sequence.relativeSlice(srcSeq, im[i].start, im[i].end)
+          destIval = sequence.relativeSlice(destSeq, im[i].target_start,
+                                            im[i].target_end)
+          l.append((srcIval, destIval,
+                    sequence.Seq2SeqEdge(None, destIval, srcIval, None)))
+      if l:
+        return l
+
+  def __dealloc__(self):
+    'remember: dealloc cannot call other methods!'
+    if self.scan:
+      free_interval_scan(self.scan)
+    free(self.offsets)
+    free(self.seqIDs)
+    free(self.qid)
+
+
+cdef class NLMSASliceBatchIterator:
+  '''iterate over (index, slice) pairs for a list of sequence intervals,
+  running their queries grouped by NLMSASequence in sorted order, chunkSize
+  at a time; see NLMSA.get_slices()'''
+
+  def __cinit__(self, NLMSA nl not None, ivals, raw=False,
+                int chunkSize=1024):
+    cdef int i
+    cdef NLMSASequence ns
+    if chunkSize <= 0:
+      raise ValueError('chunkSize must be > 0')
+    self.nlmsa = nl
+    if raw:
+      self.raw = 1
+    direct = nl.do_build or hasattr(nl, 'doSlice') # NO LOCAL QUERY TO BATCH
+    groups = {}
+    other = []
+    seqInfo = {}
+    i = 0
+    for k in ivals:
+      if direct or not isinstance(k, sequence.SeqPath):
+        other.append((i, k))
+      else:
+        if hasattr(k, 'annotationType'): # NLMSASeqDict DOESN'T CACHE THESE
+          id, ns, offset = nl.seqs[k]
+        else: # LOOK UP EACH SEQUENCE ONLY ONCE
+          try:
+            id, ns, offset = seqInfo[k.pathForward]
+          except KeyError:
+            id, ns, offset = nl.seqs[k]
+            seqInfo[k.pathForward] = (id, ns, offset)
+        if k.start >= 0: # POSITIVE ORIENTATION UNION COORDINATE
+          pos = k.start + offset
+        else:
+          pos = offset - k.stop
+        try:
+          groups[ns.id][1].append((pos, i, k, id, offset))
+        except KeyError:
+          groups[ns.id] = (ns, [(pos, i, k, id, offset)])
+      i = i + 1
+    self.nival = i
+    self.chunks = []
+    for i from 0 <= i < len(other) by chunkSize:
+      self.chunks.append((None, other[i:i + chunkSize]))
+    nsIDs = groups.keys()
+    nsIDs.sort()
+    for nsID in nsIDs: # SORTED, SO ADJACENT QUERIES SHARE BLOCK READS
+      ns, l = groups[nsID]
+      l.sort()
+      for i from 0 <= i < len(l) by chunkSize:
+        self.chunks.append((ns, l[i:i + chunkSize]))
+    self.chunks.reverse() # SO WE CAN pop() THEM IN ORDER
+    self.results = []
+
+  cdef int query_chunk(self, NLMSASequence ns, l) except -1:
+    '''join the intervals in list l of (pos, index, ival, id, offset) to
+    the aligned intervals of ns, saving (index, result) to self.results'''
+    cdef int i, m, n, q, qid, nlpo, pairwise
+    cdef int *lpoStart, *lpoCount, *hitStart, *hitCount
+    cdef IntervalInt start, stop, offset
+    cdef IntervalMap *im, *a
+    cdef IntervalFileDBIterator it, it2, ivals
+    cdef NLMSA nl
+    nl = self.nlmsa
+    pairwise = nl.pairwiseMode == 1
+    m = len(l)
+    it = IntervalFileDBIterator(0, 0, nbuffer=m)
+    for i from 0 <= i < m: # ONE seq -> UNION QUERY PER INTERVAL
+      start = l[i][2].start
+      stop = l[i][2].stop
+      offset = l[i][4]
+      if start < 0: # NEED TO TRANSLATE OFFSETS TO MINUS ORIENTATION
+        offset = -offset
+      it.im_buf[i].start = start
+      it.im_buf[i].end = stop
+      if pairwise: # TRANSLATE SEQ DIRECTLY TO ITS VIRTUAL LPO
+        it.im_buf[i].target_id = ns.id - 1
+      else:
+        it.im_buf[i].target_id = ns.id
+      it.im_buf[i].target_start = start + offset
+      it.im_buf[i].target_end = stop + offset
+      it.im_buf[i].sublist = i # ITS QUERY
+    it.nhit = m
+    if pairwise: # THE IDENTITY MAPPING IS ITS ONLY seq -> LPO INTERVAL
+      it2 = it
+      nlpo = m
+    else: # GET THE CLIPPED seq -> LPO INTERVALS OF ALL QUERIES IN ONE PASS
+      join_lpo_intervals(it, m, nl, -1, -1, 0)
+      nlpo = it.nhit - m
+      if nlpo > 0:
+        n = nlpo
+      else:
+        n = 1
+      it2 = IntervalFileDBIterator(0, 0, nbuffer=n)
+      if nlpo > 0:
+        memcpy(it2.im_buf, it.im_buf + m, nlpo * sizeof(IntervalMap))
+      it2.nhit = nlpo
+    join_lpo_intervals(it2, nlpo, nl, -1, -1, 1) # ...AND THROUGH THE LPOS
+    im = it2.im_buf
+    lpoStart = <int *>calloc(4 * m, sizeof(int))
+    if lpoStart == NULL:
+      raise MemoryError('out of memory')
+    lpoCount = lpoStart + m
+    hitStart = lpoCount + m
+    hitCount = hitStart + m
+    try:
+      for i from 0 <= i < nlpo: # BOTH ARE SAVED IN QUERY ORDER
+        q = im[i].sublist
+        if lpoCount[q] == 0:
+          lpoStart[q] = i
+        lpoCount[q] = lpoCount[q] + 1
+      for i from nlpo <= i < it2.nhit:
+        q = im[im[i].sublist].sublist
+        if hitCount[q] == 0:
+          hitStart[q] = i
+        hitCount[q] = hitCount[q] + 1
+      for q from 0 <= q < m:
+        pos, index, k, qid, offset = l[q]
+        if self.raw: # JUST THE ALIGNED INTERVALS, ORDERED BY start
+          a = NULL
+          n = 0
+          if hitCount[q] > 0:
+            a = <IntervalMap *>malloc(hitCount[q] * sizeof(IntervalMap))
+            if a == NULL:
+              raise MemoryError('out of memory')
+          for i from hitStart[q] <= i < hitStart[q] + hitCount[q]:
+            if pairwise or im[i].target_id != qid or \
+               im[i].start != im[i].target_start: # DISCARD SELF-MATCH
+              a[n] = im[i]
+              n = n + 1
+          qsort(a, n, sizeof(IntervalMap), imstart_qsort_cmp)
+          self.results.append((index, new_interval_map_array(a, n)))
+        elif lpoCount[q] == 0:
+          self.results.append((index, nlmsa_utils.EmptySlice(k)))
+        else: # ITS LPO INTERVALS FOLLOWED BY ITS JOINED INTERVALS
+          ivals = IntervalFileDBIterator(k.start, k.stop,
+                                         nbuffer=lpoCount[q] + hitCount[q])
+          memcpy(ivals.im_buf, im + lpoStart[q],
+                 lpoCount[q] * sizeof(IntervalMap))
+          n = lpoCount[q]
+          for i from hitStart[q] <= i < hitStart[q] + hitCount[q]:
+            if pairwise or im[i].target_id != qid or \
+               im[i].start != im[i].target_start: # DISCARD SELF-MATCH
+              ivals.im_buf[n] = im[i]
+              n = n + 1
+          ivals.nhit = n
+          self.results.append((index, NLMSASlice(ns, k.start, k.stop, qid,
+                                                 offset, k, ivals=ivals)))
+    finally:
+      free(lpoStart)
+    return 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self): # PYREX USES THIS NON-STANDARD NAME INSTEAD OF next()!!!
+    cdef NLMSA nl
+    nl = self.nlmsa
+    while not self.results:
+      if not self.chunks:
+        raise StopIteration
+      ns, l = self.chunks.pop()
+      if ns is not None:
+        self.query_chunk(ns, l)
+      else: # NO BATCHED QUERY POSSIBLE, USE nlmsa[k]
+        for index, k in l:
+          msaSlice = nl[k]
+          if self.raw:
+            msaSlice = slice_interval_array(msaSlice)
+          self.results.append((index, msaSlice))
+      self.results.reverse() # SO WE CAN pop() THEM IN ORDER
+    return self.results.pop()
+
+
+cdef IntervalMapArray slice_interval_array(msaSlice):
+  'IntervalMapArray of the aligned (non-LPO) intervals of msaSlice'
+  cdef int i, n
+  cdef IntervalMap *a
+  cdef NLMSASlice s
+  cdef NLMSA nl
+  if isinstance(msaSlice, nlmsa_utils.EmptySlice):
+    return new_interval_map_array(NULL, 0)
+  elif not isinstance(msaSlice, NLMSASlice):
+    raise ValueError('raw intervals require a built NLMSA')
+  s = msaSlice
+  s.load(1)
+  nl = s.nlmsa
+  a = NULL
+  n = 0
+  if s.n > 0:
+    a = interval_map_alloc(s.n)
+  for i from 0 <= i < s.n: # s.im IS ALREADY ORDERED BY start
+    if not nl.seqlist.is_lpo(s.im[i].target_id):
+      a[n] = s.im[i]
+      n = n + 1
+  return new_interval_map_array(a, n)
+
+
+cdef class NLMSASequence:
+  'sequence interface to NLMSA storage of an LPO alignment'
+
+  def __init__(self, NLMSA nl not None, filestem, seq, mode='r', is_union=0,
+               length=None, deltastem=None):
+    self.nlmsaLetters = nl
+    self.filestem = filestem
+    if deltastem is None and filestem is not None: # APPENDED INTERVALS
+      deltastem = filestem + '.delta'
+    self.deltastem = deltastem
+    self.is_union = is_union
+    self.is_lpo = 0 # DEFAULT: NOT AN LPO
+    self.seq = seq
+    if length is not None: # ALLOW USER TO SUPPLY A LENGTH FOR THIS COORD SYSTEM
+      self.length = length
+    import types
+    if isinstance(seq, types.StringType):
+      self.name = seq # ALLOW USER TO BUILD INDEXES WITH A STRING NAME
+    elif seq is not None: # REGULAR SEQUENCE
+      seq = seq.pathForward # GET THE WHOLE SEQUENCE, IN FORWARD ORIENTATION
+      try: # MAKE SURE seq HAS A UNIQUE NAME FOR INDEXING IT...
+        self.name = str(seq.path.name)
+      except AttributeError:
+        try:
+          self.name = str(seq.path.id)
+        except AttributeError:
+          raise AttributeError('NLMSASequence: seq must have name or id attribute')
+    else:
+      self.length = 0 # LPO AND UNION SEQUENCES EXPAND AUTOMATICALLY
+      if not is_union:
+        self.is_lpo = 1
+        if len(nl.lpoList) > 0:  # CALCULATE OFFSET OF NEW LPO, BASED ON LAST LPO
+          lastLPO = nl.lpoList[-1]
+          self.offset = lastLPO.offset + lastLPO.length
+        else:
+          self.offset = 0
+        nl.lpoList.append(self) # ADD TO THE LPO LIST
+    self.idb = None # DEFAULT: NOT USING IN-MEMORY DATABASE.
+    self.db = None # DEFAULT: WAIT TO OPEN DB UNTIL ACTUALLY NEEDED
+    if mode == 'r': # IMMEDIATELY OPEN DATABASE, UNLIKE onDemand MODE
+      self.forceLoad()
+    elif mode == 'memory': # OPEN IN-MEMORY DATABASE
+      self.idb = IntervalDB()
+    elif mode == 'a': # NEW INTERVALS GO TO A DELTA NEXT TO EXISTING INDEX
+      self.append_mode = 1 # ITS .build FILE IS OPENED ON FIRST USE
+      self.nbuild = 0
+      import os
+      if os.path.exists(self.deltastem + '.build'): # LEFT BY AN INTERRUPTED
+        os.remove(self.deltastem + '.build') # APPEND, SO DISCARD IT
+    elif mode == 'w': # WRITE .build FILE
+      filename = filestem + '.build'
+      self.build_ifile = fopen(filename, 'wb') # binary file
+      if self.build_ifile == NULL:
+        errmsg = 'unable to open in write mode: ' + filename
+        raise IOError(errmsg)
+      self.nbuild = 0
 
   def __dealloc__(self):
     'remember: dealloc cannot call other methods!'
@@ -1332,14 +3020,36 @@ cdef class NLMSASequence:
       fclose(self.build_ifile)
 
   def forceLoad(self):
-    'force database to be initialized, if not already open'
-    self.db = IntervalFileDB(self.filestem, 'r')
+    '''force database to be initialized, if not already open, along with
+    the delta database of intervals added in append mode, if any.  If
+    NLMSA.compact() has replaced their files since we read the
+    .NLMSAindex, open the new ones it lists instead'''
+    import os
+    while True:
+      try:
+        deltaDB = None
+        if os.path.exists(self.deltastem + '.size'):
+          deltaDB = IntervalFileDB(self.deltastem, 'r',
+                                   blockCache=self.nlmsaLetters.blockCache)
+        db = IntervalFileDB(self.filestem, 'r',
+                            blockCache=self.nlmsaLetters.blockCache)
+        break
+      except IOError:
+        stems = _read_nlmsa_index(self.nlmsaLetters.pathstem)[self.id][4:]
+        if stems == (self.filestem, self.deltastem): # NOT REPLACED
+          raise
+        self.filestem, self.deltastem = stems
+    self.deltaDB = deltaDB
+    self.db = db
 
   def close(self):
     'free memory and close files associated with this sequence index'
     if self.db is not None:
       self.db.close() # CLOSE THE DATABASE, RELEASE MEMORY
       self.db = None # DISCONNECT FROM DATABASE
+    if self.deltaDB is not None:
+      self.deltaDB.close()
+      self.deltaDB = None
     if self.idb is not None:
       self.idb.close() # CLOSE THE DATABASE, RELEASE MEMORY
       self.idb = None # DISCONNECT FROM DATABASE
@@ -1347,24 +3057,81 @@ cdef class NLMSASequence:
       fclose(self.build_ifile)
       self.build_ifile = NULL
 
-  def buildFiles(self, **kwargs):
-    'build nested list from saved unsorted alignment data'
-    cdef IntervalDB db
-    if self.build_ifile == NULL:
-      raise IOError('not opened in write mode')
-    fclose(self.build_ifile)
-    self.build_ifile = NULL
-    filename = self.filestem + '.build'
-    db = IntervalDB() # CREATE EMPTY NL IN MEMORY
-    if self.nbuild > 0:
-      db.buildFromUnsortedFile(filename, self.nbuild, **kwargs) # BUILD FROM .build
-    db.write_binaries(self.filestem) # SAVE AS IntervalDBFile
-    db.close() # DUMP NESTEDLIST FROM MEMORY
+  def buildFiles(self, maxMemory=None, compress=False, **kwargs):
+    '''build nested list from saved unsorted alignment data.  If it
+    would need more than maxMemory bytes in memory, build it out-of-core.
+    compress=True saves it as compressed blocks.  In append mode, the
+    new intervals are merged into a new version of our delta database,
+    which NLMSA.buildFiles() then switches readers to'''
+    cdef IntervalFileDB db
     import os
-    os.remove(filename) # REMOVE OUR .build FILE, NO LONGER NEEDED
-    self.db = IntervalFileDB(self.filestem) # NOW OPEN THE IntervalFileDB
+    if self.build_ifile == NULL and not self.append_mode:
+      raise IOError('not opened in write mode')
+    n = self.nbuild
+    if self.append_mode:
+      if self.build_ifile: # ONLY OPENED IF WE GOT NEW INTERVALS
+        filename = self.deltastem + '.build'
+        if n > 0 and os.path.exists(self.deltastem + '.size'): # ADD OLD ONES
+          db = IntervalFileDB(self.deltastem)
+          try:
+            n = n + save_dbfile_intervals(db, self.build_ifile)
+          finally:
+            db.close()
+        fclose(self.build_ifile)
+        self.build_ifile = NULL
+        if n > 0: # NEW STEM, SO READERS OF THE OLD DELTA ARE UNAFFECTED
+          filestem = _next_binaries_stem(self.nlmsaLetters.pathstem
+                                         + str(self.id) + '.delta',
+                                         self.deltastem)
+          _build_binaries(filename, n, filestem, maxMemory, compress,
+                          **kwargs)
+          self.deltastem = filestem
+        os.remove(filename) # REMOVE OUR .build FILE, NO LONGER NEEDED
+      self.append_mode = 0
+      self.forceLoad() # OPEN OUR INDEX AND ITS DELTA
+    else:
+      filename = self.filestem + '.build'
+      _remove_binaries(self.filestem + '.delta') # STALE IF REBUILT FROM SCRATCH
+      _remove_binaries_versions(self.filestem)
+      _remove_binaries_versions(self.filestem + '.delta')
+      fclose(self.build_ifile)
+      self.build_ifile = NULL
+      _build_binaries(filename, n, self.filestem, maxMemory, compress,
+                      **kwargs)
+      os.remove(filename) # REMOVE OUR .build FILE, NO LONGER NEEDED
+      self.db = IntervalFileDB(self.filestem, # NOW OPEN THE IntervalFileDB
+                               blockCache=self.nlmsaLetters.blockCache)
     return self.nbuild # return count of intervals
 
+  def compactFiles(self, maxMemory=None, compress=None, **kwargs):
+    '''merge our delta database of intervals added in append mode into
+    a new main database, and return its count of intervals (0 if there
+    is no delta).  compress=None compresses it if the old one was.
+    It is saved under a new file stem, leaving the old files in place
+    until NLMSA.compact() switches readers to it; queries in progress
+    keep using the old databases'''
+    cdef IntervalFileDB db
+    import os
+    deltastem = self.deltastem
+    if not os.path.exists(deltastem + '.size'):
+      return 0
+    if self.append_mode:
+      raise ValueError('build() the new intervals before compacting!')
+    if compress is None:
+      db = IntervalFileDB(self.filestem)
+      compress = db.is_compressed
+      db.close()
+    basestem = self.nlmsaLetters.pathstem + str(self.id)
+    filestem = _next_binaries_stem(basestem, self.filestem)
+    n = _merge_binaries((self.filestem, deltastem), filestem, maxMemory,
+                        compress, **kwargs)
+    db = IntervalFileDB(filestem, blockCache=self.nlmsaLetters.blockCache)
+    self.filestem = filestem
+    self.deltastem = _next_binaries_stem(basestem + '.delta', deltastem)
+    self.deltaDB = None # SWITCH QUERIES TO THE NEW DATABASE
+    self.db = db
+    return n
+
   def buildInMemory(self, **kwargs):
     try:
       n = len(self.buildList)
@@ -1375,6 +3142,17 @@ cdef class NLMSASequence:
       self.buildList = None
       return n
 
+  cdef FILE *open_build_file(self) except NULL:
+    'our .build file, opened on first use in append mode'
+    if self.build_ifile == NULL:
+      if not self.append_mode:
+        raise IOError('not opened in write mode')
+      filename = self.deltastem + '.build'
+      self.build_ifile = fopen(filename, 'ab') # binary file
+      if self.build_ifile == NULL:
+        raise IOError('unable to open in append mode: ' + filename)
+    return self.build_ifile
+
   cdef int saveInterval(self, IntervalMap im[], int n, int expand_self, FILE *ifile):
     cdef int i
     if ifile == NULL:
@@ -1395,11 +3173,11 @@ cdef class NLMSASequence:
     'save mapping [k.start:k.stop] --> (id,start,stop)'
     cdef int i
     cdef IntervalMap im_tmp
-    if self.build_ifile: # SAVE TO BUILD FILE
+    if self.build_ifile or self.append_mode: # SAVE TO BUILD FILE
       im_tmp.start, im_tmp.end = (k.start, k.stop)
       im_tmp.target_id, im_tmp.target_start, im_tmp.target_end = t
       im_tmp.sublist = -1
-      i = self.saveInterval(&im_tmp, 1, self.is_lpo, self.build_ifile)
+      i = self.saveInterval(&im_tmp, 1, self.is_lpo, self.open_build_file())
       #logger.debug('saveInterval: %s %s %s  %s %s %s' % (self.id, im_tmp.start, im_tmp.end,
       #             im_tmp.target_id, im_tmp.target_start, im_tmp.target_end))
       self.nbuild = self.nbuild + i # INCREMENT COUNTER OF INTERVALS SAVED
@@ -1448,6 +3226,166 @@ cdef class NLMSASequence:
     return self # iadd MUST ALWAYS RETURN self!!!
 
 
+_gzBufferSize = 1048576 # READ BUFFER SIZE FOR MAF / axtNet INPUT
+
+cdef class AlignmentInputStream:
+  '''text input from a MAF or axtNet file, which may be plain text or
+  gzip / bgzip compressed.  f may be a filename, or an open file object,
+  read from its file descriptor if it has one (e.g. sys.stdin or a pipe),
+  or else copied to a pipe by a nlmsa_utils.StreamFeeder thread.
+  offset starts reading filename f at that byte, e.g. a bgzip block'''
+  def __cinit__(self, f, long offset=0):
+    cdef int fd
+    if isinstance(f, str):
+      self.name = f
+      if offset > 0: # OPEN IT OURSELVES TO START AT offset
+        import os
+        try:
+          fd = os.open(f, os.O_RDONLY)
+        except OSError:
+          fd = -1
+        if fd >= 0:
+          os.lseek(fd, offset, 0)
+          self.ifile = gzdopen(fd, 'rb')
+          if self.ifile == NULL:
+            close(fd)
+      else:
+        self.ifile = gzopen(f, 'rb')
+    else:
+      self.name = getattr(f, 'name', None)
+      try:
+        fd = dup(f.fileno())
+      except (AttributeError, IOError, ValueError): # NO FILE DESCRIPTOR
+        self.feeder = nlmsa_utils.StreamFeeder(f, _gzBufferSize)
+        fd = self.feeder.fd
+      if fd >= 0:
+        self.ifile = gzdopen(fd, 'rb')
+        if self.ifile == NULL:
+          close(fd)
+    if self.ifile == NULL:
+      raise IOError('unable to open file %s' % (self.name or f,))
+    gzbuffer(self.ifile, _gzBufferSize) # READ IN BIG CHUNKS
+
+  cdef char *gets(self, char *buf, int size):
+    'read one line into buf like fgets(), returning NULL at the end'
+    cdef char *p
+    cdef gzFile ifile
+    ifile = self.ifile
+    with nogil: # A PIPE MAY BLOCK UNTIL ITS FEEDER CATCHES UP
+      p = gzgets(ifile, buf, size)
+    return p
+
+  cdef int close(self) except -1:
+    'close the stream, raising any error reading or decompressing it'
+    cdef int err
+    cdef object msg
+    err = Z_OK
+    if self.ifile != NULL:
+      msg = gzerror(self.ifile, &err) # COPY IT BEFORE gzclose() FREES IT
+      gzclose(self.ifile) # CLOSES ITS PIPE, STOPPING ITS FEEDER
+      self.ifile = NULL
+    if self.feeder is not None:
+      feeder = self.feeder
+      self.feeder = None
+      feeder.close() # RAISES ANY ERROR READING ITS FILE OBJECT
+    if err != Z_OK:
+      raise IOError('error reading %s: %s' # DROP zlib'S FILENAME PREFIX
+                    % (self.name, msg.split(': ')[-1]))
+    return 0
+
+  def __dealloc__(self):
+    if self.ifile != NULL:
+      gzclose(self.ifile)
+
+
+_minMAFRangeBytes = 1048576 # SMALLEST MAF BYTE RANGE GIVEN TO ONE WORKER
+
+cdef int parse_maf_range(f, long start, long stop, long blockOffset,
+                         long blockStart, SeqIDMap seqidmap[], int nseq,
+                         outfile) except -1:
+  '''parse the MAF blocks whose "a" lines start in bytes [start:stop) of
+  f (stop=-1: to the end), writing them to outfile with LPO
+  coordinates counted from 0 for NLMSA.read_maf_parse() to merge.
+  Reading starts at byte blockOffset of a bgzip file, the block whose
+  uncompressed data starts at byte blockStart; both are 0 otherwise'''
+  cdef int n, block_len, has_continuation
+  cdef char tmp[32768], *p
+  cdef AlignmentInputStream src
+  cdef gzFile ifile
+  cdef FILE *ofile
+  cdef IntervalMap im[4096], header
+  cdef long long linecode_count[256]
+  memset(<void *>linecode_count, 0, sizeof(linecode_count))
+  src = AlignmentInputStream(f, blockOffset)
+  ifile = src.ifile
+  ofile = fopen(outfile, 'wb')
+  if ofile == NULL:
+    raise IOError('unable to open file %s' % outfile)
+  try:
+    if start > blockStart and gzseek(ifile, start - blockStart, SEEK_SET) < 0:
+      raise IOError('unable to seek to %d in %s' % (start, src.name))
+    p = src.gets(tmp, 32767)
+    if start == 0: # CHECK AND SKIP THE ##maf HEADER LINE
+      if p == NULL or strncmp(tmp, "##maf", 4):
+        raise IOError('%s: not a MAF file? Bad format.' % (src.name,))
+      p = src.gets(tmp, 32767)
+    has_continuation = 0
+    header.target_id = -1 # MARKS A BLOCK HEADER
+    header.target_start = header.target_end = header.sublist = 0
+    while p: # GOT ANOTHER LINE TO PROCESS
+      if has_continuation or 0 == strncmp(tmp, "a ", 2): # ALIGNMENT HEADER
+        if stop >= 0 and blockStart + gztell(ifile) > stop: # STARTS NEXT RANGE
+          break
+        with nogil:
+          n = readMAFrecord(im, 0, seqidmap, nseq, 0, &block_len, ifile, 4096,
+                            linecode_count, &has_continuation)
+        if n < 0: # UNRECOVERABLE ERROR OCCURRED...
+          raise ValueError('MAF block too long!  Increase max size')
+        elif n == 0 and not has_continuation: # END OF FILE
+          break
+        elif n > 0: # SAVE ITS SIZE, THEN ITS INTERVALS
+          header.start = n
+          header.end = block_len
+          if fwrite(&header, sizeof(IntervalMap), 1, ofile) != 1 or \
+             fwrite(im, sizeof(IntervalMap), n, ofile) != n:
+            raise IOError('error writing %s' % outfile)
+      if not has_continuation:
+        p = src.gets(tmp, 32767) # TRY TO READ ANOTHER LINE...
+    src.close()
+    header.target_id = -2 # MARKS THE END, FOLLOWED BY THE LINE COUNTS
+    if fwrite(&header, sizeof(IntervalMap), 1, ofile) != 1 or \
+       fwrite(linecode_count, sizeof(long long), 256, ofile) != 256:
+      raise IOError('error writing %s' % outfile)
+  finally:
+    if fclose(ofile):
+      raise IOError('error writing %s' % outfile)
+  return 0
+
+
+cdef int read_parsed_maf_block(FILE *ifile, IntervalMap im[], int maxseq,
+                               int *p_block_len,
+                               long long linecode_count[]) except -2:
+  '''read one block written by parse_maf_range() into im, returning its
+  size, or -1 at the end, after adding its line counts to linecode_count'''
+  cdef int i, n
+  cdef IntervalMap header
+  cdef long long counts[256]
+  if fread(&header, sizeof(IntervalMap), 1, ifile) != 1:
+    raise IOError('truncated MAF parse file')
+  if header.target_id == -2: # END OF THE RANGE
+    if fread(counts, sizeof(long long), 256, ifile) != 256:
+      raise IOError('truncated MAF parse file')
+    for i from 0 <= i < 256:
+      linecode_count[i] = linecode_count[i] + counts[i]
+    return -1
+  n = header.start
+  if header.target_id != -1 or n > maxseq or \
+     fread(im, sizeof(IntervalMap), n, ifile) != n:
+    raise IOError('truncated MAF parse file')
+  p_block_len[0] = header.end
+  return n
+
+
 cdef class NLMSA:
   'toplevel interface to NLMSA storage of an LPO alignment'
 
@@ -1456,19 +3394,27 @@ cdef class NLMSA:
                trypath=None, bidirectional=True, pairwiseMode=-1,
                bidirectionalRule=nlmsa_utils.prune_self_mappings,
                use_virtual_lpo=None, maxLPOcoord=None,
-               inverseDB=None, alignedIvals=None, **kwargs):
+               inverseDB=None, alignedIvals=None, cacheBytes=None,
+               lazySlices=False, nprocs=1, sliceCache=None,
+               sliceCacheBytes=100000000, **kwargs):
     try:
       import resource # WE MAY NEED TO OPEN A LOT OF FILES...
       resource.setrlimit(resource.RLIMIT_NOFILE, (maxOpenFiles, -1))
     except: # BUT THIS IS OPTIONAL...
       pass
     self.lpoList = [] # EMPTY LIST OF LPO
+    if sliceCache is not None and mode != 'r':
+      raise ValueError('sliceCache can only be used in mode r')
+    if cacheBytes is not None: # ONE BLOCK CACHE SHARED BY ALL OUR INDEXES
+      self.blockCache = IntervalBlockCache(cacheBytes)
+    if lazySlices: # DEFER EACH SLICE'S LPO JOIN UNTIL RESULTS NEEDED
+      self.lazySlices = 1
     self.seqs = nlmsa_utils.NLMSASeqDict(self, pathstem, mode, **kwargs)
     self.seqlist = self.seqs.seqlist
     self.pathstem = pathstem
     self.inverseDB = inverseDB
     if maxlen is None:
-      maxlen = C_int_max - 65536 # C_int_max MAXIMUM VALUE REPRESENTABLE BY int
+      maxlen = C_int_max - 65536 # C_int_max MAXIMUM VALUE OF IntervalInt
       if axtFiles is not None:
         maxlen = maxlen / 2
     self.maxlen = maxlen
@@ -1500,12 +3446,39 @@ cdef class NLMSA:
         self.seqDict = nlmsa_utils.read_seq_dict(pathstem, trypath)
       self.read_indexes(self.seqDict)
       self.read_attrs()
+      if sliceCache is not None: # PERSISTENT CACHE OF SLICE JOIN RESULTS
+        if self.buildID is None:
+          raise ValueError('sliceCache needs an NLMSA with a build ID: '
+                           'rebuild it with this version of pygr')
+        import os.path
+        self.sliceCache = nlmsa_utils.SliceCache(sliceCache, self.buildID,
+                                                 os.path.abspath(pathstem),
+                                                 sliceCacheBytes)
+    elif mode == 'a': # ADD ALIGNMENTS TO EXISTING DISK FILES
+      if mafFiles is not None:
+        raise ValueError('cannot append mafFiles to an existing NLMSA')
+      if self.seqDict is None:
+        self.seqDict = nlmsa_utils.read_seq_dict(pathstem, trypath)
+      self.read_indexes(self.seqDict, mode)
+      self.read_attrs()
+      for nlmsaID in self.seqs.IDdict: # NEW SEQUENCES GET THE NEXT FREE IDs
+        if int(nlmsaID) >= self.inlmsa:
+          self.inlmsa = int(nlmsaID) + 1
+      self.append_mode = 1
+      self.do_build = 1
+      if axtFiles is not None:
+        if self.pairwiseMode == 0:
+          raise ValueError('cannot append axtFiles to an NLMSA with an LPO')
+        self.readAxtNet(axtFiles, bidirectionalRule)
+      elif alignedIvals is not None:
+        self.add_aligned_intervals(alignedIvals)
+        self.build()
     elif mode == 'w': # WRITE TO DISK FILES
       self.do_build = 1
       self.lpo_id = 0
       if mafFiles is not None:
         self.newSequence() # CREATE INITIAL LPO
-        self.readMAFfiles(mafFiles, maxint)
+        self.readMAFfiles(mafFiles, maxint, nprocs)
       elif axtFiles is not None:
         self.newSequence() # CREATE INITIAL LPO
         self.readAxtNet(axtFiles, bidirectionalRule)
@@ -1539,6 +3512,9 @@ cdef class NLMSA:
     for ns in self.seqlist: # tell each seq to close its index files
       ns.close()
     self.seqs.close()
+    if self.sliceCache is not None:
+      self.sliceCache.close()
+      self.sliceCache = None
 
   def __reduce__(self): ############################# SUPPORT FOR PICKLING
     import classutil
@@ -1553,35 +3529,60 @@ cdef class NLMSA:
   def __setstate__(self, state):
     self.__init__(**state) #JUST PASS KWARGS TO CONSTRUCTOR
 
-  def read_indexes(self, seqDict):
-    'open all nestedlist indexes in this LPO database for immediate use'
+  def read_indexes(self, seqDict, mode='onDemand'):
+    '''open all nestedlist indexes in this LPO database for immediate use,
+    or with mode='a' to add more intervals to them'''
     cdef NLMSASequence ns
+    self.buildID = nlmsa_utils.read_build_id(self.pathstem) # BEFORE INDEX
+    indexLines = _read_nlmsa_index(self.pathstem)
+    for id, name, is_union, length, filestem, deltastem in indexLines:
+      id = int(id)
+      is_union = int(is_union)
+      if id != len(self.seqlist):
+        raise IOError('corrupted NLMSAIndex???')
+      seq = None # DEFAULT: NO ACTUAL SEQUENCE ASSOCIATED WITH LPO OR UNION
+      if name == 'NLMSA_LPO_Internal': # AN LPO REFERENCE
+        self.lpo_id = id
+      elif not is_union: # REGULAR SEQUENCE
+        try:
+          seq = seqDict[name]
+        except KeyError:
+          raise KeyError('unable to find sequence %s in seqDict!' % name)
+      # CREATE THE SEQ INTERFACE, BUT DELAY OPENING THE IntervalDBFile
+      ns = NLMSASequence(self, filestem, seq, mode, is_union, # UNTIL NEEDED
+                         deltastem=deltastem)
+      ns.length = int(length) # SAVE STORED LENGTH
+      self.addToSeqlist(ns, seq)
+      if is_union: # THE LAST UNION RECEIVES ANY NEW SEQUENCES
+        self.currentUnion = ns
+
+  def save_indexes(self):
+    '''write our .NLMSAindex, listing each sequence index and the file
+    stems of its databases, then a new build ID.  It is written to a
+    temporary file that then replaces the old one with a single rename,
+    so each reader sees either the old set of databases or the new one'''
+    cdef NLMSASequence ns
+    import os
+    filename = self.pathstem + '.NLMSAindex'
+    ifile = file(filename + '.tmp', 'w') # text file
     try:
-      ifile = file(self.pathstem + '.NLMSAindex', 'rU') # text file
-    except IOError:
-      ifile = file(self.pathstem + 'NLMSAindex', 'rU') # FOR BACKWARDS COMPATIBILITY
-    try:
-      for line in ifile:
-        id, name, is_union, length = line.strip().split('\t')
-        id = int(id)
-        is_union = int(is_union)
-        if id != len(self.seqlist):
-          raise IOError('corrupted NLMSAIndex???')
-        filestem = self.pathstem + str(id)
-        seq = None # DEFAULT: NO ACTUAL SEQUENCE ASSOCIATED WITH LPO OR UNION
-        if name == 'NLMSA_LPO_Internal': # AN LPO REFERENCE
-          self.lpo_id = id
-        elif not is_union: # REGULAR SEQUENCE
-          try:
-            seq = seqDict[name]
-          except KeyError:
-            raise KeyError('unable to find sequence %s in seqDict!' % name)
-        # CREATE THE SEQ INTERFACE, BUT DELAY OPENING THE IntervalDBFile
-        ns = NLMSASequence(self, filestem, seq, 'onDemand', is_union) # UNTIL NEEDED
-        ns.length = int(length) # SAVE STORED LENGTH
-        self.addToSeqlist(ns, seq)
+      for ns in self.seqlist: # SAVE INDEX IN seqlist ORDER
+        if ns.is_lpo:
+          name, is_union = 'NLMSA_LPO_Internal', 0
+        elif ns.is_union:
+          name, is_union = 'NLMSA_UNION_Internal', 1
+        else:
+          name, is_union = ns.name, 0
+        ifile.write('%d\t%s\t%d\t%d' % (ns.id, name, is_union, ns.length))
+        basestem = self.pathstem + str(ns.id)
+        if ns.filestem != basestem or ns.deltastem != basestem + '.delta':
+          ifile.write('\t%s\t%s' % (ns.filestem[len(self.pathstem):],
+                                     ns.deltastem[len(self.pathstem):]))
+        ifile.write('\n')
     finally:
       ifile.close()
+    os.rename(filename + '.tmp', filename) # SWITCH READERS TO IT
+    self.buildID = nlmsa_utils.save_build_id(self.pathstem) # AFTER INDEX
 
   def read_attrs(self):
     'read pickled attribute dictionary from file and apply to self'
@@ -1672,7 +3673,8 @@ See the NLMSA documentation for more details.\n''')
         return nlmsa_utils.BuildMSASlice(ns, k.start, k.stop, id, offset, 0, k)
       else: # QUERY THE ALIGNMENT
         try:
-          return NLMSASlice(ns, k.start, k.stop, id, offset, k)
+          return NLMSASlice(ns, k.start, k.stop, id, offset, k,
+                            self.lazySlices)
         except nlmsa_utils.EmptySliceError:
           return nlmsa_utils.EmptySlice(k)
     try: # TREAT k AS A PYTHON SLICE OBJECT
@@ -1694,6 +3696,45 @@ See the NLMSA documentation for more details.\n''')
   def edges(self, *args, **kwargs):
     return nlmsa_utils.generate_nlmsa_edges(self, *args, **kwargs)
 
+  def scan_edges(self, raw=False, int chunkSize=65536):
+    '''iterate over all 1:1 aligned intervals of the whole alignment, as
+    lists of (srcIval, destIval, edge) tuples, or if raw is True of
+    (srcID, srcStart, srcEnd, destID, destStart, destEnd) tuples (minus
+    orientation as negative coordinates).  Scans each sequence index in
+    file order and joins chunkSize intervals at a time through the LPOs,
+    so unlike edges() its memory use does not grow with the alignment'''
+    return NLMSAEdgeScanIterator(self, raw, chunkSize)
+
+  def summarize(self, ival, binSize=None):
+    '''alignment statistics for each bin of binSize positions of sequence
+    interval ival, computed without creating sequence objects or cache
+    hints; see NLMSASlice.summarize()'''
+    if self.do_build:
+      raise ValueError('call build() before summarize()')
+    id, ns, offset = self.seqs[ival] # GET UNION INFO FOR THIS SEQ
+    try: # LAZY, SO ONLY ITS JOIN IS RUN
+      nlmsaSlice = NLMSASlice(ns, ival.start, ival.stop, id, offset, ival, True)
+    except nlmsa_utils.EmptySliceError:
+      return nlmsa_utils.AlignmentSummary(ival.start, ival.stop, binSize)
+    return nlmsaSlice.summarize(binSize)
+
+  def get_slices(self, ivals, raw=False, iterate=False, int chunkSize=1024):
+    '''get the slices for a list of sequence intervals, in the same order
+    (EmptySlice for an unaligned interval).  The queries are run grouped
+    by NLMSASequence in sorted order, chunkSize at a time, sharing their
+    iterators and block reads.  If raw is True, give for each interval an
+    IntervalMapArray of its aligned intervals (ordered by start) instead.
+    If iterate is True, return an iterator of (index, result) pairs in
+    the order the queries finish'''
+    cdef NLMSASliceBatchIterator it
+    it = NLMSASliceBatchIterator(self, ivals, raw, chunkSize)
+    if iterate:
+      return it
+    l = [None] * it.nival
+    for i, result in it:
+      l[i] = result
+    return l
+
   def __iadd__(self, seq):
     'add seq to our union'
     self.seqs.saveSeq(seq)
@@ -1709,32 +3750,183 @@ See the NLMSA documentation for more details.\n''')
     'add alignedIvals to this alignment'
     nlmsa_utils.add_aligned_intervals(self, alignedIvals)
 
+  def add_aligned_arrays(self, srcIDs, srcStarts, srcEnds,
+                         destIDs, destStarts, destEnds):
+    '''bulk version of add_aligned_intervals(): align
+    srcIDs[i][srcStarts[i]:srcEnds[i]] to destIDs[i][destStarts[i]:destEnds[i]]
+    for each i.  IDs are keys of our seqDict; negative coordinates
+    mean reverse orientation.  Each distinct ID is looked up only once,
+    then all the .build records are written in a single C loop.
+    Returns the number of aligned pairs saved.'''
+    cdef int i, j, k, n, nid, nlpo, isrc, idest
+    cdef IntervalInt d
+    cdef int *pairID
+    cdef IntervalInt *info, *lpoInfo
+    cdef IntervalInt *psrcStart, *psrcEnd, *pdestStart, *pdestEnd
+    cdef Py_ssize_t buflen
+    cdef FILE **lpoFile
+    cdef IntervalMap im
+    cdef NLMSASequence ns
+    if self.do_build == 0:
+      raise ValueError('not opened in write mode')
+    srcStarts = int_array(srcStarts)
+    srcEnds = int_array(srcEnds)
+    destStarts = int_array(destStarts)
+    destEnds = int_array(destEnds)
+    n = len(srcIDs)
+    if len(destIDs) != n or len(srcStarts) != n or len(srcEnds) != n \
+           or len(destStarts) != n or len(destEnds) != n:
+      raise ValueError('all arrays must have the same length')
+    if n == 0:
+      return 0
+    PyObject_AsReadBuffer(srcStarts, <void **>&psrcStart, &buflen)
+    PyObject_AsReadBuffer(srcEnds, <void **>&psrcEnd, &buflen)
+    PyObject_AsReadBuffer(destStarts, <void **>&pdestStart, &buflen)
+    PyObject_AsReadBuffer(destEnds, <void **>&pdestEnd, &buflen)
+    pairID = NULL
+    info = NULL
+    lpoInfo = NULL
+    lpoFile = NULL
+    try:
+      pairID = <int *>malloc(2 * n * sizeof(int))
+      if pairID == NULL:
+        raise MemoryError('unable to allocate pair index')
+      idIndex = {}
+      idList = []
+      for i from 0 <= i < 2 * n: # NUMBER DISTINCT IDs IN ORDER OF APPEARANCE
+        if i % 2:
+          seqID = destIDs[i / 2]
+        else:
+          seqID = srcIDs[i / 2]
+        try:
+          pairID[i] = idIndex[seqID]
+        except KeyError:
+          pairID[i] = len(idList)
+          idIndex[seqID] = pairID[i]
+          idList.append(seqID)
+      nid = len(idList)
+      info = <IntervalInt *>calloc(4 * nid, sizeof(IntervalInt))
+      if info == NULL:
+        raise MemoryError('unable to allocate sequence info')
+      seqList = []
+      for k from 0 <= k < nid: # LOOK UP EACH SEQUENCE ONCE
+        seq = self.seqDict[idList[k]]
+        seqList.append(seq)
+        info[4 * k + 2] = len(seq)
+      for i from 0 <= i < n: # CHECK ALL COORDINATES BEFORE CHANGING ANYTHING
+        if bad_ival_coords(psrcStart[i], psrcEnd[i], info[4 * pairID[2 * i] + 2]):
+          raise ValueError('bad source interval %s[%d:%d]'
+                           % (srcIDs[i], psrcStart[i], psrcEnd[i]))
+        if bad_ival_coords(pdestStart[i], pdestEnd[i],
+                           info[4 * pairID[2 * i + 1] + 2]):
+          raise ValueError('bad destination interval %s[%d:%d]'
+                           % (destIDs[i], pdestStart[i], pdestEnd[i]))
+      self.init_pairwise_mode() # SEQ-SEQ ALIGNMENT: USE THE VIRTUAL LPO
+      lpoIndex = {}
+      lpoList = []
+      for k from 0 <= k < nid: # RESOLVE ID, OFFSET, LPO FOR EACH SEQUENCE
+        seq = seqList[k]
+        self.__iadd__(seq) # ADD IT TO OUR UNION IF NOT ALREADY PRESENT
+        nlmsaID, ns, offset = self.seqs[seq]
+        ns = self.seqlist[ns.id - 1] # ITS VIRTUAL LPO
+        try:
+          j = lpoIndex[ns.id]
+        except KeyError:
+          j = len(lpoList)
+          lpoIndex[ns.id] = j
+          lpoList.append(ns)
+        info[4 * k] = nlmsaID
+        info[4 * k + 1] = offset
+        info[4 * k + 3] = j
+      nlpo = len(lpoList)
+      if self.in_memory_mode: # JUST SAVE TUPLES FOR buildInMemory()
+        for i from 0 <= i < n:
+          isrc = pairID[2 * i]
+          idest = pairID[2 * i + 1]
+          ns = lpoList[info[4 * isrc + 3]]
+          if ns.buildList is None:
+            ns.buildList = []
+          d = union_offset(psrcStart[i], info[4 * isrc + 1])
+          ns.buildList.append((psrcStart[i] + d, psrcEnd[i] + d,
+                               info[4 * idest], pdestStart[i], pdestEnd[i]))
+          if self.is_bidirectional:
+            ns = lpoList[info[4 * idest + 3]]
+            if ns.buildList is None:
+              ns.buildList = []
+            d = union_offset(pdestStart[i], info[4 * idest + 1])
+            ns.buildList.append((pdestStart[i] + d, pdestEnd[i] + d,
+                                 info[4 * isrc], psrcStart[i], psrcEnd[i]))
+        return n
+      lpoFile = <FILE **>malloc(nlpo * sizeof(FILE *))
+      lpoInfo = <IntervalInt *>calloc(2 * nlpo, sizeof(IntervalInt))
+      if lpoFile == NULL or lpoInfo == NULL:
+        raise MemoryError('unable to allocate LPO info')
+      for j from 0 <= j < nlpo: # PER LPO: .build FILE, LENGTH, RECORD COUNT
+        ns = lpoList[j]
+        lpoFile[j] = ns.open_build_file()
+        lpoInfo[2 * j] = ns.length
+      im.sublist = -1
+      for i from 0 <= i < n: # WRITE .build RECORDS, SAME ORDER AS al[s1]+=s2
+        isrc = pairID[2 * i]
+        idest = pairID[2 * i + 1]
+        d = union_offset(psrcStart[i], info[4 * isrc + 1])
+        im.start = psrcStart[i] + d
+        im.end = psrcEnd[i] + d
+        im.target_id = info[4 * idest]
+        im.target_start = pdestStart[i]
+        im.target_end = pdestEnd[i]
+        save_lpo_interval(&im, lpoFile, lpoInfo, info[4 * isrc + 3])
+        if self.is_bidirectional: # ALSO SAVE THE REVERSE MAPPING
+          d = union_offset(pdestStart[i], info[4 * idest + 1])
+          im.start = pdestStart[i] + d
+          im.end = pdestEnd[i] + d
+          im.target_id = info[4 * isrc]
+          im.target_start = psrcStart[i]
+          im.target_end = psrcEnd[i]
+          save_lpo_interval(&im, lpoFile, lpoInfo, info[4 * idest + 3])
+      return n
+    finally:
+      if lpoInfo != NULL: # SAVE LENGTH AND COUNTS EVEN IF A WRITE FAILED
+        for j from 0 <= j < nlpo:
+          ns = lpoList[j]
+          ns.length = lpoInfo[2 * j]
+          ns.nbuild = ns.nbuild + lpoInfo[2 * j + 1]
+      free(pairID)
+      free(info)
+      free(lpoInfo)
+      free(lpoFile)
+
   cdef void free_seqidmap(self, int nseq0, SeqIDMap *seqidmap):
     cdef int i
     for i from 0 <= i < nseq0: # DUMP STRING STORAGE FOR SEQUENCE IDENTIFIERS
       free(seqidmap[i].id)
     free(seqidmap) # WE CAN NOW FREE THE SEQUENCE LOOKUP ARRAY
 
-  cdef void save_nbuild(self, int nbuild[]):
+  cdef void save_nbuild(self, IntervalInt nbuild[]):
     cdef NLMSASequence ns
     for ns in self.seqlist: # SAVE INTERVAL COUNTS BACK TO EACH SEQUENCE
       if not ns.is_lpo or self.pairwiseMode==1:
         ns.nbuild=nbuild[ns.id]  # SAVE INTERVAL COUNTS BACK TO REGULAR SEQUENCES
         #logger.debug('nbuild[%d] = %s' % (i, ns.nbuild))
 
-  def readMAFfiles(self, mafFiles, maxint):
-    'read alignment from a set of MAF files'
-    cdef int i, j, nseq0, nseq1, n, nseq, block_len
+  def readMAFfiles(self, mafFiles, maxint, int nprocs=1):
+    '''read alignment from a set of MAF files, given as filenames or open
+    file objects, plain text or gzip / bgzip compressed.  nprocs > 1
+    parses byte ranges of them in that many worker processes, merging
+    their blocks in file order so the result is the same as reading them
+    serially'''
+    cdef int i, nseq0, n, block_len
     cdef SeqIDMap *seqidmap
     cdef char tmp[32768], *p, a_header[4]
-    cdef FILE *ifile
-    cdef IntervalMap im[4096], im_tmp
-    cdef NLMSASequence ns_lpo, ns # ns IS OUR CURRENT UNION
+    cdef AlignmentInputStream src
+    cdef gzFile ifile
+    cdef IntervalMap im[4096]
+    cdef NLMSASequence ns # ns IS OUR CURRENT UNION
     cdef FILE *build_ifile[4096]
-    cdef int nbuild[4096], has_continuation
+    cdef IntervalInt nbuild[4096]
+    cdef int has_continuation
     cdef long long linecode_count[256]
 
-    ns_lpo = self.seqlist[self.lpo_id] # OUR INITIAL LPO
     self.pairwiseMode = 0 # WE ARE USING A REAL LPO!
     memset(<void *>linecode_count, 0, sizeof(linecode_count))
     has_continuation = 0
@@ -1747,82 +3939,115 @@ See the NLMSA documentation for more details.\n''')
       try:
         seqidmap[i].length = seqInfo.length
       except OverflowError:
-        raise OverflowError('''Sequence too long for 32 bit int: %s, %d
+        raise OverflowError('''Sequence too long for %d bit int: %s, %d
 Something is probably wrong with creation / reading of this sequence.
-Check the input!''' % (pythonStr, seqInfo.length))
+Check the input!''' % (8 * sizeof(IntervalInt), pythonStr, seqInfo.length))
       i = i + 1
     qsort(seqidmap, nseq0, sizeof(SeqIDMap), seqidmap_qsort_cmp) # SORT BY id
     ns = None
 
-    im_tmp.sublist = -1 # DEFAULT
+    if nprocs > 1: # PARSE IN WORKER PROCESSES, MERGE THEIR BLOCKS IN ORDER
+      import os
+      try:
+        ranges = nlmsa_utils.split_maf_files(mafFiles, 4 * nprocs,
+                                             _minMAFRangeBytes)
+      except IOError:
+        self.free_seqidmap(nseq0, seqidmap)
+        self.save_nbuild(nbuild)
+        raise
+      logger.info('Parsing %d MAF file ranges in %d processes'
+                  % (len(ranges), nprocs))
+      running = {} # PID -> RANGE INDEX
+      parsed = {}
+      iparse = 0
+      i = 0 # NEXT RANGE TO MERGE
+      try:
+        while i < len(ranges):
+          while len(running) < nprocs and iparse < len(ranges):
+            parseFile = '%s.mafparse%d' % (self.pathstem, iparse)
+            filename, start, stop, blockOffset, blockStart = ranges[iparse]
+            pid = os.fork()
+            if pid == 0: # WORKER PROCESS: PARSE THIS RANGE, THEN EXIT
+              status = 1
+              try:
+                try:
+                  parse_maf_range(filename, start, stop, blockOffset,
+                                  blockStart, seqidmap, nseq0, parseFile)
+                  status = 0
+                except ValueError: # BLOCK TOO LONG
+                  status = 2
+                except:
+                  import traceback
+                  traceback.print_exc()
+              finally:
+                os._exit(status)
+            running[pid] = iparse
+            iparse = iparse + 1
+          if i in parsed: # MERGE WHILE THE WORKERS PARSE THE NEXT RANGES
+            logger.info('Processing MAF file: %s, bytes %d:%d' % ranges[i][:3])
+            parseFile = parsed.pop(i)
+            ns = self.read_maf_parse(parseFile, maxint, seqidmap, ns,
+                                     build_ifile, nbuild, linecode_count)
+            os.remove(parseFile)
+            i = i + 1
+            continue
+          pid, status = os.waitpid(-1, 0)
+          j = running.pop(pid)
+          if status == 2 << 8:
+            raise ValueError('MAF block too long!  Increase max size')
+          elif status != 0:
+            raise IOError('error parsing MAF file %s' % (ranges[j][0],))
+          parsed[j] = '%s.mafparse%d' % (self.pathstem, j)
+      except:
+        import signal
+        for pid in running: # STOP THE REMAINING WORKERS
+          os.kill(pid, signal.SIGTERM)
+          os.waitpid(pid, 0)
+        for j in range(iparse):
+          try:
+            os.remove('%s.mafparse%d' % (self.pathstem, j))
+          except OSError:
+            pass
+        self.free_seqidmap(nseq0, seqidmap)
+        self.save_nbuild(nbuild)
+        raise
+      mafFiles = () # ALL MERGED
     strcpy(a_header, "a ") # MAKE C STRING
     for filename in mafFiles:
-      logger.info('Processing MAF file: ' + filename)
-      ifile = fopen(filename, 'r') # text file
-      if ifile == NULL:
+      logger.info('Processing MAF file: %s' % (filename,))
+      try:
+        src = AlignmentInputStream(filename)
+      except IOError:
         self.free_seqidmap(nseq0, seqidmap)
         self.save_nbuild(nbuild)
-        raise IOError('unable to open file %s' % filename)
-      if fgets(tmp, 32767, ifile) == NULL or strncmp(tmp, "##maf", 4): # HEADER LINE
+        raise
+      ifile = src.ifile
+      if src.gets(tmp, 32767) == NULL or strncmp(tmp, "##maf", 4): # HEADER LINE
         self.free_seqidmap(nseq0, seqidmap)
         self.save_nbuild(nbuild)
-        raise IOError('%s: not a MAF file? Bad format.' % filename)
-      p = fgets(tmp, 32767, ifile) # READ 1ST DATA LINE OF THE MAF FILE
+        raise IOError('%s: not a MAF file? Bad format.' % (src.name or filename,))
+      p = src.gets(tmp, 32767) # READ 1ST DATA LINE OF THE MAF FILE
       while p: # GOT ANOTHER LINE TO PROCESS
         if has_continuation or 0 == strncmp(tmp, a_header, 2): # ALIGNMENT HEADER: READ ALIGNMENT
-          n = readMAFrecord(im, 0, seqidmap, nseq0, ns_lpo.length, # READ ONE MAF BLOCK
-                            &block_len, ifile, 4096, linecode_count, &has_continuation)
+          with nogil: # READ ONE MAF BLOCK
+            n = readMAFrecord(im, 0, seqidmap, nseq0, 0, &block_len, ifile,
+                              4096, linecode_count, &has_continuation)
           if n < 0: # UNRECOVERABLE ERROR OCCURRED...
             self.free_seqidmap(nseq0, seqidmap)
             self.save_nbuild(nbuild)
             raise ValueError('MAF block too long!  Increase max size')
           elif n == 0:
             continue
-
-          if self.maxlen - ns_lpo.length <= block_len or \
-             ns_lpo.nbuild > maxint: # TOO BIG! MUST CREATE A NEW LPO
-            j = ns_lpo.length # RECORD THE OLD OFFSET
-            ns_lpo = self.newSequence() # CREATE A NEW LPO SEQUENCE
-            for i from 0 <= i < n: # TRANSLATE THESE INTERVALS BACK TO ZERO OFFSET
-              if im[i].start >= 0: # FORWARD INTERVAL
-                im[i].start = im[i].start - j
-                im[i].end = im[i].end - j
-              else: # REVERSE INTERVAL
-                im[i].start = im[i].start + j
-                im[i].end = im[i].end + j
-
-          for i from 0 <= i < n: # SAVE EACH INTERVAL IN UNION -> LPO MAP
-            j = im[i].target_id
-            if seqidmap[j].nlmsa_id <= 0: # NEW SEQUENCE, NEED TO ADD TO UNION
-              if ns is None or self.maxlen - ns.length <= seqidmap[j].length:
-                ns = self.newSequence(None, is_union=1) # CREATE NEW UNION TO HOLD IT
-                build_ifile[ns.id] = ns.build_ifile # KEEP PTR SO WE CAN WRITE DIRECTLY!
-                nbuild[ns.id] = 0
-              seqidmap[j].ns_id = ns.id # SET IDs TO ADD THIS SEQ TO THE UNION
-              seqidmap[j].nlmsa_id = self.inlmsa
-              seqidmap[j].offset = ns.length
-              self.inlmsa = self.inlmsa + 1 # ADVANCE SEQUENCE ID COUNTER
-              ns.length = ns.length + seqidmap[j].length # EXPAND UNION SIZE
-
-            im[i].target_id = seqidmap[j].nlmsa_id # USE THE CORRECT ID
-            if im[i].target_start < 0: # OFFSET REVERSE ORI
-              im_tmp.start = -seqidmap[j].offset + im[i].target_start
-              im_tmp.end = -seqidmap[j].offset + im[i].target_end
-            else: # OFFSET FORWARD ORI
-              im_tmp.start = seqidmap[j].offset + im[i].target_start
-              im_tmp.end = seqidmap[j].offset + im[i].target_end
-            im_tmp.target_id = ns_lpo.id
-            im_tmp.target_start = im[i].start
-            im_tmp.target_end = im[i].end
-            j=seqidmap[j].ns_id # USE NLMSA ID OF THE UNION
-            ns_lpo.saveInterval(&im_tmp, 1, 0, build_ifile[j]) # SAVE SEQ -> LPO
-            nbuild[j] = nbuild[j] + 1
-
-          ns_lpo.saveInterval(im, n, 1, ns_lpo.build_ifile) # SAVE LPO -> SEQ
-          ns_lpo.nbuild = ns_lpo.nbuild+n # INCREMENT COUNT OF SAVED INTERVALS
+          ns = self.save_maf_block(im, n, block_len, maxint, seqidmap, ns,
+                                   build_ifile, nbuild)
         if not has_continuation:
-          p = fgets(tmp, 32767, ifile) # TRY TO READ ANOTHER LINE...
-      fclose(ifile) # CLOSE THIS MAF FILE
+          p = src.gets(tmp, 32767) # TRY TO READ ANOTHER LINE...
+      try:
+        src.close() # CLOSE THIS MAF FILE
+      except IOError:
+        self.free_seqidmap(nseq0, seqidmap)
+        self.save_nbuild(nbuild)
+        raise
       #logger.debug('nbuild[0] = ' + ns_lpo.nbuild)
     for i from 0 <= i < 256: # PRINT WARNINGS ABOUT NON-ALIGNMENT LINES
       if linecode_count[i] > 0:
@@ -1836,9 +4061,89 @@ Check the input!''' % (pythonStr, seqInfo.length))
     self.save_nbuild(nbuild)
     self.build() # WILL TAKE CARE OF CLOSING ALL build_ifile STREAMS
 
+  cdef NLMSASequence save_maf_block(self, IntervalMap im[], int n, int block_len,
+                                    IntervalInt maxint, SeqIDMap seqidmap[],
+                                    NLMSASequence ns, FILE *build_ifile[],
+                                    IntervalInt nbuild[]):
+    '''save a MAF block im[0:n] read with LPO coordinates counted from 0,
+    at the end of the current LPO, adding new sequences to union ns.
+    Returns the current union'''
+    cdef int i, j
+    cdef IntervalInt lpo_offset
+    cdef IntervalMap im_tmp
+    cdef NLMSASequence ns_lpo
+    ns_lpo = self.lpoList[-1] # OUR CURRENT LPO
+    if self.maxlen - ns_lpo.length <= block_len or \
+       ns_lpo.nbuild > maxint: # TOO BIG! MUST CREATE A NEW LPO
+      ns_lpo = self.newSequence() # CREATE A NEW LPO SEQUENCE
+    else: # TRANSLATE THESE INTERVALS TO THE END OF THIS LPO
+      lpo_offset = ns_lpo.length
+      for i from 0 <= i < n:
+        if im[i].start >= 0: # FORWARD INTERVAL
+          im[i].start = im[i].start + lpo_offset
+          im[i].end = im[i].end + lpo_offset
+        else: # REVERSE INTERVAL
+          im[i].start = im[i].start - lpo_offset
+          im[i].end = im[i].end - lpo_offset
+
+    im_tmp.sublist = -1 # DEFAULT
+    for i from 0 <= i < n: # SAVE EACH INTERVAL IN UNION -> LPO MAP
+      j = im[i].target_id
+      if seqidmap[j].nlmsa_id <= 0: # NEW SEQUENCE, NEED TO ADD TO UNION
+        if ns is None or self.maxlen - ns.length <= seqidmap[j].length:
+          ns = self.newSequence(None, is_union=1) # CREATE NEW UNION TO HOLD IT
+          build_ifile[ns.id] = ns.build_ifile # KEEP PTR SO WE CAN WRITE DIRECTLY!
+          nbuild[ns.id] = 0
+        seqidmap[j].ns_id = ns.id # SET IDs TO ADD THIS SEQ TO THE UNION
+        seqidmap[j].nlmsa_id = self.inlmsa
+        seqidmap[j].offset = ns.length
+        self.inlmsa = self.inlmsa + 1 # ADVANCE SEQUENCE ID COUNTER
+        ns.length = ns.length + seqidmap[j].length # EXPAND UNION SIZE
+
+      im[i].target_id = seqidmap[j].nlmsa_id # USE THE CORRECT ID
+      if im[i].target_start < 0: # OFFSET REVERSE ORI
+        im_tmp.start = -seqidmap[j].offset + im[i].target_start
+        im_tmp.end = -seqidmap[j].offset + im[i].target_end
+      else: # OFFSET FORWARD ORI
+        im_tmp.start = seqidmap[j].offset + im[i].target_start
+        im_tmp.end = seqidmap[j].offset + im[i].target_end
+      im_tmp.target_id = ns_lpo.id
+      im_tmp.target_start = im[i].start
+      im_tmp.target_end = im[i].end
+      j=seqidmap[j].ns_id # USE NLMSA ID OF THE UNION
+      ns_lpo.saveInterval(&im_tmp, 1, 0, build_ifile[j]) # SAVE SEQ -> LPO
+      nbuild[j] = nbuild[j] + 1
+
+    ns_lpo.saveInterval(im, n, 1, ns_lpo.build_ifile) # SAVE LPO -> SEQ
+    ns_lpo.nbuild = ns_lpo.nbuild+n # INCREMENT COUNT OF SAVED INTERVALS
+    return ns
+
+  cdef NLMSASequence read_maf_parse(self, filename, IntervalInt maxint,
+                                    SeqIDMap seqidmap[], NLMSASequence ns,
+                                    FILE *build_ifile[], IntervalInt nbuild[],
+                                    long long linecode_count[]):
+    '''save the MAF blocks written by parse_maf_range() to filename.
+    Returns the current union'''
+    cdef int n, block_len
+    cdef FILE *ifile
+    cdef IntervalMap im[4096]
+    ifile = fopen(filename, 'rb')
+    if ifile == NULL:
+      raise IOError('unable to open file %s' % filename)
+    try:
+      while True:
+        n = read_parsed_maf_block(ifile, im, 4096, &block_len, linecode_count)
+        if n < 0: # END OF THIS RANGE
+          break
+        ns = self.save_maf_block(im, n, block_len, maxint, seqidmap, ns,
+                                 build_ifile, nbuild)
+    finally:
+      fclose(ifile)
+    return ns
+
   cdef NLMSASequence add_seqidmap_to_union(self, int j, SeqIDMap seqidmap[],
                                            NLMSASequence ns, FILE *build_ifile[],
-                                           int nbuild[]):
+                                           IntervalInt nbuild[]):
     cdef NLMSASequence ns_lpo
     if ns is None or self.maxlen - ns.length <= seqidmap[j].length:
       ns = self.newSequence(None, is_union=1) # CREATE NEW UNION TO HOLD IT
@@ -1855,16 +4160,37 @@ Check the input!''' % (pythonStr, seqInfo.length))
     ns.length = ns.length + seqidmap[j].length # EXPAND UNION SIZE
     return ns
 
+  cdef NLMSASequence append_seqidmap(self, int nseq0, SeqIDMap seqidmap[],
+                                     FILE *build_ifile[], IntervalInt nbuild[]):
+    '''in append mode, bind the build files of our existing indexes, and
+    copy the union coordinates of sequences already in the alignment to
+    seqidmap.  Returns the union to add new sequences to'''
+    cdef int i
+    cdef NLMSASequence ns
+    for ns in self.seqlist:
+      build_ifile[ns.id] = NULL # OPENED ON FIRST USE, SEE readAxtNet()
+      nbuild[ns.id] = 0
+    for i from 0 <= i < nseq0:
+      try:
+        t = self.seqs.seqIDdict[seqidmap[i].id]
+      except KeyError: # NOT ALIGNED YET
+        continue
+      seqidmap[i].nlmsa_id, seqidmap[i].ns_id, seqidmap[i].offset = t
+    return self.currentUnion
+
   def readAxtNet(self, axtFiles, bidirectionalRule):
-    'read alignment from a set of axtnet files'
+    '''read alignment from a set of axtnet files, given as filenames or
+    open file objects, plain text or gzip / bgzip compressed'''
     cdef int i, j, nseq0, n, isrc, is_bidirectional
     cdef SeqIDMap *seqidmap
     cdef char tmp[32768], *p, comment[4], src_prefix[64], dest_prefix[64]
-    cdef FILE *ifile
+    cdef AlignmentInputStream src
+    cdef gzFile ifile
     cdef IntervalMap im[4096], im_tmp
-    cdef NLMSASequence ns_src # SOURCE UNION VS DEST UNION
+    cdef NLMSASequence ns_src, ns # SOURCE UNION VS DEST UNION
     cdef FILE *build_ifile[4096]
-    cdef int nbuild[4096], has_continuation
+    cdef IntervalInt nbuild[4096]
+    cdef int has_continuation
 
     self.pairwiseMode = 1 # WE ARE USING pairwiseMode
 
@@ -1877,20 +4203,27 @@ Check the input!''' % (pythonStr, seqInfo.length))
       i = i + 1
     qsort(seqidmap, nseq0, sizeof(SeqIDMap), seqidmap_qsort_cmp) # SORT BY id
     ns_src = None
+    if self.append_mode: # ADD TO OUR EXISTING UNIONS
+      ns_src = self.append_seqidmap(nseq0, seqidmap, build_ifile, nbuild)
 
     im_tmp.sublist = -1 # DEFAULT
     strcpy(comment, "#") # MAKE C STRING
     import string
     import os.path
     for filename in axtFiles:
-      logger.info('Processing axtnet file: ' + filename)
+      logger.info('Processing axtnet file: %s' % (filename,))
+      name = filename
+      if not isinstance(name, str): # GET PREFIXES FROM THE FILE OBJECT'S NAME
+        name = getattr(filename, 'name', None)
       try:
-        if filename[-8:] == '.net.axt':
-          t = string.split(os.path.basename(filename)[:-8], '.')[-2:]
-        elif filename[-4:] == '.axt':
-          t = string.split(os.path.basename(filename)[:-4], '.')[-2:]
+        if name[-3:] == '.gz': # COMPRESSED FILE
+          name = name[:-3]
+        if name[-8:] == '.net.axt':
+          t = string.split(os.path.basename(name)[:-8], '.')[-2:]
+        elif name[-4:] == '.axt':
+          t = string.split(os.path.basename(name)[:-4], '.')[-2:]
       except:
-        raise IOError('%s is not correct axtNet file name. Correct name is (chrid.)source.target.net.axt.' % filename)
+        raise IOError('%s is not correct axtNet file name. Correct name is (chrid.)source.target.net.axt[.gz].' % (filename,))
       #t = prefix_fun(filename) # CALL PYTHON FUNCTION TO OBTAIN PREFIXES
       if bidirectionalRule is None: # DETERMINE IF UNI- VS. BI-DIRECTIONAL
         is_bidirectional = self.is_bidirectional # JUST USE GLOBAL SETTING
@@ -1898,13 +4231,17 @@ Check the input!''' % (pythonStr, seqInfo.length))
         is_bidirectional = bidirectionalRule(t[0], t[1], self.is_bidirectional)
       strcpy(src_prefix, t[0]) # KEEP THEM IN STATIC C STRINGS FOR SPEED
       strcpy(dest_prefix, t[1])
-      ifile = fopen(filename, 'r') # text file
-      if ifile == NULL:
+      try:
+        src = AlignmentInputStream(filename)
+      except IOError:
         self.free_seqidmap(nseq0, seqidmap)
         self.save_nbuild(nbuild)
-        raise IOError('unable to open file %s' % filename)
+        raise
+      ifile = src.ifile
       while True:
-        n = read_axtnet(im, seqidmap, nseq0, ifile, 4096, &isrc, src_prefix, dest_prefix)
+        with nogil:
+          n = read_axtnet(im, seqidmap, nseq0, ifile, 4096, &isrc,
+                          src_prefix, dest_prefix)
         if n < 0: # UNRECOVERABLE ERROR OCCURRED...
           self.free_seqidmap(nseq0, seqidmap)
           self.save_nbuild(nbuild)
@@ -1945,6 +4282,9 @@ Check the input!''' % (pythonStr, seqInfo.length))
             #                                    im_tmp.target_end,
             #                                    seqidmap[j].ns_id, j))
             j = seqidmap[j].ns_id - 1 # SAVE ALL ALIGNMENTS TO THE VIRTUAL LPO
+            if build_ifile[j] == NULL: # APPEND MODE: OPEN IT NOW
+              ns = self.seqlist[j]
+              build_ifile[j] = ns.open_build_file()
             ns_src.saveInterval(&im_tmp, 1, 0, build_ifile[j]) # SAVE DEST -> SRC
             nbuild[j] = nbuild[j] + 1
           if im[i].start < 0: # OFFSET FORWARD ORI
@@ -1961,10 +4301,18 @@ Check the input!''' % (pythonStr, seqInfo.length))
 
         # SAVE THE RECORD. read_axtnet FUNCTION READS SRC/DEST AT THE SAME TIME
         j = seqidmap[isrc].ns_id - 1 # SAVE ALL ALIGNMENTS TO THE VIRTUAL LPO
+        if build_ifile[j] == NULL: # APPEND MODE: OPEN IT NOW
+          ns = self.seqlist[j]
+          build_ifile[j] = ns.open_build_file()
         ns_src.saveInterval(im, n, 0, build_ifile[j]) # SAVE SRC -> DEST
         nbuild[j] = nbuild[j] + n # INCREMENT COUNT OF SAVED INTERVALS
 
-      fclose(ifile) # CLOSE THIS AXTNET FILE
+      try:
+        src.close() # CLOSE THIS AXTNET FILE
+      except IOError:
+        self.free_seqidmap(nseq0, seqidmap)
+        self.save_nbuild(nbuild)
+        raise
 
     for i from 0 <= i <nseq0: # INDEX SEQUENCES THAT WERE ALIGNED
       if seqidmap[i].nlmsa_id > 0: # ALIGNED, SO RECORD IT
@@ -1974,24 +4322,26 @@ Check the input!''' % (pythonStr, seqInfo.length))
     self.save_nbuild(nbuild)
     self.build() # WILL TAKE CARE OF CLOSING ALL build_ifile STREAMS
 
-  def buildFiles(self, saveSeqDict=False, **kwargs):
-    'build nestedlist databases on-disk, and .seqDict index if desired'
+  def buildFiles(self, saveSeqDict=False, nthreads=1, idIndex=True,
+                 **kwargs):
+    '''build nestedlist databases on-disk, and .seqDict index if desired.
+    nthreads > 1 builds that many sequence indexes concurrently.
+    idIndex=True also saves the sequence IDs as a binary .idIndex file,
+    which is memory-mapped instead of using the shelves when reopened'''
     cdef NLMSASequence ns
-    self.seqs.reopenReadOnly() # SAVE INDEXES AND OPEN READ-ONLY
-    ntotal = 0
-    ifile=file(self.pathstem + '.NLMSAindex', 'w') # text file
-    try:
+    self.seqs.reopenReadOnly(idIndex=idIndex) # SAVE INDEXES, OPEN READ-ONLY
+    deltastems = [ns.deltastem for ns in self.seqlist]
+    if nthreads > 1: # C BUILD RELEASES THE GIL, SO THREADS RUN IN PARALLEL
+      ntotal = nlmsa_utils.build_in_threads(self.seqlist, nthreads, **kwargs)
+    else:
+      ntotal = 0
       for ns in self.seqlist: # BUILD EACH IntervalFileDB ONE BY ONE
         ntotal = ntotal + ns.buildFiles(**kwargs)
-        if ns.is_lpo:
-          ifile.write('%d\t%s\t%d\t%d\n' % (ns.id, 'NLMSA_LPO_Internal', 0, ns.length))
-        elif ns.is_union:
-          ifile.write('%d\t%s\t%d\t%d\n' % (ns.id, 'NLMSA_UNION_Internal', 1, ns.length))
-        else:
-          ifile.write('%d\t%s\t%d\t%d\n' % (ns.id, ns.name, 0, ns.length))
-    finally:
-      ifile.close()
-    if ntotal == 0:
+    self.save_indexes()
+    for ns, deltastem in zip(self.seqlist, deltastems):
+      if ns.deltastem != deltastem: # APPEND MODE REPLACED THIS DELTA
+        _remove_binaries(deltastem)
+    if ntotal == 0 and not self.append_mode:
       raise nlmsa_utils.EmptyAlignmentError('empty alignment!')
     import pickle
     import sys
@@ -2015,8 +4365,11 @@ or in the future pass the saveSeqDict=True option to NLMSA.build().''')
     'save seqDict to a worldbase-aware pickle file'
     nlmsa_utils.save_seq_dict(self.pathstem, self.seqDict)
 
-  def build(self, **kwargs):
-    'build nestedlist databases from saved mappings and initialize for use'
+  def build(self, nthreads=1, maxMemory=None, compress=False, **kwargs):
+    '''build nestedlist databases from saved mappings and initialize for use.
+    nthreads > 1 builds on-disk sequence indexes in parallel threads;
+    maxMemory caps the memory each one uses (building it out-of-core);
+    compress=True saves them as compressed blocks (see compress_nlmsa())'''
     if self.do_build == 0:
       raise ValueError('not opened in write mode')
     try: # TURN OFF AUTOMATIC ADDING OF SEQUENCES TO OUR SEQDICT...
@@ -2030,10 +4383,40 @@ or in the future pass the saveSeqDict=True option to NLMSA.build().''')
       if ntotal == 0:
         raise nlmsa_utils.EmptyAlignmentError('empty alignment!')
     else:
-      self.buildFiles(**kwargs)
+      self.buildFiles(nthreads=nthreads, maxMemory=maxMemory,
+                      compress=compress, **kwargs)
     self.do_build = 0
-
-  def seqInterval(self, int iseq, int istart, int istop):
+    self.append_mode = 0
+
+  def compact(self, maxMemory=None, compress=None, background=False,
+              **kwargs):
+    '''merge the delta indexes of intervals added in append mode into new
+    main indexes (see NLMSASequence.compactFiles()), returning their total
+    count of intervals.  Queries can continue meanwhile.  background=True
+    runs it in a thread, returning a nlmsa_utils.BackgroundTask whose
+    join() waits for it to finish'''
+    cdef NLMSASequence ns
+    if self.do_build:
+      raise ValueError('call build() before compact()')
+    if background:
+      return nlmsa_utils.BackgroundTask(self.compact, maxMemory, compress,
+                                        **kwargs)
+    ntotal = 0
+    if not self.in_memory_mode:
+      oldstems = []
+      for ns in list(self.seqlist):
+        stems = (ns.filestem, ns.deltastem)
+        n = ns.compactFiles(maxMemory, compress, **kwargs)
+        if n > 0:
+          oldstems.extend(stems)
+          ntotal = ntotal + n
+      if oldstems:
+        self.save_indexes() # ALL AT ONCE, SO READERS NEVER SEE A MIX
+        for filestem in oldstems:
+          _remove_binaries(filestem)
+    return ntotal
+
+  def seqInterval(self, int iseq, IntervalInt istart, IntervalInt istop):
     'get specified interval in the target sequence'
     seq=self.seqlist.getSeq(iseq) # JUST THE SEQ OBJECT
     return sequence.relativeSlice(seq, istart, istop)
@@ -2047,9 +4430,106 @@ or in the future pass the saveSeqDict=True option to NLMSA.build().''')
       raise ValueError('this mapping is not invertible')
 
 
+def _read_nlmsa_index(pathstem):
+  '''read the .NLMSAindex of NLMSA pathstem.  Returns a list of (id,
+  name, is_union, length, filestem, deltastem) for each of its sequence
+  indexes, the first four as strings, the last two the file stems of its
+  database and of its delta of intervals added in append mode'''
+  try:
+    ifile = file(pathstem + '.NLMSAindex', 'rU') # text file
+  except IOError:
+    ifile = file(pathstem + 'NLMSAindex', 'rU') # FOR BACKWARDS COMPATIBILITY
+  l = []
+  try:
+    for line in ifile:
+      t = line.strip().split('\t')
+      if len(t) == 4: # DEFAULT FILE STEMS
+        t = t + [t[0], t[0] + '.delta']
+      id, name, is_union, length, filestem, deltastem = t
+      l.append((id, name, is_union, length, pathstem + filestem,
+                pathstem + deltastem))
+  finally:
+    ifile.close()
+  return l
+
+
+def _seq_dict_ids(pathstem):
+  '''return (seqDictID, prefixIDs) identifying the seqDict of NLMSA
+  pathstem in a host-independent way for dump_textfile() or
+  dump_bundle(): its worldbase ID, or "unknown" if it has none, or
+  "None" for a PrefixUnionDict, whose (prefix, worldbase ID or "None")
+  pairs are listed in prefixIDs'''
+  seqDict = nlmsa_utils.read_seq_dict(pathstem)
+  try: # OBTAIN PREFIX INFO FOR SEQDICT
+    prefixDict = seqDict.prefixDict
+  except AttributeError: # NO PREFIXUNION.  TRY TO GET ID OF seqDict
+    try:
+      return seqDict._persistent_id, []
+    except AttributeError:
+      logger.info('''Warning: Because your seqDict has no worldbase ID, there
+is no host-independent way to save it to a textfile or bundle for transfer
+to another machine.  Therefore, when loading it on the destination
+machine, you will have to provide the seqDict argument to
+textfile_to_binaries() or bundle_to_binaries() on the destination machine.''')
+      return 'unknown', []
+  prefixIDs = []
+  pleaseWarn = True
+  for id, d in prefixDict.items(): # SAVE seqDict PREFIX ENTRIES
+    try:
+      prefixIDs.append((id, d._persistent_id)) # try to get worldbase ID
+    except AttributeError:
+      prefixIDs.append((id, 'None'))
+      if pleaseWarn:
+        pleaseWarn = False
+        logger.info('''Warning: Because one or more of the sequence
+databases in the seqDict have no worldbase ID, there is no
+host-independent way to save it to a textfile or bundle for transfer
+to another machine.  Therefore, when loading it on the destination
+machine, you will have to provide a dictionary for these sequence
+database(s) as the prefixDict argument to textfile_to_binaries() or
+bundle_to_binaries() on the destination machine.''')
+  return 'None', prefixIDs
+
+
+def _restore_seq_dict(seqDictID, prefixIDs, seqDict=None, prefixDict=None):
+  '''return the seqDict of an NLMSA restored from a dump, obtaining its
+  sequence databases from worldbase by the IDs saved by _seq_dict_ids(),
+  or else from the seqDict or prefixDict arguments'''
+  if seqDict is not None:
+    ignorePrefix = True
+  else:
+    ignorePrefix = False
+  if seqDictID == 'unknown':
+    if seqDict is None:
+      raise ValueError('You must provide a seqDict for this NLMSA!')
+  elif seqDictID != 'None': # try obtaining as worldbase ID
+    from pygr import worldbase
+    seqDict = worldbase(seqDictID)
+  if prefixDict is None or ignorePrefix:
+    prefixDict = {}
+  missing = []
+  if not ignorePrefix: # OTHERWISE JUST IGNORE THE PREFIX INFO WE READ
+    for prefix, id in prefixIDs:
+      if id == 'None':
+        if prefix not in prefixDict:
+          missing.append(prefix) # MISSING A SEQDICT DICTIONARY ENTRY!
+      else: # load it from worldbase
+        from pygr import worldbase
+        prefixDict[prefix] = worldbase(id)
+  if len(missing)>0:
+    raise KeyError('''You must supply sequence database(s) for the
+following prefixes, by passing them in the prefixDict optional
+dictionary argument: %s''' % missing)
+  if len(prefixDict) > 0: # CREATE A PREFIX UNION
+    import seqdb
+    seqDict = seqdb.PrefixUnionDict(prefixDict)
+  return seqDict
+
+
 def dump_textfile(pathstem, outfilename=None):
   'dump NLMSA binary files to a text file'
-  cdef int n, nlmsaID, nsID, offset, is_bidirectional, pairwiseMode, nprefix
+  cdef int n, nlmsaID, nsID, is_bidirectional, pairwiseMode, nprefix
+  cdef long long offset
   cdef FILE *outfile
   cdef char err_msg[2048], tmp[2048], seqDictID[256]
   err_msg[0] = 0 # ENSURE STRING IS EMPTY
@@ -2060,23 +4540,9 @@ def dump_textfile(pathstem, outfilename=None):
   import sys
   seqIDdict = classutil.open_shelve(pathstem + '.seqIDdict', 'r')
   n = len(seqIDdict)
-  seqDict = nlmsa_utils.read_seq_dict(pathstem)
-  try: # OBTAIN PREFIX INFO FOR SEQDICT
-    prefixDict = seqDict.prefixDict
-    nprefix = len(prefixDict)
-    strcpy(seqDictID, "None")
-  except AttributeError: # NO PREFIXUNION.  TRY TO GET ID OF seqDict
-    nprefix = 0
-    prefixDict = {}
-    try:
-      strcpy(seqDictID, seqDict._persistent_id)
-    except AttributeError:
-      strcpy(seqDictID, "unknown")
-      logger.info('''Warning: Because your seqDict has no worldbase ID, there
-is no host-independent way to save it to a textfile for transfer
-to another machine.  Therefore, when loading this textfile
-on the destination machine, you will have to provide the
-seqDict argument to textfile_to_binaries() on the destination machine.''')
+  id, prefixIDs = _seq_dict_ids(pathstem)
+  strcpy(seqDictID, id)
+  nprefix = len(prefixIDs)
   try:
     ifile = file(pathstem + '.attrDict', 'rb') # pickle is binary file!
     d = pickle.load(ifile)
@@ -2095,22 +4561,9 @@ seqDict argument to textfile_to_binaries() on the destination machine.''')
     if fprintf(outfile, "PATHSTEM\t%s\t%d\t%d\t%d\t%d\t%s\n", tmp, n,
                is_bidirectional, pairwiseMode, nprefix, seqDictID) < 0:
       raise IOError('error writing to file %s' % outfilename)
-    pleaseWarn = True
-    for id, d in prefixDict.items(): # SAVE seqDict PREFIX ENTRIES
+    for id, d in prefixIDs: # SAVE seqDict PREFIX ENTRIES
       strcpy(tmp, id) # CONVERT TO C DATA TYPES FOR fprintf
-      try:
-        strcpy(seqDictID, d._persistent_id) # try to get worldbase ID
-      except AttributeError:
-        strcpy(seqDictID, "None")
-        if pleaseWarn:
-          pleaseWarn = False
-          logger.info('''Warning: Because one or more of the sequence
-databases in the seqDict have no worldbase ID, there is no
-host-independent way to save it to a textfile for transfer
-to another machine.  Therefore, when loading this textfile
-on the destination machine, you will have to provide a dictionary
-for these sequence database(s) as the prefixDict argument
-to textfile_to_binaries() on the destination machine.''')
+      strcpy(seqDictID, d)
       if fprintf(outfile, "PREFIXUNION\t%s\t%s\n", tmp, seqDictID) < 0:
         raise IOError('error writing to file %s' % outfilename)
     for id, t in seqIDdict.iteritems(): # SAVE seqIDdict
@@ -2118,40 +4571,219 @@ to textfile_to_binaries() on the destination machine.''')
       nlmsaID = t[0]
       nsID = t[1]
       offset = t[2]
-      if fprintf(outfile, "SEQID\t%s\t%d\t%d\t%d\n", tmp,
+      if fprintf(outfile, "SEQID\t%s\t%d\t%d\t%lld\n", tmp,
                  nlmsaID, nsID, offset) < 0:
         raise IOError('error writing to file %s' %outfilename)
-    try:
-      ifile = file(pathstem + '.NLMSAindex', 'rU') # text file
-    except IOError:
-      ifile = file(pathstem + 'NLMSAindex', 'rU')
+    indexLines = _read_nlmsa_index(pathstem)
   except:
     fclose(outfile)
     raise
+  import shutil
+  import tempfile
+  tmpdir = tempfile.mkdtemp() # FOR MERGING DELTAS OF APPENDED INTERVALS
   try:
-    for line in ifile:  # NOW SAVE THE NLMSA DATA
-      id, name, is_union, length = line.strip().split('\t')
+    for t in indexLines:  # NOW SAVE THE NLMSA DATA
+      line = '\t'.join(t[:4]) + '\n' # BASENAME IS ENOUGH TO FIND ITS FILES
       strcpy(tmp, line) # COPY TO C STRING SO WE CAN fprintf
       if fprintf(outfile, "NLMSASequence\t%s", tmp) < 0:
         raise IOError('error writing file %s' % outfilename)
-      mypath = pathstem + id
-      mybase = basestem + id
+      mypath = _export_stem(t, tmpdir)
+      mybase = basestem + t[0]
       if save_text_file(mypath, mybase, err_msg, outfile) != 0:
         raise IOError(err_msg)
+      if mypath != t[4]:
+        _remove_binaries(mypath)
   finally:
     fclose(outfile)
-    ifile.close()
+    shutil.rmtree(tmpdir)
+
+
+def unsorted_file_to_binaries(filename, IntervalInt n, filestem, maxMemory,
+                              int div=256):
+  '''build the nested list for n unsorted IntervalMap records saved in
+  binary file filename, writing it directly as on-disk IntervalFileDB
+  filestem.  Sort buffers use at most maxMemory bytes; the rest of the
+  build streams through temporary files next to filestem'''
+  cdef FILE *ifile
+  cdef long long max_memory
+  cdef char *err_msg, *path
+  cdef char err_buf[1024]
+  max_memory = maxMemory
+  ifile = fopen(filename, 'rb') # binary file
+  if ifile == NULL:
+    raise IOError('unable to open ' + filename)
+  path = filestem
+  with nogil:
+    err_msg = build_binary_files_external(ifile, n, div, max_memory, path,
+                                          err_buf)
+  fclose(ifile)
+  if err_msg:
+    raise IOError(err_msg)
+
+
+def _build_binaries(filename, IntervalInt n, filestem, maxMemory=None,
+                    compress=False, **kwargs):
+  '''build IntervalFileDB filestem from n unsorted IntervalMap records
+  saved in binary file filename, out-of-core if it would need more than
+  maxMemory bytes in memory; compress=True saves it as compressed blocks'''
+  cdef IntervalDB db
+  if maxMemory is not None and n * sizeof(IntervalMap) > maxMemory:
+    unsorted_file_to_binaries(filename, n, filestem,
+                              maxMemory) # STREAM .build TO IntervalDBFile
+  else:
+    db = IntervalDB() # CREATE EMPTY NL IN MEMORY
+    if n > 0:
+      db.buildFromUnsortedFile(filename, n, **kwargs) # BUILD FROM .build
+    db.write_binaries(filestem) # SAVE AS IntervalDBFile
+    db.close() # DUMP NESTEDLIST FROM MEMORY
+  if compress:
+    compress_binaries(filestem)
+
+
+_binarySuffixes = ('.idb', '.index', '.size', '.subhead', '.blocks')
+
+def _merge_binaries(filestems, newstem, maxMemory=None, compress=False,
+                    **kwargs):
+  '''build IntervalFileDB newstem from all the intervals of the
+  IntervalFileDBs filestems, via a temporary newstem.build file;
+  return its count of intervals'''
+  cdef FILE *ifile
+  cdef IntervalFileDB db
+  import os
+  filename = newstem + '.build'
+  ifile = fopen(filename, 'wb') # binary file
+  if ifile == NULL:
+    raise IOError('unable to open in write mode: ' + filename)
+  n = 0
+  try:
+    for filestem in filestems:
+      db = IntervalFileDB(filestem) # OUR OWN COPY, JUST FOR READING
+      try:
+        n = n + save_dbfile_intervals(db, ifile)
+      finally:
+        db.close()
+  finally:
+    fclose(ifile)
+  try:
+    _build_binaries(filename, n, newstem, maxMemory, compress, **kwargs)
+  finally:
+    os.remove(filename)
+  return n
+
+
+def _export_stem(t, tmpdir):
+  '''file stem to export for NLMSASequence index line t: its main
+  database, or if it has a delta database of intervals appended but not
+  yet compacted, a copy merging both, built in directory tmpdir'''
+  import os
+  if not os.path.exists(t[5] + '.size'): # NO DELTA, USE THE MAIN DB
+    return t[4]
+  filestem = os.path.join(tmpdir, t[0])
+  _merge_binaries((t[4], t[5]), filestem)
+  return filestem
+
+
+def _next_binaries_stem(basestem, filestem):
+  '''file stem basestem.N for a new version of IntervalFileDB filestem
+  (basestem or an earlier basestem.N), whose files do not exist yet'''
+  import os
+  i = 0
+  if filestem != basestem:
+    i = int(filestem[len(basestem) + 1:])
+  while True:
+    i = i + 1
+    stem = '%s.%d' % (basestem, i)
+    for suffix in _binarySuffixes:
+      if os.path.exists(stem + suffix):
+        break
+    else:
+      return stem
+
+
+def _remove_binaries_versions(basestem):
+  'delete the files of all versions basestem.N of IntervalFileDB basestem'
+  import glob
+  import os
+  for suffix in _binarySuffixes:
+    for filename in glob.glob(basestem + '.[0-9]*' + suffix):
+      if filename[len(basestem) + 1:-len(suffix)].isdigit():
+        os.remove(filename)
+
+
+def _remove_binaries(filestem):
+  'delete the files of IntervalFileDB filestem'
+  import os
+  for suffix in _binarySuffixes:
+    if os.path.exists(filestem + suffix):
+      os.remove(filestem + suffix)
+
+
+cdef IntervalInt save_dbfile_intervals(IntervalFileDB db,
+                                       FILE *ifile) except -1:
+  '''write all intervals of db to unsorted binary build file ifile,
+  e.g. to rebuild it merged with other intervals.  Returns their count'''
+  cdef int i, n
+  cdef IntervalInt ntotal
+  cdef IntervalScan *scan
+  cdef IntervalMap *buf
+  cdef IntervalDBFile *dbfile
+  db.check_nonempty() # RAISE EXCEPTION IF NO DATA
+  dbfile = acquire_interval_dbfile(db.db) # KEEP IT OPEN EVEN IF close()d
+  buf = NULL
+  scan = NULL
+  ntotal = 0
+  try:
+    buf = interval_map_alloc(65536)
+    scan = interval_scan_alloc(dbfile, 65536, 0)
+    if scan == NULL:
+      raise MemoryError('out of memory')
+    while True:
+      with nogil:
+        n = interval_scan_next(scan, buf, 65536)
+      if n < 0:
+        raise IOError('error reading IntervalFileDB')
+      elif n == 0:
+        break
+      for i from 0 <= i < n:
+        buf[i].sublist = -1
+      if write_padded_binary(buf, n, 1, ifile) != n:
+        raise IOError('write_padded_binary failed???')
+      ntotal = ntotal + n
+  finally:
+    free_interval_scan(scan)
+    free(buf)
+    free_interval_dbfile(dbfile) # RELEASE OUR REFERENCE
+  return ntotal
+
+
+def compress_binaries(filestem):
+  '''rewrite on-disk IntervalFileDB filestem with its intervals stored
+  as delta / varint compressed blocks of div intervals (saved as
+  filestem.idb plus the block offsets in filestem.blocks).  Queries read
+  one block per index entry just as before, but the files are typically
+  several times smaller.  Does nothing if already compressed'''
+  cdef char *err_msg, *path
+  cdef char err_buf[1024]
+  path = filestem
+  with nogil:
+    err_msg = compress_binary_files(path, err_buf)
+  if err_msg:
+    raise IOError(err_msg)
+
+
+def compress_nlmsa(pathstem):
+  '''compress the nested list files of the on-disk NLMSA pathstem in
+  place; see compress_binaries().  Close any NLMSA opened on it first'''
+  for t in _read_nlmsa_index(pathstem):
+    compress_binaries(t[4])
 
 
 def textfile_to_binaries(filename, seqDict=None, prefixDict=None, buildpath=''):
   'convert pathstem.txt textfile to NLMSA binary files'
-  cdef int i, n, nlmsaID, nsID, offset, is_bidirectional, pairwiseMode, nprefix
+  cdef int i, n, nlmsaID, nsID, is_bidirectional, pairwiseMode, nprefix
+  cdef long long offset
   cdef FILE *infile
   cdef char err_msg[2048], line[32768], tmp[2048], basestem[2048], seqDictID[2048]
-  if seqDict is not None:
-    ignorePrefix = True
-  else:
-    ignorePrefix = False
   err_msg[0] = 0 # ENSURE STRING IS EMPTY
   infile = fopen(filename, "r") # text file
   if infile == NULL:
@@ -2162,9 +4794,9 @@ def textfile_to_binaries(filename, seqDict=None, prefixDict=None, buildpath=''):
     is_bidirectional = -1 # INVALID INITIAL SETTING
     pairwiseMode = -1
     nprefix = 0
-    strcpy(tmp, "None")
+    strcpy(seqDictID, "None")
     if 2 > sscanf(line, "PATHSTEM\t%s\t%d\t%d\t%d\t%d\t%s", basestem, &n,
-                &is_bidirectional, &pairwiseMode, &nprefix, tmp):
+                &is_bidirectional, &pairwiseMode, &nprefix, seqDictID):
       raise IOError('bad format in %s' % filename)
     if buildpath != '': # USER-SPECIFIED PATH FOR BINARIES
       import os
@@ -2172,12 +4804,15 @@ def textfile_to_binaries(filename, seqDict=None, prefixDict=None, buildpath=''):
       strcpy(basestem, buildpath1) # COPY BACK TO C STRING USABLE IN C FUNCTIONS
     else: # JUST USE PATH IN CURRENT DIRECTORY
       buildpath1 = basestem
-    if 0 == strcmp(tmp, "unknown"):
-      if seqDict is None:
-        raise ValueError('You must provide a seqDict for this NLMSA!')
-    elif 0 != strcmp(tmp, "None"): # try obtaining as worldbase ID
-      from pygr import worldbase
-      seqDict = worldbase(tmp)
+    topID = seqDictID # CONVERT TO PYTHON STRING BEFORE REUSING seqDictID
+    prefixIDs = []
+    for i from 0 <= i < nprefix: # READ seqDICT PREFIX ENTRIES
+      if fgets(line, 32767, infile) == NULL:
+        raise IOError('error or EOF reading %s' % filename)
+      if 2 != sscanf(line, "PREFIXUNION\t%s\t%s", tmp, seqDictID):
+        raise IOError('bad format in %s'%filename)
+      prefixIDs.append((tmp, seqDictID))
+    seqDict = _restore_seq_dict(topID, prefixIDs, seqDict, prefixDict)
     import classutil # CREATE THE seqIDdict
     import pickle
     seqIDdict = classutil.open_shelve(basestem + '.seqIDdict', 'n')
@@ -2192,40 +4827,18 @@ def textfile_to_binaries(filename, seqDict=None, prefixDict=None, buildpath=''):
       pickle.dump(d, ifile)
     finally:
       ifile.close()
-    if prefixDict is None or ignorePrefix:
-      prefixDict = {}
-    missing = []
-    for i from 0 <= i < nprefix: # READ seqDICT PREFIX ENTRIES
-      if fgets(line, 32767, infile) == NULL:
-        raise IOError('error or EOF reading %s' % filename)
-      if 2 != sscanf(line, "PREFIXUNION\t%s\t%s", tmp, seqDictID):
-        raise IOError('bad format in %s'%filename)
-      if ignorePrefix: # JUST IGNORE THE PREFIX INFO WE READ
-        continue
-      if 0 == strcmp(seqDictID, "None"):
-        if tmp not in prefixDict:
-          missing.append(tmp) # MISSING A SEQDICT DICTIONARY ENTRY!
-      else: # load it from worldbase
-        from pygr import worldbase
-        prefixDict[tmp] = worldbase(seqDictID)
-    if len(missing)>0:
-      raise KeyError('''You must supply sequence database(s) for the
-following prefixes, by passing them in the prefixDict optional
-dictionary argument: %s''' % missing)
-    if len(prefixDict) > 0: # CREATE A PREFIX UNION
-      import seqdb
-      seqDict = seqdb.PrefixUnionDict(prefixDict)
     nlmsa_utils.save_seq_dict(basestem, seqDict) # SAVE SEQDICT
     for i from 0 <= i <n: # seqIDDict READING
       if fgets(line, 32767, infile) == NULL:
         raise IOError('error or EOF reading %s' % filename)
-      if 4 != sscanf(line, "SEQID\t%s\t%d %d %d", tmp,
+      if 4 != sscanf(line, "SEQID\t%s\t%d %d %lld", tmp,
                    &nlmsaID, &nsID, &offset):
         raise IOError('bad format in %s' % filename)
       seqIDdict[tmp] = (nlmsaID, nsID, offset) # SAVE THIS ENTRY
       IDdict[str(nlmsaID)] = (tmp, nsID)
     seqIDdict.close() # DONE WRITING THE seqIDdict
     IDdict.close() # DONE WRITING THE seqIDdict
+    nlmsa_utils.write_id_index(basestem) # AND ITS BINARY INDEX
 
     NLMSAindexText = ''
     if buildpath != '': # USER-SPECIFIED PATH FOR BINARIES
@@ -2246,6 +4859,221 @@ dictionary argument: %s''' % missing)
     ifile = file(buildpath1 + '.NLMSAindex', "w") # text file
     ifile.write(NLMSAindexText) # LAST, WRITE TOP INDEX FILE
     ifile.close()
+    nlmsa_utils.save_build_id(buildpath1)
   finally:
     fclose(infile)
   return buildpath1 # ACTUAL PATH TO NLMSA INDEX FILESET
+
+
+NLMSA_BUNDLE_MAGIC = 'PYGRNLMB'
+NLMSA_BUNDLE_VERSION = 1
+
+cdef FILE *_open_bundle_stream(f, mode) except NULL:
+  '''open a C stream on filename f, or on a duplicate of the file
+  descriptor of open file object f (e.g. sys.stdout or a pipe)'''
+  cdef int fd
+  cdef FILE *stream
+  if hasattr(f, 'fileno'):
+    if 'w' in mode:
+      f.flush() # ITS BUFFERED DATA MUST PRECEDE OURS
+    fd = dup(f.fileno())
+    if fd < 0:
+      raise IOError('unable to duplicate file descriptor of %s' % f)
+    stream = fdopen(fd, mode)
+    if stream == NULL:
+      close(fd)
+  else:
+    stream = fopen(f, mode)
+  if stream == NULL:
+    raise IOError('unable to open %s' % f)
+  return stream
+
+cdef int _write_bundle(FILE *stream, s) except -1:
+  'write string s to the bundle stream'
+  cdef char *p
+  cdef int n, nwrite
+  p = s
+  n = len(s)
+  with nogil: # A PIPE MAY BLOCK UNTIL ITS READER CATCHES UP
+    nwrite = fwrite(p, 1, n, stream)
+  if nwrite != n:
+    raise IOError('error writing bundle! out of disk space?')
+  return 0
+
+cdef object _read_bundle(FILE *stream, int n):
+  'read n bytes from the bundle stream'
+  cdef char *p
+  cdef int nread
+  if n <= 0:
+    return ''
+  p = <char *>malloc(n)
+  if p == NULL:
+    raise MemoryError('unable to allocate %d bytes' % n)
+  try:
+    with nogil:
+      nread = fread(p, 1, n, stream)
+    if nread != n:
+      raise IOError('error or EOF reading bundle')
+    return p[:n]
+  finally:
+    free(p)
+
+cdef object _read_bundle_int(FILE *stream):
+  import struct
+  return struct.unpack('<q', _read_bundle(stream, 8))[0]
+
+cdef object _read_bundle_str(FILE *stream):
+  n = _read_bundle_int(stream)
+  if n < 0 or n > 1 << 30: # NO STRING IN A BUNDLE IS THAT BIG
+    raise IOError('bad format in bundle')
+  return _read_bundle(stream, n)
+
+def _bundle_str(s):
+  'string s as saved in a bundle: its length, then its bytes'
+  import struct
+  return struct.pack('<q', len(s)) + s
+
+
+def dump_bundle(pathstem, outfile=None):
+  '''save NLMSA pathstem as a portable binary bundle, the binary
+  equivalent of dump_textfile(): every integer is saved as 8 bytes
+  little-endian, and the intervals are written in bulk.  outfile may be
+  a filename (default pathstem.bundle) or an open file object such as
+  sys.stdout; the bundle is written sequentially, so it can be piped'''
+  cdef int i
+  cdef FILE *stream
+  cdef char *path, *base
+  cdef char err_msg[2048]
+  err_msg[0] = 0 # ENSURE STRING IS EMPTY
+  if outfile is None:
+    outfile = pathstem + '.bundle' # DEFAULT BUNDLE NAME
+  import classutil
+  import pickle
+  import struct
+  import os.path
+  seqDictID, prefixIDs = _seq_dict_ids(pathstem)
+  try:
+    ifile = file(pathstem + '.attrDict', 'rb') # pickle is binary file!
+    d = pickle.load(ifile)
+    ifile.close()
+  except IOError:
+    d = {}
+  indexLines = _read_nlmsa_index(pathstem)
+  basestem = os.path.basename(pathstem) # GET RID OF PATH INFO
+  seqIDdict = classutil.open_shelve(pathstem + '.seqIDdict', 'r')
+  import shutil
+  import tempfile
+  tmpdir = tempfile.mkdtemp() # FOR MERGING DELTAS OF APPENDED INTERVALS
+  try:
+    stream = _open_bundle_stream(outfile, 'wb')
+    try:
+      l = [NLMSA_BUNDLE_MAGIC, struct.pack('<q', NLMSA_BUNDLE_VERSION),
+           _bundle_str(basestem), _bundle_str(seqDictID),
+           struct.pack('<q', len(prefixIDs))]
+      for prefix, id in prefixIDs: # SAVE seqDict PREFIX ENTRIES
+        l.append(_bundle_str(prefix) + _bundle_str(id))
+      l.append(_bundle_str(pickle.dumps(d, 2)))
+      l.append(struct.pack('<q', len(seqIDdict)))
+      for id, t in seqIDdict.iteritems(): # SAVE seqIDdict
+        l.append(_bundle_str(id) + struct.pack('<qqq', t[0], t[1], t[2]))
+        if len(l) >= 10000: # WRITE IN BIG CHUNKS
+          _write_bundle(stream, ''.join(l))
+          l = []
+      l.append(struct.pack('<q', len(indexLines)))
+      _write_bundle(stream, ''.join(l))
+      for t in indexLines: # NOW SAVE THE NLMSA DATA
+        _write_bundle(stream, _bundle_str('\t'.join(t[:4])))
+        mypath = _export_stem(t, tmpdir)
+        mybase = basestem + t[0]
+        path = mypath
+        base = mybase
+        with nogil:
+          i = save_bundle_file(path, base, err_msg, stream)
+        if i != 0:
+          raise IOError(err_msg)
+        if mypath != t[4]:
+          _remove_binaries(mypath)
+    except:
+      fclose(stream)
+      raise
+    if fclose(stream) != 0:
+      raise IOError('error writing bundle! out of disk space?')
+  finally:
+    seqIDdict.close()
+    shutil.rmtree(tmpdir)
+
+
+def bundle_to_binaries(infile, seqDict=None, prefixDict=None, buildpath=''):
+  '''restore NLMSA binary files from a bundle saved by dump_bundle(),
+  writing its nested list files directly.  infile may be a filename or
+  an open file object (e.g. a pipe) that has not been read from yet;
+  see textfile_to_binaries() for the other arguments.  Returns the
+  path of the restored NLMSA'''
+  cdef int result
+  cdef long long i, n
+  cdef FILE *stream
+  cdef char *path
+  cdef char err_msg[2048]
+  err_msg[0] = 0 # ENSURE STRING IS EMPTY
+  import classutil
+  import struct
+  import os
+  stream = _open_bundle_stream(infile, 'rb')
+  try:
+    if _read_bundle(stream, len(NLMSA_BUNDLE_MAGIC)) != NLMSA_BUNDLE_MAGIC:
+      raise IOError('%s is not an NLMSA bundle' % infile)
+    i = _read_bundle_int(stream)
+    if i != NLMSA_BUNDLE_VERSION:
+      raise IOError('NLMSA bundle version %d: pygr must be upgraded' % i)
+    basestem = _read_bundle_str(stream)
+    seqDictID = _read_bundle_str(stream)
+    prefixIDs = []
+    n = _read_bundle_int(stream)
+    for i from 0 <= i < n: # READ seqDict PREFIX ENTRIES
+      prefixIDs.append((_read_bundle_str(stream), _read_bundle_str(stream)))
+    attrDict = _read_bundle_str(stream) # ALREADY PICKLED
+    seqDict = _restore_seq_dict(seqDictID, prefixIDs, seqDict, prefixDict)
+    buildpath1 = os.path.join(buildpath, basestem) # CONSTRUCT FILE PATH
+    seqIDdict = classutil.open_shelve(buildpath1 + '.seqIDdict', 'n')
+    IDdict = classutil.open_shelve(buildpath1 + '.idDict', 'n')
+    try:
+      n = _read_bundle_int(stream)
+      for i from 0 <= i < n: # READ seqIDdict ENTRIES
+        id = _read_bundle_str(stream)
+        t = struct.unpack('<qqq', _read_bundle(stream, 24))
+        seqIDdict[id] = t
+        IDdict[str(t[0])] = (id, t[1])
+    finally:
+      seqIDdict.close()
+      IDdict.close()
+    nlmsa_utils.write_id_index(buildpath1) # AND ITS BINARY INDEX
+    ifile = file(buildpath1 + '.attrDict', 'wb') # pickle is binary file!
+    try:
+      ifile.write(attrDict)
+    finally:
+      ifile.close()
+    nlmsa_utils.save_seq_dict(buildpath1, seqDict) # SAVE SEQDICT
+    if buildpath != '': # ENSURE THIS ENDS IN DIRECTORY SEPARATOR
+      buildpath2 = os.path.join(buildpath, '')
+    else:
+      buildpath2 = ''
+    NLMSAindexText = []
+    n = _read_bundle_int(stream)
+    for i from 0 <= i < n: # NOW READ THE NLMSA DATA
+      line = _read_bundle_str(stream)
+      NLMSAindexText.append(line + '\n')
+      logger.info('Saving NLMSA binary index: ' + line + '...')
+      path = buildpath2
+      with nogil:
+        result = bundle_file_to_binaries(stream, path, err_msg)
+      if result < 0:
+        raise IOError(err_msg)
+  finally:
+    fclose(stream)
+  ifile = file(buildpath1 + '.NLMSAindex', 'w') # text file
+  try:
+    ifile.write(''.join(NLMSAindexText)) # LAST, WRITE TOP INDEX FILE
+  finally:
+    ifile.close()
+  nlmsa_utils.save_build_id(buildpath1)
+  return buildpath1 # ACTUAL PATH TO NLMSA INDEX FILESET
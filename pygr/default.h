@@ -16,11 +16,53 @@
 #define PYGR_FSEEK(IFILE,OFFSET,WHENCE) fseeko(IFILE,OFFSET,WHENCE)
 #endif
 
+/* POSITIONAL READS (pread) LEAVE THE SHARED FILE POSITION ALONE, SO
+   SEVERAL THREADS CAN QUERY ONE OPEN FILE.  WHERE pread IS MISSING
+   WE LOCK THE FILE AROUND fseek / fread INSTEAD */
+#ifdef _WIN32
+#define PYGR_LOCK_FILE(IFILE) _lock_file(IFILE)
+#define PYGR_UNLOCK_FILE(IFILE) _unlock_file(IFILE)
+#else
+#define PYGR_USE_PREAD 1
+#endif
+
+/* posix_fadvise() LETS SEQUENTIAL SCANS ASK THE OS TO READ AHEAD */
+#if !defined(_WIN32) && !defined(__APPLE__)
+#define PYGR_USE_FADVISE 1
+#endif
+
+/* A MUTEX FOR STATE SHARED BY QUERIES RUNNING IN SEVERAL THREADS,
+   E.G. THE BLOCK CACHE */
+#ifdef _WIN32
+#include <windows.h>
+#define PYGR_MUTEX_T CRITICAL_SECTION
+#define PYGR_MUTEX_INIT(M) InitializeCriticalSection(&(M))
+#define PYGR_MUTEX_LOCK(M) EnterCriticalSection(&(M))
+#define PYGR_MUTEX_UNLOCK(M) LeaveCriticalSection(&(M))
+#define PYGR_MUTEX_DESTROY(M) DeleteCriticalSection(&(M))
+#else
+#include <pthread.h>
+#define PYGR_MUTEX_T pthread_mutex_t
+#define PYGR_MUTEX_INIT(M) pthread_mutex_init(&(M),NULL)
+#define PYGR_MUTEX_LOCK(M) pthread_mutex_lock(&(M))
+#define PYGR_MUTEX_UNLOCK(M) pthread_mutex_unlock(&(M))
+#define PYGR_MUTEX_DESTROY(M) pthread_mutex_destroy(&(M))
+#endif
+
+/* USE mmap() FOR ON-DISK DATABASES WHERE AVAILABLE; OTHERWISE
+   FALL BACK TO fseek/fread.  DEFINE PYGR_NO_MMAP TO DISABLE */
+#if !defined(_WIN32) && !defined(PYGR_NO_MMAP)
+#define PYGR_USE_MMAP 1
+#endif
+
 #ifdef BUILD_C_LIBRARY
 #include <sys/types.h>
 #else
 #include "Python.h"
 #endif
+#ifdef PYGR_USE_PREAD
+#include <unistd.h>
+#endif
 #include <stdio.h>
 #include <stdlib.h>
 #include <stddef.h>
@@ -41,6 +83,15 @@
 /* USE THESE DEFINITIONS FOR BUILDING A PYTHON EXTENSION MODULE  *****************************/
 
 
+/* QUERY FUNCTIONS MAY RUN WITHOUT HOLDING THE PYTHON GIL, SO
+   ACQUIRE IT BEFORE SETTING A PYTHON EXCEPTION */
+#define PYGR_SET_ERROR(PYEXC,MSG) {\
+    PyGILState_STATE gil_state_ZZ=PyGILState_Ensure(); \
+    PyErr_SetString(PYEXC,MSG); \
+    PyGILState_Release(gil_state_ZZ); \
+  }
+#define PYGR_SET_IO_ERROR(MSG) PYGR_SET_ERROR(PyExc_IOError,MSG)
+
 /* IF YOU USE CALLOC, YOUR FUNCTION MUST DEFINE A HANDLER WITH LABEL
    handle_malloc_failure:
    THIS HANDLER SHOULD RELEASE ANY TEMPORARILY ALLOCATED MEMORY AND
@@ -54,16 +105,16 @@
 #define CALLOC(memptr,N,ATYPE) \
   if ((N)<=0) {\
     char errstr[1024]; \
-    sprintf(errstr,"%s, line %d: *** invalid memory request: %s[%d].\n",\
-              __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
-    PyErr_SetString(PyExc_ValueError,errstr); \
+    sprintf(errstr,"%s, line %d: *** invalid memory request: %s[%lld].\n",\
+              __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
+    PYGR_SET_ERROR(PyExc_ValueError,errstr); \
     MALLOC_FAILURE_ACTION;\
   }\
   else if (NULL == ((memptr)=(ATYPE *)calloc((size_t)(N),sizeof(ATYPE))))  { \
     char errstr[1024]; \
-    sprintf(errstr,"%s, line %d: memory request failed: %s[%d].\n",\
-              __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
-    PyErr_SetString(PyExc_MemoryError,errstr); \
+    sprintf(errstr,"%s, line %d: memory request failed: %s[%lld].\n",\
+              __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
+    PYGR_SET_ERROR(PyExc_MemoryError,errstr); \
     MALLOC_FAILURE_ACTION;\
   }
 
@@ -71,18 +122,18 @@
 #define REALLOC(memptr,N,ATYPE) \
   if ((N)<=0) {\
     char errstr[1024]; \
-    sprintf(errstr,"%s, line %d: *** invalid memory request: %s[%d].\n",\
-              __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
-    PyErr_SetString(PyExc_ValueError,errstr); \
+    sprintf(errstr,"%s, line %d: *** invalid memory request: %s[%lld].\n",\
+              __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
+    PYGR_SET_ERROR(PyExc_ValueError,errstr); \
     MALLOC_FAILURE_ACTION;\
   }\
   else {\
     void *tmp_realloc_ptrZZ; \
     if (NULL == (tmp_realloc_ptrZZ=realloc((memptr),(size_t)(N)*sizeof(ATYPE))))  { \
       char errstr[1024]; \
-      sprintf(errstr,"%s, line %d: memory request failed: %s[%d].\n",\
-                __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
-      PyErr_SetString(PyExc_MemoryError,errstr); \
+      sprintf(errstr,"%s, line %d: memory request failed: %s[%lld].\n",\
+                __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
+      PYGR_SET_ERROR(PyExc_MemoryError,errstr); \
       MALLOC_FAILURE_ACTION;\
     } \
     else \
@@ -93,30 +144,31 @@
 #else
 /* USE THESE DEFINITIONS FOR BUILDING A C LIBRARY *****************************/
 #define MALLOC_FAILURE_ACTION abort()
+#define PYGR_SET_IO_ERROR(MSG) fprintf(stderr,"%s\n",MSG)
 #define CALLOC(memptr,N,ATYPE) \
   if ((N)<=0) {\
-    fprintf(stderr,"%s, line %d: *** invalid memory request: %s[%d].\n",\
-              __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
+    fprintf(stderr,"%s, line %d: *** invalid memory request: %s[%lld].\n",\
+              __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
     MALLOC_FAILURE_ACTION;\
   }\
   else if (NULL == ((memptr)=(ATYPE *)calloc((size_t)(N),sizeof(ATYPE))))  { \
-    fprintf(stderr,"%s, line %d: memory request failed: %s[%d].\n",\
-              __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
+    fprintf(stderr,"%s, line %d: memory request failed: %s[%lld].\n",\
+              __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
     MALLOC_FAILURE_ACTION;\
   }
 
 /* IF realloc FAILS, memptr REMAINS VALID, BUT MALLOC_FAILURE_ACTION IS INVOKED. */
 #define REALLOC(memptr,N,ATYPE) \
   if ((N)<=0) {\
-    fprintf(stderr,"%s, line %d: *** invalid memory request: %s[%d].\n",\
-              __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
+    fprintf(stderr,"%s, line %d: *** invalid memory request: %s[%lld].\n",\
+              __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
     MALLOC_FAILURE_ACTION;\
   }\
   else {\
     void *tmp_realloc_ptrZZ; \
     if (NULL == (tmp_realloc_ptrZZ=realloc((memptr),(size_t)(N)*sizeof(ATYPE))))  { \
-      fprintf(stderr,"%s, line %d: memory request failed: %s[%d].\n",\
-                __FILE__,__LINE__,STRINGIFY(memptr),(N));   \
+      fprintf(stderr,"%s, line %d: memory request failed: %s[%lld].\n",\
+                __FILE__,__LINE__,STRINGIFY(memptr),(long long)(N));   \
       MALLOC_FAILURE_ACTION;\
     } \
     else \
@@ -1,21 +1,32 @@
 
 #include "intervaldb.h"
+#ifdef PYGR_USE_MMAP
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#endif
+#ifdef PYGR_USE_FADVISE
+#include <fcntl.h>
+#endif
 
-int C_int_max=INT_MAX; /* KLUDGE TO LET PYREX CODE ACCESS VALUE OF INT_MAX MACRO */
+IntervalInt C_int_max=INTERVAL_INT_MAX; /* KLUDGE TO LET PYREX CODE ACCESS VALUE OF INT_MAX MACRO */
 
-IntervalMap *read_intervals(int n,FILE *ifile)
+IntervalMap *read_intervals(IntervalInt n,FILE *ifile)
 {
-  int i=0;
+  IntervalInt i=0;
   IntervalMap *im=NULL;
   CALLOC(im,n,IntervalMap); /* ALLOCATE THE WHOLE ARRAY */
-  while (i<n && fscanf(ifile," %d %d %d %d %d",&im[i].start,&im[i].end,
+  while (i<n && fscanf(ifile," " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		       " " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		       " " INTERVAL_INT_FORMAT,&im[i].start,&im[i].end,
 		       &im[i].target_id,&im[i].target_start,
 		       &im[i].target_end)==5) {
     im[i].sublist= -1; /* DEFAULT: NO SUBLIST */
     i++;
   }
   if (i!=n) {
-    fprintf(stderr,"WARNING: number of records read %d does not match allocation %d\n",i,n);
+    fprintf(stderr,"WARNING: number of records read %lld does not match allocation %lld\n",
+	    (long long)i,(long long)n);
   }
   return im;
  handle_malloc_failure:
@@ -48,7 +59,7 @@ int imstart_qsort_cmp(const void *void_a,const void *void_b)
 #ifdef MERGE_INTERVAL_ORIENTATIONS
 int im_qsort_cmp(const void *void_a,const void *void_b)
 { /* MERGE FORWARD AND REVERSE INTERVALS AS IF THEY WERE ALL IN FORWARD ORI */
-  int a_start,a_end,b_start,b_end;
+  IntervalInt a_start,a_end,b_start,b_end;
   IntervalMap *a=(IntervalMap *)void_a,*b=(IntervalMap *)void_b;
   SET_INTERVAL_POSITIVE(*a,a_start,a_end);
   SET_INTERVAL_POSITIVE(*b,b_start,b_end);
@@ -98,10 +109,10 @@ int target_qsort_cmp(const void *void_a,const void *void_b)
 }
 
 
-SublistHeader *build_nested_list_inplace(IntervalMap im[],int n,
-					 int *p_n,int *p_nlists)
+SublistHeader *build_nested_list_inplace(IntervalMap im[],IntervalInt n,
+					 IntervalInt *p_n,IntervalInt *p_nlists)
 {
-  int i=0,parent,nlists=1,isublist=0,total=0,temp=0;
+  IntervalInt i=0,parent,nlists=1,isublist=0,total=0,temp=0;
   SublistHeader *subheader=NULL;
 
 #ifdef ALL_POSITIVE_ORIENTATION
@@ -219,10 +230,10 @@ SublistHeader *build_nested_list_inplace(IntervalMap im[],int n,
 
 
 
-SublistHeader *build_nested_list(IntervalMap im[],int n,
-				 int *p_n,int *p_nlists)
+SublistHeader *build_nested_list(IntervalMap im[],IntervalInt n,
+				 IntervalInt *p_n,IntervalInt *p_nlists)
 {
-  int i=0,j,k,parent,nsub=0,nlists=0;
+  IntervalInt i=0,j,k,parent,nsub=0,nlists=0;
   IntervalMap *imsub=NULL;
   SublistHeader *subheader=NULL;
 
@@ -305,7 +316,7 @@ SublistHeader *build_nested_list(IntervalMap im[],int n,
 }
 
 
-IntervalMap *interval_map_alloc(int n)
+IntervalMap *interval_map_alloc(IntervalInt n)
 {
   IntervalMap *im=NULL;
   CALLOC(im,n,IntervalMap);
@@ -316,9 +327,10 @@ IntervalMap *interval_map_alloc(int n)
 
 
 
-int find_overlap_start(int start,int end,IntervalMap im[],int n)
+IntervalInt find_overlap_start(IntervalInt start,IntervalInt end,
+			       IntervalMap im[],IntervalInt n)
 {
-  int l=0,mid,r;
+  IntervalInt l=0,mid,r;
 
   r=n-1;
   while (l<r) {
@@ -337,9 +349,10 @@ int find_overlap_start(int start,int end,IntervalMap im[],int n)
 
 
 
-int find_index_start(int start,int end,IntervalIndex im[],int n)
+IntervalInt find_index_start(IntervalInt start,IntervalInt end,
+			     IntervalIndex im[],IntervalInt n)
 {
-  int l=0,mid,r;
+  IntervalInt l=0,mid,r;
 
   r=n-1;
   while (l<r) {
@@ -354,10 +367,11 @@ int find_index_start(int start,int end,IntervalIndex im[],int n)
 
 
 
-int find_suboverlap_start(int start,int end,int isub,IntervalMap im[],
-			  SublistHeader subheader[],int nlists)
+IntervalInt find_suboverlap_start(IntervalInt start,IntervalInt end,
+				  IntervalInt isub,IntervalMap im[],
+				  SublistHeader subheader[],IntervalInt nlists)
 {
-  int i;
+  IntervalInt i;
 
   if (isub>=0) {
     i=find_overlap_start(start,end,im+subheader[isub].start,subheader[isub].len);
@@ -388,6 +402,20 @@ int free_interval_iterator(IntervalIterator *it)
 
 
 IntervalIterator *reset_interval_iterator(IntervalIterator *it)
+{
+  IntervalIterator *it2;
+  ITERATOR_STACK_TOP(it);
+  it->n=0;
+  it->sh_n=0;
+  for (it2=it;it2;it2=it2->down) /* MAY BE USED ON ANOTHER DATABASE */
+    it2->im_buf_div=0; /* SO FORGET ANY BLOCKS WE READ */
+  return it;
+}
+
+
+/* REUSE ITERATOR FOR ANOTHER QUERY OF THE SAME DATABASE, KEEPING ANY
+   BLOCKS IT ALREADY READ, SO ADJACENT QUERIES DON'T RE-READ THEM */
+IntervalIterator *rewind_interval_iterator(IntervalIterator *it)
 {
   ITERATOR_STACK_TOP(it);
   it->n=0;
@@ -395,9 +423,9 @@ IntervalIterator *reset_interval_iterator(IntervalIterator *it)
 }
 
 
-void reorient_intervals(int n,IntervalMap im[],int ori_sign)
+void reorient_intervals(IntervalInt n,IntervalMap im[],int ori_sign)
 {
-  int i,tmp;
+  IntervalInt i,tmp;
   for (i=0;i<n;i++) {
     if ((im[i].start>=0 ? 1:-1)!=ori_sign) { /* ORIENTATION MISMATCH */
       tmp=im[i].start; /* SO REVERSE THIS INTERVAL MAPPING */
@@ -410,14 +438,15 @@ void reorient_intervals(int n,IntervalMap im[],int ori_sign)
   }
 }
 
-int find_intervals(IntervalIterator *it0,int start,int end,
-		   IntervalMap im[],int n,
-		   SublistHeader subheader[],int nlists,
+int find_intervals(IntervalIterator *it0,IntervalInt start,IntervalInt end,
+		   IntervalMap im[],IntervalInt n,
+		   SublistHeader subheader[],IntervalInt nlists,
 		   IntervalMap buf[],int nbuf,
 		   int *p_nreturn,IntervalIterator **it_return)
 {
   IntervalIterator *it=NULL,*it2=NULL;
-  int ibuf=0,j,k,ori_sign=1;
+  IntervalInt j,k;
+  int ibuf=0,ori_sign=1;
   if (!it0) { /* ALLOCATE AN ITERATOR IF NOT SUPPLIED*/
     CALLOC(it,1,IntervalIterator);
   }
@@ -477,78 +506,418 @@ int find_intervals(IntervalIterator *it0,int start,int end,
  */
 
 
+/* READ nitems RECORDS STARTING AT BYTE OFFSET ipos, WITHOUT DEPENDING ON
+   THE SHARED FILE POSITION, SO THREADS CAN SAFELY SHARE ONE ifile */
+size_t read_file_at(FILE *ifile,void *buf,size_t size,size_t nitems,
+		    PYGR_OFF_T ipos)
+{
+#ifdef PYGR_USE_PREAD
+  size_t nbytes=0,ntotal;
+  ssize_t nread;
+  ntotal=size*nitems;
+  while (nbytes<ntotal) { /* pread MAY RETURN LESS THAN WE ASKED FOR */
+    nread=pread(fileno(ifile),(char *)buf+nbytes,ntotal-nbytes,ipos+nbytes);
+    if (nread<=0) /* EOF OR ERROR */
+      break;
+    nbytes+=nread;
+  }
+  return nbytes/size;
+#else
+  size_t nread;
+  PYGR_LOCK_FILE(ifile); /* KEEP OUR fseek AND fread TOGETHER */
+  PYGR_FSEEK(ifile,ipos,SEEK_SET);
+  nread=fread(buf,size,nitems,ifile);
+  PYGR_UNLOCK_FILE(ifile);
+  return nread;
+#endif
+}
+
+
+/* WIDEN n 32 BIT INTEGERS AT THE START OF buf TO IntervalInt, IN PLACE */
+void widen_ints(void *buf,size_t n)
+{
+  IntervalInt *v=(IntervalInt *)buf;
+  int *v32=(int *)buf;
+  while (n-->0) /* LAST FIRST, SO NONE IS OVERWRITTEN BEFORE IT IS READ */
+    v[n]=v32[n];
+}
+
+
+/* LIKE read_file_at(), BUT ipos IS A RECORD NUMBER, IN A FILE WHOSE
+   INTEGERS ARE isize BYTES.  RECORDS OF A FILE SAVED BY A 32 BIT BUILD
+   ARE WIDENED TO IntervalInt AS THEY ARE READ.  RETURNS #RECORDS READ */
+size_t read_records_at(FILE *ifile,void *buf,size_t size,size_t nitems,
+		       PYGR_OFF_T irec,int isize)
+{
+  size_t fsize,n;
+  if (isize==(int)sizeof(IntervalInt))
+    return read_file_at(ifile,buf,size,nitems,irec*size);
+  fsize=size/sizeof(IntervalInt)*isize; /* RECORD SIZE IN THE FILE */
+  n=read_file_at(ifile,buf,fsize,nitems,irec*fsize);
+  widen_ints(buf,n*(size/sizeof(IntervalInt)));
+  return n;
+}
+
+
+/* LIKE fread(), WIDENING RECORDS SAVED BY A 32 BIT BUILD */
+size_t fread_records(void *buf,size_t size,size_t nitems,FILE *ifile,
+		     int isize)
+{
+  size_t n;
+  if (isize==(int)sizeof(IntervalInt))
+    return fread(buf,size,nitems,ifile);
+  n=fread(buf,size/sizeof(IntervalInt)*isize,nitems,ifile);
+  widen_ints(buf,n*(size/sizeof(IntervalInt)));
+  return n;
+}
+
+
 /* READ A BLOCK FROM THE DATABASE FILE */
-int read_imdiv(FILE *ifile,IntervalMap imdiv[],int div,int i_div,int ntop)
+int read_imdiv(FILE *ifile,IntervalMap imdiv[],int div,IntervalInt i_div,
+	       IntervalInt ntop)
 {
   int block;
   PYGR_OFF_T ipos;
-  ipos=div*i_div; /* CALCULATE POSITION IN RECORDS */
+  ipos=div; /* CALCULATE POSITION IN RECORDS */
+  ipos*=i_div;
   if (ipos+div<=ntop) /* GET A WHOLE BLOCK */
     block=div;
   else /* JUST READ PARTIAL BLOCK AT END */
     block=ntop%div;
   ipos *= sizeof(IntervalMap); /* CALCULATE FILE POSITION IN BYTES */
-  PYGR_FSEEK(ifile,ipos,SEEK_SET);
-  fread(imdiv,sizeof(IntervalMap),block,ifile);
+  read_file_at(ifile,imdiv,sizeof(IntervalMap),block,ipos);
   return block;
 }
 
 
 /* READ A SUBLIST FROM DATABASE FILE */
 IntervalMap *read_sublist(FILE *ifile,SublistHeader *subheader,
-			  IntervalMap *im)
+			  IntervalMap *im,int isize)
 {
-  PYGR_OFF_T ipos;
   if (im==NULL) {
     CALLOC(im,subheader->len,IntervalMap);
   }
-  ipos=subheader->start; /* CALCULATE POSITION IN RECORDS */
-  ipos*=sizeof(IntervalMap);  /* CALCULATE FILE POSITION IN BYTES */
-  PYGR_FSEEK(ifile,ipos,SEEK_SET);
-  fread(im,sizeof(IntervalMap),subheader->len,ifile);
+  read_records_at(ifile,im,sizeof(IntervalMap),subheader->len,
+		  subheader->start,isize);
   return im;
  handle_malloc_failure:
   return NULL;
 }
 
 
-/* READ A BLOCK OF THE SUBLIST HEADER FILE */
-int read_subheader_block(SublistHeader subheader[],int isub,int nblock,
-			 int nsubheader,FILE *ifile)
+
+
+/****************************************************************
+ *
+ *   LRU CACHE OF BLOCKS READ FROM ON-DISK DATABASES
+ */
+
+
+/* CREATE A CACHE HOLDING AT MOST max_bytes OF BLOCKS.  ITS CREATOR
+   OWNS ONE REFERENCE, RELEASED BY free_block_cache() */
+BlockCache *block_cache_alloc(long long max_bytes)
+{
+  BlockCache *cache=NULL;
+  CALLOC(cache,1,BlockCache);
+  cache->max_bytes=max_bytes;
+  cache->nhash=64; /* ROUGHLY ONE BUCKET PER KB OF CACHE */
+  while (cache->nhash<(1<<22) && ((long long)cache->nhash)*1024<max_bytes)
+    cache->nhash*=2;
+  CALLOC(cache->hash,cache->nhash,BlockCacheEntry *);
+  cache->nref=1;
+  PYGR_MUTEX_INIT(cache->lock);
+  return cache;
+ handle_malloc_failure:
+  FREE(cache);
+  return NULL;
+}
+
+
+BlockCacheEntry **block_cache_bucket(BlockCache *cache,FILE *ifile,
+				     IntervalInt ipos)
+{
+  size_t h;
+  h=((size_t)ipos)*2654435761U + (((size_t)ifile)>>4);
+  return cache->hash+(h%cache->nhash);
+}
+
+
+void block_cache_unlink(BlockCache *cache,BlockCacheEntry *e)
+{
+  if (e->prev)
+    e->prev->next=e->next;
+  else
+    cache->head=e->next;
+  if (e->next)
+    e->next->prev=e->prev;
+  else
+    cache->tail=e->prev;
+}
+
+
+void block_cache_push_head(BlockCache *cache,BlockCacheEntry *e)
+{
+  e->prev=NULL;
+  e->next=cache->head;
+  if (cache->head)
+    cache->head->prev=e;
+  else
+    cache->tail=e;
+  cache->head=e;
+}
+
+
+/* REMOVE e FROM THE CACHE AND FREE IT.  CALLER MUST HOLD THE LOCK */
+void block_cache_remove(BlockCache *cache,BlockCacheEntry *e)
+{
+  BlockCacheEntry **pe;
+  for (pe=block_cache_bucket(cache,e->ifile,e->ipos);*pe!=e;pe= &(*pe)->hnext)
+    ;
+  *pe=e->hnext;
+  block_cache_unlink(cache,e);
+  cache->nbytes-=sizeof(BlockCacheEntry)+e->n*sizeof(IntervalMap);
+  free(e);
+}
+
+
+/* COPY THE CACHED RECORDS STARTING AT ipos OF ifile TO im[].  RETURNS
+   #RECORDS, OR -1 IF NOT CACHED.  COPYING (RATHER THAN HANDING BACK
+   A POINTER) MEANS ANOTHER THREAD CAN EVICT THE ENTRY AT ANY TIME */
+int block_cache_get(BlockCache *cache,FILE *ifile,IntervalInt ipos,
+		    IntervalMap im[])
+{
+  int n= -1;
+  BlockCacheEntry *e;
+  PYGR_MUTEX_LOCK(cache->lock);
+  for (e= *block_cache_bucket(cache,ifile,ipos);e;e=e->hnext)
+    if (e->ipos==ipos && e->ifile==ifile)
+      break;
+  if (e) {
+    if (e!=cache->head) { /* MAKE IT THE MOST RECENTLY USED */
+      block_cache_unlink(cache,e);
+      block_cache_push_head(cache,e);
+    }
+    memcpy(im,e->im,e->n*sizeof(IntervalMap));
+    n=e->n;
+    cache->hits++;
+  }
+  else
+    cache->misses++;
+  PYGR_MUTEX_UNLOCK(cache->lock);
+  return n;
+}
+
+
+/* SAVE A COPY OF n RECORDS im[] READ FROM ipos OF ifile, EVICTING THE
+   LEAST RECENTLY USED BLOCKS TO MAKE ROOM.  FAILING TO CACHE IS NOT AN
+   ERROR FOR THE QUERY, SO THIS NEVER SETS AN EXCEPTION: IT JUST
+   RETURNS -1 IF OUT OF MEMORY */
+int block_cache_put(BlockCache *cache,FILE *ifile,IntervalInt ipos,
+		    IntervalMap im[],int n)
+{
+  long long size;
+  BlockCacheEntry *e,**pe;
+  size=sizeof(BlockCacheEntry)+n*sizeof(IntervalMap);
+  if (n<=0 || size>cache->max_bytes) /* NEVER FITS */
+    return 0;
+  PYGR_MUTEX_LOCK(cache->lock);
+  pe=block_cache_bucket(cache,ifile,ipos);
+  for (e= *pe;e;e=e->hnext)
+    if (e->ipos==ipos && e->ifile==ifile) /* ANOTHER THREAD BEAT US TO IT */
+      break;
+  if (!e) {
+    while (cache->tail && cache->nbytes+size>cache->max_bytes) {
+      block_cache_remove(cache,cache->tail);
+      cache->evictions++;
+    }
+    e=(BlockCacheEntry *)malloc((size_t)size); /* RECORDS FOLLOW THE ENTRY */
+    if (!e) {
+      PYGR_MUTEX_UNLOCK(cache->lock);
+      return -1;
+    }
+    e->ifile=ifile;
+    e->ipos=ipos;
+    e->n=n;
+    e->im=(IntervalMap *)(e+1);
+    memcpy(e->im,im,n*sizeof(IntervalMap));
+    e->hnext= *pe;
+    *pe=e;
+    block_cache_push_head(cache,e);
+    cache->nbytes+=size;
+  }
+  PYGR_MUTEX_UNLOCK(cache->lock);
+  return 0;
+}
+
+
+/* DROP ALL BLOCKS OF ifile FROM THE CACHE (ALL BLOCKS IF ifile IS NULL),
+   E.G. BEFORE CLOSING ifile, SO A NEW FILE OPENED AT THE SAME ADDRESS
+   CANNOT SEE THEM */
+int block_cache_purge(BlockCache *cache,FILE *ifile)
+{
+  BlockCacheEntry *e,*e_next;
+  PYGR_MUTEX_LOCK(cache->lock);
+  for (e=cache->head;e;e=e_next) {
+    e_next=e->next;
+    if (!ifile || e->ifile==ifile)
+      block_cache_remove(cache,e);
+  }
+  PYGR_MUTEX_UNLOCK(cache->lock);
+  return 0;
+}
+
+
+/* RELEASE ONE REFERENCE TO cache, FREEING IT WHEN NO OWNERS REMAIN */
+int free_block_cache(BlockCache *cache)
+{
+  int nref;
+  if (!cache)
+    return 0;
+  PYGR_MUTEX_LOCK(cache->lock);
+  nref= --cache->nref;
+  PYGR_MUTEX_UNLOCK(cache->lock);
+  if (nref>0) /* STILL IN USE */
+    return 0;
+  block_cache_purge(cache,NULL);
+  PYGR_MUTEX_DESTROY(cache->lock);
+  free(cache->hash);
+  free(cache);
+  return 0;
+}
+
+
+/* MAKE db_file CACHE ITS BLOCKS IN cache (OR STOP CACHING, IF NULL).
+   db_file HOLDS ITS OWN REFERENCE, SO cache MAY BE SHARED BY MANY
+   DATABASES, AND OUTLIVE ITS CREATOR'S REFERENCE */
+int set_dbfile_cache(IntervalDBFile *db_file,BlockCache *cache)
 {
+  if (cache) {
+    PYGR_MUTEX_LOCK(cache->lock);
+    cache->nref++;
+    PYGR_MUTEX_UNLOCK(cache->lock);
+  }
+  if (db_file->cache) {
+    block_cache_purge(db_file->cache,db_file->ifile_idb);
+    free_block_cache(db_file->cache);
+  }
+  db_file->cache=cache;
+  return 0;
+}
+
+
+/* READ BLOCK i_div OF ifile (block RECORDS, OR ALL THE RECORDS OF A
+   COMPRESSED BLOCK) INTO it->im_buf, USING cache IF NOT NULL.
+   RETURNS #RECORDS, OR -1 ON ERROR */
+int fill_block_buffer(IntervalIterator *it,FILE *ifile,int isize,
+		      CompressedBlocks *blocks,BlockCache *cache,int div,
+		      IntervalInt i_div,int block)
+{
+  int n= -1;
+  PYGR_OFF_T ipos;
+  ipos=div; /* CALCULATE POSITION IN RECORDS */
+  ipos*=i_div;
+  it->im_buf_div=0;
+  if (cache)
+    n=block_cache_get(cache,ifile,(IntervalInt)ipos,it->im_buf);
+  if (n<0) { /* NOT CACHED, SO READ IT */
+    if (blocks) {
+      if ((n=load_compressed_block(ifile,blocks,div,i_div,it->im_buf,
+				   &it->zbuf,&it->zbuf_size))<0)
+	return -1;
+    }
+    else
+      n=read_records_at(ifile,it->im_buf,sizeof(IntervalMap),block,ipos,
+			isize);
+    if (cache)
+      block_cache_put(cache,ifile,(IntervalInt)ipos,it->im_buf,n);
+  }
+  it->im_buf_div=i_div+1;
+  return n;
+}
+
+
+/* GET BLOCK i_div FOR ITERATOR it: POINT DIRECTLY INTO THE MAPPED
+   FILE IF im_map IS AVAILABLE, OTHERWISE READ IT INTO it->im_buf,
+   DECODING IT IF THE FILE IS COMPRESSED.  RETURNS #RECORDS, OR -1 */
+int load_imdiv(IntervalIterator *it,FILE *ifile,int isize,IntervalMap *im_map,
+	       CompressedBlocks *blocks,BlockCache *cache,int div,
+	       IntervalInt i_div,IntervalInt ntop)
+{
+  int block,n;
   PYGR_OFF_T ipos;
-  long start;
+  ipos=div; /* CALCULATE POSITION IN RECORDS */
+  ipos*=i_div;
+  if (ipos+div<=ntop) /* A WHOLE BLOCK */
+    block=div;
+  else /* JUST A PARTIAL BLOCK AT END */
+    block=ntop%div;
+  if (im_map) /* NO I/O NEEDED: JUST POINT INTO THE MAPPED FILE */
+    it->im=im_map+ipos;
+  else { /* READ (AND DECODE, IF COMPRESSED) INTO OUR BUFFER */
+    it->im=it->im_buf;
+    if (it->im_buf_div!=i_div+1) { /* NOT ALREADY IN OUR BUFFER */
+      n=fill_block_buffer(it,ifile,isize,blocks,cache,div,i_div,block);
+      if (n<0 || (blocks && n<block))
+	return -1;
+    }
+  }
+  return block;
+}
+
+
+/* READ A BLOCK OF THE SUBLIST HEADER FILE */
+IntervalInt read_subheader_block(SublistHeader subheader[],IntervalInt isub,
+				 IntervalInt nblock,IntervalInt nsubheader,
+				 FILE *ifile,int isize)
+{
+  IntervalInt start;
   start=isub-(isub%nblock); /* GET BLOCK START */
   if (start+nblock>nsubheader)
     nblock=nsubheader-start; /* TRUNCATE TO FIT MAX FILE LENGTH */
-  ipos=start; /* CONVERT TO off_t TYPE */
-  ipos *= sizeof(SublistHeader); /* CALCULATE ACTUAL BYTE OFFSET */
-  PYGR_FSEEK(ifile,ipos,SEEK_SET);
-  fread(subheader,sizeof(SublistHeader),nblock,ifile);
+  read_records_at(ifile,subheader,sizeof(SublistHeader),nblock,start,isize);
   return start;
 }
 
 
 
 
-int find_file_start(IntervalIterator *it,int start,int end,int isub,
-		    IntervalIndex ii[],int nii,
-		    SublistHeader *subheader,int nlists,
-                    SubheaderFile *subheader_file,
-		    int ntop,int div,FILE *ifile)
+/* POSITION it AT THE FIRST INTERVAL OF LIST isub (-1 FOR THE TOP LEVEL)
+   OVERLAPPING start..end.  SUBLIST HEADERS READ FROM DISK ARE KEPT IN
+   sh_it->sh_buf, E.G. THE TOP OF it'S ITERATOR STACK */
+IntervalInt find_file_start(IntervalIterator *it,IntervalIterator *sh_it,
+			    IntervalInt start,IntervalInt end,IntervalInt isub,
+			    IntervalIndex ii[],IntervalInt nii,
+			    SublistHeader *subheader,IntervalInt nlists,
+			    SubheaderFile *subheader_file,
+			    IntervalInt ntop,int div,FILE *ifile,int isize,
+			    IntervalMap *im_map,CompressedBlocks *blocks,
+			    BlockCache *cache)
 {
-  int i_div= -1,offset=0,offset_div=0;
+  IntervalInt i_div= -1,offset=0,offset_div=0;
   if (isub<0)  /* TOP-LEVEL SEARCH: USE THE INDEX */
     i_div=find_index_start(start,end,ii,nii);
   else { /* GET PTR TO subheader[isub] */
 #ifdef ON_DEMAND_SUBLIST_HEADER
-    if (isub<subheader_file->start /* isub OUTSIDE OUR CURRENT BLOCK */
-	|| isub>=subheader_file->start+subheader_file->nblock)
-      subheader_file->start=  /* LOAD NEW BLOCK FROM DISK */
-	read_subheader_block(subheader_file->subheader,isub,
-			     subheader_file->nblock,nlists,
-			     subheader_file->ifile);
-    subheader=subheader_file->subheader + (isub-subheader_file->start);
+    if (isub>=subheader_file->start /* IN MEMORY, E.G. A MAPPED FILE */
+	&& isub<subheader_file->start+subheader_file->nblock)
+      subheader=subheader_file->subheader + (isub-subheader_file->start);
+    else { /* READ A BLOCK INTO THE BUFFER OF OUR ITERATOR STACK, SO NO
+	      SHARED STATE: THREADSAFE */
+      if (isub<sh_it->sh_start || isub>=sh_it->sh_start+sh_it->sh_n) {
+	if (!sh_it->sh_buf) {
+	  CALLOC(sh_it->sh_buf,subheader_file->read_nblock,SublistHeader);
+	}
+	sh_it->sh_n=0; /* IN CASE THE READ FAILS */
+	sh_it->sh_start=read_subheader_block(sh_it->sh_buf,isub,
+					     subheader_file->read_nblock,
+					     nlists,subheader_file->ifile,
+					     subheader_file->isize);
+	sh_it->sh_n=subheader_file->read_nblock;
+	if (sh_it->sh_start+sh_it->sh_n>nlists) /* TRUNCATED AT END OF FILE */
+	  sh_it->sh_n=nlists-sh_it->sh_start;
+      }
+      subheader=sh_it->sh_buf + (isub-sh_it->sh_start);
+    }
 #else
     subheader += isub; /* POINT TO OUR SUBHEADER */
 #endif
@@ -563,17 +932,37 @@ int find_file_start(IntervalIterator *it,int start,int end,int isub,
     }
   }
 
-  if (!it->im) { /* NO ALLOCATION? ALLOCATE OUR BLOCK SIZE div */
-    CALLOC(it->im,div,IntervalMap); /* ALWAYS ALLOCATE div BUFFERSIZE */
+  if (!im_map && !it->im_buf) { /* NO ALLOCATION? ALLOCATE OUR BLOCK SIZE div */
+    CALLOC(it->im_buf,div,IntervalMap); /* ALWAYS ALLOCATE div BUFFERSIZE */
   }
   if (i_div>=0) { /* READ A SPECIFIC BLOCK OF SIZE div */
-    it->n=read_imdiv(ifile,it->im,div,i_div+offset_div,ntop+offset);
+    if ((it->n=load_imdiv(it,ifile,isize,im_map,blocks,cache,div,
+			  i_div+offset_div,ntop+offset))<0)
+      goto handle_malloc_failure;
     it->ntop=ntop+offset; /* END OF THIS LIST IN THE BINARY FILE */
     it->nii=nii+offset_div; /* SAVE INFORMATION FOR READING SUBSEQUENT BLOCKS */
     it->i_div=i_div+offset_div; /* INDEX OF THIS BLOCK IN THE BINARY FILE */
   }
   else { /* A SMALL SUBLIST: READ THE WHOLE LIST INTO MEMORY */
-    read_sublist(ifile,subheader,it->im); /* GUARANTEED TO BE <=div ITEMS */
+    if (im_map) /* NO NEED TO READ, JUST POINT TO IT */
+      it->im=im_map+subheader->start;
+    else if (blocks) { /* NEVER CROSSES A BLOCK: SEE compress_binary_files() */
+      i_div=subheader->start/div;
+      if (it->im_buf_div!=i_div+1 /* NOT ALREADY IN OUR BUFFER */
+	  && fill_block_buffer(it,ifile,isize,blocks,cache,div,i_div,div)
+	  < subheader->start%div+subheader->len)
+	goto handle_malloc_failure;
+      it->im=it->im_buf+subheader->start%div;
+    }
+    else {
+      it->im=it->im_buf;
+      if (!cache || block_cache_get(cache,ifile,subheader->start,it->im)<0) {
+	read_sublist(ifile,subheader,it->im,isize); /* <=div ITEMS */
+	if (cache)
+	  block_cache_put(cache,ifile,subheader->start,it->im,subheader->len);
+      }
+      it->im_buf_div=0; /* BUFFER NO LONGER HOLDS A NUMBERED BLOCK */
+    }
     it->n=subheader->len;
     it->nii=1;
     it->i_div=0; /* INDICATE THAT THERE ARE NO ADDITIONAL BLOCKS TO READ*/
@@ -582,25 +971,30 @@ int find_file_start(IntervalIterator *it,int start,int end,int isub,
   it->i=find_overlap_start(start,end,it->im,it->n);
   return it->i;
  handle_malloc_failure:
-  return -2; /* SIGNAL THAT MEMORY ERROR OCCURRED */
+  return -2; /* SIGNAL THAT MEMORY OR COMPRESSED BLOCK ERROR OCCURRED */
 }
 
 
-int find_file_intervals(IntervalIterator *it0,int start,int end,
-			IntervalIndex ii[],int nii,
-			SublistHeader subheader[],int nlists,
+int find_file_intervals(IntervalIterator *it0,IntervalInt start,
+			IntervalInt end,
+			IntervalIndex ii[],IntervalInt nii,
+			SublistHeader subheader[],IntervalInt nlists,
 			SubheaderFile *subheader_file,
-			int ntop,int div,FILE *ifile,
-			IntervalMap buf[],int nbuf,
+			IntervalInt ntop,int div,FILE *ifile,int isize,
+			IntervalMap *im_map,CompressedBlocks *blocks,
+			BlockCache *cache,IntervalMap buf[],int nbuf,
 			int *p_nreturn,IntervalIterator **it_return)
 {
-  IntervalIterator *it=NULL,*it2=NULL;
-  int k,ibuf=0,ori_sign=1,ov=0;
+  IntervalIterator *it=NULL,*it2=NULL,*top;
+  IntervalInt k,ov=0;
+  int ibuf=0,ori_sign=1;
   if (!it0) { /* ALLOCATE AN ITERATOR IF NOT SUPPLIED*/
     CALLOC(it,1,IntervalIterator);
   }
   else 
     it=it0;
+  top=it; /* IT HOLDS OUR SUBLIST HEADER BUFFER */
+  ITERATOR_STACK_TOP(top);
 
 #if defined(ALL_POSITIVE_ORIENTATION) || defined(MERGE_INTERVAL_ORIENTATIONS)
   if (start<0) { /* NEED TO CONVERT TO POSITIVE ORIENTATION */
@@ -612,8 +1006,9 @@ int find_file_intervals(IntervalIterator *it0,int start,int end,
 #endif
 
   if (it->n == 0)  /* DEFAULT: SEARCH THE TOP NESTED LIST */
-    if (find_file_start(it,start,end,-1,ii,nii,subheader,nlists,
-			subheader_file,ntop,div,ifile) == FIND_FILE_MALLOC_ERR)
+    if (find_file_start(it,top,start,end,-1,ii,nii,subheader,nlists,
+			subheader_file,ntop,div,ifile,isize,im_map,blocks,cache)
+	== FIND_FILE_MALLOC_ERR)
       goto handle_malloc_failure;
   
   do { /* ITERATOR STACK LOOP */
@@ -625,8 +1020,9 @@ int find_file_intervals(IntervalIterator *it0,int start,int end,
 	k=it->im[it->i].sublist; /* GET SUBLIST OF i IF ANY */
 	it->i++; /* ADVANCE TO NEXT INTERVAL */
 	PUSH_ITERATOR_STACK(it,it2,IntervalIterator); /* RECURSE TO SUBLIST */
-	if (k>=0 && (ov=find_file_start(it2,start,end,k,ii,nii,subheader,nlists,
-					subheader_file,ntop,div,ifile))>=0)
+	if (k>=0 && (ov=find_file_start(it2,top,start,end,k,ii,nii,subheader,
+					nlists,subheader_file,ntop,div,ifile,
+					isize,im_map,blocks,cache))>=0)
 	  it=it2; /* PUSH THE ITERATOR STACK */
 	if (FIND_FILE_MALLOC_ERR == ov)
 	  goto handle_malloc_failure;
@@ -637,7 +1033,10 @@ int find_file_intervals(IntervalIterator *it0,int start,int end,
       it->i_div++; /* TRY GOING TO NEXT BLOCK */
       if (it->i == it->n  /* USED WHOLE BLOCK, SO THERE MIGHT BE MORE */
 	  && it->i_div < it->nii) { /* CONTINUE TO NEXT BLOCK */
-	it->n=read_imdiv(ifile,it->im,div,it->i_div,it->ntop); /*READ NEXT BLOCK*/
+	it->n=load_imdiv(it,ifile,isize,im_map,blocks,cache,div,it->i_div,
+			 it->ntop); /* READ NEXT BLOCK */
+	if (it->n<0)
+	  goto handle_malloc_failure;
 	it->i=0; /* PROCESS IT FROM ITS START */
       }
     }
@@ -662,105 +1061,713 @@ int find_file_intervals(IntervalIterator *it0,int start,int end,
 
 
 
-/* FUNCTIONS FOR READING AND WRITING OF THE BINARY DATABASE FILES */
+/****************************************************************
+ *
+ *   READAHEAD FOR SCANS OF AN ON-DISK DATABASE
+ */
 
-int write_padded_binary(IntervalMap im[],int n,int div,FILE *ifile)
+
+/* ADVISE THE OS HOW WE WILL READ BYTES offset .. offset+len-1 OF db_file's
+   .idb: madvise ON THE MAPPING IF IT IS MAPPED, OTHERWISE posix_fadvise.
+   len 0 MEANS TO THE END OF THE FILE.  PURELY A HINT, SO ERRORS ARE IGNORED */
+void advise_dbfile_range(IntervalDBFile *db_file,PYGR_OFF_T offset,
+			 PYGR_OFF_T len,int sequential)
 {
-  int i,npad;
-  fwrite(im,sizeof(IntervalMap),n,ifile); /* SAVE THE ACTUAL DATA */
-  npad=n%div;
-  if (npad) {
-    npad=div-npad; /* #ITEMS NEEDED TO PAD TO AN EXACT MULTIPLE OF div */
-    for (i=0;i<npad;i++) /* GUARANTEED im HAS AT LEAST ONE RECORD */
-      fwrite(im,sizeof(IntervalMap),1,ifile); /*THIS IS JUST PADDING */
+#ifdef PYGR_USE_MMAP
+  char *map=NULL;
+  size_t map_size=0,page;
+  if (db_file->im_map) {
+    map=(char *)db_file->im_map;
+    map_size=db_file->im_map_size;
   }
-  return n+npad; /* #RECORDS SAVED */
+  else if (db_file->blocks && db_file->blocks->map) {
+    map=(char *)db_file->blocks->map;
+    map_size=db_file->blocks->map_size;
+  }
+  if (map) {
+    if (offset>=(PYGR_OFF_T)map_size)
+      return;
+    if (len<=0 || offset+len>(PYGR_OFF_T)map_size)
+      len=map_size-offset;
+    page=(size_t)sysconf(_SC_PAGESIZE);
+    len+=offset%page; /* madvise NEEDS A PAGE-ALIGNED ADDRESS */
+    offset-=offset%page;
+    madvise(map+offset,(size_t)len,sequential ? MADV_SEQUENTIAL:MADV_WILLNEED);
+    return;
+  }
+#endif
+#ifdef PYGR_USE_FADVISE
+  if (db_file->ifile_idb)
+    posix_fadvise(fileno(db_file->ifile_idb),offset,len,
+		  sequential ? POSIX_FADV_SEQUENTIAL:POSIX_FADV_WILLNEED);
+#endif
 }
 
 
-int repack_subheaders(IntervalMap im[],int n,int div,
-		      SublistHeader *subheader,int nlists)
+/* TELL THE OS THAT db_file WILL BE READ IN ORDER, SO IT READS AHEAD MORE */
+int advise_sequential_scan(IntervalDBFile *db_file)
 {
-  int i,j,*sub_map=NULL;
-  SublistHeader *sub_pack=NULL;
+  advise_dbfile_range(db_file,0,0,1);
+  return 0;
+}
 
-  CALLOC(sub_map,nlists,int);
-  CALLOC(sub_pack,nlists,SublistHeader);
-  for (i=j=0;i<nlists;i++) { /* PLACE SUBLISTS W/ len>div AT FRONT */
-    if (subheader[i].len>div) {
-      memcpy(sub_pack+j,subheader+i,sizeof(SublistHeader));
-      sub_map[i]=j;
-      j++;
-    }
+
+/* START READING TOP-LEVEL BLOCKS AHEAD OF A LEFT-TO-RIGHT SCAN NOW AT
+   start..end, nblock BLOCKS BEYOND THE ONE HOLDING start.  prefetched IS
+   THE END OF THE BLOCKS ALREADY REQUESTED BY THE PREVIOUS CALL; WE ONLY
+   ASK AGAIN ONCE THE SCAN IS HALFWAY THROUGH THEM.  RETURNS THE NEW END */
+IntervalInt prefetch_file_blocks(IntervalDBFile *db_file,IntervalInt start,
+				 IntervalInt end,IntervalInt nblock,
+				 IntervalInt prefetched)
+{
+  IntervalInt i_div,i_end,ntop_div;
+  PYGR_OFF_T offset,len;
+  ntop_div=db_file->ntop/db_file->div; /* #TOP-LEVEL BLOCKS */
+  if (db_file->ntop%db_file->div)
+    ntop_div++;
+  if (ntop_div<=0 || nblock<=0)
+    return prefetched;
+  i_div=find_index_start(start,end,db_file->ii,ntop_div);
+  if (i_div+nblock/2<prefetched) /* STILL WELL AHEAD OF THE SCAN */
+    return prefetched;
+  if (prefetched>i_div) /* DON'T ASK FOR THE SAME BLOCKS TWICE */
+    i_div=prefetched;
+  i_end=i_div+nblock;
+  if (i_end>ntop_div)
+    i_end=ntop_div;
+  if (i_div>=i_end)
+    return i_end;
+  if (db_file->blocks) { /* COMPRESSED: LOOK UP THE BLOCKS' BYTE RANGE */
+    offset=db_file->blocks->offset[i_div];
+    len=db_file->blocks->offset[i_end]-offset;
   }
-  for (i=0;i<nlists;i++) { /* PLACE SUBLISTS W/ len<=div AFTERWARDS */
-    if (subheader[i].len<=div) {
-      memcpy(sub_pack+j,subheader+i,sizeof(SublistHeader));
-      sub_map[i]=j;
+  else {
+    offset=i_div;
+    offset*=db_file->div*sizeof(IntervalMap);
+    len=i_end-i_div;
+    len*=db_file->div*sizeof(IntervalMap);
+  }
+  advise_dbfile_range(db_file,offset,len,0);
+  return i_end;
+}
+
+
+
+
+
+
+/****************************************************************
+ *
+ *   SWEEP-LINE JOIN OF TWO NESTED LISTS
+ */
+
+
+/* TRUE IF THE NEXT INTERVAL OF LIST x SORTS BEFORE THAT OF LIST y */
+int nested_list_walk_less(IntervalIterator *x,IntervalIterator *y)
+{
+  return imstart_qsort_cmp(x->im+x->i,y->im+y->i)<0;
+}
+
+
+void nested_list_walk_sift_down(NestedListWalk *w,int i)
+{
+  int j;
+  IntervalIterator *it=w->heap[i];
+  while ((j=2*i+1)<w->nheap) {
+    if (j+1<w->nheap && nested_list_walk_less(w->heap[j+1],w->heap[j]))
       j++;
-    }
+    if (!nested_list_walk_less(w->heap[j],it))
+      break;
+    w->heap[i]=w->heap[j];
+    i=j;
   }
-  for (i=0;i<n;i++) /* ADJUST im[].sublist TO THE NEW LOCATIONS */
-    if (im[i].sublist>=0)
-      im[i].sublist=sub_map[im[i].sublist];
-  memcpy(subheader,sub_pack,nlists*sizeof(SublistHeader)); /* SAVE REORDERED LIST*/
+  w->heap[i]=it;
+}
 
-  FREE(sub_map);
-  FREE(sub_pack);
+
+void nested_list_walk_sift_up(NestedListWalk *w,int i)
+{
+  int j;
+  IntervalIterator *it=w->heap[i];
+  while (i>0 && nested_list_walk_less(it,w->heap[j=(i-1)/2])) {
+    w->heap[i]=w->heap[j];
+    i=j;
+  }
+  w->heap[i]=it;
+}
+
+
+/* START READING LIST isub (-1 FOR THE TOP LEVEL) OF w, IN PLACE: AN
+   ON-DISK LIST BLOCK BY BLOCK, JUST AS A QUERY READS IT.  RETURNS -1 ON
+   A MEMORY OR READ ERROR */
+int nested_list_walk_open(NestedListWalk *w,IntervalInt isub)
+{
+  IntervalIterator *it=NULL,**new_heap;
+  IntervalDBFile *db=w->db_file;
+  if (w->spare) { /* REUSE AN ITERATOR, AND ITS BLOCK BUFFER */
+    it=w->spare;
+    w->spare=it->down;
+    it->down=NULL;
+  }
+  else {
+    CALLOC(it,1,IntervalIterator);
+  }
+  if (db) {
+    it->n=0;
+    if (find_file_start(it,w->sh_it,-C_int_max,C_int_max,isub,db->ii,db->nii,
+			db->subheader,db->nlists,&(db->subheader_file),
+			db->ntop,db->div,db->ifile_idb,db->isize,db->im_map,
+			db->blocks,db->cache)==FIND_FILE_MALLOC_ERR)
+      goto handle_malloc_failure;
+  }
+  else { /* IN-MEMORY LISTS ARE JUST SLICES OF im */
+    if (isub<0) {
+      it->im=w->im;
+      it->n=w->ntop;
+    }
+    else {
+      it->im=w->im+w->subheader[isub].start;
+      it->n=w->subheader[isub].len;
+    }
+    it->i=0;
+    it->i_div=0;
+    it->nii=1; /* NO MORE BLOCKS TO READ */
+  }
+  if (it->i<0 || it->i>=it->n) { /* EMPTY */
+    it->down=w->spare;
+    w->spare=it;
+    return 0;
+  }
+  if (w->nheap>=w->maxheap) {
+    new_heap=(IntervalIterator **)realloc(w->heap,2*w->maxheap
+					  *sizeof(IntervalIterator *));
+    if (!new_heap)
+      goto handle_malloc_failure;
+    w->heap=new_heap;
+    w->maxheap*=2;
+  }
+  w->heap[w->nheap]=it;
+  nested_list_walk_sift_up(w,w->nheap++);
   return 0;
  handle_malloc_failure:
+  if (it)
+    free_interval_iterator(it);
   return -1;
 }
 
 
-int write_binary_index(IntervalMap im[],int n,int div,FILE *ifile)
+/* READ THE INTERVALS OF A NESTED LIST IN start ORDER, WITHOUT COPYING OR
+   SORTING IT: EITHER THE IN-MEMORY LIST im[], OR THE ON-DISK db_file (IF
+   NOT NULL), WHICH WE HOLD A REFERENCE TO UNTIL free_nested_list_walk().
+   EACH INTERVAL IS READ ONCE.  SINCE A SUBLIST LIES INSIDE ITS PARENT
+   INTERVAL, ONLY THE SUBLISTS OF INTERVALS OPEN AT THE CURRENT POSITION
+   ARE BEING READ AT ONCE, MERGED BY A SMALL HEAP */
+NestedListWalk *nested_list_walk_alloc(IntervalMap im[],IntervalInt ntop,
+				       SublistHeader subheader[],
+				       IntervalInt nlists,
+				       IntervalDBFile *db_file)
 {
-  int i,j,nsave=0;
-  for (i=0;i<n;i+=div) {
-#ifdef MERGE_INTERVAL_ORIENTATIONS
-    if (im[i].start>=0) /* FORWARD ORI */
-#endif
-      fwrite(&(im[i].start),sizeof(int),1,ifile);  /*SAVE start */
-#ifdef MERGE_INTERVAL_ORIENTATIONS
-    else { /* REVERSE ORI */
-      j= - im[i].end;
-      fwrite(&j,sizeof(int),1,ifile);  /*SAVE start */
+  NestedListWalk *w=NULL;
+  CALLOC(w,1,NestedListWalk);
+  w->im=im;
+  w->ntop=ntop;
+  w->subheader=subheader;
+  w->nlists=nlists;
+  w->db_file=acquire_interval_dbfile(db_file);
+  CALLOC(w->sh_it,1,IntervalIterator);
+  w->maxheap=16;
+  CALLOC(w->heap,w->maxheap,IntervalIterator *);
+  if (nested_list_walk_open(w,-1)<0)
+    goto handle_malloc_failure;
+  return w;
+ handle_malloc_failure:
+  if (w)
+    free_nested_list_walk(w);
+  return NULL;
+}
+
+
+/* COPY THE NEXT INTERVAL IN start ORDER TO im.  RETURNS 1 IF AN INTERVAL
+   WAS COPIED, 0 WHEN THE LIST IS FINISHED, -1 ON A MEMORY OR READ ERROR */
+int nested_list_walk_next(NestedListWalk *w,IntervalMap *im)
+{
+  IntervalIterator *it;
+  IntervalDBFile *db=w->db_file;
+  if (w->nheap==0)
+    return 0;
+  it=w->heap[0];
+  *im=it->im[it->i];
+  if (++it->i>=it->n) { /* END OF THIS BLOCK */
+    it->i_div++;
+    if (it->i_div<it->nii) { /* READ THE NEXT BLOCK OF A BIG LIST */
+      if ((it->n=load_imdiv(it,db->ifile_idb,db->isize,db->im_map,db->blocks,
+			    db->cache,db->div,it->i_div,it->ntop))<0)
+	return -1;
+      it->i=0;
     }
-#endif
-    j=i+div-1;
-    if (j>=n)
-      j=n-1;
-#ifdef MERGE_INTERVAL_ORIENTATIONS
-    if (im[j].start>=0)  /* FORWARD ORI */
-#endif
-      fwrite(&(im[j].end),sizeof(int),1,ifile);  /*SAVE end */
-#ifdef MERGE_INTERVAL_ORIENTATIONS
-    else { /* REVERSE ORI */
-      j= - im[j].start;
-      fwrite(&j,sizeof(int),1,ifile);  /*SAVE end */
+    else { /* THIS LIST IS FINISHED */
+      w->heap[0]=w->heap[--w->nheap];
+      it->down=w->spare;
+      w->spare=it;
     }
-#endif
-    nsave++;
   }
-  return nsave;
+  if (w->nheap>0)
+    nested_list_walk_sift_down(w,0);
+  if (im->sublist>=0 && nested_list_walk_open(w,im->sublist)<0)
+    return -1; /* ITS SUBLIST STARTS AT OR AFTER im, SO READ IT NEXT */
+  return 1;
 }
 
 
+int free_nested_list_walk(NestedListWalk *w)
+{
+  int i;
+  IntervalIterator *it;
+  for (i=0;i<w->nheap;i++)
+    free_interval_iterator(w->heap[i]);
+  while (w->spare) {
+    it=w->spare;
+    w->spare=it->down;
+    it->down=NULL;
+    free_interval_iterator(it);
+  }
+  free_interval_iterator(w->sh_it);
+  FREE(w->heap);
+  free_interval_dbfile(w->db_file);
+  free(w);
+  return 0;
+}
+
 
-char *write_binary_files(IntervalMap im[],int n,int ntop,int div,
-			 SublistHeader *subheader,int nlists,char filestem[])
+/* START A JOIN OF THE NESTED LISTS a AND b, WHICH IT TAKES OVER */
+IntervalJoin *interval_join_alloc(NestedListWalk *a,NestedListWalk *b)
 {
-  int i,npad=0,nii;
-  char path[2048];
-  FILE *ifile=NULL,*ifile_subheader=NULL;
-  SublistHeader sh_tmp;
-  static char err_msg[1024];
+  IntervalJoin *ij=NULL;
+  CALLOC(ij,1,IntervalJoin);
+  ij->a=a;
+  ij->b=b;
+  ij->maxactive_a=ij->maxactive_b=64; /* GROWN AS NEEDED */
+  CALLOC(ij->active_a,ij->maxactive_a,IntervalMap);
+  CALLOC(ij->active_b,ij->maxactive_b,IntervalMap);
+  if ((ij->has_a=nested_list_walk_next(a,&ij->next_a))<0
+      || (ij->has_b=nested_list_walk_next(b,&ij->next_b))<0)
+    goto handle_malloc_failure;
+  return ij;
+ handle_malloc_failure:
+  if (ij) {
+    ij->a=ij->b=NULL; /* CALLER STILL OWNS a, b */
+    free_interval_join(ij);
+  }
+  return NULL;
+}
 
-  if (nlists>0  /* REPACK SMALL SUBLISTS TO END */
-      && repack_subheaders(im,n,div,subheader,nlists)
-      == FIND_FILE_MALLOC_ERR) {
-    sprintf(err_msg,"unable to malloc %d subheaders",nlists);
-    return err_msg;
+
+/* ADD iv TO THE OPEN INTERVALS active[0..*p_n-1], GROWING IT IF NEEDED */
+int interval_join_activate(IntervalMap **p_active,IntervalInt *p_n,
+			   IntervalInt *p_max,IntervalMap *iv)
+{
+  IntervalMap *new_active;
+  if (*p_n>=*p_max) {
+    new_active=(IntervalMap *)realloc(*p_active,2*(*p_max)*sizeof(IntervalMap));
+    if (!new_active)
+      return -1;
+    *p_active=new_active;
+    *p_max*=2;
+  }
+  (*p_active)[(*p_n)++]= *iv;
+  return 0;
+}
+
+
+/* SAVE UP TO nbuf MORE OVERLAPPING PAIRS (buf_a[k],buf_b[k]).  RETURNS
+   THE NUMBER SAVED, 0 WHEN THE JOIN IS FINISHED, -1 ON A MEMORY OR READ
+   ERROR.  BOTH LISTS ARE READ ONCE IN start ORDER; EACH INTERVAL IS
+   COMPARED ONLY WITH THE INTERVALS OF THE OTHER LIST STILL OPEN WHEN THE
+   SWEEP REACHES IT, AND EACH EXPIRED INTERVAL IS DROPPED ONCE, SO THE
+   COST IS O(na+nb+#PAIRS), PLUS THE HEAP OF OPEN SUBLISTS OF EACH LIST */
+int interval_join_next(IntervalJoin *ij,IntervalMap buf_a[],
+		       IntervalMap buf_b[],int nbuf)
+{
+  int ibuf=0;
+  IntervalInt *p_nactive;
+  IntervalMap *iv,*other;
+  while (ibuf<nbuf) {
+    if (ij->emit_from) { /* COMPARE CURRENT INTERVAL WITH OPEN INTERVALS */
+      iv= &(ij->emit);
+      if (ij->emit_from==1) {
+	other=ij->active_b;
+	p_nactive= &(ij->nactive_b);
+      }
+      else {
+	other=ij->active_a;
+	p_nactive= &(ij->nactive_a);
+      }
+      while (ij->emit_k < *p_nactive && ibuf<nbuf) {
+	if (END_POSITIVE(other[ij->emit_k])<=START_POSITIVE(*iv)) { /* EXPIRED */
+	  other[ij->emit_k]=other[--(*p_nactive)]; /* SO DROP IT */
+	  continue;
+	}
+	if (HAS_OVERLAP_POSITIVE(other[ij->emit_k],START_POSITIVE(*iv),
+				 END_POSITIVE(*iv))) {
+	  if (ij->emit_from==1) { /* SAVE THE PAIR, a FIRST */
+	    buf_a[ibuf]= *iv;
+	    buf_b[ibuf]=other[ij->emit_k];
+	  }
+	  else {
+	    buf_a[ibuf]=other[ij->emit_k];
+	    buf_b[ibuf]= *iv;
+	  }
+	  ibuf++;
+	}
+	ij->emit_k++;
+      }
+      if (ij->emit_k < *p_nactive) /* BUFFER FULL: RESUME HERE NEXT TIME */
+	break;
+      if (ij->emit_from==1) { /* NOW iv IS OPEN, FOR LATER b INTERVALS */
+	if (ij->has_b && interval_join_activate(&ij->active_a,&ij->nactive_a,
+						&ij->maxactive_a,iv)<0)
+	  return -1;
+      }
+      else if (ij->has_a && interval_join_activate(&ij->active_b,
+						   &ij->nactive_b,
+						   &ij->maxactive_b,iv)<0)
+	return -1;
+      ij->emit_from=0;
+    }
+    if ((!ij->has_a && ij->nactive_a==0) /* NOTHING LEFT TO PAIR */
+	|| (!ij->has_b && ij->nactive_b==0)
+	|| (!ij->has_a && !ij->has_b))
+      break;
+    if (ij->has_a && (!ij->has_b /* TAKE WHICHEVER STARTS FIRST */
+		      || imstart_qsort_cmp(&ij->next_a,&ij->next_b)<=0)) {
+      ij->emit_from=1;
+      ij->emit=ij->next_a;
+      if ((ij->has_a=nested_list_walk_next(ij->a,&ij->next_a))<0)
+	return -1;
+    }
+    else {
+      ij->emit_from=2;
+      ij->emit=ij->next_b;
+      if ((ij->has_b=nested_list_walk_next(ij->b,&ij->next_b))<0)
+	return -1;
+    }
+    ij->emit_k=0;
+  }
+  return ibuf;
+}
+
+
+int free_interval_join(IntervalJoin *ij)
+{
+  if (ij->a)
+    free_nested_list_walk(ij->a);
+  if (ij->b)
+    free_nested_list_walk(ij->b);
+  FREE(ij->active_a);
+  FREE(ij->active_b);
+  free(ij);
+  return 0;
+}
+
+
+
+
+/* GROUP-BY OPERATIONS FOR NLMSASlice.groupByIntervals, groupBySequences */
+
+int target_order_qsort_cmp(const void *void_a,const void *void_b)
+{ /* SORT IN target_id ORDER, SECONDARILY BY ORIGINAL ORDER SAVED IN sublist */
+  IntervalMap *a=(IntervalMap *)void_a,*b=(IntervalMap *)void_b;
+  if (a->target_id<b->target_id)
+    return -1;
+  else if (a->target_id>b->target_id)
+    return 1;
+  else if (a->sublist<b->sublist)
+    return -1;
+  else if (a->sublist>b->sublist)
+    return 1;
+  else
+    return 0;
+}
+
+
+int seqbound_qsort_cmp(const void *void_a,const void *void_b)
+{ /* SORT BY POSITION, stop B4 start, THEN SEQ ORDER, INDEL, INTERVAL COORDS */
+  SeqBound *a=(SeqBound *)void_a,*b=(SeqBound *)void_b;
+  if (a->ipos!=b->ipos)
+    return (a->ipos<b->ipos) ? -1 : 1;
+  if (a->is_start!=b->is_start)
+    return (a->is_start<b->is_start) ? -1 : 1;
+  if (a->iseq!=b->iseq)
+    return (a->iseq<b->iseq) ? -1 : 1;
+  if (a->is_indel!=b->is_indel)
+    return (a->is_indel<b->is_indel) ? -1 : 1;
+  if (a->start!=b->start)
+    return (a->start<b->start) ? -1 : 1;
+  if (a->end!=b->end)
+    return (a->end<b->end) ? -1 : 1;
+  if (a->target_start!=b->target_start)
+    return (a->target_start<b->target_start) ? -1 : 1;
+  if (a->target_end!=b->target_end)
+    return (a->target_end<b->target_end) ? -1 : 1;
+  if (a->ival!=b->ival) /* KEEP ORIGINAL ORDER OF IDENTICAL INTERVALS */
+    return (a->ival<b->ival) ? -1 : 1;
+  return 0;
+}
+
+
+int merge_aligned_intervals(IntervalMap im[],int n,int maxgap,
+			    int maxinsert,int mininsert,
+			    long long maxsize,int merge_all,
+			    IntervalMap ival[],int sub_start[],int sub_count[])
+{ /* MERGE ONE TARGET'S INTERVALS im[0..n-1] IN PLACE BY INDEL LENGTH RULES,
+     RETURNING THE NUMBER OF MERGED INTERVALS.  THE 1:1 INTERVALS OF MERGED
+     INTERVAL k ARE SAVED AS ival[sub_start[k]] .. ival[sub_start[k]+
+     sub_count[k]-1], FUSING THOSE WITH NO GAP; sub_count[k]==0 IF NONE
+     NEEDED.  ival MUST HAVE ROOM FOR n INTERVALS */
+  int j,k=0,nival=0;
+  IntervalInt gap,insert;
+  IntervalMap *last;
+  if (n<=0)
+    return 0;
+  sub_start[0]=0;
+  sub_count[0]=0;
+  for (j=1;j<n;j++) {
+    gap=im[j].start-im[k].end; /* current.start - last.end */
+    insert=im[j].target_start-im[k].target_end;
+    if (!merge_all &&
+	(gap>maxgap || insert>maxinsert || insert<mininsert
+	 || (long long)im[j].end-im[k].start>maxsize
+	 || (long long)im[j].target_end-im[k].target_start>maxsize)) {
+      k++; /* SPLIT, SO START A NEW INTERVAL */
+      if (k<j) { /* COPY START COORDS TO NEW SLOT */
+	im[k].start=im[j].start;
+	im[k].target_start=im[j].target_start;
+      }
+      sub_start[k]=nival;
+      sub_count[k]=0;
+    }
+    else if (sub_count[k]==0) { /* FIRST MERGE: CREATE 1:1 INTERVAL LIST */
+      ival[nival]=im[k];
+      if (im[k].end==im[j].start && im[k].target_end==im[j].target_start) {
+	ival[nival].end=im[j].end; /* NO GAP, SO FUSE THEM */
+	ival[nival].target_end=im[j].target_end;
+	sub_count[k]=1;
+      }
+      else { /* TWO SEPARATE 1:1 INTERVALS */
+	ival[nival+1]=im[j];
+	sub_count[k]=2;
+      }
+      nival+=sub_count[k];
+    }
+    else { /* SEE IF WE CAN FUSE TO LAST 1:1 INTERVAL */
+      last=ival+nival-1;
+      if (last->end==im[j].start && last->target_end==im[j].target_start) {
+	last->end=im[j].end;
+	last->target_end=im[j].target_end;
+      }
+      else { /* GAP, SO JUST APPEND THIS 1:1 INTERVAL */
+	ival[nival++]=im[j];
+	sub_count[k]++;
+      }
+    }
+    if (k<j) { /* COPY END COORDS TO CURRENT SLOT */
+      im[k].end=im[j].end;
+      im[k].target_end=im[j].target_end;
+    }
+  }
+  for (j=0;j<=k;j++) /* CULL SINGLETON 1:1 INTERVAL LISTS (DUE TO FUSION) */
+    if (sub_count[j]==1)
+      sub_count[j]=0;
+  return k+1;
+}
+
+
+int group_seq_bounds(SeqBound b[],int n,int nseq,int count[],
+		     double min_aligned,double p_min_aligned,
+		     int source_only,int indel_cut,IntervalMap out[],
+		     int *p_ibad)
+{ /* SWEEP SORTED BOUNDS b[0..n-1], MASKING REGIONS WHERE FEWER THAN
+     min_aligned (OR FRACTION p_min_aligned OF nseq) SEQS ARE ALIGNED.
+     count[] (ZEROED) TRACKS OPEN INTERVALS PER islot.  SAVES TARGET
+     INTERVALS AS out[].target_id=ival (sublist=1 IF ITS START WAS CLIPPED),
+     OR IF source_only, SOURCE INTERVALS WITH target_id= -1.  out MUST HAVE
+     ROOM FOR 2n.  RETURNS #out, OR -1 IF b[*p_ibad] STOPS AN UNOPENED SEQ.
+     CALLER MUST USE source_only IF MASKING CAN CUT OPEN TARGET INTERVALS */
+  int i,nopen=0,nout=0,has_mask=0;
+  IntervalInt mask_start=0,end=0;
+  float f;
+  for (i=0;i<n;i++) {
+    if (b[i].is_start) { /* INTERVAL START */
+      if (count[b[i].islot]++ == 0)
+	nopen++;
+    }
+    else { /* INTERVAL STOP */
+      end=b[i].end;
+      if (has_mask && !source_only) { /* SAVE TARGET IVAL */
+	out[nout].target_id=b[i].ival;
+	out[nout].end=b[i].end;
+	out[nout].target_end=b[i].target_end;
+	if (mask_start>b[i].start) { /* TRUNCATE TARGET IVAL START */
+	  out[nout].start=mask_start;
+	  out[nout].target_start=b[i].target_start+mask_start-b[i].start;
+	  out[nout].sublist=1;
+	}
+	else {
+	  out[nout].start=b[i].start;
+	  out[nout].target_start=b[i].target_start;
+	  out[nout].sublist=0;
+	}
+	nout++;
+      }
+      if (count[b[i].islot]==0) { /* NO MATCHING START! */
+	*p_ibad=i;
+	return -1;
+      }
+      if (--count[b[i].islot] == 0)
+	nopen--;
+    }
+    f=nopen; /* #ALIGNED SEQS IN THIS REGION */
+    if (f<min_aligned || f/nseq<p_min_aligned) { /* APPLY MASKING */
+      if (has_mask && source_only) { /* SAVE MERGED SOURCE INTERVAL */
+	out[nout].target_id= -1;
+	out[nout].start=mask_start;
+	out[nout].end=end;
+	nout++;
+      }
+      has_mask=0; /* REGION NOW BELOW THRESHOLD */
+    }
+    else if (!has_mask) { /* START OF REGION ABOVE THRESHOLD */
+      has_mask=1;
+      mask_start=b[i].ipos;
+    }
+    if (has_mask && source_only && indel_cut && b[i].is_indel
+	&& mask_start<b[i].ipos) {
+      out[nout].target_id= -1;
+      out[nout].start=mask_start;
+      out[nout].end=b[i].ipos;
+      nout++;
+      mask_start=b[i].ipos;
+    }
+  }
+  return nout;
+}
+
+
+
+
+
+
+/* FUNCTIONS FOR READING AND WRITING OF THE BINARY DATABASE FILES */
+
+IntervalInt write_padded_binary(IntervalMap im[],IntervalInt n,int div,
+				FILE *ifile)
+{
+  IntervalInt i,npad;
+  fwrite(im,sizeof(IntervalMap),n,ifile); /* SAVE THE ACTUAL DATA */
+  npad=n%div;
+  if (npad) {
+    npad=div-npad; /* #ITEMS NEEDED TO PAD TO AN EXACT MULTIPLE OF div */
+    for (i=0;i<npad;i++) /* GUARANTEED im HAS AT LEAST ONE RECORD */
+      fwrite(im,sizeof(IntervalMap),1,ifile); /*THIS IS JUST PADDING */
+  }
+  return n+npad; /* #RECORDS SAVED */
+}
+
+
+int repack_subheaders(IntervalMap im[],IntervalInt n,int div,
+		      SublistHeader *subheader,IntervalInt nlists)
+{
+  IntervalInt i,j,*sub_map=NULL;
+  SublistHeader *sub_pack=NULL;
+
+  CALLOC(sub_map,nlists,IntervalInt);
+  CALLOC(sub_pack,nlists,SublistHeader);
+  for (i=j=0;i<nlists;i++) { /* PLACE SUBLISTS W/ len>div AT FRONT */
+    if (subheader[i].len>div) {
+      memcpy(sub_pack+j,subheader+i,sizeof(SublistHeader));
+      sub_map[i]=j;
+      j++;
+    }
+  }
+  for (i=0;i<nlists;i++) { /* PLACE SUBLISTS W/ len<=div AFTERWARDS */
+    if (subheader[i].len<=div) {
+      memcpy(sub_pack+j,subheader+i,sizeof(SublistHeader));
+      sub_map[i]=j;
+      j++;
+    }
+  }
+  for (i=0;i<n;i++) /* ADJUST im[].sublist TO THE NEW LOCATIONS */
+    if (im[i].sublist>=0)
+      im[i].sublist=sub_map[im[i].sublist];
+  memcpy(subheader,sub_pack,nlists*sizeof(SublistHeader)); /* SAVE REORDERED LIST*/
+
+  FREE(sub_map);
+  FREE(sub_pack);
+  return 0;
+ handle_malloc_failure:
+  return -1;
+}
+
+
+IntervalInt write_binary_index(IntervalMap im[],IntervalInt n,int div,
+			       FILE *ifile)
+{
+  IntervalInt i,j,nsave=0;
+  for (i=0;i<n;i+=div) {
+#ifdef MERGE_INTERVAL_ORIENTATIONS
+    if (im[i].start>=0) /* FORWARD ORI */
+#endif
+      fwrite(&(im[i].start),sizeof(IntervalInt),1,ifile);  /*SAVE start */
+#ifdef MERGE_INTERVAL_ORIENTATIONS
+    else { /* REVERSE ORI */
+      j= - im[i].end;
+      fwrite(&j,sizeof(IntervalInt),1,ifile);  /*SAVE start */
+    }
+#endif
+    j=i+div-1;
+    if (j>=n)
+      j=n-1;
+#ifdef MERGE_INTERVAL_ORIENTATIONS
+    if (im[j].start>=0)  /* FORWARD ORI */
+#endif
+      fwrite(&(im[j].end),sizeof(IntervalInt),1,ifile);  /*SAVE end */
+#ifdef MERGE_INTERVAL_ORIENTATIONS
+    else { /* REVERSE ORI */
+      j= - im[j].start;
+      fwrite(&j,sizeof(IntervalInt),1,ifile);  /*SAVE end */
+    }
+#endif
+    nsave++;
+  }
+  return nsave;
+}
+
+
+
+char *write_binary_files(IntervalMap im[],IntervalInt n,IntervalInt ntop,
+			 int div,SublistHeader *subheader,IntervalInt nlists,
+			 char filestem[])
+{
+  static char err_msg[1024]; /* NOT THREADSAFE: USE write_binary_files_r() */
+  return write_binary_files_r(im,n,ntop,div,subheader,nlists,filestem,err_msg);
+}
+
+
+/* REENTRANT VERSION: ERROR MESSAGE IS SAVED TO CALLER'S err_msg[1024] */
+char *write_binary_files_r(IntervalMap im[],IntervalInt n,IntervalInt ntop,
+			   int div,SublistHeader *subheader,IntervalInt nlists,
+			   char filestem[],char err_msg[])
+{
+  IntervalInt i,npad=0,nii;
+  char path[2048];
+  FILE *ifile=NULL,*ifile_subheader=NULL;
+  SublistHeader sh_tmp;
+
+  if (nlists>0  /* REPACK SMALL SUBLISTS TO END */
+      && repack_subheaders(im,n,div,subheader,nlists)
+      == FIND_FILE_MALLOC_ERR) {
+    sprintf(err_msg,"unable to malloc %lld subheaders",(long long)nlists);
+    return err_msg;
   }
   sprintf(path,"%s.subhead",filestem); /* SAVE THE SUBHEADER LIST */
   ifile_subheader=fopen(path,"wb"); /* binary file */
@@ -786,31 +1793,1091 @@ char *write_binary_files(IntervalMap im[],int n,int ntop,int div,
       npad+=subheader[i].len;
     }
   }
-  fclose(ifile);
-  fclose(ifile_subheader);
+  fclose(ifile);
+  fclose(ifile_subheader);
+
+  sprintf(path,"%s.index",filestem); /* SAVE THE COMPACTED INDEX */
+  ifile=fopen(path,"wb"); /* binary file */
+  if (!ifile) {
+    sprintf(err_msg,"unable to open file %s for writing",path);
+    return err_msg;
+  }
+  nii=write_binary_index(im,ntop,div,ifile);
+  for (i=0;i<nlists;i++) /* ALSO STORE INDEX DATA FOR BIG SUBLISTS */
+    if (subheader[i].len>div)
+      nii+=write_binary_index(im+subheader[i].start,subheader[i].len,div,ifile);
+  fclose(ifile);
+
+  if (write_binary_size(filestem,n,ntop,div,nlists,nii,
+			NCLIST_CODEC_NONE)<0) {
+    sprintf(err_msg,"unable to open file %s.size for writing",filestem);
+    return err_msg;
+  }
+
+  return NULL; /* RETURN CODE SIGNALS SUCCESS!! */
+}
+
+
+/* SAVE THE SIZE INFO FOR THE BINARY FILES.  VERSION 1 FILES (32 BIT
+   RECORDS, UNCOMPRESSED) HAVE NO HEADER LINE, SO OLDER PYGR CAN STILL READ
+   THEM; OTHERWISE A HEADER GIVES THE FORMAT VERSION, INTEGER SIZE AND
+   .idb BLOCK CODEC */
+int write_binary_size(char filestem[],IntervalInt n,IntervalInt ntop,int div,
+		      IntervalInt nlists,IntervalInt nii,int codec)
+{
+  char path[2048];
+  FILE *ifile;
+  sprintf(path,"%s.size",filestem); /* SAVE BASIC SIZE INFO*/
+  ifile=fopen(path,"w"); /* text file */
+  if (!ifile)
+    return -1;
+  if (sizeof(IntervalInt)!=sizeof(int) || codec!=NCLIST_CODEC_NONE)
+    fprintf(ifile,"%s %d %d %d\n",NCLIST_FORMAT_TAG,NCLIST_FORMAT_VERSION,
+	    (int)sizeof(IntervalInt),codec);
+  fprintf(ifile,INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT " %d "
+	  INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT "\n",
+	  n,ntop,div,nlists,nii);
+  if (fclose(ifile))
+    return -1;
+  return 0;
+}
+
+
+/* READ THE SIZE INFO SAVED BY write_binary_size(), CHECKING THAT WE CAN
+   READ THE BINARY FILES' INTEGER SIZE, SAVED IN *p_isize (A 64 BIT BUILD
+   WIDENS THE RECORDS OF A 32 BIT FILE AS IT READS THEM), AND THEIR CODEC.
+   RETURNS 0 ON SUCCESS, -1 WITH AN ERROR MESSAGE IN err_msg (IF NOT NULL) */
+int read_binary_size(char filestem[],char err_msg[],IntervalInt *p_n,
+		     IntervalInt *p_ntop,int *p_div,IntervalInt *p_nlists,
+		     IntervalInt *p_nii,int *p_codec,int *p_isize)
+{
+  int version=1,isize=(int)sizeof(int),ok;
+  char path[2048],tag[32];
+  FILE *ifile;
+  *p_codec=NCLIST_CODEC_NONE; /* DEFAULT FOR VERSIONS BEFORE 3 */
+  sprintf(path,"%s.size",filestem); /* READ BASIC SIZE INFO*/
+  ifile=fopen(path,"r"); /* text file */
+  if (!ifile) {
+    if (err_msg)
+      sprintf(err_msg,"unable to open file %s",path);
+    return -1;
+  }
+  if (1==fscanf(ifile," %31[A-Z_]",tag)) { /* VERSIONED FORMAT HEADER */
+    if (strcmp(tag,NCLIST_FORMAT_TAG) || 2!=fscanf(ifile,"%d %d",&version,&isize)
+	|| (version>=3 && 1!=fscanf(ifile,"%d",p_codec))) {
+      fclose(ifile);
+      if (err_msg)
+	sprintf(err_msg,"bad header in file %s",path);
+      return -1;
+    }
+  }
+  ok=(5==fscanf(ifile,INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT " %d "
+		INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT,
+		p_n,p_ntop,p_div,p_nlists,p_nii));
+  fclose(ifile);
+  if (version>NCLIST_FORMAT_VERSION) {
+    if (err_msg)
+      sprintf(err_msg,"%s is nested list format version %d, but this pygr"
+	      " only reads up to version %d.  Please upgrade pygr.",
+	      path,version,NCLIST_FORMAT_VERSION);
+    return -1;
+  }
+  if (isize>(int)sizeof(IntervalInt)) { /* CAN'T NARROW TO 32 BITS */
+    if (err_msg)
+      sprintf(err_msg,"%s was built with %d bit intervals, but this pygr uses"
+	      " %d bit intervals.  Rebuild pygr with PYGR_64BIT_INTERVALS, or"
+	      " convert the files using dump_textfile() / textfile_to_binaries().",
+	      path,8*isize,8*(int)sizeof(IntervalInt));
+    return -1;
+  }
+  if (isize!=(int)sizeof(int) && isize!=(int)sizeof(IntervalInt)) {
+    if (err_msg)
+      sprintf(err_msg,"%s has unknown integer size %d",path,isize);
+    return -1;
+  }
+  if (*p_codec!=NCLIST_CODEC_NONE && *p_codec!=NCLIST_CODEC_VARINT) {
+    if (err_msg)
+      sprintf(err_msg,"%s uses unknown block codec %d.  Please upgrade pygr.",
+	      path,*p_codec);
+    return -1;
+  }
+  if (!ok) {
+    if (err_msg)
+      sprintf(err_msg,"unable to read sizes from file %s",path);
+    return -1;
+  }
+  *p_isize=isize;
+  return 0;
+}
+
+
+
+/****************************************************************
+ *
+ *   COMPRESSED .idb: EACH BLOCK OF UP TO div RECORDS IS SAVED AS ITS
+ *   RECORD COUNT FOLLOWED BY ZIGZAG VARINT DELTAS OF EACH FIELD, SO
+ *   SORTED INTERVALS WITH SHORT GAPS AND REPEATED target_id TAKE A FEW
+ *   BYTES EACH.  BLOCKS ARE NUMBERED BY RECORD POSITION / div, SO THE
+ *   IntervalIndex ii[] STILL LOCATES EACH BLOCK OF THE TOP LEVEL LIST
+ *   AND BIG SUBLISTS, AND filestem.blocks GIVES ITS BYTE OFFSET
+ */
+
+/* DIFFERENCES ARE TAKEN MODULO 2^64 AND ZIGZAG ENCODED, SO SMALL
+   NEGATIVE DELTAS ALSO GIVE SHORT VARINTS */
+#define VARINT_DIFF(A,B) ((unsigned long long)(A)-(unsigned long long)(B))
+#define ZIGZAG_ENCODE(D) ((D)>>63 ? ~((D)<<1) : (D)<<1)
+#define ZIGZAG_DECODE(Z) ((Z)&1 ? ~((Z)>>1) : (Z)>>1)
+
+
+/* SAVE x AS A BASE 128 VARINT, LOW BITS FIRST.  RETURNS #BYTES USED */
+int put_varint(unsigned char buf[],unsigned long long x)
+{
+  int i=0;
+  while (x>=0x80) {
+    buf[i++]=(unsigned char)(x|0x80);
+    x>>=7;
+  }
+  buf[i++]=(unsigned char)x;
+  return i;
+}
+
+
+/* READ A VARINT STARTING AT buf[*p_i], NEVER PAST buf[nbytes-1].
+   RETURNS 0 ON SUCCESS, -1 IF THE VARINT IS TRUNCATED */
+int get_varint(unsigned char buf[],size_t nbytes,size_t *p_i,
+	       unsigned long long *p_x)
+{
+  unsigned long long x=0;
+  int shift=0;
+  size_t i= *p_i;
+  do {
+    if (i>=nbytes || shift>63)
+      return -1;
+    x|=(unsigned long long)(buf[i]&0x7f)<<shift;
+    shift+=7;
+  } while (buf[i++]&0x80);
+  *p_i=i;
+  *p_x=x;
+  return 0;
+}
+
+
+/* ENCODE im[0..n-1] INTO buf, WHICH MUST HOLD NCLIST_BLOCK_MAXBYTES(n)
+   BYTES.  RETURNS #BYTES USED */
+int encode_interval_block(IntervalMap im[],int n,unsigned char buf[])
+{
+  int i,nbytes;
+  unsigned long long d,prev_start=0,prev_id=0,prev_offset=0,last_sub=0;
+  nbytes=put_varint(buf,n);
+  for (i=0;i<n;i++) {
+    d=VARINT_DIFF(im[i].start,prev_start); /* GAP FROM LAST start */
+    nbytes+=put_varint(buf+nbytes,ZIGZAG_ENCODE(d));
+    prev_start=im[i].start;
+    d=VARINT_DIFF(im[i].end,im[i].start); /* LENGTH */
+    nbytes+=put_varint(buf+nbytes,ZIGZAG_ENCODE(d));
+    d=VARINT_DIFF(im[i].target_id,prev_id); /* USUALLY 0 */
+    nbytes+=put_varint(buf+nbytes,ZIGZAG_ENCODE(d));
+    prev_id=im[i].target_id;
+    d=VARINT_DIFF(im[i].target_start,im[i].start); /* TARGET OFFSET... */
+    nbytes+=put_varint(buf+nbytes,ZIGZAG_ENCODE(d-prev_offset)); /* CHANGE */
+    prev_offset=d;
+    d=VARINT_DIFF(im[i].target_end,im[i].target_start) /* TARGET LENGTH */
+      -VARINT_DIFF(im[i].end,im[i].start); /* USUALLY SAME AS LENGTH */
+    nbytes+=put_varint(buf+nbytes,ZIGZAG_ENCODE(d));
+    if (im[i].sublist== -1) /* NO SUBLIST: 0 */
+      nbytes+=put_varint(buf+nbytes,0);
+    else { /* OTHERWISE 1 + CHANGE FROM THE LAST SUBLIST IN THIS BLOCK */
+      d=VARINT_DIFF(im[i].sublist,last_sub);
+      nbytes+=put_varint(buf+nbytes,ZIGZAG_ENCODE(d)+1);
+      last_sub=im[i].sublist;
+    }
+  }
+  return nbytes;
+}
+
+
+/* DECODE A BLOCK SAVED BY encode_interval_block() INTO im[div].
+   RETURNS #RECORDS, OR -1 IF THE BLOCK IS CORRUPTED */
+int decode_interval_block(unsigned char buf[],size_t nbytes,
+			  IntervalMap im[],int div)
+{
+  int i,j;
+  size_t ibyte=0;
+  unsigned long long n,z[6],start=0,id=0,offset=0,last_sub=0,len;
+  if (get_varint(buf,nbytes,&ibyte,&n) || n>(unsigned long long)div)
+    return -1;
+  for (i=0;i<(int)n;i++) {
+    for (j=0;j<6;j++)
+      if (get_varint(buf,nbytes,&ibyte,z+j))
+	return -1;
+    start+=ZIGZAG_DECODE(z[0]);
+    len=ZIGZAG_DECODE(z[1]);
+    id+=ZIGZAG_DECODE(z[2]);
+    offset+=ZIGZAG_DECODE(z[3]);
+    im[i].start=(IntervalInt)start;
+    im[i].end=(IntervalInt)(start+len);
+    im[i].target_id=(IntervalInt)id;
+    im[i].target_start=(IntervalInt)(start+offset);
+    im[i].target_end=(IntervalInt)(start+offset+len+ZIGZAG_DECODE(z[4]));
+    if (z[5]) {
+      last_sub+=ZIGZAG_DECODE(z[5]-1);
+      im[i].sublist=(IntervalInt)last_sub;
+    }
+    else
+      im[i].sublist= -1;
+  }
+  return (int)n;
+}
+
+
+/* READ AND DECODE BLOCK iblock OF A COMPRESSED .idb INTO im_buf[div],
+   DIRECTLY FROM THE MAPPED FILE IF AVAILABLE, OTHERWISE VIA *p_zbuf,
+   WHICH IS GROWN AS NEEDED.  RETURNS #RECORDS IN THE BLOCK, OR -1 WITH
+   AN IOError / MemoryError SET */
+int load_compressed_block(FILE *ifile,CompressedBlocks *blocks,int div,
+			  IntervalInt iblock,IntervalMap im_buf[],
+			  unsigned char **p_zbuf,size_t *p_zbuf_size)
+{
+  int n= -1;
+  size_t nbytes=0;
+  unsigned char *zbuf;
+  if (iblock>=0 && iblock<blocks->nblock
+      && blocks->offset[iblock]<=blocks->offset[iblock+1])
+    nbytes=(size_t)(blocks->offset[iblock+1]-blocks->offset[iblock]);
+  if (nbytes==0)
+    ; /* NO SUCH BLOCK */
+  else if (blocks->map) { /* NO I/O NEEDED */
+    if (blocks->offset[iblock+1]<=(long long)blocks->map_size)
+      n=decode_interval_block(blocks->map+blocks->offset[iblock],nbytes,
+			      im_buf,div);
+  }
+  else {
+    if (nbytes>*p_zbuf_size) { /* GROW OUR READ BUFFER */
+      zbuf= *p_zbuf;
+      REALLOC(zbuf,nbytes,unsigned char);
+      *p_zbuf=zbuf;
+      *p_zbuf_size=nbytes;
+    }
+    if (read_file_at(ifile,*p_zbuf,1,nbytes,blocks->offset[iblock])==nbytes)
+      n=decode_interval_block(*p_zbuf,nbytes,im_buf,div);
+  }
+  if (n<0)
+    PYGR_SET_IO_ERROR("compressed nested list block corrupted?");
+  return n;
+ handle_malloc_failure:
+  return -1;
+}
+
+
+/* ENCODE blk[0..nblk-1] AS THE NEXT BLOCK OF ofile, AND SAVE THE OFFSET
+   WHERE IT ENDS TO blocks_file.  RETURNS 0 ON SUCCESS, -1 ON ERROR */
+int write_compressed_block(IntervalMap blk[],int nblk,unsigned char zbuf[],
+			   FILE *ofile,FILE *blocks_file,long long *p_offset)
+{
+  int nbytes;
+  nbytes=encode_interval_block(blk,nblk,zbuf);
+  if (fwrite(zbuf,1,nbytes,ofile)!=(size_t)nbytes)
+    return -1;
+  *p_offset+=nbytes;
+  if (fwrite(p_offset,sizeof(long long),1,blocks_file)!=1)
+    return -1;
+  return 0;
+}
+
+
+/* REWRITE THE .idb OF AN UNCOMPRESSED DATABASE filestem AS COMPRESSED
+   BLOCKS, SAVING THE BLOCK OFFSETS AS filestem.blocks.  THE TOP LEVEL
+   LIST AND BIG SUBLISTS KEEP THEIR RECORD POSITIONS, SO .index IS
+   UNCHANGED; SMALL SUBLISTS ARE MOVED SO THAT NONE CROSSES A BLOCK
+   BOUNDARY, AND .subhead IS UPDATED TO MATCH.  PADDING IS NOT STORED.
+   FILES SAVED BY A 32 BIT BUILD ARE ALSO WIDENED TO OUR IntervalInt.
+   RETURNS NULL ON SUCCESS, OR AN ERROR MESSAGE SAVED IN err_msg[1024] */
+char *compress_binary_files(char filestem[],char err_msg[])
+{
+  IntervalInt i,j,k,n,ntop,nlists,nii,nblock=0;
+  int div,codec,isize,nblk=0;
+  long long offset=0,nblock_save;
+  char path[2048],tmp_path[2048],*result=err_msg;
+  IntervalMap *blk=NULL;
+  IntervalIndex *ii=NULL;
+  unsigned char *zbuf=NULL;
+  SublistHeader sh;
+  FILE *idb_file=NULL,*subheader_file=NULL,*blocks_file=NULL;
+  FILE *out_idb=NULL,*out_subheader=NULL,*ifile;
+
+  err_msg[0]='\0';
+  if (read_binary_size(filestem,err_msg,&n,&ntop,&div,&nlists,&nii,&codec,
+		       &isize)<0)
+    return err_msg;
+  if (codec!=NCLIST_CODEC_NONE) /* ALREADY COMPRESSED, NOTHING TO DO */
+    return NULL;
+
+  CALLOC(blk,div,IntervalMap);
+  CALLOC(zbuf,NCLIST_BLOCK_MAXBYTES(div),unsigned char);
+  sprintf(path,"%s.idb",filestem);
+  if (!(idb_file=fopen(path,"rb"))) /* binary file */
+    goto unable_to_open_file;
+  if (nlists>0) {
+    sprintf(path,"%s.subhead",filestem);
+    if (!(subheader_file=fopen(path,"rb"))) /* binary file */
+      goto unable_to_open_file;
+    sprintf(path,"%s.subhead.tmp",filestem);
+    if (!(out_subheader=fopen(path,"wb"))) /* binary file */
+      goto unable_to_open_file;
+  }
+  sprintf(path,"%s.idb.tmp",filestem);
+  if (!(out_idb=fopen(path,"wb"))) /* binary file */
+    goto unable_to_open_file;
+  sprintf(path,"%s.blocks",filestem);
+  if (!(blocks_file=fopen(path,"w+b"))) /* binary file */
+    goto unable_to_open_file;
+  nblock_save=0; /* FILLED IN AT THE END: #BLOCKS, THEN THEIR OFFSETS */
+  if (fwrite(&nblock_save,sizeof(long long),1,blocks_file)!=1
+      || fwrite(&offset,sizeof(long long),1,blocks_file)!=1)
+    goto write_error_occurred;
+
+  for (i= -1;i<nlists;i++) { /* i<0: THE TOP LEVEL LIST */
+    if (i<0) {
+      sh.start=0;
+      sh.len=ntop;
+    }
+    else if (fread_records(&sh,sizeof(SublistHeader),1,subheader_file,
+			   isize)!=1) {
+      sprintf(err_msg,"error or EOF reading file %s.subhead",filestem);
+      goto handle_malloc_failure;
+    }
+    if ((i<0 || sh.len>div || nblk+sh.len>div) && nblk>0) {
+      if (write_compressed_block(blk,nblk,zbuf,out_idb,blocks_file,&offset))
+	goto write_error_occurred;
+      nblock++; /* START THIS LIST ON A NEW BLOCK */
+      nblk=0;
+    }
+    if ((long long)nblock*div+nblk+sh.len>(long long)C_int_max) {
+      sprintf(err_msg,"%s is too big to compress with %d bit intervals",
+	      filestem,8*(int)sizeof(IntervalInt));
+      goto handle_malloc_failure;
+    }
+    if (i>=0) { /* SAVE ITS NEW LOCATION */
+      k=sh.start;
+      sh.start=nblock*div+nblk;
+      if (fwrite(&sh,sizeof(SublistHeader),1,out_subheader)!=1)
+	goto write_error_occurred;
+      sh.start=k;
+    }
+    for (j=0;j<sh.len;j+=k) { /* COPY ITS RECORDS INTO BLOCKS */
+      k=sh.len-j<div-nblk ? sh.len-j : div-nblk;
+      if (read_records_at(idb_file,blk+nblk,sizeof(IntervalMap),k,
+			  (PYGR_OFF_T)sh.start+j,isize)!=(size_t)k) {
+	sprintf(err_msg,"IntervalMap file %s.idb corrupted?",filestem);
+	goto handle_malloc_failure;
+      }
+      nblk+=k;
+      if (nblk==div) { /* A FULL BLOCK */
+	if (write_compressed_block(blk,nblk,zbuf,out_idb,blocks_file,&offset))
+	  goto write_error_occurred;
+	nblock++;
+	nblk=0;
+      }
+    }
+  }
+  if (nblk>0) { /* THE LAST PARTIAL BLOCK */
+    if (write_compressed_block(blk,nblk,zbuf,out_idb,blocks_file,&offset))
+      goto write_error_occurred;
+    nblock++;
+  }
+  nblock_save=nblock;
+  PYGR_FSEEK(blocks_file,0,SEEK_SET);
+  if (fwrite(&nblock_save,sizeof(long long),1,blocks_file)!=1)
+    goto write_error_occurred;
+  j=fclose(blocks_file)!=0;
+  blocks_file=NULL;
+  if (fclose(out_idb))
+    j=1;
+  out_idb=NULL;
+  if (out_subheader && fclose(out_subheader))
+    j=1;
+  out_subheader=NULL;
+  if (j)
+    goto write_error_occurred;
+  fclose(idb_file);
+  idb_file=NULL;
+  if (subheader_file)
+    fclose(subheader_file);
+  subheader_file=NULL;
+  if (isize!=(int)sizeof(IntervalInt) && nii>0) { /* WIDEN THE INDEX TOO */
+    CALLOC(ii,nii,IntervalIndex);
+    sprintf(path,"%s.index",filestem);
+    if (!(ifile=fopen(path,"rb"))) /* binary file */
+      goto unable_to_open_file;
+    j=fread_records(ii,sizeof(IntervalIndex),nii,ifile,isize)!=(size_t)nii;
+    fclose(ifile);
+    if (j) {
+      sprintf(err_msg,"error or EOF reading file %s",path);
+      goto handle_malloc_failure;
+    }
+    sprintf(path,"%s.index.tmp",filestem);
+    if (!(ifile=fopen(path,"wb"))) /* binary file */
+      goto unable_to_open_file;
+    j=fwrite(ii,sizeof(IntervalIndex),nii,ifile)!=(size_t)nii;
+    if (fclose(ifile) || j)
+      goto write_error_occurred;
+  }
+
+  sprintf(path,"%s.idb",filestem); /* REPLACE THE UNCOMPRESSED FILES */
+  sprintf(tmp_path,"%s.idb.tmp",filestem);
+  remove(path);
+  if (rename(tmp_path,path))
+    goto write_error_occurred;
+  if (nlists>0) {
+    sprintf(path,"%s.subhead",filestem);
+    sprintf(tmp_path,"%s.subhead.tmp",filestem);
+    remove(path);
+    if (rename(tmp_path,path))
+      goto write_error_occurred;
+  }
+  if (ii) {
+    sprintf(path,"%s.index",filestem);
+    sprintf(tmp_path,"%s.index.tmp",filestem);
+    remove(path);
+    if (rename(tmp_path,path))
+      goto write_error_occurred;
+  }
+  if (write_binary_size(filestem,n,ntop,div,nlists,nii,NCLIST_CODEC_VARINT)<0) {
+    sprintf(path,"%s.size",filestem);
+    goto write_error_occurred;
+  }
+  result=NULL; /* RETURN CODE SIGNALS SUCCESS!! */
+  goto handle_malloc_failure;
+ unable_to_open_file:
+  sprintf(err_msg,"unable to open file %s",path);
+  goto handle_malloc_failure;
+ write_error_occurred:
+  sprintf(err_msg,"error writing file %s! out of disk space?",path);
+ handle_malloc_failure: /* ALSO OUR CLEANUP FOR SUCCESS OR ANY ERROR */
+  if (result && !err_msg[0])
+    sprintf(err_msg,"out of memory");
+  if (idb_file)
+    fclose(idb_file);
+  if (subheader_file)
+    fclose(subheader_file);
+  if (blocks_file)
+    fclose(blocks_file);
+  if (out_idb)
+    fclose(out_idb);
+  if (out_subheader)
+    fclose(out_subheader);
+  if (result) { /* LEAVE THE ORIGINAL FILES AS THEY WERE */
+    sprintf(tmp_path,"%s.idb.tmp",filestem);
+    remove(tmp_path);
+    sprintf(tmp_path,"%s.subhead.tmp",filestem);
+    remove(tmp_path);
+    sprintf(tmp_path,"%s.blocks",filestem);
+    remove(tmp_path);
+    sprintf(tmp_path,"%s.index.tmp",filestem);
+    remove(tmp_path);
+  }
+  FREE(blk);
+  FREE(ii);
+  FREE(zbuf);
+  return result;
+}
+
+
+/* READ THE BLOCK OFFSETS SAVED BY compress_binary_files() */
+CompressedBlocks *read_compressed_blocks(char filestem[],char err_msg[])
+{
+  long long nblock;
+  char path[2048];
+  CompressedBlocks *blocks=NULL;
+  FILE *ifile=NULL;
+  sprintf(path,"%s.blocks",filestem);
+  ifile=fopen(path,"rb"); /* binary file */
+  if (!ifile) {
+    if (err_msg)
+      sprintf(err_msg,"unable to open file %s",path);
+    return NULL;
+  }
+  if (fread(&nblock,sizeof(long long),1,ifile)!=1 || nblock<0
+      || nblock>(long long)C_int_max)
+    goto fread_error_occurred;
+  if (err_msg)
+    sprintf(err_msg,"out of memory reading file %s",path);
+  CALLOC(blocks,1,CompressedBlocks);
+  blocks->nblock=(IntervalInt)nblock;
+  CALLOC(blocks->offset,nblock+1,long long);
+  if (fread(blocks->offset,sizeof(long long),nblock+1,ifile)!=(size_t)(nblock+1))
+    goto fread_error_occurred;
+  fclose(ifile);
+  return blocks;
+ fread_error_occurred:
+  if (err_msg)
+    sprintf(err_msg,"error or EOF reading file %s",path);
+ handle_malloc_failure:
+  fclose(ifile);
+  free_compressed_blocks(blocks);
+  return NULL;
+}
+
+
+int free_compressed_blocks(CompressedBlocks *blocks)
+{
+  if (!blocks)
+    return 0;
+#ifdef PYGR_USE_MMAP
+  if (blocks->map)
+    munmap(blocks->map,blocks->map_size);
+#endif
+  FREE(blocks->offset);
+  free(blocks);
+  return 0;
+}
+
+
+
+/****************************************************************
+ *
+ *   OUT-OF-CORE BUILD: BOUNDED-MEMORY EXTERNAL SORT, THEN A
+ *   STREAMING PASS THAT ASSIGNS EACH INTERVAL TO ITS SUBLIST
+ */
+
+#define EXTERNAL_SORT_MIN_BUF 256 /* MIN RECORDS PER RUN BUFFER WHEN MERGING */
+#define EXTERNAL_SORT_HEAD(ES,K) ((ES)->buf+((size_t)(K)*(ES)->nmbuf+(ES)->ihead[K])*(ES)->size)
+
+
+/* START A SORT OF RECORDS OF size BYTES, USING AT MOST max_memory BYTES
+   OF BUFFER AND THE TEMPORARY FILE path (path.merge FOR MERGE PASSES) */
+ExternalSort *external_sort_alloc(int size,int (*cmp)(const void *,const void *),
+				  long long max_memory,char path[])
+{
+  long long maxbuf;
+  ExternalSort *es=NULL;
+  CALLOC(es,1,ExternalSort);
+  es->size=size;
+  es->cmp=cmp;
+  maxbuf=max_memory/size;
+  if (maxbuf<=2*EXTERNAL_SORT_MIN_BUF) /* NEED ENOUGH TO MERGE TWO RUNS */
+    maxbuf=2*EXTERNAL_SORT_MIN_BUF+1;
+  if (maxbuf>INT_MAX/size) /* KEEP EACH RUN UNDER 2 GB */
+    maxbuf=INT_MAX/size;
+  es->maxbuf=(int)maxbuf;
+  CALLOC(es->buf,es->maxbuf*size,char);
+  es->maxrun=64;
+  CALLOC(es->run,es->maxrun+1,PYGR_OFF_T);
+  strcpy(es->path,path);
+  es->ifile=fopen(path,"w+b"); /* binary file */
+  if (!es->ifile) {
+    free_external_sort(es);
+    return NULL;
+  }
+  return es;
+ handle_malloc_failure:
+  if (es)
+    free_external_sort(es);
+  return NULL;
+}
+
+
+/* SORT THE BUFFERED RECORDS AND APPEND THEM TO ifile AS A NEW RUN */
+int external_sort_flush(ExternalSort *es)
+{
+  if (es->nbuf==0)
+    return 0;
+  if (es->nrun==es->maxrun) {
+    es->maxrun*=2;
+    REALLOC(es->run,es->maxrun+1,PYGR_OFF_T);
+  }
+  qsort(es->buf,es->nbuf,es->size,es->cmp);
+  if (fwrite(es->buf,es->size,es->nbuf,es->ifile)!=(size_t)es->nbuf)
+    return -1;
+  es->run[es->nrun+1]=es->run[es->nrun]+es->nbuf;
+  es->nrun++;
+  es->nbuf=0;
+  return 0;
+ handle_malloc_failure:
+  return -1;
+}
+
+
+int external_sort_add(ExternalSort *es,void *rec)
+{
+  if (es->nbuf==es->maxbuf && external_sort_flush(es)<0)
+    return -1;
+  memcpy(es->buf+(size_t)es->nbuf*es->size,rec,es->size);
+  es->nbuf++;
+  return 0;
+}
+
+
+/* READ THE NEXT BUFFERFUL OF MERGE INPUT k; RETURNS #RECORDS READ */
+int external_sort_refill(ExternalSort *es,int k)
+{
+  int n=es->nmbuf;
+  PYGR_OFF_T left;
+  left=es->run[es->irun+k+1]-es->next[k];
+  if (left<n)
+    n=(int)left;
+  if (n>0 && read_file_at(es->ifile,es->buf+(size_t)k*es->nmbuf*es->size,
+			  es->size,n,es->next[k]*es->size)!=(size_t)n)
+    return -1;
+  es->next[k]+=n;
+  es->ihead[k]=0;
+  es->nhead[k]=n;
+  return n;
+}
+
+
+/* TRUE IF THE CURRENT RECORD OF INPUT a SORTS BEFORE THAT OF b */
+int external_sort_less(ExternalSort *es,int a,int b)
+{
+  int c;
+  c=es->cmp(EXTERNAL_SORT_HEAD(es,a),EXTERNAL_SORT_HEAD(es,b));
+  return c<0 || (c==0 && a<b); /* TIES: EARLIER RUN FIRST */
+}
+
+
+void external_sort_sift_down(ExternalSort *es,int i)
+{
+  int j,k=es->heap[i];
+  while ((j=2*i+1)<es->nheap) {
+    if (j+1<es->nheap && external_sort_less(es,es->heap[j+1],es->heap[j]))
+      j++;
+    if (!external_sort_less(es,es->heap[j],k))
+      break;
+    es->heap[i]=es->heap[j];
+    i=j;
+  }
+  es->heap[i]=k;
+}
+
+
+/* BEGIN MERGING RUNS r0 .. r1-1, SPLITTING buf BETWEEN THEM.  THE LAST
+   RECORD OF buf IS KEPT FREE AS SCRATCH SPACE FOR MERGE PASSES */
+int external_sort_start_merge(ExternalSort *es,int r0,int r1)
+{
+  int k,n;
+  es->irun=r0;
+  es->nmbuf=(es->maxbuf-1)/(r1-r0);
+  es->nheap=0;
+  for (k=0;k<r1-r0;k++) {
+    es->next[k]=es->run[r0+k];
+    if ((n=external_sort_refill(es,k))<0)
+      return -1;
+    if (n>0)
+      es->heap[es->nheap++]=k;
+  }
+  for (k=es->nheap/2-1;k>=0;k--)
+    external_sort_sift_down(es,k);
+  return 0;
+}
+
+
+/* COPY THE NEXT RECORD IN SORTED ORDER TO rec.  RETURNS 1 IF A RECORD
+   WAS COPIED, 0 WHEN THE SORT IS FINISHED, -1 ON A READ ERROR */
+int external_sort_next(ExternalSort *es,void *rec)
+{
+  int k,n;
+  if (es->nheap==0)
+    return 0;
+  k=es->heap[0];
+  memcpy(rec,EXTERNAL_SORT_HEAD(es,k),es->size);
+  if (++es->ihead[k]==es->nhead[k]) { /* BUFFER USED UP: READ MORE */
+    if ((n=external_sort_refill(es,k))<0)
+      return -1;
+    if (n==0) /* THIS RUN IS FINISHED */
+      es->heap[0]=es->heap[--es->nheap];
+  }
+  if (es->nheap>0)
+    external_sort_sift_down(es,0);
+  return 1;
+}
+
+
+/* FLUSH THE LAST RUN, MERGE GROUPS OF RUNS UNTIL ONE PASS CAN MERGE
+   THEM ALL WITH AT LEAST EXTERNAL_SORT_MIN_BUF RECORDS BUFFERED PER RUN,
+   THEN START THAT FINAL PASS FOR external_sort_next() */
+int external_sort_finish(ExternalSort *es)
+{
+  int i,fanin,r;
+  char path[2048],*rec;
+  FILE *ofile;
+  if (external_sort_flush(es)<0 || fflush(es->ifile))
+    return -1;
+  fanin=(es->maxbuf-1)/EXTERNAL_SORT_MIN_BUF;
+  CALLOC(es->next,fanin,PYGR_OFF_T);
+  CALLOC(es->ihead,fanin,int);
+  CALLOC(es->nhead,fanin,int);
+  CALLOC(es->heap,fanin,int);
+  while (es->nrun>fanin) { /* TOO MANY RUNS: MERGE IN GROUPS OF fanin */
+    sprintf(path,"%s.merge",es->path);
+    ofile=fopen(path,"w+b"); /* binary file */
+    if (!ofile)
+      return -1;
+    for (r=0;r<es->nrun;r+=fanin) {
+      if (external_sort_start_merge(es,r,r+fanin<es->nrun ? r+fanin : es->nrun)<0)
+	break;
+      rec=es->buf+(size_t)(es->maxbuf-1)*es->size; /* SCRATCH RECORD */
+      while ((i=external_sort_next(es,rec))>0)
+	if (fwrite(rec,es->size,1,ofile)!=1)
+	  break;
+      if (i!=0)
+	break;
+    }
+    fclose(es->ifile); /* DONE WITH THE OLD RUNS */
+    remove(es->path);
+    es->ifile=ofile; /* MERGED RUNS OCCUPY THE SAME RECORD POSITIONS */
+    if (rename(path,es->path)) /* KEEP path AS THE NAME WE CLEAN UP */
+      strcpy(es->path,path);
+    if (r<es->nrun || fflush(ofile))
+      return -1;
+    for (i=0;i*fanin<es->nrun;i++)
+      es->run[i]=es->run[i*fanin];
+    es->run[i]=es->run[es->nrun];
+    es->nrun=i;
+  }
+  if (es->nrun>0)
+    return external_sort_start_merge(es,0,es->nrun);
+  return 0;
+ handle_malloc_failure:
+  return -1;
+}
+
+
+/* CLOSE AND DELETE THE TEMPORARY FILE, AND FREE ALL MEMORY */
+int free_external_sort(ExternalSort *es)
+{
+  if (es->ifile) {
+    fclose(es->ifile);
+    remove(es->path);
+  }
+  FREE(es->buf);
+  FREE(es->run);
+  FREE(es->next);
+  FREE(es->ihead);
+  FREE(es->nhead);
+  FREE(es->heap);
+  free(es);
+  return 0;
+}
+
+
+int sublist_record_cmp(const void *void_a,const void *void_b)
+{ /* SORT BY SUBLIST, THEN BY POSITION IN start ORDER */
+  SublistRecord *a=(SublistRecord *)void_a,*b=(SublistRecord *)void_b;
+  if (a->isublist<b->isublist)
+    return -1;
+  else if (a->isublist>b->isublist)
+    return 1;
+  else if (a->ipos<b->ipos)
+    return -1;
+  else if (a->ipos>b->ipos)
+    return 1;
+  else
+    return 0;
+}
+
+
+int count_bits(unsigned int x)
+{
+  int n=0;
+  for (;x;x&=x-1)
+    n++;
+  return n;
+}
+
+
+/* COPY nlist RECORDS STARTING AT RECORD ipos OF ifile TO ofile, IN CHUNKS
+   OF nchunk (A MULTIPLE OF div), MAPPING EACH sublist FIELD FROM BUILD
+   NUMBERING TO ITS PACKED SUBHEADER INDEX VIA THE big BITMAP.  IF index_file
+   IS NOT NULL, PAD THE LIST TO A MULTIPLE OF div AND SAVE ITS INDEX ENTRIES
+   TO index_file, COUNTING THEM IN *p_nii.  RETURNS #RECORDS WRITTEN, -1 ON ERROR */
+IntervalInt copy_external_sublist(FILE *ifile,PYGR_OFF_T ipos,
+				  IntervalInt nlist,FILE *ofile,
+				  IntervalMap chunk[],int nchunk,int div,
+				  unsigned int big[],IntervalInt nbig_before[],
+				  IntervalInt nbig,FILE *index_file,
+				  IntervalInt *p_nii)
+{
+  IntervalInt i,c,nbelow;
+  int j,n;
+  IntervalMap first;
+  for (i=0;i<nlist;i+=n) {
+    n=nlist-i<nchunk ? nlist-i : nchunk;
+    if (read_file_at(ifile,chunk,sizeof(IntervalMap),n,
+		     (ipos+i)*sizeof(IntervalMap))!=(size_t)n)
+      return -1;
+    for (j=0;j<n;j++) {
+      if ((c=chunk[j].sublist)<0) /* NO SUBLIST */
+	continue;
+      nbelow=nbig_before[c>>5]+count_bits(big[c>>5]&((1U<<(c&31))-1));
+      if (big[c>>5]&(1U<<(c&31))) /* BIG LISTS ARE PACKED FIRST */
+	chunk[j].sublist=nbelow;
+      else
+	chunk[j].sublist=nbig+(c-1-nbelow);
+    }
+    if (i==0)
+      first=chunk[0];
+    if (fwrite(chunk,sizeof(IntervalMap),n,ofile)!=(size_t)n)
+      return -1;
+    if (index_file)
+      *p_nii+=write_binary_index(chunk,n,div,index_file);
+  }
+  if (index_file && nlist%div) { /* PAD TO EXACT MULTIPLE OF div */
+    for (j=nlist%div;j<div;j++,nlist++)
+      fwrite(&first,sizeof(IntervalMap),1,ofile); /*THIS IS JUST PADDING */
+  }
+  return nlist;
+}
+
+
+/* BUILD THE NESTED LIST FOR THE n UNSORTED RECORDS IN ifile AND SAVE IT
+   AS filestem.idb ETC., EXACTLY AS write_binary_files() WOULD, WITHOUT
+   LOADING IT INTO MEMORY.  SORT BUFFERS ARE LIMITED TO max_memory BYTES;
+   BEYOND THAT WE ONLY KEEP THE CURRENT CONTAINMENT CHAIN AND TWO BITS PER
+   SUBLIST.  TEMPORARY FILES filestem.sort* ARE CREATED AND REMOVED.
+   RETURNS NULL ON SUCCESS, OR AN ERROR MESSAGE SAVED IN err_msg[1024] */
+char *build_binary_files_external(FILE *ifile,IntervalInt n,int div,
+				  long long max_memory,char filestem[],
+				  char err_msg[])
+{
+  IntervalInt i,ipos,nlists=0,len,nwritten;
+  IntervalInt nwords,nbig=0,ntop=0,nii=0,npad=0,isublist;
+  IntervalInt *nbig_before=NULL;
+  int j,nread,nstack=0,maxstack=64,nchunk,ipass;
+  unsigned int *big=NULL;
+  char path[2048],*result=err_msg;
+  PYGR_OFF_T igroup;
+  ExternalSort *es_start=NULL,*es_sublist=NULL;
+  SublistRecord *stack=NULL,rec;
+  SublistHeader sh_tmp;
+  IntervalMap *chunk=NULL,im;
+  FILE *group_file=NULL,*len_file=NULL,*idb_file=NULL,*subheader_file=NULL;
+  FILE *index_file=NULL;
+
+  err_msg[0]='\0';
+  max_memory/=2; /* THE TWO SORTS OVERLAP, SO SPLIT max_memory BETWEEN THEM */
+  if (max_memory>(long long)n*sizeof(SublistRecord)) /* NO NEED FOR MORE */
+    max_memory=(long long)n*sizeof(SublistRecord);
+  nchunk=div*(1+1023/div); /* I/O CHUNK: >=1024 RECORDS, MULTIPLE OF div */
+  CALLOC(chunk,nchunk,IntervalMap);
+  CALLOC(stack,maxstack,SublistRecord);
+  sprintf(path,"%s.sortstart",filestem); /* 1. SORT BY start */
+  if (!(es_start=external_sort_alloc(sizeof(IntervalMap),
+#ifdef MERGE_INTERVAL_ORIENTATIONS
+				     im_qsort_cmp,
+#else
+				     imstart_qsort_cmp,
+#endif
+				     max_memory,path))) {
+    sprintf(err_msg,"unable to start sort using %s",path);
+    goto handle_malloc_failure;
+  }
+  for (i=0;i<n;i+=nread) {
+    nread=n-i<nchunk ? n-i : nchunk;
+    if (read_file_at(ifile,chunk,sizeof(IntervalMap),nread,
+		     (PYGR_OFF_T)i*sizeof(IntervalMap))!=(size_t)nread) {
+      sprintf(err_msg,"IntervalMap file corrupted?");
+      goto handle_malloc_failure;
+    }
+#ifdef ALL_POSITIVE_ORIENTATION
+    reorient_intervals(nread,chunk,1); /* FORCE ALL INTERVALS INTO POSITIVE ORI */
+#endif
+    for (j=0;j<nread;j++)
+      if (external_sort_add(es_start,chunk+j)<0) {
+	sprintf(err_msg,"error writing sort file %s",path);
+	goto handle_malloc_failure;
+      }
+  }
+  if (external_sort_finish(es_start)<0) {
+    sprintf(err_msg,"error merging sort file %s",path);
+    goto handle_malloc_failure;
+  }
+
+  /* 2. WALK THE SORTED INTERVALS WITH A STACK OF THE CURRENT CONTAINMENT
+     CHAIN, EXACTLY AS build_nested_list_inplace() DOES: A SUBLIST GETS
+     ITS NUMBER WHEN ITS FIRST MEMBER ARRIVES.  EACH INTERVAL IS SAVED
+     WHEN POPPED, SINCE ONLY THEN DO WE KNOW ITS OWN SUBLIST NUMBER */
+  sprintf(path,"%s.sortsublist",filestem);
+  if (!(es_sublist=external_sort_alloc(sizeof(SublistRecord),
+				       sublist_record_cmp,max_memory,path))) {
+    sprintf(err_msg,"unable to start sort using %s",path);
+    goto handle_malloc_failure;
+  }
+  for (ipos=0;(i=external_sort_next(es_start,&im))>0;ipos++) {
+    while (nstack>0 /* POP INTERVALS THAT DON'T CONTAIN im */
+	   && (END_POSITIVE(im)>END_POSITIVE(stack[nstack-1].im)
+	       || (END_POSITIVE(im)==END_POSITIVE(stack[nstack-1].im) /* SAME INTERVAL! */
+		   && START_POSITIVE(im)==START_POSITIVE(stack[nstack-1].im))))
+      if (external_sort_add(es_sublist,stack+(--nstack))<0) {
+	sprintf(err_msg,"error writing sort file %s",path);
+	goto handle_malloc_failure;
+      }
+    if (nstack==maxstack) {
+      maxstack*=2;
+      REALLOC(stack,maxstack,SublistRecord);
+    }
+    if (nstack>0) { /* im IS CONTAINED IN stack[nstack-1] */
+      if (stack[nstack-1].im.sublist<0) /* FIRST MEMBER OF A NEW SUBLIST */
+	stack[nstack-1].im.sublist= ++nlists;
+      stack[nstack].isublist=stack[nstack-1].im.sublist;
+    }
+    else /* TOP LEVEL */
+      stack[nstack].isublist=0;
+    stack[nstack].ipos=ipos;
+    stack[nstack].im=im;
+    stack[nstack].im.sublist= -1;
+    nstack++;
+  }
+  while (nstack>0 && i==0) /* POP THE REST OF THE STACK */
+    i=external_sort_add(es_sublist,stack+(--nstack));
+  if (i!=0 || ipos!=n) {
+    sprintf(err_msg,"error reading sort file %s.sortstart",filestem);
+    goto handle_malloc_failure;
+  }
+  free_external_sort(es_start); /* DONE WITH THAT SORT */
+  es_start=NULL;
+  if (external_sort_finish(es_sublist)<0) {
+    sprintf(err_msg,"error merging sort file %s",path);
+    goto handle_malloc_failure;
+  }
+
+  /* 3. SAVE INTERVALS GROUPED BY SUBLIST, AND EACH SUBLIST'S LENGTH.
+     MARK SUBLISTS WITH len>div IN A BITMAP, SINCE THEY ARE PACKED FIRST */
+  nwords=nlists/32+1;
+  CALLOC(big,nwords,unsigned int);
+  CALLOC(nbig_before,nwords,IntervalInt);
+  sprintf(path,"%s.sortgroup",filestem);
+  group_file=fopen(path,"w+b"); /* binary file */
+  sprintf(path,"%s.sortlen",filestem);
+  len_file=fopen(path,"w+b"); /* binary file */
+  if (!group_file || !len_file) {
+    sprintf(err_msg,"unable to open file %s.sortgroup for writing",filestem);
+    goto handle_malloc_failure;
+  }
+  for (isublist=0,len=0;(i=external_sort_next(es_sublist,&rec))>0;len++) {
+    if (rec.isublist!=isublist) { /* SAVE LENGTH OF THE GROUP JUST DONE */
+      fwrite(&len,sizeof(IntervalInt),1,len_file);
+      if (isublist>0 && len>div)
+	big[isublist>>5]|=1U<<(isublist&31);
+      isublist=rec.isublist;
+      len=0;
+    }
+    if (fwrite(&(rec.im),sizeof(IntervalMap),1,group_file)!=1)
+      break;
+  }
+  if (i!=0 || isublist!=nlists) {
+    sprintf(err_msg,"error reading sort file %s.sortsublist",filestem);
+    goto handle_malloc_failure;
+  }
+  fwrite(&len,sizeof(IntervalInt),1,len_file); /* LENGTH OF THE LAST GROUP */
+  if (isublist>0 && len>div)
+    big[isublist>>5]|=1U<<(isublist&31);
+  free_external_sort(es_sublist);
+  es_sublist=NULL;
+  for (i=0;i<nwords;i++) { /* PREFIX COUNTS SO WE CAN RANK ANY SUBLIST */
+    nbig_before[i]=nbig;
+    nbig+=count_bits(big[i]);
+  }
+  if (fflush(group_file) || fflush(len_file)) {
+    sprintf(err_msg,"error writing file %s.sortgroup",filestem);
+    goto handle_malloc_failure;
+  }
 
-  sprintf(path,"%s.index",filestem); /* SAVE THE COMPACTED INDEX */
-  ifile=fopen(path,"wb"); /* binary file */
-  if (!ifile) {
+  /* 4. WRITE TOP LEVEL AND BIG SUBLISTS (PADDED, INDEXED), THEN SMALL
+     SUBLISTS, AS write_binary_files() DOES AFTER repack_subheaders() */
+  sprintf(path,"%s.subhead",filestem); /* SAVE THE SUBHEADER LIST */
+  subheader_file=fopen(path,"wb"); /* binary file */
+  if (!subheader_file) {
     sprintf(err_msg,"unable to open file %s for writing",path);
-    return err_msg;
+    goto handle_malloc_failure;
   }
-  nii=write_binary_index(im,ntop,div,ifile);
-  for (i=0;i<nlists;i++) /* ALSO STORE INDEX DATA FOR BIG SUBLISTS */
-    if (subheader[i].len>div)
-      nii+=write_binary_index(im+subheader[i].start,subheader[i].len,div,ifile);
-  fclose(ifile);
-
-  sprintf(path,"%s.size",filestem); /* SAVE BASIC SIZE INFO*/
-  ifile=fopen(path,"w"); /* text file */
-  if (!ifile) {
+  sprintf(path,"%s.idb",filestem); /* SAVE THE DATABASE */
+  idb_file=fopen(path,"wb"); /* binary file */
+  if (!idb_file) {
     sprintf(err_msg,"unable to open file %s for writing",path);
-    return err_msg;
+    goto handle_malloc_failure;
+  }
+  sprintf(path,"%s.index",filestem); /* SAVE THE COMPACTED INDEX */
+  index_file=fopen(path,"wb"); /* binary file */
+  if (!index_file) {
+    sprintf(err_msg,"unable to open file %s for writing",path);
+    goto handle_malloc_failure;
+  }
+  for (ipass=0;ipass<2;ipass++) {
+    rewind(len_file);
+    for (isublist=0,igroup=0;isublist<=nlists;isublist++,igroup+=len) {
+      if (fread(&len,sizeof(IntervalInt),1,len_file)!=1) {
+	sprintf(err_msg,"error reading file %s.sortlen",filestem);
+	goto handle_malloc_failure;
+      }
+      if (isublist==0)
+	ntop=len;
+      if ((isublist==0 || len>div)!=(ipass==0)) /* NOT IN THIS PASS */
+	continue;
+      if (isublist>0) {
+	sh_tmp.start=npad; /* FILE LOCATION WHERE THIS SUBLIST STORED */
+	sh_tmp.len=len; /* SAVE THE TRUE SUBLIST LENGTH, UNPADDED */
+	fwrite(&sh_tmp,sizeof(SublistHeader),1,subheader_file);
+      }
+      nwritten=copy_external_sublist(group_file,igroup,len,idb_file,chunk,
+				     nchunk,div,big,nbig_before,nbig,
+				     ipass==0 ? index_file : NULL,&nii);
+      if (nwritten<0) {
+	sprintf(err_msg,"error writing file %s.idb",filestem);
+	goto handle_malloc_failure;
+      }
+      npad+=nwritten;
+    }
+  }
+  i=ferror(idb_file)||ferror(subheader_file)||ferror(index_file);
+  if (fclose(idb_file))
+    i=1;
+  idb_file=NULL;
+  if (fclose(subheader_file))
+    i=1;
+  subheader_file=NULL;
+  if (fclose(index_file))
+    i=1;
+  index_file=NULL;
+  if (i) {
+    sprintf(err_msg,"error writing binary files %s",filestem);
+    goto handle_malloc_failure;
   }
-  fprintf(ifile,"%d %d %d %d %d\n",n,ntop,div,nlists,nii);
-  fclose(ifile);
 
-  return NULL; /* RETURN CODE SIGNALS SUCCESS!! */
+  if (write_binary_size(filestem,n,ntop,div,nlists,nii,
+			NCLIST_CODEC_NONE)<0) {
+    sprintf(err_msg,"unable to open file %s.size for writing",filestem);
+    goto handle_malloc_failure;
+  }
+  result=NULL; /* RETURN CODE SIGNALS SUCCESS!! */
+
+ handle_malloc_failure: /* ALSO OUR CLEANUP FOR SUCCESS OR ANY ERROR */
+  if (result && !err_msg[0])
+    sprintf(err_msg,"out of memory");
+  if (es_start)
+    free_external_sort(es_start);
+  if (es_sublist)
+    free_external_sort(es_sublist);
+  if (group_file) {
+    fclose(group_file);
+    sprintf(path,"%s.sortgroup",filestem);
+    remove(path);
+  }
+  if (len_file) {
+    fclose(len_file);
+    sprintf(path,"%s.sortlen",filestem);
+    remove(path);
+  }
+  if (idb_file)
+    fclose(idb_file);
+  if (subheader_file)
+    fclose(subheader_file);
+  if (index_file)
+    fclose(index_file);
+  FREE(chunk);
+  FREE(stack);
+  FREE(big);
+  FREE(nbig_before);
+  return result;
 }
 
 
@@ -818,22 +2885,21 @@ char *write_binary_files(IntervalMap im[],int n,int ntop,int div,
 IntervalDBFile *read_binary_files(char filestem[],char err_msg[],
 				  int subheader_nblock)
 {
-  int n,ntop,div,nlists,nii;
+  IntervalInt n,ntop,nlists,nii;
+  int div,codec,isize;
   char path[2048];
   IntervalIndex *ii=NULL;
   SublistHeader *subheader=NULL;
   IntervalDBFile *idb_file=NULL;
+  CompressedBlocks *blocks=NULL;
   FILE *ifile=NULL;
 
-  sprintf(path,"%s.size",filestem); /* READ BASIC SIZE INFO*/
-  ifile=fopen(path,"r"); /* text file */
-  if (!ifile) {
-    if (err_msg)
-      sprintf(err_msg,"unable to open file %s",path);
+  if (read_binary_size(filestem,err_msg,&n,&ntop,&div,&nlists,&nii,&codec,
+		       &isize)<0)
+    return NULL;
+  if (codec==NCLIST_CODEC_VARINT /* READ THE BLOCK OFFSETS */
+      && !(blocks=read_compressed_blocks(filestem,err_msg)))
     return NULL;
-  }
-  fscanf(ifile,"%d %d %d %d %d",&n,&ntop,&div,&nlists,&nii);
-  fclose(ifile);
 
   CALLOC(ii,nii+1,IntervalIndex);
   if (nii>0) {
@@ -844,7 +2910,7 @@ IntervalDBFile *read_binary_files(char filestem[],char err_msg[],
 	sprintf(err_msg,"unable to open file %s",path);
       return NULL;
     }
-    fread(ii,sizeof(IntervalIndex),nii,ifile);
+    fread_records(ii,sizeof(IntervalIndex),nii,ifile,isize);
     fclose(ifile);
   }
 
@@ -858,14 +2924,17 @@ IntervalDBFile *read_binary_files(char filestem[],char err_msg[],
       return NULL;
     }
 #ifdef ON_DEMAND_SUBLIST_HEADER
-    CALLOC(subheader,subheader_nblock,SublistHeader);
-    idb_file->subheader_file.subheader=subheader;
-    idb_file->subheader_file.nblock=subheader_nblock;
-    idb_file->subheader_file.start = -subheader_nblock; /* NO BLOCK LOADED */
+    /* NO BLOCK HELD IN MEMORY: SUBHEADERS ARE READ INDIVIDUALLY AS
+       NEEDED, OR FROM THE MAPPED FILE (SEE map_binary_files()) */
+    idb_file->subheader_file.subheader=NULL;
+    idb_file->subheader_file.nblock=0;
+    idb_file->subheader_file.start=0;
+    idb_file->subheader_file.read_nblock=subheader_nblock>0 ? subheader_nblock:1;
+    idb_file->subheader_file.isize=isize;
     idb_file->subheader_file.ifile=ifile;
 #else
     CALLOC(subheader,nlists,SublistHeader); /* LOAD THE ENTIRE SUBHEADER */
-    fread(subheader,sizeof(SublistHeader),nlists,ifile);  /*SAVE LIST */
+    fread_records(subheader,sizeof(SublistHeader),nlists,ifile,isize);
     fclose(ifile);
 #endif
   }
@@ -879,32 +2948,358 @@ IntervalDBFile *read_binary_files(char filestem[],char err_msg[],
     idb_file->nii++; /* ONE EXTRA ENTRY FOR PARTIAL BLOCK */
   idb_file->ii=ii;
   idb_file->subheader=subheader;
+  idb_file->blocks=blocks;
+  idb_file->isize=isize;
   sprintf(path,"%s.idb",filestem); /* OPEN THE DATABASE */
   idb_file->ifile_idb=fopen(path,"rb"); /* binary file */
   if (!idb_file->ifile_idb) {
     if (err_msg)
       sprintf(err_msg,"unable to open file %s",path);
+    free_compressed_blocks(blocks);
     free(idb_file);
     return NULL;
   }
+  idb_file->nref=1; /* HELD BY OUR CALLER */
+  PYGR_MUTEX_INIT(idb_file->lock);
   return idb_file;
  handle_malloc_failure:
   FREE(ii); /* DUMP OUR MEMORY */
   FREE(subheader);
   FREE(idb_file);
+  free_compressed_blocks(blocks);
+  return NULL;
+}
+
+
+
+/* MAP THE .idb AND .subhead FILES INTO MEMORY, SO QUERIES CAN READ
+   THEM WITHOUT ANY fseek/fread CALLS.  A COMPRESSED .idb IS MAPPED AS
+   blocks->map, AND DECODED FROM THERE.  RETURNS -1 IF mmap IS NOT
+   AVAILABLE OR FAILED, OR THE RECORDS MUST BE WIDENED AS THEY ARE READ;
+   db_file THEN SIMPLY CONTINUES TO USE stdio */
+int map_binary_files(IntervalDBFile *db_file)
+{
+#ifdef PYGR_USE_MMAP
+  struct stat st;
+  void *p;
+
+  if (db_file->im_map || (db_file->blocks && db_file->blocks->map))
+    return 0; /* ALREADY MAPPED */
+  if (db_file->isize!=(int)sizeof(IntervalInt) && !db_file->blocks)
+    return -1; /* 32 BIT RECORDS, READ BY read_records_at() */
+  if (!db_file->ifile_idb || fstat(fileno(db_file->ifile_idb),&st)
+      || st.st_size<=0 || (PYGR_OFF_T)(size_t)st.st_size!=st.st_size)
+    return -1; /* NOTHING TO MAP, OR TOO BIG FOR OUR ADDRESS SPACE */
+  p=mmap(NULL,(size_t)st.st_size,PROT_READ,MAP_SHARED,
+	 fileno(db_file->ifile_idb),0);
+  if (p==MAP_FAILED)
+    return -1;
+  if (db_file->blocks) { /* COMPRESSED: QUERIES DECODE FROM THE MAPPING */
+    db_file->blocks->map=(unsigned char *)p;
+    db_file->blocks->map_size=(size_t)st.st_size;
+  }
+  else {
+    db_file->im_map=(IntervalMap *)p;
+    db_file->im_map_size=(size_t)st.st_size;
+  }
+
+#ifdef ON_DEMAND_SUBLIST_HEADER
+  if (db_file->nlists>0 && db_file->subheader_file.ifile
+      && db_file->isize==(int)sizeof(IntervalInt)
+      && !fstat(fileno(db_file->subheader_file.ifile),&st)
+      && st.st_size>=db_file->nlists*(PYGR_OFF_T)sizeof(SublistHeader)
+      && (PYGR_OFF_T)(size_t)st.st_size==st.st_size
+      && (p=mmap(NULL,(size_t)st.st_size,PROT_READ,MAP_SHARED,
+		 fileno(db_file->subheader_file.ifile),0))!=MAP_FAILED) {
+    FREE(db_file->subheader); /* REPLACE BLOCK BUFFER BY WHOLE MAPPED FILE */
+    db_file->subheader_map=(SublistHeader *)p;
+    db_file->subheader_map_size=(size_t)st.st_size;
+    db_file->subheader=db_file->subheader_map;
+    db_file->subheader_file.subheader=db_file->subheader_map;
+    db_file->subheader_file.nblock=db_file->nlists; /* ONE BLOCK HOLDS ALL */
+    db_file->subheader_file.start=0;
+  }
+#endif
+  return 0;
+#else
+  return -1; /* mmap NOT AVAILABLE ON THIS PLATFORM */
+#endif
+}
+
+
+
+/****************************************************************
+ *
+ *   SEQUENTIAL SCAN OF ALL RECORDS OF AN ON-DISK DATABASE
+ */
+
+
+/* START A SCAN OF db_file, READING THE FILE chunk_size RECORDS (OR THAT
+   MANY BYTES OF COMPRESSED BLOCKS) AT A TIME.  padded NON-ZERO ALSO
+   RETURNS THE PADDING OF THE TOP LEVEL LIST AND BIG SUBLISTS (EXCEPT
+   THE LAST LIST), I.E. THE RECORDS OF AN UNCOMPRESSED .idb */
+IntervalScan *interval_scan_alloc(IntervalDBFile *db_file,int chunk_size,
+				  int padded)
+{
+  IntervalScan *scan=NULL;
+  CALLOC(scan,1,IntervalScan);
+  scan->db_file=db_file;
+  scan->padded=padded;
+  scan->chunk_size=chunk_size;
+  scan->isub= -1; /* START WITH THE TOP LEVEL LIST */
+  scan->sh.len=db_file->ntop;
+  scan->nlist=db_file->ntop;
+  if (padded && db_file->ntop%db_file->div)
+    scan->nlist+=db_file->div-db_file->ntop%db_file->div;
+  if (db_file->blocks) {
+    CALLOC(scan->dbuf,db_file->div,IntervalMap);
+  }
+  else if (!db_file->im_map) {
+    CALLOC(scan->rbuf,chunk_size,IntervalMap);
+  }
+  return scan;
+ handle_malloc_failure:
+  free_interval_scan(scan);
   return NULL;
 }
 
 
+int free_interval_scan(IntervalScan *scan)
+{
+  if (!scan)
+    return 0;
+  FREE(scan->subheader);
+  FREE(scan->rbuf);
+  FREE(scan->zbuf);
+  FREE(scan->dbuf);
+  free(scan);
+  return 0;
+}
+
+
+/* READ THE COMPRESSED BYTES OF BLOCK iblock, AND AS MANY FOLLOWING BLOCKS
+   AS FIT IN chunk_size RECORDS' WORTH OF BYTES, INTO scan->zbuf */
+int scan_read_blocks(IntervalScan *scan,IntervalInt iblock)
+{
+  IntervalInt i;
+  size_t nbytes,nmax;
+  unsigned char *zbuf;
+  CompressedBlocks *blocks=scan->db_file->blocks;
+  nmax=scan->chunk_size*sizeof(IntervalMap);
+  for (i=iblock+1;i<blocks->nblock /* ONE READ FOR MANY BLOCKS */
+	 && blocks->offset[i+1]-blocks->offset[iblock]<=(long long)nmax;i++)
+    ;
+  nbytes=(size_t)(blocks->offset[i]-blocks->offset[iblock]);
+  if (nbytes>scan->zbuf_size) { /* GROW OUR READ BUFFER */
+    zbuf=scan->zbuf;
+    REALLOC(zbuf,nbytes,unsigned char);
+    scan->zbuf=zbuf;
+    scan->zbuf_size=nbytes;
+  }
+  if (read_file_at(scan->db_file->ifile_idb,scan->zbuf,1,nbytes,
+		   blocks->offset[iblock])!=nbytes)
+    return -1;
+  scan->zblock=iblock;
+  scan->nzblock=i-iblock;
+  return 0;
+ handle_malloc_failure:
+  return -1;
+}
+
+
+/* COPY m RECORDS STARTING AT RECORD ipos OF THE .idb TO im[].
+   RETURNS 0 ON SUCCESS, -1 ON ERROR */
+int scan_read_records(IntervalScan *scan,IntervalInt ipos,IntervalInt m,
+		      IntervalMap im[])
+{
+  IntervalInt i,k,iblock;
+  int div=scan->db_file->div;
+  unsigned char *p;
+  CompressedBlocks *blocks=scan->db_file->blocks;
+  if (scan->db_file->im_map) { /* NO I/O NEEDED */
+    memcpy(im,scan->db_file->im_map+ipos,m*sizeof(IntervalMap));
+    return 0;
+  }
+  for (i=0;i<m;i+=k,ipos+=k) {
+    if (blocks) {
+      iblock=ipos/div;
+      if (iblock<0 || iblock>=blocks->nblock)
+	goto corrupted_block;
+      if (scan->dblock!=iblock+1) { /* DECODE THIS BLOCK */
+	scan->dblock=0;
+	if (blocks->map) {
+	  if (blocks->offset[iblock+1]>(long long)blocks->map_size)
+	    goto corrupted_block;
+	  p=blocks->map+blocks->offset[iblock];
+	}
+	else {
+	  if ((iblock<scan->zblock || iblock>=scan->zblock+scan->nzblock)
+	      && scan_read_blocks(scan,iblock))
+	    goto read_error;
+	  p=scan->zbuf+(blocks->offset[iblock]-blocks->offset[scan->zblock]);
+	}
+	if ((scan->dn=decode_interval_block(p,(size_t)(blocks->offset[iblock+1]
+						       -blocks->offset[iblock]),
+					    scan->dbuf,div))<0)
+	  goto corrupted_block;
+	scan->dblock=iblock+1;
+      }
+      k=scan->dn-ipos%div; /* RECORDS LEFT IN THIS BLOCK */
+      if (k<=0)
+	goto corrupted_block;
+      if (k>m-i)
+	k=m-i;
+      memcpy(im+i,scan->dbuf+ipos%div,k*sizeof(IntervalMap));
+    }
+    else {
+      if (ipos<scan->rpos || ipos>=scan->rpos+scan->rn) { /* READ MORE */
+	scan->rpos=ipos;
+	scan->rn=read_records_at(scan->db_file->ifile_idb,scan->rbuf,
+				 sizeof(IntervalMap),scan->chunk_size,ipos,
+				 scan->db_file->isize);
+	if (scan->rn<=0)
+	  goto read_error;
+      }
+      k=scan->rpos+scan->rn-ipos;
+      if (k>m-i)
+	k=m-i;
+      memcpy(im+i,scan->rbuf+(ipos-scan->rpos),k*sizeof(IntervalMap));
+    }
+  }
+  return 0;
+ corrupted_block:
+  PYGR_SET_IO_ERROR("compressed nested list block corrupted?");
+  return -1;
+ read_error:
+  PYGR_SET_IO_ERROR("error or EOF reading nested list .idb file");
+  return -1;
+}
+
+
+/* MOVE THE SCAN TO THE NEXT LIST.  RETURNS 1 IF THERE IS ONE, 0 IF DONE,
+   -1 ON ERROR */
+int scan_next_list(IntervalScan *scan)
+{
+  IntervalInt isub,nblock=1024;
+  IntervalDBFile *db_file=scan->db_file;
+#ifdef ON_DEMAND_SUBLIST_HEADER
+  SubheaderFile *shf= &db_file->subheader_file;
+#endif
+  isub= ++scan->isub;
+  if (isub>=db_file->nlists)
+    return 0;
+#ifdef ON_DEMAND_SUBLIST_HEADER
+  if (isub>=shf->start && isub<shf->start+shf->nblock) /* IN MEMORY */
+    scan->sh=shf->subheader[isub-shf->start];
+  else { /* READ THE NEXT BLOCK OF SUBLIST HEADERS */
+    if (!scan->subheader) {
+      CALLOC(scan->subheader,nblock,SublistHeader);
+    }
+    if (isub>=scan->subheader_start+scan->nsubheader) {
+      scan->subheader_start=read_subheader_block(scan->subheader,isub,nblock,
+						 db_file->nlists,shf->ifile,
+						 shf->isize);
+      scan->nsubheader=db_file->nlists-scan->subheader_start;
+      if (scan->nsubheader>nblock)
+	scan->nsubheader=nblock;
+    }
+    scan->sh=scan->subheader[isub-scan->subheader_start];
+  }
+#else
+  scan->sh=db_file->subheader[isub];
+#endif
+  scan->k=0;
+  scan->nlist=scan->sh.len;
+  if (scan->padded && scan->sh.len>db_file->div && isub<db_file->nlists-1
+      && scan->sh.len%db_file->div) /* BIG LIST IS PADDED, UNLESS LAST */
+    scan->nlist+=db_file->div-scan->sh.len%db_file->div;
+  return 1;
+ handle_malloc_failure:
+  return -1;
+}
+
+
+/* COPY THE NEXT RECORDS OF THE SCAN, IN FILE ORDER (THE TOP LEVEL LIST,
+   THEN EACH SUBLIST), TO buf[0..nbuf-1].  RETURNS #RECORDS COPIED, 0 AT
+   THE END OF THE DATABASE, -1 ON ERROR */
+int interval_scan_next(IntervalScan *scan,IntervalMap buf[],int nbuf)
+{
+  int nreturn=0,i;
+  IntervalInt m;
+  while (nreturn<nbuf) {
+    if (scan->k>=scan->nlist) { /* FINISHED THIS LIST */
+      if ((i=scan_next_list(scan))<0)
+	return -1;
+      else if (i==0) /* NO MORE LISTS */
+	break;
+      continue;
+    }
+    if (scan->k<scan->sh.len) { /* COPY RECORDS OF THIS LIST */
+      m=scan->sh.len-scan->k;
+      if (m>nbuf-nreturn)
+	m=nbuf-nreturn;
+      if (scan_read_records(scan,scan->sh.start+scan->k,m,buf+nreturn))
+	return -1;
+      if (scan->k==0) /* PADDING IS COPIES OF THE FIRST RECORD */
+	scan->first=buf[nreturn];
+    }
+    else { /* PADDING */
+      m=scan->nlist-scan->k;
+      if (m>nbuf-nreturn)
+	m=nbuf-nreturn;
+      for (i=0;i<m;i++)
+	buf[nreturn+i]=scan->first;
+    }
+    scan->k+=m;
+    nreturn+=m;
+  }
+  return nreturn;
+}
+
+
+/* ADD A REFERENCE TO db_file FOR A QUERY ABOUT TO READ IT, E.G. WITHOUT
+   THE PYTHON GIL.  ITS OWNER'S free_interval_dbfile() THEN LEAVES IT
+   OPEN UNTIL THE QUERY RELEASES IT BY ITS OWN free_interval_dbfile() */
+IntervalDBFile *acquire_interval_dbfile(IntervalDBFile *db_file)
+{
+  if (db_file) {
+    PYGR_MUTEX_LOCK(db_file->lock);
+    db_file->nref++;
+    PYGR_MUTEX_UNLOCK(db_file->lock);
+  }
+  return db_file;
+}
+
 
+/* RELEASE ONE REFERENCE TO db_file, CLOSING AND FREEING IT WHEN NO
+   OWNERS REMAIN */
 int free_interval_dbfile(IntervalDBFile *db_file)
 {
+  int nref;
+  if (!db_file)
+    return 0;
+  PYGR_MUTEX_LOCK(db_file->lock);
+  nref= --db_file->nref;
+  PYGR_MUTEX_UNLOCK(db_file->lock);
+  if (nref>0) /* A QUERY IS STILL READING IT */
+    return 0;
+  PYGR_MUTEX_DESTROY(db_file->lock);
+#ifdef PYGR_USE_MMAP
+  if (db_file->im_map)
+    munmap(db_file->im_map,db_file->im_map_size);
+  if (db_file->subheader_map) {
+    munmap(db_file->subheader_map,db_file->subheader_map_size);
+    db_file->subheader=NULL; /* NOT OURS TO free() */
+  }
+#endif
+  set_dbfile_cache(db_file,NULL); /* DROP OUR BLOCKS FROM THE CACHE */
   if (db_file->ifile_idb)
     fclose(db_file->ifile_idb);
 #ifdef ON_DEMAND_SUBLIST_HEADER
   if (db_file->subheader_file.ifile)
     fclose(db_file->subheader_file.ifile);
 #endif
+  free_compressed_blocks(db_file->blocks);
   FREE(db_file->ii);
   FREE(db_file->subheader);
   free(db_file);
@@ -914,30 +3309,80 @@ int free_interval_dbfile(IntervalDBFile *db_file)
 
 
 
+/* SAVE ONE "M" LINE FOR EACH RECORD OF im[] */
+int write_text_intervals(FILE *ofile,IntervalMap im[],IntervalInt n)
+{
+  IntervalInt i;
+  for (i=0;i<n;i++)
+    if (fprintf(ofile,"M " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		" " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		" " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT "\n",
+		im[i].start,im[i].end,
+		im[i].target_id,im[i].target_start,
+		im[i].target_end,im[i].sublist)<0)
+      return -1;
+  return 0;
+}
+
+
+/* SAVE THE FIRST npad RECORDS OF THE UNCOMPRESSED LAYOUT OF filestem
+   (DECODING IT IF COMPRESSED) AS "M" LINES, READING THE .idb
+   SEQUENTIALLY IN BIG CHUNKS.  RETURNS 0 ON SUCCESS, -1 ON A READ ERROR
+   (MESSAGE IN err_msg), -2 ON A WRITE ERROR */
+int save_text_intervals(char filestem[],char err_msg[],FILE *ofile,
+			IntervalInt npad)
+{
+  int nread,nbuf=65536,result= -1;
+  IntervalMap *buf=NULL;
+  IntervalDBFile *db_file=NULL;
+  IntervalScan *scan=NULL;
+  if (!(db_file=read_binary_files(filestem,err_msg,1024)))
+    return -1;
+  if (err_msg)
+    sprintf(err_msg,"error reading file %s.idb",filestem);
+  CALLOC(buf,nbuf,IntervalMap);
+  if (!(scan=interval_scan_alloc(db_file,nbuf,1)))
+    goto handle_malloc_failure;
+  while (npad>0) {
+    nread=npad<nbuf ? (int)npad : nbuf;
+    if ((nread=interval_scan_next(scan,buf,nread))<=0)
+      goto handle_malloc_failure; /* SHORTER THAN THE HEADERS SAY? */
+    if (write_text_intervals(ofile,buf,nread)) {
+      result= -2;
+      goto handle_malloc_failure;
+    }
+    npad-=nread;
+  }
+  result=0;
+ handle_malloc_failure: /* ALSO OUR CLEANUP FOR SUCCESS OR ANY ERROR */
+  free_interval_scan(scan);
+  FREE(buf);
+  free_interval_dbfile(db_file);
+  return result;
+}
+
+
 int save_text_file(char filestem[],char basestem[],
 		   char err_msg[],FILE *ofile)
 {
-  int i,n,ntop,div,nlists,nii,npad;
+  IntervalInt i,n,ntop,nlists,nii,npad,raw_start;
+  int div,codec,isize;
   char path[2048];
-  IntervalMap im;
   IntervalIndex ii;
   SublistHeader subheader;
   FILE *ifile=NULL;
 
-  sprintf(path,"%s.size",filestem); /* READ BASIC SIZE INFO*/
-  ifile=fopen(path,"r"); /* text file */
-  if (!ifile) 
-    goto unable_to_open_file;
-  if (5!=fscanf(ifile,"%d %d %d %d %d",&n,&ntop,&div,&nlists,&nii))
-    goto fread_error_occurred;
-  fclose(ifile);
+  if (read_binary_size(filestem,err_msg,&n,&ntop,&div,&nlists,&nii,&codec,
+		       &isize)<0)
+    return -1;
   npad=ntop%div;
   if (npad>0) /* PAD TO AN EXACT MULTIPLE OF div */
     npad=ntop+(div-npad);
   else /* AN EXACT MULTIPLE OF div, SO NO PADDING */
     npad=ntop;
 
-  if (fprintf(ofile,"SIZE\t%s\t%d %d %d %d %d\n",
+  if (fprintf(ofile,"SIZE\t%s\t" INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+	      " %d " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT "\n",
 	      basestem,n,ntop,div,nlists,nii)<0)
     goto write_error_occurred;
 
@@ -947,9 +3392,10 @@ int save_text_file(char filestem[],char basestem[],
     if (!ifile) 
       goto unable_to_open_file;
     for (i=0;i<nii;i++) {
-      if (1!=fread(&ii,sizeof(IntervalIndex),1,ifile))
+      if (1!=fread_records(&ii,sizeof(IntervalIndex),1,ifile,isize))
 	goto fread_error_occurred;
-      if (fprintf(ofile,"I %d %d\n",ii.start,ii.end)<0)
+      if (fprintf(ofile,"I " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT "\n",
+		  ii.start,ii.end)<0)
 	goto write_error_occurred;
     }
     fclose(ifile);
@@ -960,30 +3406,29 @@ int save_text_file(char filestem[],char basestem[],
     ifile=fopen(path,"rb"); /* binary file */
     if (!ifile) 
       goto unable_to_open_file;
+    raw_start=npad; /* WHERE THE UNCOMPRESSED .idb WOULD PUT IT */
     for (i=0;i<nlists;i++) {
-      if (1!=fread(&subheader,sizeof(SublistHeader),1,ifile))
+      if (1!=fread_records(&subheader,sizeof(SublistHeader),1,ifile,isize))
 	goto fread_error_occurred;
-      if (fprintf(ofile,"S %d %d\n",subheader.start,subheader.len)<0)
+      if (codec!=NCLIST_CODEC_NONE) { /* SAVE THE UNCOMPRESSED LAYOUT */
+	subheader.start=raw_start;
+	raw_start+=subheader.len;
+	if (subheader.len>div && subheader.len%div) /* BIG LIST IS PADDED */
+	  raw_start+=div-subheader.len%div;
+      }
+      if (fprintf(ofile,"S " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT "\n",
+		  subheader.start,subheader.len)<0)
 	goto write_error_occurred;
       npad=subheader.start+subheader.len;
     }
     fclose(ifile);
   }
 
-  if (npad>0) {
-    sprintf(path,"%s.idb",filestem); /* READ THE DATABASE */
-    ifile=fopen(path,"rb"); /* binary file */
-    if (!ifile) 
-      goto unable_to_open_file;
-    for (i=0;i<npad;i++) {
-      if (1!=fread(&im,sizeof(IntervalMap),1,ifile))
-	goto fread_error_occurred;
-      if (fprintf(ofile,"M %d %d %d %d %d %d\n",im.start,im.end,
-		  im.target_id,im.target_start,
-		  im.target_end,im.sublist)<0)
-	goto write_error_occurred;
-    }
-    fclose(ifile);
+  if (npad>0) { /* SAVE THE RECORDS OF THE UNCOMPRESSED .idb */
+    if ((i=save_text_intervals(filestem,err_msg,ofile,npad))==-2)
+      goto write_error_occurred;
+    else if (i<0)
+      return -1;
   }
   return 0; /* INDICATES NO ERROR OCCURRED */
  unable_to_open_file:
@@ -1004,7 +3449,8 @@ int save_text_file(char filestem[],char basestem[],
 
 int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
 {
-  int i,n,ntop,div,nlists,nii,npad;
+  IntervalInt i,n,ntop,nlists,nii,npad;
+  int div;
   char path[2048],line[32768],filestem[2048];
   IntervalMap im;
   IntervalIndex ii;
@@ -1013,16 +3459,15 @@ int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
 
   if (NULL==fgets(line,32767,infile))
     goto fread_error_occurred;
-  if (6!=sscanf(line,"SIZE\t%s\t%d %d %d %d %d",
+  if (6!=sscanf(line,"SIZE\t%s\t" INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		" %d " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT,
 		filestem,&n,&ntop,&div,&nlists,&nii))
     goto fread_error_occurred;
-  sprintf(path,"%s%s.size",buildpath,filestem); /* SAVE BASIC SIZE INFO*/
-  ifile=fopen(path,"w"); /* text file */
-  if (!ifile) 
+  sprintf(path,"%s%s",buildpath,filestem); /* SAVE BASIC SIZE INFO*/
+  if (write_binary_size(path,n,ntop,div,nlists,nii,NCLIST_CODEC_NONE)<0) {
+    strcat(path,".size");
     goto unable_to_open_file;
-  if (fprintf(ifile,"%d %d %d %d %d\n",n,ntop,div,nlists,nii)<0)
-    goto write_error_occurred;
-  fclose(ifile);
+  }
   npad=ntop%div;
   if (npad>0) /* PAD TO AN EXACT MULTIPLE OF div */
     npad=ntop+(div-npad);
@@ -1037,7 +3482,8 @@ int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
     for (i=0;i<nii;i++) {
       if (NULL==fgets(line,32767,infile))
 	goto fread_error_occurred;
-      if (2!=sscanf(line,"I %d %d",&(ii.start),&(ii.end)))
+      if (2!=sscanf(line,"I " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT,
+		    &(ii.start),&(ii.end)))
 	goto fread_error_occurred;
       if (1!=fwrite(&ii,sizeof(IntervalIndex),1,ifile))
 	goto write_error_occurred;
@@ -1053,7 +3499,8 @@ int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
     for (i=0;i<nlists;i++) {
       if (NULL==fgets(line,32767,infile))
 	goto fread_error_occurred;
-      if (2!=sscanf(line,"S %d %d",&(subheader.start),&(subheader.len)))
+      if (2!=sscanf(line,"S " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT,
+		    &(subheader.start),&(subheader.len)))
 	goto fread_error_occurred;
       if (1!=fwrite(&subheader,sizeof(SublistHeader),1,ifile))
 	goto write_error_occurred;
@@ -1069,7 +3516,9 @@ int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
   for (i=0;i<npad;i++) {
     if (NULL==fgets(line,32767,infile))
       goto fread_error_occurred;
-    if (6!=sscanf(line,"M %d %d %d %d %d %d",&(im.start),&(im.end),
+    if (6!=sscanf(line,"M " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		  " " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT
+		  " " INTERVAL_INT_FORMAT " " INTERVAL_INT_FORMAT,&(im.start),&(im.end),
 		  &(im.target_id),&(im.target_start),
 		  &(im.target_end),&(im.sublist)))
       goto fread_error_occurred;
@@ -1095,3 +3544,269 @@ int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
 }
 
 
+
+
+
+
+/***************************************************************
+ * PORTABLE BINARY BUNDLE OF A NESTED LIST DATABASE: THE SAME CONTENT
+ * AS THE TEXT DUMP, BUT EVERY INTEGER IS SAVED AS 8 BYTES LITTLE-ENDIAN
+ * (WHATEVER THE PLATFORM OR SIZE OF IntervalInt), IN BIG CHUNKS.
+ * BOTH DIRECTIONS READ / WRITE STRICTLY SEQUENTIALLY, SO A BUNDLE CAN
+ * BE PIPED STRAIGHT FROM ONE HOST TO ANOTHER.
+ ***************************************************************/
+
+/* SAVE n INTEGERS AS 8 BYTE LITTLE-ENDIAN VALUES, VIA buf OF
+   BUNDLE_BUF_INTS*8 BYTES.  RETURNS 0 ON SUCCESS, -1 ON A WRITE ERROR */
+int write_bundle_ints(FILE *ofile,IntervalInt v[],IntervalInt n,
+		      unsigned char buf[])
+{
+  IntervalInt i,m;
+  unsigned long long u;
+  unsigned char *p;
+  int k;
+  while (n>0) {
+    m=n<BUNDLE_BUF_INTS ? n : BUNDLE_BUF_INTS;
+    for (i=0,p=buf;i<m;i++) /* LOW BYTE FIRST */
+      for (k=0,u=(unsigned long long)v[i];k<8;k++,u>>=8)
+	*p++ = (unsigned char)(u&0xff);
+    if (fwrite(buf,8,m,ofile)!=(size_t)m)
+      return -1;
+    v+=m;
+    n-=m;
+  }
+  return 0;
+}
+
+
+/* READ n INTEGERS SAVED BY write_bundle_ints().  RETURNS 0 ON SUCCESS,
+   -1 ON A READ ERROR OR EOF, -2 IF A VALUE DOESN'T FIT IN IntervalInt */
+int read_bundle_ints(FILE *infile,IntervalInt v[],IntervalInt n,
+		     unsigned char buf[])
+{
+  IntervalInt i,m;
+  unsigned long long u;
+  long long x;
+  unsigned char *p;
+  int k;
+  while (n>0) {
+    m=n<BUNDLE_BUF_INTS ? n : BUNDLE_BUF_INTS;
+    if (fread(buf,8,m,infile)!=(size_t)m)
+      return -1;
+    for (i=0,p=buf;i<m;i++,p+=8) {
+      for (k=7,u=0;k>=0;k--)
+	u=(u<<8)|p[k];
+      x=(long long)u;
+      if ((IntervalInt)x!=x) /* NEEDS A BUILD WITH 64 BIT INTERVALS */
+	return -2;
+      v[i]=(IntervalInt)x;
+    }
+    v+=m;
+    n-=m;
+  }
+  return 0;
+}
+
+
+/* SAVE NESTED LIST DATABASE filestem TO THE BUNDLE ofile UNDER THE NAME
+   basestem.  LIKE save_text_file(), A COMPRESSED DATABASE IS SAVED IN
+   THE UNCOMPRESSED LAYOUT.  RETURNS 0 ON SUCCESS, -1 ON ERROR */
+int save_bundle_file(char filestem[],char basestem[],char err_msg[],
+		     FILE *ofile)
+{
+  IntervalInt i,j,m,npad,raw_start,hdr[5];
+  int nread,result= -1;
+  char path[2048];
+  unsigned char *buf=NULL;
+  IntervalMap *im=NULL;
+  SublistHeader *subheader;
+  IntervalDBFile *db_file=NULL;
+  IntervalScan *scan=NULL;
+  FILE *ifile=NULL;
+
+  if (!(db_file=read_binary_files(filestem,err_msg,1024)))
+    return -1;
+  sprintf(path,"%s.idb",filestem);
+  CALLOC(buf,BUNDLE_BUF_INTS*8,unsigned char);
+  CALLOC(im,BUNDLE_CHUNK,IntervalMap);
+  hdr[0]=(IntervalInt)strlen(basestem); /* SAVE ITS NAME, THEN SIZE INFO */
+  if (write_bundle_ints(ofile,hdr,1,buf)
+      || fwrite(basestem,1,hdr[0],ofile)!=(size_t)hdr[0])
+    goto write_error_occurred;
+  hdr[0]=db_file->n;
+  hdr[1]=db_file->ntop;
+  hdr[2]=db_file->div;
+  hdr[3]=db_file->nlists;
+  hdr[4]=db_file->nii;
+  if (write_bundle_ints(ofile,hdr,5,buf)
+      || write_bundle_ints(ofile,(IntervalInt *)db_file->ii,
+			   2*db_file->nii,buf))
+    goto write_error_occurred;
+
+  npad=db_file->ntop%db_file->div;
+  if (npad>0) /* PAD TO AN EXACT MULTIPLE OF div */
+    npad=db_file->ntop+(db_file->div-npad);
+  else /* AN EXACT MULTIPLE OF div, SO NO PADDING */
+    npad=db_file->ntop;
+  if (db_file->nlists>0) {
+    sprintf(path,"%s.subhead",filestem); /* COPY THE SUBHEADER LIST */
+    if (!(ifile=fopen(path,"rb"))) { /* binary file */
+      if (err_msg)
+	sprintf(err_msg,"unable to open file %s",path);
+      goto handle_malloc_failure;
+    }
+    subheader=(SublistHeader *)im; /* im HAS ROOM FOR 3*BUNDLE_CHUNK */
+    raw_start=npad; /* WHERE THE UNCOMPRESSED .idb WOULD PUT IT */
+    for (i=0;i<db_file->nlists;i+=m) {
+      m=db_file->nlists-i<3*BUNDLE_CHUNK ? db_file->nlists-i : 3*BUNDLE_CHUNK;
+      if (fread_records(subheader,sizeof(SublistHeader),m,ifile,
+			db_file->isize)!=(size_t)m)
+	goto read_error_occurred;
+      if (db_file->blocks) /* SAVE THE UNCOMPRESSED LAYOUT */
+	for (j=0;j<m;j++) {
+	  subheader[j].start=raw_start;
+	  raw_start+=subheader[j].len;
+	  if (subheader[j].len>db_file->div && subheader[j].len%db_file->div)
+	    raw_start+=db_file->div-subheader[j].len%db_file->div;
+	}
+      if (write_bundle_ints(ofile,(IntervalInt *)subheader,2*m,buf))
+	goto write_error_occurred;
+      npad=subheader[m-1].start+subheader[m-1].len;
+    }
+    fclose(ifile);
+    ifile=NULL;
+    sprintf(path,"%s.idb",filestem);
+  }
+
+  if (write_bundle_ints(ofile,&npad,1,buf)) /* THEN ALL ITS RECORDS */
+    goto write_error_occurred;
+  if (!(scan=interval_scan_alloc(db_file,BUNDLE_CHUNK,1)))
+    goto handle_malloc_failure;
+  while (npad>0) {
+    nread=npad<BUNDLE_CHUNK ? (int)npad : BUNDLE_CHUNK;
+    if ((nread=interval_scan_next(scan,im,nread))<=0)
+      goto read_error_occurred; /* SHORTER THAN THE HEADERS SAY? */
+    if (write_bundle_ints(ofile,(IntervalInt *)im,6*nread,buf))
+      goto write_error_occurred;
+    npad-=nread;
+  }
+  result=0;
+ handle_malloc_failure: /* ALSO OUR CLEANUP FOR SUCCESS OR ANY ERROR */
+  if (ifile)
+    fclose(ifile);
+  free_interval_scan(scan);
+  FREE(im);
+  FREE(buf);
+  free_interval_dbfile(db_file);
+  return result;
+ read_error_occurred:
+  if (err_msg)
+    sprintf(err_msg,"error or EOF reading file %s",path);
+  goto handle_malloc_failure;
+ write_error_occurred:
+  if (err_msg)
+    sprintf(err_msg,"error writing output file! out of disk space?");
+  goto handle_malloc_failure;
+}
+
+
+/* COPY m IntervalInt[] RECORDS OF width INTEGERS FROM THE BUNDLE infile
+   TO THE BINARY FILE path, VIA v[] WITH ROOM FOR BUNDLE_CHUNK IntervalMap.
+   RETURNS 0 ON SUCCESS, OR -1 ON ERROR (MESSAGE IN err_msg) */
+int copy_bundle_records(FILE *infile,char path[],IntervalInt m,int width,
+			IntervalInt v[],unsigned char buf[],char err_msg[])
+{
+  IntervalInt k,nbuf=6*BUNDLE_CHUNK/width;
+  int i;
+  FILE *ofile;
+  if (!(ofile=fopen(path,"wb"))) { /* binary file */
+    if (err_msg)
+      sprintf(err_msg,"unable to open file %s",path);
+    return -1;
+  }
+  for (;m>0;m-=k) {
+    k=m<nbuf ? m : nbuf;
+    if ((i=read_bundle_ints(infile,v,width*k,buf))<0) {
+      if (err_msg && i== -2)
+	sprintf(err_msg,"bundle values too big: this needs a pygr build"
+		" with 64 bit intervals");
+      else if (err_msg)
+	sprintf(err_msg,"error or EOF reading input file");
+      fclose(ofile);
+      return -1;
+    }
+    if (fwrite(v,width*sizeof(IntervalInt),k,ofile)!=(size_t)k) {
+      if (err_msg)
+	sprintf(err_msg,"error writing file %s! out of disk space?",path);
+      fclose(ofile);
+      return -1;
+    }
+  }
+  if (fclose(ofile)) {
+    if (err_msg)
+      sprintf(err_msg,"error writing file %s! out of disk space?",path);
+    return -1;
+  }
+  return 0;
+}
+
+
+/* READ ONE NESTED LIST DATABASE SAVED BY save_bundle_file() FROM infile,
+   WRITING ITS UNCOMPRESSED BINARY FILES DIRECTLY IN DIRECTORY buildpath.
+   RETURNS 0 ON SUCCESS, -1 ON ERROR (MESSAGE IN err_msg) */
+int bundle_file_to_binaries(FILE *infile,char buildpath[],char err_msg[])
+{
+  IntervalInt hdr[5],npad;
+  int i=0,result= -1;
+  char path[2048],filestem[1024];
+  unsigned char *buf=NULL;
+  IntervalMap *im=NULL;
+
+  CALLOC(buf,BUNDLE_BUF_INTS*8,unsigned char);
+  CALLOC(im,BUNDLE_CHUNK,IntervalMap);
+  if ((i=read_bundle_ints(infile,hdr,1,buf))<0 || hdr[0]<=0
+      || hdr[0]>=sizeof(filestem) || strlen(buildpath)+hdr[0]>=sizeof(path)-16
+      || fread(filestem,1,hdr[0],infile)!=(size_t)hdr[0])
+    goto fread_error_occurred;
+  filestem[hdr[0]]='\0';
+  if ((i=read_bundle_ints(infile,hdr,5,buf))<0)
+    goto fread_error_occurred;
+  if (hdr[2]<=0 || hdr[2]>INT_MAX) /* div */
+    goto fread_error_occurred;
+  sprintf(path,"%s%s",buildpath,filestem); /* SAVE BASIC SIZE INFO*/
+  if (write_binary_size(path,hdr[0],hdr[1],(int)hdr[2],hdr[3],hdr[4],
+			NCLIST_CODEC_NONE)<0) {
+    if (err_msg)
+      sprintf(err_msg,"unable to open file %s.size",path);
+    goto handle_malloc_failure;
+  }
+  if (hdr[4]>0) { /* SAVE INDEX INFO */
+    sprintf(path,"%s%s.index",buildpath,filestem);
+    if (copy_bundle_records(infile,path,hdr[4],2,(IntervalInt *)im,buf,
+			    err_msg))
+      goto handle_malloc_failure;
+  }
+  if (hdr[3]>0) { /* SAVE THE SUBHEADER LIST */
+    sprintf(path,"%s%s.subhead",buildpath,filestem);
+    if (copy_bundle_records(infile,path,hdr[3],2,(IntervalInt *)im,buf,
+			    err_msg))
+      goto handle_malloc_failure;
+  }
+  if ((i=read_bundle_ints(infile,&npad,1,buf))<0 || npad<0)
+    goto fread_error_occurred;
+  sprintf(path,"%s%s.idb",buildpath,filestem); /* SAVE THE ACTUAL INTERVAL DB*/
+  if (copy_bundle_records(infile,path,npad,6,(IntervalInt *)im,buf,err_msg))
+    goto handle_malloc_failure;
+  result=0;
+ handle_malloc_failure: /* ALSO OUR CLEANUP FOR SUCCESS OR ANY ERROR */
+  FREE(im);
+  FREE(buf);
+  return result;
+ fread_error_occurred:
+  if (err_msg && i== -2)
+    sprintf(err_msg,"bundle values too big: this needs a pygr build"
+	    " with 64 bit intervals");
+  else if (err_msg)
+    sprintf(err_msg,"error or bad format reading input file");
+  goto handle_malloc_failure;
+}
@@ -4,67 +4,238 @@
 #include "default.h"
 #include <limits.h>
 
-extern int C_int_max;
+/* COORDINATES, COUNTS AND RECORD OFFSETS.  COMPILE WITH
+   -DPYGR_64BIT_INTERVALS FOR SEQUENCES / UNIONS LONGER THAN 2^31,
+   OR MORE THAN 2^31 INTERVALS IN ONE DATABASE */
+#ifdef PYGR_64BIT_INTERVALS
+typedef long long IntervalInt;
+#define INTERVAL_INT_MAX LLONG_MAX
+#define INTERVAL_INT_FORMAT "%lld"
+#else
+typedef int IntervalInt;
+#define INTERVAL_INT_MAX INT_MAX
+#define INTERVAL_INT_FORMAT "%d"
+#endif
+
+/* BINARY FILE FORMAT VERSION, SAVED IN THE .size FILE.  VERSION 1
+   (32 BIT int RECORDS) HAS NO HEADER LINE, FOR COMPATIBILITY.
+   VERSION 2 ADDS THE INTEGER SIZE, VERSION 3 THE .idb BLOCK CODEC */
+#define NCLIST_FORMAT_TAG "NCLIST_FORMAT"
+#define NCLIST_FORMAT_VERSION 3
+
+#define NCLIST_CODEC_NONE 0 /* .idb IS AN ARRAY OF RAW IntervalMap */
+#define NCLIST_CODEC_VARINT 1 /* .idb IS div-RECORD BLOCKS OF DELTA VARINTS */
+#define NCLIST_VARINT_MAXBYTES 10 /* LONGEST VARINT OF A 64 BIT VALUE */
+/* MAXIMUM BYTES OF AN ENCODED BLOCK OF N RECORDS, INCLUDING ITS COUNT */
+#define NCLIST_BLOCK_MAXBYTES(N) (((N)*6+1)*NCLIST_VARINT_MAXBYTES)
+#define BUNDLE_CHUNK 65536 /* RECORDS PER BUNDLE fread() / fwrite() */
+#define BUNDLE_BUF_INTS (6*BUNDLE_CHUNK)
+
+extern IntervalInt C_int_max;
 
 typedef struct {
-  int start;
-  int end;
-  int target_id;
-  int target_start;
-  int target_end;
-  int sublist;
+  IntervalInt start;
+  IntervalInt end;
+  IntervalInt target_id;
+  IntervalInt target_start;
+  IntervalInt target_end;
+  IntervalInt sublist;
 } IntervalMap;
 
 
 typedef struct {
-  int start;
-  int end;
+  IntervalInt start;
+  IntervalInt end;
 } IntervalIndex;
 
 typedef struct {
-  int start;
-  int len;
+  IntervalInt start;
+  IntervalInt len;
 } SublistHeader;
 
 typedef struct {
-  int n;
-  int ntop;
-  int nlists;
+  IntervalInt n;
+  IntervalInt ntop;
+  IntervalInt nlists;
   IntervalMap *im;
   SublistHeader *subheader;
 } IntervalDB;
 
 typedef struct { /* FOR REAL-TIME DISK ACCESS TO SUBLIST HEADER FILE*/
-  SublistHeader *subheader;
-  int nblock;
-  int start;
+  SublistHeader *subheader; /* SHARED, READ-ONLY, E.G. THE MAPPED FILE */
+  IntervalInt nblock;
+  IntervalInt start;
+  IntervalInt read_nblock; /* #HEADERS PER READ INTO AN ITERATOR'S sh_buf */
+  int isize; /* INTEGER SIZE OF ifile: 4 IF SAVED BY A 32 BIT BUILD */
   FILE *ifile;
 } SubheaderFile;
 
-typedef struct {
+typedef struct { /* BLOCK OFFSETS OF A COMPRESSED .idb FILE */
+  long long *offset; /* BLOCK k IS BYTES offset[k] .. offset[k+1]-1 */
+  IntervalInt nblock;
+  unsigned char *map; /* MEMORY-MAPPED .idb FILE, OR NULL IF NOT MAPPED */
+  size_t map_size;
+} CompressedBlocks;
+
+typedef struct BlockCacheEntry_S { /* ONE CACHED BLOCK OR SMALL SUBLIST */
+  FILE *ifile; /* KEY: THE .idb FILE IT CAME FROM ... */
+  IntervalInt ipos; /* ... AND ITS FIRST RECORD POSITION IN THAT FILE */
   int n;
-  int ntop;
-  int nlists;
+  IntervalMap *im;
+  struct BlockCacheEntry_S *prev; /* LRU LIST, MOST RECENTLY USED FIRST */
+  struct BlockCacheEntry_S *next;
+  struct BlockCacheEntry_S *hnext; /* HASH BUCKET CHAIN */
+} BlockCacheEntry;
+
+typedef struct { /* SIZE-BOUNDED LRU CACHE OF DECODED BLOCKS, WHICH
+		    SEVERAL IntervalDBFile MAY SHARE */
+  long long max_bytes;
+  long long nbytes; /* CURRENTLY CACHED, INCLUDING ENTRY OVERHEAD */
+  long long hits;
+  long long misses;
+  long long evictions;
+  BlockCacheEntry **hash;
+  int nhash;
+  BlockCacheEntry *head; /* MOST RECENTLY USED */
+  BlockCacheEntry *tail; /* NEXT TO EVICT */
+  int nref; /* #OWNERS: ITS CREATOR PLUS EACH IntervalDBFile USING IT */
+  PYGR_MUTEX_T lock;
+} BlockCache;
+
+typedef struct {
+  IntervalInt n;
+  IntervalInt ntop;
+  IntervalInt nlists;
   int div;
-  int nii;
+  IntervalInt nii;
   IntervalIndex *ii;
   SublistHeader *subheader;
   SubheaderFile subheader_file;
   FILE *ifile_idb;
+  int isize; /* INTEGER SIZE OF THE FILES: 4 IF SAVED BY A 32 BIT BUILD */
+  IntervalMap *im_map; /* MEMORY-MAPPED .idb FILE, OR NULL IF NOT MAPPED */
+  size_t im_map_size;
+  SublistHeader *subheader_map; /* MEMORY-MAPPED .subhead FILE, OR NULL */
+  size_t subheader_map_size;
+  CompressedBlocks *blocks; /* NULL UNLESS .idb IS COMPRESSED */
+  BlockCache *cache; /* SHARED BLOCK CACHE, OR NULL: SEE set_dbfile_cache() */
+  int nref; /* #OWNERS: ITS OPENER PLUS EACH QUERY RUNNING WITHOUT THE GIL */
+  PYGR_MUTEX_T lock;
 } IntervalDBFile;
 
 typedef struct IntervalIterator_S {
-  int i;
-  int n;
-  int nii;
-  int ntop;
-  int i_div;
-  IntervalMap *im;
+  IntervalInt i;
+  IntervalInt n;
+  IntervalInt nii;
+  IntervalInt ntop;
+  IntervalInt i_div;
+  IntervalMap *im; /* CURRENT BLOCK: EITHER im_buf OR POINTER INTO MAPPED FILE */
+  IntervalMap *im_buf; /* BLOCK BUFFER OWNED BY THIS ITERATOR, IF ANY */
+  IntervalInt im_buf_div; /* 1 + BLOCK NUMBER HELD IN im_buf, OR 0 IF NONE */
+  unsigned char *zbuf; /* COMPRESSED BYTES OF A BLOCK, IF COMPRESSED */
+  size_t zbuf_size;
+  SublistHeader *sh_buf; /* STACK TOP ONLY: SUBLIST HEADERS READ FROM DISK */
+  IntervalInt sh_start; /* INDEX OF sh_buf[0] */
+  IntervalInt sh_n; /* #HEADERS IN sh_buf */
   struct IntervalIterator_S *up;
   struct IntervalIterator_S *down;
 } IntervalIterator;
 
 
+typedef struct { /* SEQUENTIAL READ OF ALL RECORDS OF AN IntervalDBFile */
+  IntervalDBFile *db_file;
+  int padded; /* ALSO RETURN THE PADDING OF AN UNCOMPRESSED .idb */
+  int chunk_size; /* RECORDS PER READ */
+  IntervalInt isub; /* CURRENT LIST: -1 FOR THE TOP LEVEL */
+  SublistHeader sh; /* ITS RECORDS IN THE .idb */
+  IntervalInt nlist; /* ITS LENGTH, INCLUDING ANY PADDING TO RETURN */
+  IntervalInt k; /* #RECORDS OF IT RETURNED SO FAR */
+  IntervalMap first; /* ITS FIRST RECORD, WHICH IS ALSO ITS PADDING */
+  SublistHeader *subheader; /* BLOCK OF SUBLIST HEADERS READ FROM DISK */
+  IntervalInt subheader_start;
+  IntervalInt nsubheader; /* #HEADERS READ INTO subheader */
+  IntervalMap *rbuf; /* UNCOMPRESSED: RECORDS rpos .. rpos+rn-1 */
+  PYGR_OFF_T rpos;
+  IntervalInt rn;
+  unsigned char *zbuf; /* COMPRESSED: BYTES OF BLOCKS zblock .. +nzblock-1 */
+  size_t zbuf_size;
+  IntervalInt zblock;
+  IntervalInt nzblock;
+  IntervalMap *dbuf; /* COMPRESSED: DECODED BLOCK dblock-1, dn RECORDS */
+  IntervalInt dblock;
+  int dn;
+} IntervalScan;
+
+typedef struct { /* READS A NESTED LIST IN start ORDER, IN PLACE */
+  IntervalMap *im; /* IN-MEMORY LIST ... */
+  IntervalInt ntop;
+  SublistHeader *subheader;
+  IntervalInt nlists;
+  IntervalDBFile *db_file; /* ... OR ON-DISK LIST, IF NOT NULL */
+  IntervalIterator *sh_it; /* HOLDS SUBLIST HEADERS READ FROM DISK */
+  IntervalIterator **heap; /* LISTS BEING READ, BY THEIR NEXT INTERVAL */
+  int nheap;
+  int maxheap;
+  IntervalIterator *spare; /* ITERATORS FOR REUSE, CHAINED BY down */
+} NestedListWalk;
+
+typedef struct { /* STATE OF A SWEEP-LINE OVERLAP JOIN OF TWO NESTED LISTS */
+  NestedListWalk *a; /* BOTH READ IN start ORDER */
+  NestedListWalk *b;
+  IntervalMap next_a; /* NEXT INTERVAL OF a, b TO PROCESS, IF has_a, has_b */
+  IntervalMap next_b;
+  int has_a;
+  int has_b;
+  IntervalMap *active_a; /* INTERVALS STILL OPEN AT THE SWEEP POSITION */
+  IntervalMap *active_b;
+  IntervalInt nactive_a;
+  IntervalInt nactive_b;
+  IntervalInt maxactive_a;
+  IntervalInt maxactive_b;
+  int emit_from; /* 1: EMITTING emit VS. active_b; 2: emit VS. active_a */
+  IntervalMap emit;
+  IntervalInt emit_k; /* NEXT ACTIVE INTERVAL TO COMPARE WITH */
+} IntervalJoin;
+
+typedef struct { /* BOUNDED-MEMORY SORT OF FIXED-SIZE RECORDS VIA A TEMP FILE */
+  int size; /* BYTES PER RECORD */
+  int (*cmp)(const void *,const void *);
+  char *buf; /* RUN BEING FILLED, THEN THE MERGE BUFFERS */
+  int nbuf;
+  int maxbuf;
+  FILE *ifile; /* TEMP FILE HOLDING THE SORTED RUNS */
+  char path[2048];
+  PYGR_OFF_T *run; /* RUN i IS RECORDS run[i] .. run[i+1]-1 OF ifile */
+  int nrun;
+  int maxrun;
+  int irun; /* MERGE: FIRST RUN BEING MERGED */
+  int nmbuf; /* MERGE: RECORDS BUFFERED PER RUN */
+  PYGR_OFF_T *next; /* MERGE: NEXT RECORD TO READ FROM EACH RUN */
+  int *ihead; /* MERGE: CURRENT RECORD IN EACH RUN BUFFER */
+  int *nhead; /* MERGE: #RECORDS IN EACH RUN BUFFER */
+  int *heap; /* MERGE: RUNS ORDERED BY THEIR CURRENT RECORD */
+  int nheap;
+} ExternalSort;
+
+typedef struct { /* AN INTERVAL TAGGED WITH ITS PLACE IN THE NESTED LIST */
+  IntervalInt isublist; /* SUBLIST IT BELONGS TO, 0 FOR TOP LEVEL */
+  IntervalInt ipos; /* ITS POSITION IN start ORDER */
+  IntervalMap im; /* im.sublist IS ITS OWN SUBLIST, OR -1 */
+} SublistRecord;
+
+typedef struct { /* START OR STOP OF A TARGET INTERVAL, FOR groupBySequences */
+  IntervalInt ipos; /* SOURCE POSITION OF THIS BOUND */
+  int is_start;
+  int iseq; /* ORDER OF ITS SEQUENCE IN THE GROUP */
+  int islot; /* ITS SEQUENCE'S OPEN INTERVAL COUNTER */
+  int is_indel; /* NOT THE FIRST INTERVAL OF ITS SEQUENCE */
+  int ival; /* INDEX OF ITS INTERVAL */
+  IntervalInt start; /* COORDS OF ITS INTERVAL */
+  IntervalInt end;
+  IntervalInt target_start;
+  IntervalInt target_end;
+} SeqBound;
+
 typedef struct {
   FILE *ifile;
   int left;
@@ -75,37 +246,128 @@ typedef struct {
 
 extern int imstart_qsort_cmp(const void *void_a,const void *void_b);
 extern int target_qsort_cmp(const void *void_a,const void *void_b);
-extern IntervalMap *read_intervals(int n,FILE *ifile);
-extern SublistHeader *build_nested_list(IntervalMap im[],int n,
-					int *p_n,int *p_nlists);
-extern SublistHeader *build_nested_list_inplace(IntervalMap im[],int n,
-                                                int *p_n,int *p_nlists);
-extern IntervalMap *interval_map_alloc(int n);
-extern IntervalDB *build_interval_db(IntervalMap im[],int n);
+extern IntervalMap *read_intervals(IntervalInt n,FILE *ifile);
+extern SublistHeader *build_nested_list(IntervalMap im[],IntervalInt n,
+					IntervalInt *p_n,IntervalInt *p_nlists);
+extern SublistHeader *build_nested_list_inplace(IntervalMap im[],IntervalInt n,
+                                                IntervalInt *p_n,
+						IntervalInt *p_nlists);
+extern IntervalMap *interval_map_alloc(IntervalInt n);
+extern IntervalDB *build_interval_db(IntervalMap im[],IntervalInt n);
 extern IntervalIterator *interval_iterator_alloc(void);
 extern int free_interval_iterator(IntervalIterator *it);
 extern IntervalIterator *reset_interval_iterator(IntervalIterator *it);
-extern int find_intervals(IntervalIterator *it0,int start,int end,IntervalMap im[],int n,SublistHeader subheader[],int nlists,IntervalMap buf[],int nbuf,int *p_nreturn,IntervalIterator **it_return);
-extern int read_imdiv(FILE *ifile,IntervalMap imdiv[],int div,int i_div,int ntop);
-extern IntervalMap *read_sublist(FILE *ifile,SublistHeader *subheader,IntervalMap *im);
-extern int find_file_intervals(IntervalIterator *it0,int start,int end,
-			       IntervalIndex ii[],int nii,
-			       SublistHeader subheader[],int nlists,
+extern IntervalIterator *rewind_interval_iterator(IntervalIterator *it);
+extern int find_intervals(IntervalIterator *it0,IntervalInt start,IntervalInt end,IntervalMap im[],IntervalInt n,SublistHeader subheader[],IntervalInt nlists,IntervalMap buf[],int nbuf,int *p_nreturn,IntervalIterator **it_return);
+extern int read_imdiv(FILE *ifile,IntervalMap imdiv[],int div,IntervalInt i_div,IntervalInt ntop);
+extern size_t read_records_at(FILE *ifile,void *buf,size_t size,size_t nitems,
+			      PYGR_OFF_T irec,int isize);
+extern size_t fread_records(void *buf,size_t size,size_t nitems,FILE *ifile,
+			    int isize);
+extern IntervalMap *read_sublist(FILE *ifile,SublistHeader *subheader,IntervalMap *im,int isize);
+extern int find_file_intervals(IntervalIterator *it0,IntervalInt start,
+			       IntervalInt end,
+			       IntervalIndex ii[],IntervalInt nii,
+			       SublistHeader subheader[],IntervalInt nlists,
 			       SubheaderFile *subheader_file,
-			       int ntop,int div,FILE *ifile,
-			       IntervalMap buf[],int nbuf,
+			       IntervalInt ntop,int div,FILE *ifile,int isize,
+			       IntervalMap *im_map,CompressedBlocks *blocks,
+			       BlockCache *cache,IntervalMap buf[],int nbuf,
 			       int *p_nreturn,IntervalIterator **it_return);
-extern int write_padded_binary(IntervalMap im[],int n,int div,FILE *ifile);
-extern char *write_binary_files(IntervalMap im[],int n,int ntop,int div,
-				SublistHeader *subheader,int nlists,char filestem[]);
+extern BlockCache *block_cache_alloc(long long max_bytes);
+extern int block_cache_get(BlockCache *cache,FILE *ifile,IntervalInt ipos,
+			   IntervalMap im[]);
+extern int block_cache_put(BlockCache *cache,FILE *ifile,IntervalInt ipos,
+			   IntervalMap im[],int n);
+extern int block_cache_purge(BlockCache *cache,FILE *ifile);
+extern int free_block_cache(BlockCache *cache);
+extern int set_dbfile_cache(IntervalDBFile *db_file,BlockCache *cache);
+extern int advise_sequential_scan(IntervalDBFile *db_file);
+extern IntervalInt prefetch_file_blocks(IntervalDBFile *db_file,
+					IntervalInt start,IntervalInt end,
+					IntervalInt nblock,
+					IntervalInt prefetched);
+extern NestedListWalk *nested_list_walk_alloc(IntervalMap im[],
+					      IntervalInt ntop,
+					      SublistHeader subheader[],
+					      IntervalInt nlists,
+					      IntervalDBFile *db_file);
+extern int nested_list_walk_next(NestedListWalk *w,IntervalMap *im);
+extern int free_nested_list_walk(NestedListWalk *w);
+extern IntervalJoin *interval_join_alloc(NestedListWalk *a,NestedListWalk *b);
+extern int interval_join_next(IntervalJoin *ij,IntervalMap buf_a[],
+			      IntervalMap buf_b[],int nbuf);
+extern int free_interval_join(IntervalJoin *ij);
+extern int target_order_qsort_cmp(const void *void_a,const void *void_b);
+extern int seqbound_qsort_cmp(const void *void_a,const void *void_b);
+extern int merge_aligned_intervals(IntervalMap im[],int n,int maxgap,
+				   int maxinsert,int mininsert,
+				   long long maxsize,int merge_all,
+				   IntervalMap ival[],int sub_start[],
+				   int sub_count[]);
+extern int group_seq_bounds(SeqBound b[],int n,int nseq,int count[],
+			    double min_aligned,double p_min_aligned,
+			    int source_only,int indel_cut,IntervalMap out[],
+			    int *p_ibad);
+extern IntervalInt write_padded_binary(IntervalMap im[],IntervalInt n,int div,
+				       FILE *ifile);
+extern char *write_binary_files(IntervalMap im[],IntervalInt n,
+				IntervalInt ntop,int div,
+				SublistHeader *subheader,IntervalInt nlists,
+				char filestem[]);
+extern char *write_binary_files_r(IntervalMap im[],IntervalInt n,
+				  IntervalInt ntop,int div,
+				  SublistHeader *subheader,IntervalInt nlists,
+				  char filestem[],char err_msg[]);
+extern ExternalSort *external_sort_alloc(int size,
+					 int (*cmp)(const void *,const void *),
+					 long long max_memory,char path[]);
+extern int external_sort_add(ExternalSort *es,void *rec);
+extern int external_sort_finish(ExternalSort *es);
+extern int external_sort_next(ExternalSort *es,void *rec);
+extern int free_external_sort(ExternalSort *es);
+extern char *build_binary_files_external(FILE *ifile,IntervalInt n,int div,
+					 long long max_memory,char filestem[],
+					 char err_msg[]);
+extern int write_binary_size(char filestem[],IntervalInt n,IntervalInt ntop,
+			     int div,IntervalInt nlists,IntervalInt nii,
+			     int codec);
+extern int read_binary_size(char filestem[],char err_msg[],IntervalInt *p_n,
+			    IntervalInt *p_ntop,int *p_div,
+			    IntervalInt *p_nlists,IntervalInt *p_nii,
+			    int *p_codec,int *p_isize);
+extern int encode_interval_block(IntervalMap im[],int n,unsigned char buf[]);
+extern int decode_interval_block(unsigned char buf[],size_t nbytes,
+				 IntervalMap im[],int div);
+extern int load_compressed_block(FILE *ifile,CompressedBlocks *blocks,int div,
+				 IntervalInt iblock,IntervalMap im_buf[],
+				 unsigned char **p_zbuf,size_t *p_zbuf_size);
+extern char *compress_binary_files(char filestem[],char err_msg[]);
+extern CompressedBlocks *read_compressed_blocks(char filestem[],
+						char err_msg[]);
+extern int free_compressed_blocks(CompressedBlocks *blocks);
 extern IntervalDBFile *read_binary_files(char filestem[],char err_msg[],
 					 int subheader_nblock);
+extern int map_binary_files(IntervalDBFile *db_file);
+extern IntervalScan *interval_scan_alloc(IntervalDBFile *db_file,
+					 int chunk_size,int padded);
+extern int interval_scan_next(IntervalScan *scan,IntervalMap buf[],int nbuf);
+extern int free_interval_scan(IntervalScan *scan);
+extern IntervalDBFile *acquire_interval_dbfile(IntervalDBFile *db_file);
 extern int free_interval_dbfile(IntervalDBFile *db_file);
 
 extern int save_text_file(char filestem[],char err_msg[],
 			  char basestem[],FILE *ofile);
 extern int text_file_to_binaries(FILE *infile,char buildpath[],char err_msg[]);
-extern void reorient_intervals(int n,IntervalMap im[],int ori_sign);
+extern int write_bundle_ints(FILE *ofile,IntervalInt v[],IntervalInt n,
+			     unsigned char buf[]);
+extern int read_bundle_ints(FILE *infile,IntervalInt v[],IntervalInt n,
+			    unsigned char buf[]);
+extern int save_bundle_file(char filestem[],char basestem[],char err_msg[],
+			    FILE *ofile);
+extern int bundle_file_to_binaries(FILE *infile,char buildpath[],
+				   char err_msg[]);
+extern void reorient_intervals(IntervalInt n,IntervalMap im[],int ori_sign);
 
 #define FIND_FILE_MALLOC_ERR -2
 
@@ -113,14 +375,22 @@ extern void reorient_intervals(int n,IntervalMap im[],int ori_sign);
 #define FREE_ITERATOR_STACK(it,it2,it_next) \
   for (it2=it->down;it2;it2=it_next) { \
     it_next=it2->down; \
-    if (it2->im) \
-      free(it2->im); \
+    if (it2->im_buf) \
+      free(it2->im_buf); \
+    if (it2->zbuf) \
+      free(it2->zbuf); \
+    if (it2->sh_buf) \
+      free(it2->sh_buf); \
     free(it2); \
   } \
   for (it2=it;it2;it2=it_next) { \
     it_next=it2->up; \
-    if (it2->im) \
-      free(it2->im); \
+    if (it2->im_buf) \
+      free(it2->im_buf); \
+    if (it2->zbuf) \
+      free(it2->zbuf); \
+    if (it2->sh_buf) \
+      free(it2->sh_buf); \
     free(it2); \
   }
 
@@ -1,9 +1,17 @@
+import array
 import os
+import struct
 import types
+import zlib
 import classutil
 import logger
 from UserDict import DictMixin
 
+try:
+    import fcntl
+except ImportError: # NOT AVAILABLE ON WINDOWS
+    fcntl = None
+
 
 class NLMSASeqList(list):
 
@@ -50,6 +58,43 @@ class EmptyAlignmentError(ValueError):
     pass
 
 
+class AlignmentSummary(object):
+    '''alignment statistics for bins of binSize positions of the query
+    interval [start:stop] (the last bin may be shorter), as computed by
+    NLMSASlice.summarize().  For bin i, nseqs[i] counts the sequences
+    aligned to it and alignedBases[i] their total aligned bases.  For the
+    j-th aligned sequence seqIDs[j], seqBases[i * len(seqIDs) + j] counts
+    its aligned bases in bin i, and seqBlocks[i * len(seqIDs) + j] its
+    alignment intervals overlapping bin i'''
+
+    def __init__(self, start, stop, binSize=None, seqIDs=()):
+        if binSize is None: # ONE BIN FOR THE WHOLE INTERVAL
+            binSize = stop - start
+        if binSize <= 0:
+            raise ValueError('binSize must be positive')
+        self.start = start
+        self.stop = stop
+        self.binSize = binSize
+        self.seqIDs = list(seqIDs)
+        nbins = (stop - start + binSize - 1) / binSize
+        n = nbins * len(self.seqIDs)
+        self.nseqs = array.array('i', [0]) * nbins
+        self.alignedBases = array.array('l', [0]) * nbins
+        self.seqBases = array.array('l', [0]) * n
+        self.seqBlocks = array.array('i', [0]) * n
+
+    def __len__(self):
+        return len(self.nseqs)
+
+    def seq_bases(self, seqID):
+        'array of the aligned bases of seqID in each bin'
+        return self.seqBases[self.seqIDs.index(seqID)::len(self.seqIDs)]
+
+    def seq_blocks(self, seqID):
+        'array of the alignment intervals of seqID overlapping each bin'
+        return self.seqBlocks[self.seqIDs.index(seqID)::len(self.seqIDs)]
+
+
 class EmptySlice:
     'Empty slice for use by NLMSASlice'
 
@@ -104,6 +149,9 @@ class EmptySlice:
     def rawIvals(self):
         return []
 
+    def summarize(self, binSize=None):
+        return AlignmentSummary(self.seq.start, self.seq.stop, binSize)
+
 
 class _NLMSASeqDict_ValueWrapper(object):
     """A wrapper class for NLMSASeqDict to use to store 3-tuples in its cache.
@@ -126,6 +174,321 @@ class _NLMSASeqDict_ValueWrapper(object):
     def __getitem__(self, n):
         return self.v[n]
 
+# BINARY ID INDEX: HEADER, RECORDS SORTED BY nlmsaID, HASH TABLE OF seqIDs
+# (RECORD NUMBER + 1, OR 0 IF EMPTY), THEN THE seqID STRING TABLE
+_ID_INDEX_MAGIC = 'PYGRIDX1'
+_ID_INDEX_HEADER = struct.Struct('<8sqq') # MAGIC, #RECORDS, #HASH SLOTS
+_ID_INDEX_RECORD = struct.Struct('<qqiiq') # nlmsaID, offset, nsID,
+                                            # seqID LENGTH, seqID POSITION
+_ID_INDEX_SLOT = struct.Struct('<i')
+
+
+def _id_hash(seqID):
+    return zlib.crc32(seqID) & 0xffffffff
+
+
+def write_id_index(filename, seqIDdict=None):
+    '''write filename.idIndex, a binary index of the seqIDdict mapping
+    seqID --> (nlmsaID, nsID, offset), by default read from the
+    filename.seqIDdict shelve.  Replaces any old index atomically'''
+    if seqIDdict is None:
+        d = classutil.open_shelve(filename + '.seqIDdict', 'r')
+        try:
+            return write_id_index(filename, d)
+        finally:
+            d.close()
+    l = [(t[0], t[2], t[1], seqID) for seqID, t in seqIDdict.iteritems()]
+    l.sort()
+    nhash = 2
+    while nhash < 2 * len(l): # KEEP HASH TABLE AT MOST HALF FULL
+        nhash = 2 * nhash
+    slots = [0] * nhash
+    records = []
+    pos = 0
+    for i, (nlmsaID, offset, nsID, seqID) in enumerate(l):
+        records.append(_ID_INDEX_RECORD.pack(nlmsaID, offset, nsID,
+                                             len(seqID), pos))
+        pos += len(seqID)
+        h = _id_hash(seqID) & (nhash - 1)
+        while slots[h]: # LINEAR PROBING
+            h = (h + 1) & (nhash - 1)
+        slots[h] = i + 1
+    tmpname = filename + '.idIndex.new'
+    ofile = file(tmpname, 'wb')
+    try:
+        ofile.write(_ID_INDEX_HEADER.pack(_ID_INDEX_MAGIC, len(l), nhash))
+        ofile.write(''.join(records))
+        ofile.write(struct.pack('<%di' % nhash, *slots))
+        ofile.write(''.join([t[3] for t in l]))
+    finally:
+        ofile.close()
+    if os.path.exists(filename + '.idIndex') and os.name == 'nt':
+        os.remove(filename + '.idIndex') # WINDOWS RENAME WON'T REPLACE
+    os.rename(tmpname, filename + '.idIndex')
+    return len(l)
+
+
+class NLMSAIDIndex(object):
+    '''memory-mapped index written by write_id_index(), looked up by
+    seqID via its hash table, or by nlmsaID via binary search'''
+
+    def __init__(self, filename):
+        import mmap
+        ifile = file(filename, 'rb')
+        try:
+            self.data = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            ifile.close()
+        magic, self.n, self.nhash = _ID_INDEX_HEADER.unpack_from(self.data)
+        if magic != _ID_INDEX_MAGIC:
+            self.data.close()
+            raise IOError('%s is not an NLMSA ID index' % filename)
+        self.hashStart = _ID_INDEX_HEADER.size + \
+                         self.n * _ID_INDEX_RECORD.size
+        self.stringStart = self.hashStart + self.nhash * _ID_INDEX_SLOT.size
+
+    def __len__(self):
+        return self.n
+
+    def record(self, i):
+        'return (seqID, nlmsaID, nsID, offset) for record i'
+        nlmsaID, offset, nsID, length, pos = _ID_INDEX_RECORD.unpack_from(
+            self.data, _ID_INDEX_HEADER.size + i * _ID_INDEX_RECORD.size)
+        pos += self.stringStart
+        return self.data[pos:pos + length], nlmsaID, nsID, offset
+
+    def find_seqID(self, seqID):
+        'return (seqID, nlmsaID, nsID, offset) for seqID'
+        if not isinstance(seqID, types.StringType):
+            raise KeyError(seqID)
+        h = _id_hash(seqID) & (self.nhash - 1)
+        while True:
+            i = _ID_INDEX_SLOT.unpack_from(self.data, self.hashStart +
+                                           h * _ID_INDEX_SLOT.size)[0]
+            if i == 0: # EMPTY SLOT, SO NOT FOUND
+                raise KeyError(seqID)
+            t = self.record(i - 1)
+            if t[0] == seqID:
+                return t
+            h = (h + 1) & (self.nhash - 1)
+
+    def get_nlmsaID(self, i):
+        return struct.unpack_from('<q', self.data, _ID_INDEX_HEADER.size +
+                                  i * _ID_INDEX_RECORD.size)[0]
+
+    def find_nlmsaID(self, nlmsaID):
+        'return (seqID, nlmsaID, nsID, offset) for nlmsaID'
+        if self.n > 0: # IDs ARE USUALLY DENSE, SO TRY DIRECT POSITION 1ST
+            i = nlmsaID - self.get_nlmsaID(0)
+            if 0 <= i < self.n and self.get_nlmsaID(i) == nlmsaID:
+                return self.record(i)
+        left = 0
+        right = self.n
+        while left < right: # BINARY SEARCH OF RECORDS IN nlmsaID ORDER
+            mid = (left + right) // 2
+            if self.get_nlmsaID(mid) < nlmsaID:
+                left = mid + 1
+            else:
+                right = mid
+        if left < self.n:
+            t = self.record(left)
+            if t[1] == nlmsaID:
+                return t
+        raise KeyError(nlmsaID)
+
+    def __iter__(self):
+        'generate (seqID, nlmsaID, nsID, offset) in nlmsaID order'
+        for i in xrange(self.n):
+            yield self.record(i)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+class SeqIDIndexDict(object, DictMixin):
+    'read-only seqIDdict interface to NLMSAIDIndex'
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, seqID):
+        return self.index.find_seqID(seqID)[1:]
+
+    def __iter__(self):
+        for t in self.index:
+            yield t[0]
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for t in self.index:
+            yield t[0], t[1:]
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.index.close()
+
+
+class IDIndexDict(SeqIDIndexDict):
+    'read-only IDdict interface to NLMSAIDIndex, keyed by str(nlmsaID)'
+
+    def __getitem__(self, k):
+        try:
+            nlmsaID = int(k)
+        except ValueError:
+            raise KeyError(k)
+        t = self.index.find_nlmsaID(nlmsaID)
+        return t[0], t[2]
+
+    def __iter__(self):
+        for t in self.index:
+            yield str(t[1])
+
+    def iteritems(self):
+        for t in self.index:
+            yield str(t[1]), (t[0], t[2])
+
+
+def new_build_id():
+    'random ID for a new build of an NLMSA\'s index files'
+    return os.urandom(16).encode('hex')
+
+
+def save_build_id(pathstem):
+    '''save a new build ID in pathstem.buildID and return it.  Called
+    after each switch of pathstem.NLMSAindex, which readers read after
+    the build ID, so an ID never labels an older index than its own.
+    The .NLMSAindex itself keeps the format older pygr versions read'''
+    buildID = new_build_id()
+    filename = pathstem + '.buildID'
+    ifile = file(filename + '.tmp', 'w') # text file
+    try:
+        ifile.write(buildID + '\n')
+    finally:
+        ifile.close()
+    os.rename(filename + '.tmp', filename)
+    return buildID
+
+
+def read_build_id(pathstem):
+    'build ID saved in pathstem.buildID, or None if saved by an older pygr'
+    try:
+        ifile = file(pathstem + '.buildID')
+    except IOError:
+        return None
+    try:
+        return ifile.read().strip() or None
+    finally:
+        ifile.close()
+
+
+_SLICE_CACHE_ORDER = struct.Struct('<q') # ENTRY'S STORE COUNTER
+
+
+class SliceCache(object):
+    '''size-bounded persistent cache of NLMSASlice join results, keyed by
+    (NLMSA name, nlmsaID, start, stop).  Entries for an NLMSA are dropped
+    when its build ID changes; when the cache exceeds maxBytes, the
+    oldest entries are dropped until it is half full.  Only one process
+    may have the cache file open at a time: it holds an exclusive lock on
+    filename.lock (where fcntl is available) until close()'''
+
+    def __init__(self, filename, buildID, name='', maxBytes=100000000):
+        import dbfile
+        self.lockFile = file(filename + '.lock', 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self.lockFile.close()
+                raise IOError('slice cache %s is in use by another process'
+                              % filename)
+        try:
+            self.db = dbfile.open_index(filename, 'c', useHash=True)
+        except:
+            self.lockFile.close()
+            raise
+        self.name = name
+        self.maxBytes = maxBytes
+        self.hits = self.misses = 0
+        buildKey = '__build__\t' + name
+        if self.db.get(buildKey) != buildID: # REBUILT: OLD RESULTS INVALID
+            self.clear()
+            self.db[buildKey] = buildID
+
+    def _get_count(self, k):
+        return int(self.db.get(k, '0'))
+
+    def key(self, nlmsaID, start, stop):
+        return '%s\t%d\t%d\t%d' % (self.name, nlmsaID, start, stop)
+
+    def get(self, nlmsaID, start, stop):
+        'return the saved string for this slice, or None if not cached'
+        try:
+            s = self.db[self.key(nlmsaID, start, stop)]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return s[_SLICE_CACHE_ORDER.size:]
+
+    def put(self, nlmsaID, start, stop, data):
+        'save string data for this slice, dropping old entries if needed'
+        n = _SLICE_CACHE_ORDER.size + len(data)
+        if n > self.maxBytes: # TOO BIG TO CACHE
+            return
+        k = self.key(nlmsaID, start, stop)
+        nbytes = self._get_count('__bytes__')
+        try: # REPLACING AN EXISTING ENTRY
+            nbytes -= len(self.db[k])
+        except KeyError:
+            pass
+        if nbytes + n > self.maxBytes:
+            nbytes = self.evict(min(self.maxBytes / 2, self.maxBytes - n),
+                                k)
+        counter = self._get_count('__counter__')
+        self.db[k] = _SLICE_CACHE_ORDER.pack(counter) + data
+        self.db['__counter__'] = str(counter + 1)
+        self.db['__bytes__'] = str(nbytes + n)
+
+    def evict(self, maxBytes, skip=None):
+        '''drop the oldest entries (except key skip) until they total no
+        more than maxBytes.  Returns their new total'''
+        l = []
+        for k in self.db.keys():
+            if not k.startswith('__') and k != skip:
+                s = self.db[k]
+                l.append((_SLICE_CACHE_ORDER.unpack_from(s)[0], k, len(s)))
+        l.sort()
+        nbytes = sum([t[2] for t in l])
+        for counter, k, n in l:
+            if nbytes <= maxBytes:
+                break
+            del self.db[k]
+            nbytes -= n
+        self.db['__bytes__'] = str(nbytes)
+        return nbytes
+
+    def clear(self):
+        'drop all entries for this NLMSA'
+        prefix = self.name + '\t'
+        nbytes = self._get_count('__bytes__')
+        for k in self.db.keys():
+            if k.startswith(prefix):
+                nbytes -= len(self.db[k])
+                del self.db[k]
+        self.db['__bytes__'] = str(max(nbytes, 0))
+
+    def close(self):
+        self.db.close()
+        self.lockFile.close() # RELEASES OUR LOCK
+
+
 _DEFAULT_SEQUENCE_CACHE_SIZE=100
 class NLMSASeqDict(object, DictMixin):
     """Index sequences by pathForward, and use list to keep reverse mapping.
@@ -145,7 +508,12 @@ class NLMSASeqDict(object, DictMixin):
             idDictClass = dict
         elif mode == 'w': # new database
             mode = 'n'
-        if idDictClass is None: # use persistent id dictionary storage
+        elif mode == 'a': # add to existing database
+            mode = 'w'
+        if idDictClass is None and mode == 'r' and \
+               os.path.exists(filename + '.idIndex'):
+            self.open_id_index() # FAST BINARY INDEX, IF BUILD SAVED ONE
+        elif idDictClass is None: # use persistent id dictionary storage
             self.seqIDdict = classutil.open_shelve(filename + '.seqIDdict',
                                                    mode)
             self.IDdict = classutil.open_shelve(filename + '.idDict', mode)
@@ -227,9 +595,23 @@ class NLMSASeqDict(object, DictMixin):
         do_close() # close both shelve objects
         self.IDdict.close()
 
-    def reopenReadOnly(self, mode='r'):
-        'save existing data and reopen in read-only mode'
+    def open_id_index(self):
+        'use the memory-mapped index saved by write_id_index()'
+        index = NLMSAIDIndex(self.filename + '.idIndex')
+        self.seqIDdict = SeqIDIndexDict(index)
+        self.IDdict = IDIndexDict(index)
+
+    def reopenReadOnly(self, mode='r', idIndex=False):
+        '''save existing data and reopen in read-only mode.
+        idIndex=True also saves a binary index (see write_id_index())
+        and uses that instead of the shelves'''
         self.close()
+        if idIndex:
+            write_id_index(self.filename)
+            self.open_id_index()
+            return
+        if os.path.exists(self.filename + '.idIndex'): # NOW OUT OF DATE
+            os.remove(self.filename + '.idIndex')
         self.seqIDdict = classutil.open_shelve(self.filename + '.seqIDdict',
                                                mode)
         self.IDdict = classutil.open_shelve(self.filename + '.idDict', mode)
@@ -403,13 +785,16 @@ def prune_self_mappings(src_prefix, dest_prefix, is_bidirectional):
 
 
 def nlmsa_textdump_unpickler(filepath, kwargs):
-    from cnestedlist import textfile_to_binaries, NLMSA
+    from cnestedlist import textfile_to_binaries, bundle_to_binaries, NLMSA
     logger.info('Saving NLMSA indexes from textdump: %s' % filepath)
     try:
         buildpath = os.environ['WORLDBASEBUILDDIR']
     except KeyError:
         buildpath = classutil.get_env_or_cwd('PYGRDATABUILDDIR')
-    path = textfile_to_binaries(filepath, buildpath=buildpath, **kwargs)
+    if filepath.endswith('.bundle'): # BINARY BUNDLE FROM dump_bundle()
+        path = bundle_to_binaries(filepath, buildpath=buildpath, **kwargs)
+    else:
+        path = textfile_to_binaries(filepath, buildpath=buildpath, **kwargs)
     o = NLMSA(path) # now open in read mode from the saved index fileset
     o._saveLocalBuild = True # mark this for saving in local metabase
     return o
@@ -419,7 +804,7 @@ nlmsa_textdump_unpickler.__safe_for_unpickling__ = 1
 
 
 class NLMSABuilder(object):
-    'when unpickled triggers construction of NLMSA from textdump'
+    'when unpickled triggers construction of NLMSA from textdump or bundle'
     _worldbase_no_cache = True # force worldbase to reload this fresh
 
     def __init__(self, filepath, **kwargs):
@@ -441,9 +826,251 @@ class SeqCacheOwner(object):
         self.cachedSeqs[seq.id] = seq
 
 
+def build_in_threads(seqlist, nthreads, **kwargs):
+    """call buildFiles(**kwargs) on each NLMSASequence in seqlist, using
+    nthreads worker threads.  Returns the total interval count; the first
+    exception raised by any worker is re-raised here."""
+    import threading
+    import sys
+    seqs = list(seqlist)
+    counts = [0] * len(seqs)
+    errors = []
+    lock = threading.Lock()
+    queue = range(len(seqs))
+    queue.reverse()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if errors or not queue:
+                    return
+                i = queue.pop()
+            finally:
+                lock.release()
+            try:
+                counts[i] = seqs[i].buildFiles(**kwargs)
+            except:
+                lock.acquire()
+                errors.append(sys.exc_info())
+                lock.release()
+    threads = [threading.Thread(target=worker)
+               for i in range(min(nthreads, len(seqs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return sum(counts)
+
+
+class StreamFeeder(object):
+    """copy file object ifile to a pipe in a background thread, so that
+    C code can read it from the pipe's file descriptor fd.  close() waits
+    for the thread, re-raising any exception from reading ifile."""
+
+    def __init__(self, ifile, bufsize=1048576):
+        import threading
+        self.ifile = ifile
+        self.bufsize = bufsize
+        self.error = None
+        self.fd, self.wfd = os.pipe()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        import errno
+        import sys
+        try:
+            try:
+                while True:
+                    s = self.ifile.read(self.bufsize)
+                    if not s:
+                        break
+                    while s:
+                        s = s[os.write(self.wfd, s):]
+            except OSError, e:
+                if e.errno != errno.EPIPE: # EPIPE: READER STOPPED EARLY
+                    self.error = sys.exc_info()
+            except:
+                self.error = sys.exc_info()
+        finally:
+            os.close(self.wfd)
+
+    def close(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+class BackgroundTask(object):
+    """run func(*args, **kwargs) in a background thread.  join() waits
+    for it to finish, returning its result or re-raising its exception."""
+
+    def __init__(self, func, *args, **kwargs):
+        import threading
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        import sys
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except:
+            self.error = sys.exc_info()
+
+    def isAlive(self):
+        'True if the task is still running'
+        return self.thread.isAlive()
+
+    def join(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+def _bgzf_blocks(ifile):
+    """list the (compressed, uncompressed) start offsets of the blocks of
+    open BGZF (bgzip) file ifile, followed by its total (compressed,
+    uncompressed) sizes; or None if it is not a BGZF file."""
+    import struct
+    blocks = []
+    coffset = uoffset = 0
+    while True:
+        ifile.seek(coffset)
+        header = ifile.read(12)
+        if not header: # END OF FILE
+            blocks.append((coffset, uoffset))
+            return blocks
+        if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+            return None # NOT A GZIP MEMBER WITH AN EXTRA FIELD
+        extra = ifile.read(struct.unpack('<H', header[10:])[0])
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra): # FIND THE BC SUBFIELD: BLOCK SIZE - 1
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == 'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            return None
+        ifile.seek(coffset + bsize - 3) # ISIZE: ITS UNCOMPRESSED SIZE
+        isize = ifile.read(4)
+        if len(isize) < 4:
+            return None
+        blocks.append((coffset, uoffset))
+        coffset += bsize + 1
+        uoffset += struct.unpack('<I', isize)[0]
+
+
+def _next_alignment(ifile, offset):
+    """find the first "a" line starting after byte offset of plain text
+    file ifile, returning (start, 0, 0), or None if there is none."""
+    ifile.seek(offset)
+    ifile.readline() # SKIP TO THE START OF THE NEXT LINE
+    while True:
+        line = ifile.readline()
+        if not line:
+            return None
+        if line.startswith('a'):
+            return ifile.tell() - len(line), 0, 0
+
+
+def _bgzf_next_alignment(ifile, blocks, k):
+    """find the first "a" line starting after the start of BGZF block k,
+    returning (start, blockOffset, blockStart) of the block holding it,
+    or None if there is none."""
+    last = ''
+    for j in range(k, len(blocks) - 1):
+        coffset, uoffset = blocks[j]
+        ifile.seek(coffset)
+        data = zlib.decompress(ifile.read(blocks[j + 1][0] - coffset), 31)
+        i = (last + data).find('\na')
+        if i >= 0:
+            return uoffset + i + 1 - len(last), coffset, uoffset
+        last = data[-1:]
+    return None
+
+
+def split_maf_files(mafFiles, nranges, minBytes=1048576):
+    """split mafFiles into about nranges byte ranges of at least minBytes,
+    each starting at an alignment ("a") line, for parsing in parallel.
+    Returns a list of (filename, start, stop, blockOffset, blockStart) in
+    file order; start, stop are uncompressed bytes, stop -1 for the end
+    of the file.  A bgzip file is split at its blocks: each range starts
+    reading at compressed byte blockOffset, which holds uncompressed
+    bytes from blockStart.  A gzip file or open file object cannot be
+    split, so it gives one range."""
+    import bisect
+    import gzip
+    sizes = []
+    blockLists = []
+    for filename in mafFiles:
+        blocks = None
+        if not isinstance(filename, str): # FILE OBJECT: READ IT ALL AT ONCE
+            sizes.append(0)
+            blockLists.append(blocks)
+            continue
+        ifile = file(filename, 'rb')
+        try:
+            if ifile.read(2) == '\x1f\x8b': # gzip OR bgzip COMPRESSED
+                blocks = _bgzf_blocks(ifile)
+                ifile.seek(0)
+                line = gzip.GzipFile(fileobj=ifile).readline()
+                if blocks is None:
+                    sizes.append(0)
+                else:
+                    sizes.append(blocks[-1][1])
+            else:
+                ifile.seek(0)
+                line = ifile.readline()
+                sizes.append(os.path.getsize(filename))
+            if not line.startswith('##maf'):
+                raise IOError('%s: not a MAF file? Bad format.' % filename)
+        finally:
+            ifile.close()
+        blockLists.append(blocks)
+    total = sum(sizes) or 1
+    ranges = []
+    for filename, size, blocks in zip(mafFiles, sizes, blockLists):
+        n = min(int(round(float(nranges) * size / total)), size / minBytes)
+        starts = [(0, 0, 0)]
+        if n > 1:
+            ifile = file(filename, 'rb')
+            try:
+                if blocks is not None:
+                    uoffsets = [t[1] for t in blocks]
+                for i in range(1, n):
+                    if blocks is None:
+                        t = _next_alignment(ifile,
+                                            max(starts[-1][0], size * i / n))
+                    else: # SEARCH FROM THE NEXT BLOCK
+                        k = bisect.bisect_left(uoffsets, max(starts[-1][0] + 1,
+                                                             size * i / n))
+                        t = _bgzf_next_alignment(ifile, blocks, k)
+                    if t is None: # NO MORE ALIGNMENT BLOCKS
+                        break
+                    starts.append(t)
+            finally:
+                ifile.close()
+        stops = [t[0] for t in starts[1:]] + [-1]
+        for (start, blockOffset, blockStart), stop in zip(starts, stops):
+            ranges.append((filename, start, stop, blockOffset, blockStart))
+    return ranges
+
+
 def generate_nlmsa_edges(self, *args, **kwargs):
     """iterate over all edges for all sequences in the alignment.
-    Very slow for a big alignment!"""
+    Very slow for a big alignment!  To export a big alignment, use
+    NLMSA.scan_edges() instead."""
     for seq in self.seqs:
         myslice = self[seq]
         for results in myslice.edges(*args, **kwargs):
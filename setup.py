@@ -79,6 +79,11 @@ nested_src = [os.path.join('pygr', 'intervaldb.c'),
               os.path.join('pygr', 'cnestedlist.%s' % ext),
               os.path.join('pygr', 'apps', 'maf2nclist.c')]
 
+# set PYGR_64BIT_INTERVALS=1 to build NLMSA with 64 bit coordinates / counts
+nested_macros = []
+if os.environ.get('PYGR_64BIT_INTERVALS'):
+    nested_macros.append(('PYGR_64BIT_INTERVALS', '1'))
+
 
 def main():
     setup(
@@ -98,7 +103,9 @@ def main():
         ext_modules = [
             Extension('pygr.seqfmt', seqfmt_src),
             Extension('pygr.cdict', cdict_src),
-            Extension('pygr.cnestedlist', nested_src),
+            Extension('pygr.cnestedlist', nested_src,
+                      define_macros=nested_macros,
+                      libraries=['z']), # zlib reads compressed MAF / axtNet
         ],
 
         cmdclass = cmdclass,
@@ -0,0 +1,118 @@
+"""Benchmark NLMSASlice construction: batched LPO join vs. one LPO query
+per interval (the join used by pygr up to 0.8).
+
+usage: python nlmsa_slice_benchmark.py [SEQDIR MAF...]
+
+SEQDIR must contain one sequence file per genome prefix used in the MAF
+files (e.g. SEQDIR/dm2 for dm2.chr4), as for the nlmsa megatests.  With
+no arguments, the megatests_dm2 mafDir / seqDir of your pygr config file
+are used if set, otherwise a synthetic multiz-style alignment is
+generated in a temporary directory.  Slices are taken over NWINDOW
+consecutive windows of WINDOW bp, from the first sequence of the first
+MAF block.
+"""
+
+import ConfigParser
+import glob
+import os
+import sys
+import time
+
+from testlib import testutil
+from pygr import cnestedlist, seqdb
+
+WINDOW = 20000
+NWINDOW = 10
+NREPEAT = 5
+
+
+def maf_prefixes(mafFiles, maxLines=100000):
+    'genome prefixes used in the first lines of the MAF files'
+    prefixes = []
+    for mafFile in mafFiles:
+        ifile = file(mafFile)
+        for i, line in enumerate(ifile):
+            if i >= maxLines:
+                break
+            if line.startswith('s '):
+                prefix = line.split()[1].split('.')[0]
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+        ifile.close()
+    return prefixes
+
+
+def first_seq(mafFile):
+    'ID and start of the first sequence of the first MAF block'
+    ifile = file(mafFile)
+    try:
+        for line in ifile:
+            if line.startswith('s '):
+                t = line.split()
+                return t[1], int(t[2])
+    finally:
+        ifile.close()
+
+
+def main():
+    args = sys.argv[1:]
+    tempdir = testutil.TempDir('nlmsa-benchmark')
+    if args:
+        seqDir, mafFiles = args[0], args[1:]
+    else:
+        config = ConfigParser.ConfigParser()
+        config.read([os.path.join(os.path.expanduser('~'), '.pygrrc'),
+                     os.path.join(os.path.expanduser('~'), 'pygr.cfg'),
+                     '.pygrrc', 'pygr.cfg'])
+        try:
+            seqDir = config.get('megatests_dm2', 'seqDir')
+            mafFiles = glob.glob(os.path.join(config.get('megatests_dm2',
+                                                         'mafDir'), '*.maf'))
+            mafFiles.sort()
+        except ConfigParser.Error:
+            mafFiles = None
+        if not mafFiles:
+            print 'generating synthetic MAF alignment...'
+            seqDir, mafFiles = testutil.make_maf(tempdir.path)
+    genomes = {}
+    for prefix in maf_prefixes(mafFiles):
+        genomes[prefix] = seqdb.SequenceFileDB(os.path.join(seqDir, prefix))
+    genomeUnion = seqdb.PrefixUnionDict(genomes)
+    print 'building NLMSA from %d MAF file(s)...' % len(mafFiles)
+    msa = cnestedlist.NLMSA(tempdir.subfile('msa'), 'w', genomeUnion,
+                            mafFiles=mafFiles)
+    seqID, start = first_seq(mafFiles[0])
+    seq = genomeUnion[seqID]
+    ivals = [seq[i:min(i + WINDOW, len(seq))]
+             for i in range(start, len(seq), WINDOW)[:NWINDOW]]
+
+    nival = 0
+    for ival in ivals: # BOTH JOINS MUST GIVE THE SAME SLICES
+        l = []
+        for serial in (True, False):
+            cnestedlist._serialLPOJoin = serial
+            msaSlice = msa[ival]
+            l.append([(repr(src), repr(dest))
+                      for src, dest, e in msaSlice.edges()])
+        assert l[0] == l[1], 'batched join differs on %s' % repr(ival)
+        nival += len(l[0])
+    print '%d windows of %d bp on %s: %d aligned intervals' \
+          % (len(ivals), WINDOW, seqID, nival)
+    for label, serial in (('one query per interval', True),
+                          ('batched LPO join', False)):
+        cnestedlist._serialLPOJoin = serial
+        best = None
+        for i in range(NREPEAT): # BEST OF NREPEAT RUNS
+            t = time.time()
+            for ival in ivals:
+                msa[ival]
+            t = time.time() - t
+            if best is None or t < best:
+                best = t
+        print '%-24s %8.3f s' % (label, best)
+    cnestedlist._serialLPOJoin = False
+    msa.close()
+
+
+if __name__ == '__main__':
+    main()
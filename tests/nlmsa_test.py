@@ -1,8 +1,142 @@
+import array
+import glob
+import os
+import random
+import struct
+import sys
+import threading
+import time
 import unittest
 from testlib import testutil, PygrTestProgram
 from pygr import cnestedlist, nlmsa_utils, seqdb, sequence
 
 
+def make_nested_ivals(n, seed=1234):
+    "random alignment tuples with plenty of containment, for index tests"
+    rand = random.Random(seed)
+    ivals = []
+    for i in range(n):
+        start = rand.randint(0, 5000)
+        end = start + rand.choice((1, 5, 20, 100, 1000))
+        if rand.random() < 0.2: # REVERSE ORIENTATION
+            start, end = -end, -start
+        ivals.append((start, end, i % 7, 10 * i, 10 * i + end - start))
+    return ivals
+
+
+def make_random_seqs(n, length, rand):
+    "n random DNA sequences s0, s1, ... of the given length, for alignments"
+    return [sequence.Sequence(''.join([rand.choice('ACGT')
+                                       for j in range(length)]), 's%d' % i)
+            for i in range(n)]
+
+
+def group_by_intervals_py(msaSlice, maxgap=0, maxinsert=0, mininsert=0,
+                          filterSeqs=None, filterList=None, mergeMost=False,
+                          maxsize=500000000, mergeAll=True, ivalMethod=None,
+                          **kwargs):
+    "pure Python NLMSASlice.groupByIntervals(), as a reference for tests"
+    nl = msaSlice.nlmsa
+    if mergeMost: # BE REASONABLE: DON'T MERGE A WHOLE CHROMOSOME
+        maxgap = 10000
+        maxinsert = 10000
+        mininsert = -10 # ALLOW SOME OVERLAP IN INTERVAL ALIGNMENTS
+        maxsize = 50000
+    if filterList is not None:
+        targetDict = {}
+        for seq in filterList: # CREATE AN INDEX OF SEQUENCE IDs TO KEEP
+            t = nl.seqs.getIDcoords(seq)
+            targetDict[t[0]] = t[1:] # SAVE START,STOP
+    seqIntervals = {}
+    for start, end, targetID, targetStart, targetEnd in msaSlice.rawIvals():
+        if nl.seqlist.is_lpo(targetID):
+            continue # IT IS AN LPO, SO SKIP IT
+        if filterList is not None:
+            try: # CHECK IF SEQUENCE IS IN MASKING DICTIONARY
+                maskStart, maskEnd = targetDict[targetID]
+            except KeyError:
+                continue # FILTER THIS SEQUENCE OUT OF THE RESULT SET
+            if start >= maskEnd or end <= maskStart: # NO OVERLAP
+                continue
+            if start < maskStart: # CLIP START TO MASKED REGION
+                targetStart = targetStart + maskStart - start
+                start = maskStart
+            if end > maskEnd: # CLIP END TO MASKED REGION
+                targetEnd = targetEnd + maskEnd - end
+                end = maskEnd
+        elif filterSeqs is not None: # CLIP TARGET SEQ INTERVAL
+            target = nl.seqInterval(targetID, targetStart, targetEnd)
+            try:
+                target = filterSeqs[target] # PERFORM CLIPPING
+            except KeyError: # NO OVERLAP IN filterSeqs, SO SKIP
+                continue
+            start = start + target.start - targetStart # CLIP SOURCE
+            end = end + target.stop - targetEnd
+            targetStart = target.start # GET COORDS OF CLIPPED TARGET
+            targetEnd = target.stop
+        seqIntervals.setdefault(targetID, []) \
+            .append([start, end, targetStart, targetEnd, None])
+    for i, l in seqIntervals.iteritems(): # MERGE INTERVALS FOR EACH SEQ
+        if ivalMethod is not None: # USER-SUPPLIED GROUPING FUNCTION
+            ivalMethod(l, nl.seqlist.getSeq(i), msaSlice=msaSlice,
+                       maxgap=maxgap, maxinsert=maxinsert,
+                       mininsert=mininsert, filterSeqs=filterSeqs,
+                       mergeAll=mergeAll, **kwargs)
+            continue # NO NEED TO APPLY GENERIC MERGING OPERATION BELOW
+        n = 0
+        for j in range(1, len(l)): # MERGE BY INDEL LENGTH RULES
+            gap = l[j][0] - l[n][1] # current.start - last.end
+            insert = l[j][2] - l[n][3] # current.target_start - last.target_end
+            if not mergeAll and \
+                   (gap > maxgap or insert > maxinsert or
+                    insert < mininsert or l[j][1] - l[n][0] > maxsize or
+                    l[j][3] - l[n][2] > maxsize):
+                n += 1 # SPLIT, SO START A NEW INTERVAL
+                if n < j: # COPY START COORDS TO NEW SLOT
+                    l[n][0] = l[j][0]
+                    l[n][2] = l[j][2]
+            elif l[n][4] is None: # FIRST MERGE: SAVE 1:1 INTERVAL LIST
+                if l[n][1] == l[j][0] and l[n][3] == l[j][2]: # NO GAP
+                    l[n][4] = [(l[n][0], l[j][1], l[n][2], l[j][3])]
+                else: # TWO SEPARATE 1:1 INTERVALS
+                    l[n][4] = [tuple(l[n][:4]), tuple(l[j][:4])]
+            else: # SEE IF WE CAN FUSE TO LAST 1:1 INTERVAL
+                lastIval = l[n][4][-1]
+                if lastIval[1] == l[j][0] and lastIval[3] == l[j][2]:
+                    l[n][4][-1] = (lastIval[0], l[j][1], lastIval[2],
+                                   l[j][3])
+                else: # GAP, SO JUST APPEND THIS 1:1 INTERVAL
+                    l[n][4].append(tuple(l[j][:4]))
+            if n < j: # COPY END COORDS TO CURRENT SLOT
+                l[n][1] = l[j][1]
+                l[n][3] = l[j][3]
+        del l[n + 1:] # DELETE REMAINING UNMERGED INTERVALS
+        for m in l: # CULL SINGLETON 1:1 INTERVAL LISTS (DUE TO FUSION)
+            if m[4] is not None and len(m[4]) == 1:
+                m[4] = None # NO NEED TO KEEP SINGLETON!
+    # SEQUENCE MASKING BY CONSERVATION OR %ALIGNED CONSTRAINT
+    if 'pAlignedMin' in kwargs or 'pIdentityMin' in kwargs or \
+           'minAlignSize' in kwargs or 'maxAlignSize' in kwargs:
+        msaSlice.filterIvalConservation(seqIntervals, **kwargs)
+    return seqIntervals
+
+
+def write_bgzf(filename, data, blockSize=4096):
+    "write data to filename in bgzip format, using many small blocks"
+    import struct
+    import zlib
+    ofile = file(filename, 'wb')
+    for i in range(0, len(data), blockSize) + [len(data)]: # EMPTY EOF BLOCK
+        block = data[i:i + blockSize]
+        c = zlib.compressobj(6, zlib.DEFLATED, -15) # RAW DEFLATE
+        z = c.compress(block) + c.flush()
+        ofile.write('\x1f\x8b\x08\x04\0\0\0\0\0\xff' +
+                    struct.pack('<H2sHH', 6, 'BC', 2, len(z) + 25) + z +
+                    struct.pack('<II', zlib.crc32(block) & 0xffffffffL,
+                                len(block)))
+    ofile.close()
+
+
 class NestedList_Test(unittest.TestCase):
     "Basic cnestedlist class tests"
 
@@ -35,6 +169,406 @@ class NestedList_Test(unittest.TestCase):
         # fails on windows
         #tempdir.remove()  @CTB
 
+    def test_filedb_mmap(self):
+        "NestedList filedb, mmap vs. file reads"
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(make_nested_ivals(2000))
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa2')
+        db.write_binaries(filename, div=8) # SMALL div: MANY BLOCKS & BIG SUBLISTS
+        mdb = cnestedlist.IntervalFileDB(filename)
+        fdb = cnestedlist.IntervalFileDB(filename, useMmap=False)
+        if sys.platform != 'win32': # BUILT WITHOUT MMAP ON WINDOWS
+            assert mdb.is_mapped
+        assert not fdb.is_mapped
+        for start, end in ((0, 10), (100, 3000), (-4000, -3900), (2500, 2501),
+                           (6100, 7000), (-200000, -1)):
+            l = db.find_overlap_list(start, end)
+            l.sort()
+            for d in (mdb, fdb):
+                l2 = d.find_overlap_list(start, end)
+                l2.sort()
+                assert l == l2
+                l2 = list(d.find_overlap(start, end))
+                l2.sort()
+                assert l == l2
+
+    def test_batch_query(self):
+        "NestedList find_overlap_batch"
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(make_nested_ivals(2000))
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa4')
+        db.write_binaries(filename, div=8)
+        rand = random.Random(42)
+        starts = []
+        ends = []
+        for i in range(200): # UNSORTED, BOTH ORIENTATIONS
+            start = rand.randint(-6000, 6000)
+            starts.append(start)
+            ends.append(start + rand.randint(1, 200))
+        for d in (db, cnestedlist.IntervalFileDB(filename),
+                  cnestedlist.IntervalFileDB(filename, useMmap=False)):
+            hits, offsets = d.find_overlap_batch(starts, array.array('i', ends))
+            assert len(offsets) == len(starts) + 1
+            assert len(hits) == 5 * offsets[-1]
+            for i in range(len(starts)):
+                l = [tuple(hits[5 * j:5 * j + 5])
+                     for j in range(offsets[i], offsets[i + 1])]
+                assert l == d.find_overlap_list(starts[i], ends[i])
+        hits, offsets = db.find_overlap_batch([], [])
+        assert len(hits) == 0 and list(offsets) == [0]
+
+    def test_array_results(self):
+        "NestedList IntervalMapArray results"
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa5')
+        self.db.write_binaries(filename)
+        fdb = cnestedlist.IntervalFileDB(filename)
+        for d in (self.db, fdb):
+            a = d.find_overlap_array(0, 10)
+            assert list(a) == d.find_overlap_list(0, 10)
+            assert a[-1] == (5, 20, 2, -315, -300)
+            assert len(d.find_overlap_array(100, 200)) == 0
+            hits, offsets = d.find_overlap_batch([0, -11], [10, -7],
+                                                 asArray=True)
+            assert list(offsets) == [0, 2, 4]
+            assert list(hits)[2:] == d.find_overlap_list(-11, -7)
+        try:
+            import numpy
+        except ImportError:
+            return
+        x = self.db.find_overlap_array(-11, -7).asarray()
+        assert list(x['start']) == [-10, -20]
+        assert list(x['target_end']) == [110, 315]
+
+    def test_join(self):
+        "NestedList join"
+        ivals1 = make_nested_ivals(300, 1)
+        ivals2 = make_nested_ivals(200, 2)
+        db1 = cnestedlist.IntervalDB()
+        db1.save_tuples(ivals1)
+        db2 = cnestedlist.IntervalDB()
+        db2.save_tuples(ivals2)
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa6')
+        db2.write_binaries(filename, div=8)
+
+        def positive(t): # JOIN RESULTS ARE IN POSITIVE ORIENTATION
+            if t[0] < 0:
+                return (-t[1], -t[0], t[2], -t[4], -t[3])
+            return t
+        correct = [(a, b) for a in map(positive, ivals1)
+                   for b in map(positive, ivals2)
+                   if a[0] < b[1] and b[0] < a[1]]
+        correct.sort()
+        db2.write_binaries(filename + 'z', div=8, compress=True)
+        for other in (db2, cnestedlist.IntervalFileDB(filename),
+                      cnestedlist.IntervalFileDB(filename, useMmap=False),
+                      cnestedlist.IntervalFileDB(filename + 'z')):
+            for chunkSize in (1, 1024):
+                l = []
+                for a, b in db1.join(other, chunkSize):
+                    assert len(a) == len(b) <= chunkSize
+                    l.extend(zip(a, b))
+                l.sort()
+                assert l == correct
+        fdb = cnestedlist.IntervalFileDB(filename) # JOIN KEEPS ITS FILES OPEN
+        joined = db1.join(fdb, 16)
+        l = zip(*joined.next())
+        fdb.close()
+        for a, b in joined:
+            l.extend(zip(a, b))
+        l.sort()
+        assert l == correct
+        joined = db2.join(db1, 16)
+        joined.next()
+        db1.close()
+        self.assertRaises(IOError, joined.next)
+
+    def test_filedb_threads(self):
+        "NestedList filedb, concurrent queries from several threads"
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(make_nested_ivals(2000))
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa3')
+        db.write_binaries(filename, div=8)
+        queries = [(i * 37 % 6000 - 500, i * 37 % 6000 - 500 + i % 300 + 1)
+                   for i in range(300)]
+        correct = []
+        for start, end in queries:
+            l = db.find_overlap_list(start, end)
+            l.sort()
+            correct.append(l)
+        for useMmap, cacheBytes in ((True, None), (False, None),
+                                    (False, 20000)): # SMALL SHARED CACHE
+            fdb = cnestedlist.IntervalFileDB(filename, useMmap=useMmap,
+                                             cacheBytes=cacheBytes)
+            errors = []
+
+            def run_queries():
+                for i, (start, end) in enumerate(queries):
+                    l = fdb.find_overlap_list(start, end)
+                    l.sort()
+                    if l != correct[i]:
+                        errors.append((start, end))
+            threads = [threading.Thread(target=run_queries) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert errors == []
+            fdb.close()
+        for useMmap in (True, False): # close() WHILE QUERIES ARE RUNNING
+            fdb = cnestedlist.IntervalFileDB(filename, useMmap=useMmap)
+            errors = []
+
+            def query_until_closed():
+                try:
+                    for k in range(50):
+                        for i, (start, end) in enumerate(queries):
+                            l = fdb.find_overlap_list(start, end)
+                            l.sort()
+                            if l != correct[i]:
+                                errors.append((start, end))
+                except IndexError: # CLOSED
+                    pass
+            threads = [threading.Thread(target=query_until_closed)
+                       for i in range(4)]
+            for t in threads:
+                t.start()
+            time.sleep(0.05)
+            fdb.close()
+            for t in threads:
+                t.join()
+            assert errors == []
+
+    def test_external_build(self):
+        "NestedList out-of-core build matches in-memory build"
+        d = {}
+        for t in make_nested_ivals(3000): # UNIQUE COORDS FIX THE FILE ORDER
+            d[t[:2]] = t
+        ivals = d.values()
+        tempdir = testutil.TempDir('nlmsa-test')
+        buildfile = tempdir.subfile('nlmsa7.build')
+        a = array.array(cnestedlist.interval_typecode)
+        for t in ivals:
+            a.extend(t + (-1, ))
+        ifile = file(buildfile, 'wb')
+        a.tofile(ifile)
+        ifile.close()
+        db = cnestedlist.IntervalDB()
+        db.buildFromUnsortedFile(buildfile, len(ivals))
+        db.write_binaries(tempdir.subfile('nlmsa7a'), div=8)
+        # TINY maxMemory FORCES MANY SORTED RUNS AND SEVERAL MERGE PASSES
+        cnestedlist.unsorted_file_to_binaries(buildfile, len(ivals),
+                                              tempdir.subfile('nlmsa7b'),
+                                              2000, div=8)
+        for suffix in ('.idb', '.subhead', '.index', '.size'):
+            ifile = file(tempdir.subfile('nlmsa7a') + suffix, 'rb')
+            data = ifile.read()
+            ifile.close()
+            ifile = file(tempdir.subfile('nlmsa7b') + suffix, 'rb')
+            assert ifile.read() == data
+            ifile.close()
+
+    def test_interval_size(self):
+        "NestedList coordinates past 2^31, and binary format size check"
+        isize = array.array(cnestedlist.interval_typecode).itemsize
+        big = 0
+        if isize >= 8: # 64 BIT BUILD: SHIFT EVERYTHING PAST 2^32
+            big = 2 ** 33
+        ivals = [(big + t[0], big + t[1], t[2], big + t[3], big + t[4])
+                 for t in make_nested_ivals(500) if t[0] >= 0]
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(ivals)
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa8')
+        db.write_binaries(filename, div=8)
+        fdb = cnestedlist.IntervalFileDB(filename)
+        for start, end in ((0, 10), (100, 3000), (2500, 2501)):
+            l = db.find_overlap_list(big + start, big + end)
+            l.sort()
+            l2 = fdb.find_overlap_list(big + start, big + end)
+            l2.sort()
+            assert l and l == l2
+        fdb.close()
+        db = cnestedlist.IntervalDB() # SAVE AS THE OTHER BUILD WOULD
+        db.save_tuples(make_nested_ivals(500))
+        filename = tempdir.subfile('nlmsa8b')
+        db.write_binaries(filename, div=8)
+        fdb = cnestedlist.IntervalFileDB(filename)
+        correct = [tuple(t) for chunk in fdb.scan() for t in chunk]
+        correct.sort()
+        fdb.close()
+        for suffix in ('.idb', '.subhead', '.index'):
+            ifile = file(filename + suffix, 'rb')
+            a = array.array(cnestedlist.interval_typecode, ifile.read())
+            ifile.close()
+            ifile = file(filename + suffix, 'wb')
+            ifile.write(struct.pack('=%d%s' % (len(a), 'qi'[isize // 8]), *a))
+            ifile.close()
+        ifile = file(filename + '.size')
+        sizes = ifile.read().split('\n')[-2] # SKIP HEADER LINE, IF ANY
+        ifile.close()
+        ifile = file(filename + '.size', 'w')
+        if isize < 8: # A 32 BIT BUILD CAN'T READ 64 BIT FILES
+            ifile.write('NCLIST_FORMAT 2 8\n%s\n' % sizes)
+            ifile.close()
+            try:
+                cnestedlist.IntervalFileDB(filename)
+                raise AssertionError('failed to detect wrong integer size')
+            except IOError, e:
+                assert 'PYGR_64BIT_INTERVALS' in str(e)
+            return
+        ifile.write('%s\n' % sizes) # A VERSION 1, 32 BIT .size FILE
+        ifile.close()
+        for useMmap in (True, False, None): # READ 32 BIT FILES, WIDENING THEM
+            if useMmap is None: # ALSO WIDENED BY COMPRESSION
+                cnestedlist.compress_binaries(filename)
+                useMmap = True
+            fdb = cnestedlist.IntervalFileDB(filename, useMmap=useMmap)
+            for start, end in ((0, 10), (100, 3000), (-3000, -100)):
+                l1 = db.find_overlap_list(start, end)
+                l1.sort()
+                l2 = fdb.find_overlap_list(start, end)
+                l2.sort()
+                assert l1 and l1 == l2
+            l = [tuple(t) for chunk in fdb.scan() for t in chunk]
+            l.sort()
+            assert l == correct
+            fdb.close()
+
+    def test_compressed_filedb(self):
+        "NestedList compressed filedb matches uncompressed"
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(make_nested_ivals(3000))
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa9')
+        db.write_binaries(filename, div=8) # SMALL div: MANY BLOCKS & BIG SUBLISTS
+        zfilename = tempdir.subfile('nlmsa9z')
+        db.write_binaries(zfilename, div=8, compress=True)
+        assert os.path.getsize(zfilename + '.idb') * 2 < \
+               os.path.getsize(filename + '.idb')
+        cnestedlist.compress_binaries(zfilename) # ALREADY DONE: NO-OP
+        rand = random.Random(7)
+        starts = [rand.randint(-6000, 6000) for i in range(300)]
+        ends = [start + rand.randint(1, 300) for start in starts]
+        fdb = cnestedlist.IntervalFileDB(filename)
+        assert not fdb.is_compressed
+        correct = fdb.find_overlap_batch(starts, ends)
+        for useMmap in (True, False):
+            zdb = cnestedlist.IntervalFileDB(zfilename, useMmap=useMmap)
+            assert zdb.is_compressed
+            for start, end in zip(starts, ends)[:50]:
+                assert zdb.find_overlap_list(start, end) == \
+                       fdb.find_overlap_list(start, end)
+            assert zdb.find_overlap_batch(starts, ends) == correct
+            l = [tuple(a) + tuple(b) for a, b in db.join(zdb)]
+            assert l == [tuple(a) + tuple(b) for a, b in db.join(fdb)]
+            zdb.close()
+
+    def test_block_cache(self):
+        "NestedList block cache shared by two filedbs"
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(make_nested_ivals(3000))
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa10')
+        db.write_binaries(filename, div=8)
+        zfilename = tempdir.subfile('nlmsa10z')
+        db.write_binaries(zfilename, div=8, compress=True)
+        rand = random.Random(10)
+        starts = [rand.randint(-6000, 6000) for i in range(100)]
+        ends = [start + rand.randint(1, 300) for start in starts]
+        correct = db.find_overlap_batch(starts, ends)
+        cache = cnestedlist.IntervalBlockCache(20000) # TOO SMALL FOR ALL
+        fdb = cnestedlist.IntervalFileDB(filename, useMmap=False,
+                                         blockCache=cache)
+        zdb = cnestedlist.IntervalFileDB(zfilename, blockCache=cache)
+        assert fdb.blockCache is cache and zdb.blockCache is cache
+        for i in range(2):
+            assert fdb.find_overlap_batch(starts, ends) == correct
+            assert zdb.find_overlap_batch(starts, ends) == correct
+            for start, end in zip(starts, ends)[:20]:
+                assert zdb.find_overlap_list(start, end) == \
+                       db.find_overlap_list(start, end)
+        assert cache.hits > 0 and cache.misses > 0 and cache.evictions > 0
+        assert 0 < cache.nbytes <= cache.cacheBytes
+        assert 0. < cache.hitRate < 1.
+        fdb.close() # DROPS ITS BLOCKS, BUT zdb KEEPS USING THE CACHE
+        del cache
+        assert zdb.find_overlap_batch(starts, ends) == correct
+        zdb.blockCache.clear()
+        assert zdb.blockCache.nbytes == zdb.blockCache.hits == 0
+        zdb = cnestedlist.IntervalFileDB(zfilename, cacheBytes=1000000)
+        assert zdb.find_overlap_batch(starts, ends) == correct
+        assert zdb.find_overlap_batch(starts, ends) == correct
+        assert zdb.blockCache.evictions == 0
+        assert zdb.blockCache.hits >= zdb.blockCache.misses
+
+    def test_scan(self):
+        "NestedList filedb scan returns every interval once"
+        ivals = make_nested_ivals(3000)
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(ivals)
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa12')
+        db.write_binaries(filename, div=8)
+        zfilename = tempdir.subfile('nlmsa12z')
+        db.write_binaries(zfilename, div=8, compress=True)
+        correct = []
+        for start, end, id, tstart, tend in ivals: # STORED AS POSITIVE ORI
+            if start < 0:
+                start, end, tstart, tend = -end, -start, -tend, -tstart
+            correct.append((start, end, id, tstart, tend))
+        correct.sort()
+        for stem in (filename, zfilename):
+            for useMmap in (True, False):
+                fdb = cnestedlist.IntervalFileDB(stem, useMmap=useMmap)
+                l = []
+                for chunk in fdb.scan(chunkSize=100):
+                    assert 0 < len(chunk) <= 100
+                    l += [tuple(t) for t in chunk]
+                l.sort()
+                assert l == correct
+                it = fdb.scan(chunkSize=100)
+                it.next()
+                fdb.close()
+                fdb.open(stem, useMmap=useMmap) # MAYBE AT THE SAME ADDRESS
+                self.assertRaises(IOError, it.next)
+                fdb.close()
+
+    def test_cursor(self):
+        "NestedList filedb cursor scan of increasing windows"
+        db = cnestedlist.IntervalDB()
+        db.save_tuples(make_nested_ivals(3000))
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('nlmsa11')
+        db.write_binaries(filename, div=8)
+        zfilename = tempdir.subfile('nlmsa11z')
+        db.write_binaries(zfilename, div=8, compress=True)
+        windows = [(i, i + 150) for i in range(-100, 6200, 100)]
+        for stem, useMmap in ((filename, True), (filename, False),
+                              (zfilename, True), (zfilename, False)):
+            fdb = cnestedlist.IntervalFileDB(stem, useMmap=useMmap)
+            cursor = fdb.cursor(readahead=4)
+            for start, end in windows:
+                correct = db.find_overlap_list(start, end)
+                assert cursor.find_overlap_list(start, end) == correct
+                a = cursor.find_overlap_array(start, end) # SAME WINDOW AGAIN
+                assert [tuple(t) for t in a] == correct
+            self.assertRaises(ValueError, cursor.find_overlap_list, 0, 100)
+            cursor = fdb.cursor()
+            for start, end in windows: # REVERSE ORIENTATION QUERIES
+                assert cursor.find_overlap_list(-end, -start) == \
+                       db.find_overlap_list(-end, -start)
+            fdb.close()
+            self.assertRaises(IndexError, cursor.find_overlap_list, 7000, 7001)
+            fdb.open(stem, useMmap=useMmap) # MAYBE AT THE SAME ADDRESS
+            assert cursor.find_overlap_list(0, 100) == \
+                   db.find_overlap_list(0, 100) # A NEW SCAN OF THE NEW DB
+            fdb.close()
+
 
 class NLMSA_SimpleTests(unittest.TestCase):
 
@@ -70,6 +604,89 @@ class NLMSA_SimpleTests(unittest.TestCase):
                                 bidirectional=False)
         # @CTB should there be something else here?  What is this testing?
 
+    def test_build_threads(self):
+        "NLMSA parallel, out-of-core and compressed builds match serial build"
+        seqs = [sequence.Sequence('ACGT' * (50 + i), 's%d' % i)
+                for i in range(6)]
+        tempdir = testutil.TempDir('nlmsa-test')
+        results = []
+        for k, kwargs in enumerate(({}, dict(nthreads=3),
+                                    dict(maxMemory=100),
+                                    dict(nthreads=2, compress=True))):
+            filename = tempdir.subfile('threads%d' % k)
+            msa = cnestedlist.NLMSA(filename, mode='w', pairwiseMode=True,
+                                    bidirectional=False)
+            for i, s in enumerate(seqs):
+                msa += s
+                for j in range(i + 1, len(seqs)):
+                    msa[s[i * 3:i * 3 + 50]] += seqs[j][j * 2:j * 2 + 50]
+            msa.build(**kwargs)
+            ifile = file(filename + '.NLMSAindex')
+            index = ifile.read()
+            ifile.close()
+            l = []
+            for s in seqs[:-1]:
+                edges = [(repr(src), repr(dest))
+                         for src, dest, e in msa[s].edges()]
+                edges.sort()
+                l.append(edges)
+            results.append((index, l))
+        assert results[0] == results[1] == results[2] == results[3]
+
+    def test_bundle(self):
+        "NLMSA binary bundle export / import matches the text dump"
+        seqs = [sequence.Sequence('ACGT' * (100 + i), 's%d' % i)
+                for i in range(5)]
+        tempdir = testutil.TempDir('nlmsa-test')
+        for compress in (False, True):
+            filename = tempdir.subfile('bundle%d' % compress)
+            msa = cnestedlist.NLMSA(filename, mode='w', pairwiseMode=True,
+                                    bidirectional=False)
+            for i, s in enumerate(seqs):
+                msa += s
+                for j in range(i + 1, len(seqs) - 1):
+                    for k in range(0, 300, 7):
+                        msa[s[k:k + 20 + j]] += seqs[j][k + 3:k + 23 + j]
+            msa.build(compress=compress, saveSeqDict=True)
+            msa = cnestedlist.NLMSA(filename, 'a', msa.seqDict)
+            for s in seqs[:-1]: # APPENDED, NOT COMPACTED: DUMPED FROM DELTAS
+                for k in range(0, 300, 7):
+                    msa[s[k:k + 24]] += seqs[-1][k + 3:k + 27]
+            msa.build()
+            msa.close()
+            assert glob.glob(filename + '*.delta*.idb') != []
+            ofile = file(filename + '.bundle', 'wb') # via a file object
+            cnestedlist.dump_bundle(filename, ofile)
+            ofile.close()
+            restoreDir = tempdir.subfile('restore%d' % compress)
+            os.mkdir(restoreDir)
+            path = cnestedlist.bundle_to_binaries(filename + '.bundle',
+                                                  seqDict=msa.seqDict,
+                                                  buildpath=restoreDir)
+            assert path == os.path.join(restoreDir,
+                                        os.path.basename(filename))
+            l = []
+            for stem in (filename, path):
+                cnestedlist.dump_textfile(stem, stem + '.txt')
+                ifile = file(stem + '.txt')
+                l.append(ifile.read())
+                ifile.close()
+            assert l[0] == l[1]
+            l = []
+            for stem in (filename, path):
+                msa2 = cnestedlist.NLMSA(stem, seqDict=msa.seqDict)
+                l.append([[(repr(src), repr(dest)) for src, dest, e
+                           in msa2[s].edges()] for s in seqs[:-1]])
+                msa2.close()
+            assert l[0] == l[1]
+        ifile = file(filename + '.txt', 'rb') # NOT A BUNDLE
+        try:
+            cnestedlist.bundle_to_binaries(ifile, buildpath=restoreDir)
+            raise AssertionError('failed to trap bad bundle file!')
+        except IOError:
+            pass
+        ifile.close()
+
     def test_lpo_query(self):
         s1=sequence.Sequence('aaaa', 's1')
         s2=sequence.Sequence('bbbb', 's2')
@@ -85,6 +702,755 @@ class NLMSA_SimpleTests(unittest.TestCase):
         correct.sort()
         assert l == correct
 
+    def test_lpo_join(self):
+        "NLMSASlice LPO join: batched = one query per interval, any layout"
+        rand = random.Random(5)
+        seqs = make_random_seqs(6, 1500, rand)
+        ivals = []
+        for i in range(400): # SPREAD OVER 4 LPOS, NOT CROSSING THEIR ENDS
+            s = rand.choice(seqs)
+            start = rand.randint(0, 1400)
+            length = rand.randint(1, 100)
+            lpoStart = rand.randint(0, 3) * 2000
+            dest = rand.randint(lpoStart, lpoStart + 2000 - length)
+            ivals.append((dest, dest + length, s[start:start + length]))
+        tempdir = testutil.TempDir('nlmsa-test')
+        results = []
+        for k, (mode, kwargs) in enumerate((('memory', {}), ('w', {}),
+                                            ('w', dict(maxlen=2000,
+                                                       maxLPOcoord=8000)))):
+            msa = cnestedlist.NLMSA(tempdir.subfile('lpojoin%d' % k), mode,
+                                    **kwargs)
+            for dest, end, ival in ivals:
+                msa[dest:end] += ival
+            msa.build()
+            try:
+                for serial in (True, False):
+                    cnestedlist._serialLPOJoin = serial
+                    l = []
+                    for s in seqs:
+                        for start in range(0, 1500, 100):
+                            try:
+                                msaSlice = msa[s[start:start + 400]]
+                            except KeyError: # NOT ALIGNED
+                                l.append(None)
+                                continue
+                            l.append(([(repr(src), repr(dest)) for src, dest,
+                                       e in msaSlice.edges()],
+                                      [repr(ival) for ival in msaSlice]))
+                    results.append(l)
+            finally:
+                cnestedlist._serialLPOJoin = False
+        assert filter(None, results[0]) # SOME SLICES ARE ALIGNED
+        for l in results[1:]:
+            assert l == results[0]
+
+    def test_lazy_slice(self):
+        "NLMSASlice lazySlices mode gives the same results"
+        rand = random.Random(6)
+        seqs = make_random_seqs(5, 1000, rand)
+        msa = cnestedlist.NLMSA(mode='memory')
+        for i in range(200):
+            s = rand.choice(seqs)
+            start = rand.randint(0, 900)
+            length = rand.randint(1, 100)
+            if rand.random() < 0.3:
+                s = -s
+            dest = rand.randint(0, 900)
+            msa[dest:dest + length] += s[start:start + length]
+        msa.build()
+        results = []
+        for lazy in (False, True):
+            msa.lazySlices = lazy
+            l = []
+            for s in seqs:
+                for start in range(0, 1000, 100):
+                    ival = s[start:start + 300]
+                    msaSlice = msa[ival] # TARGETED QUERIES
+                    for seq in seqs + [-seq for seq in seqs]:
+                        try:
+                            ends = repr(msaSlice.findSeqEnds(seq))
+                        except KeyError:
+                            ends = None
+                        matches = [(repr(a), repr(b))
+                                   for a, b in msaSlice.matchIntervals(seq)]
+                        matches.sort()
+                        l.append((ends, matches))
+                    msaSlice = msa[ival]
+                    l.append(len(msaSlice))
+                    edges = [(repr(a), repr(b))
+                             for a, b, e in msa[ival].edges()]
+                    edges.sort()
+                    l.append(edges)
+            results.append(l)
+        assert results[0] == results[1]
+
+    def test_scan_edges(self):
+        "NLMSA.scan_edges() matches the 1:1 intervals of every slice"
+        rand = random.Random(7)
+        seqs = make_random_seqs(5, 1000, rand)
+        tempdir = testutil.TempDir('nlmsa-test')
+        for k, (mode, kwargs) in enumerate((('memory', {}), ('w', {}),
+                                            ('w', dict(pairwiseMode=True)))):
+            msa = cnestedlist.NLMSA(tempdir.subfile('scanedges%d' % k), mode,
+                                    **kwargs)
+            for s in seqs:
+                msa += s
+            for i in range(200):
+                s = rand.choice(seqs)
+                start = rand.randint(0, 900)
+                length = rand.randint(1, 100)
+                if rand.random() < 0.3:
+                    s = -s
+                dest = rand.randint(0, 900)
+                if kwargs: # ALIGN TWO SEQUENCES DIRECTLY
+                    msa[rand.choice(seqs)[dest:dest + length]] += \
+                          s[start:start + length]
+                else:
+                    msa[dest:dest + length] += s[start:start + length]
+            msa.build()
+            correct = []
+            for s in seqs:
+                correct.extend([(repr(a), repr(b))
+                                for a, b in msa[s].matchIntervals()])
+            correct.sort()
+            for chunkSize in (5, 65536):
+                l = []
+                for chunk in msa.scan_edges(chunkSize=chunkSize):
+                    for srcIval, destIval, edge in chunk:
+                        assert edge.items() == [(srcIval, destIval)]
+                        l.append((repr(srcIval), repr(destIval)))
+                l.sort()
+                assert l == correct
+                l = []
+                for chunk in msa.scan_edges(raw=True, chunkSize=chunkSize):
+                    for t in chunk:
+                        src = sequence.relativeSlice(msa.seqDict[t[0]],
+                                                     t[1], t[2])
+                        dest = sequence.relativeSlice(msa.seqDict[t[3]],
+                                                      t[4], t[5])
+                        l.append((repr(src), repr(dest)))
+                l.sort()
+                assert l == correct
+
+    def test_get_slices(self):
+        "NLMSA.get_slices() gives the same slices as one query per interval"
+        rand = random.Random(11)
+        seqs = make_random_seqs(5, 1000, rand)
+        unaligned = sequence.Sequence('ACGT' * 50, 'unaligned')
+        tempdir = testutil.TempDir('nlmsa-test')
+        for k, (mode, kwargs) in enumerate((('memory', {}), ('w', {}),
+                                            ('w', dict(pairwiseMode=True)))):
+            msa = cnestedlist.NLMSA(tempdir.subfile('getslices%d' % k), mode,
+                                    **kwargs)
+            msa += unaligned
+            for s in seqs:
+                msa += s
+            for i in range(200):
+                s = rand.choice(seqs)
+                start = rand.randint(0, 900)
+                length = rand.randint(1, 100)
+                if rand.random() < 0.3:
+                    s = -s
+                dest = rand.randint(0, 900)
+                if kwargs: # ALIGN TWO SEQUENCES DIRECTLY
+                    msa[rand.choice(seqs)[dest:dest + length]] += \
+                          s[start:start + length]
+                else:
+                    msa[dest:dest + length] += s[start:start + length]
+            msa.build()
+            ivals = [unaligned[10:20]]
+            for i in range(100):
+                start = rand.randint(0, 900)
+                ival = rand.choice(seqs)[start:start + rand.randint(1, 300)]
+                if rand.random() < 0.3:
+                    ival = -ival
+                ivals.append(ival)
+
+            def slice_info(msaSlice):
+                if isinstance(msaSlice, nlmsa_utils.EmptySlice):
+                    return None
+                return (msaSlice.rawIvals(), [(repr(a), repr(b))
+                                              for a, b, e in msaSlice.edges()])
+            correct = [slice_info(msa[ival]) for ival in ivals]
+            if not kwargs:
+                assert correct[0] is None # NOT ALIGNED
+            for chunkSize in (7, 1024):
+                l = msa.get_slices(ivals, chunkSize=chunkSize)
+                assert [slice_info(msaSlice) for msaSlice in l] == correct
+                l = list(msa.get_slices(ivals, iterate=True,
+                                        chunkSize=chunkSize))
+                l.sort()
+                assert [i for i, msaSlice in l] == range(len(ivals))
+                assert [slice_info(msaSlice) for i, msaSlice in l] == correct
+                l = msa.get_slices(ivals, raw=True, chunkSize=chunkSize)
+                for ivalInfo, a in zip(correct, l):
+                    if ivalInfo is None:
+                        assert len(a) == 0
+                    else:
+                        assert [t[0] for t in a] == sorted([t[0] for t in a])
+                        assert sorted(a) == [t for t in sorted(ivalInfo[0])
+                                             if not msa.seqlist.is_lpo(t[2])]
+
+    def test_maf_processes(self):
+        "NLMSA MAF reading in worker processes matches serial reading"
+        tempdir = testutil.TempDir('nlmsa-test')
+        genomeUnion, mafFiles = testutil.make_maf_genomes(tempdir.path,
+                                                          length=20000)
+        minBytes = cnestedlist._minMAFRangeBytes
+        cnestedlist._minMAFRangeBytes = 1000 # SPLIT IT INTO MANY RANGES
+        try:
+            l = []
+            indexData = []
+            for nprocs in (1, 3):
+                filename = tempdir.subfile('maf%d' % nprocs)
+                msa = cnestedlist.NLMSA(filename, 'w', genomeUnion,
+                                        mafFiles=mafFiles, maxint=2000,
+                                        nprocs=nprocs)
+                assert len(msa.lpoList) > 1
+                ival = genomeUnion['sp0.chr1'][1000:3000]
+                l.append((sorted(msa.seqs.seqIDdict.items()),
+                          [(ns.id, ns.length) for ns in msa.lpoList],
+                          [(repr(a), repr(b)) for a, b, e in msa[ival].edges()]))
+                msa.close()
+                d = {} # INDEX FILE CONTENTS, BY NAME RELATIVE TO filename
+                for suffix in ('.idb', '.subhead', '.index'):
+                    for path in glob.glob(filename + '*' + suffix):
+                        d[path[len(filename):]] = file(path, 'rb').read()
+                indexData.append(d)
+        finally:
+            cnestedlist._minMAFRangeBytes = minBytes
+        assert len(nlmsa_utils.split_maf_files(mafFiles, 12, 1000)) == 12
+        assert l[0] == l[1]
+        assert len(indexData[0]) >= 3 * len(l[0][1])
+        assert indexData[0] == indexData[1] # SAME INDEX FILES, BYTE FOR BYTE
+
+    def test_maf_compressed(self):
+        "NLMSA reads gzip and bgzip MAF files and file objects"
+        import gzip
+        from StringIO import StringIO
+        tempdir = testutil.TempDir('nlmsa-test')
+        genomeUnion, mafFiles = testutil.make_maf_genomes(tempdir.path,
+                                                          length=20000)
+        data = file(mafFiles[0], 'rb').read()
+        gzFile = tempdir.subfile('synthetic.maf.gz')
+        ofile = gzip.GzipFile(gzFile, 'wb')
+        ofile.write(data)
+        ofile.close()
+        bgzFile = tempdir.subfile('synthetic.maf.bgz')
+        write_bgzf(bgzFile, data)
+        ranges = nlmsa_utils.split_maf_files([bgzFile], 12, 1000)
+        assert len(ranges) == 12
+        for filename, start, stop, blockOffset, blockStart in ranges[1:]:
+            assert data[start - 1:start + 2] == '\na ' # AT AN "a" LINE
+            assert blockStart <= start < blockStart + 4096
+        assert len(nlmsa_utils.split_maf_files([gzFile], 12, 1000)) == 1
+        minBytes = cnestedlist._minMAFRangeBytes
+        cnestedlist._minMAFRangeBytes = 1000 # SPLIT IT INTO MANY RANGES
+        try:
+            l = []
+            for i, (f, nprocs) in enumerate(((mafFiles[0], 1), (gzFile, 1),
+                                             (bgzFile, 1), (bgzFile, 3),
+                                             (StringIO(data), 1),
+                                             (file(gzFile, 'rb'), 1))):
+                msa = cnestedlist.NLMSA(tempdir.subfile('maf%d' % i), 'w',
+                                        genomeUnion, mafFiles=[f],
+                                        maxint=2000, nprocs=nprocs)
+                ival = genomeUnion['sp0.chr1'][1000:3000]
+                l.append((sorted(msa.seqs.seqIDdict.items()),
+                          [(ns.id, ns.length) for ns in msa.lpoList],
+                          [(repr(a), repr(b)) for a, b, e in msa[ival].edges()]))
+        finally:
+            cnestedlist._minMAFRangeBytes = minBytes
+        for t in l[1:]:
+            assert t == l[0]
+
+    def test_append(self):
+        "NLMSA append mode and compact() give the same alignment as one build"
+        rand = random.Random(5)
+        seqs = make_random_seqs(6, 1000, rand)
+        edges = []
+        for i in range(300):
+            src = rand.choice(seqs[:5]) # s5 ONLY APPEARS IN THE LAST APPEND
+            if i >= 250:
+                src = seqs[5]
+            start = rand.randint(0, 900)
+            length = rand.randint(1, 100)
+            dest = rand.randint(0, 900)
+            s = rand.choice(seqs[:5])
+            if rand.random() < 0.3:
+                s = -s
+            edges.append((src[dest:dest + length], s[start:start + length]))
+        tempdir = testutil.TempDir('nlmsa-test')
+
+        def alignment_info(msa):
+            l = []
+            for s in seqs:
+                l.append(sorted([(repr(a), repr(b))
+                                 for a, b in msa[s].matchIntervals()]))
+            l.append(sorted([t for chunk in msa.scan_edges(raw=True)
+                             for t in chunk]))
+            l.append([sorted(msaSlice.rawIvals()) for msaSlice in
+                      msa.get_slices([s[100:600] for s in seqs])])
+            return l
+        msa = cnestedlist.NLMSA(tempdir.subfile('full'), 'w',
+                                pairwiseMode=True)
+        for s in seqs:
+            msa += s
+        for src, dest in edges:
+            msa[src] += dest
+        msa.build()
+        correct = alignment_info(msa)
+        filename = tempdir.subfile('append')
+        seqDict = seqdb.SeqPrefixUnionDict(addAll=True)
+        msa = cnestedlist.NLMSA(filename, 'w', seqDict, pairwiseMode=True)
+        for s in seqs[:5]:
+            msa += s
+        for src, dest in edges[:100]:
+            msa[src] += dest
+        msa.build()
+        files = lambda pattern: sorted(glob.glob(filename + pattern))
+        for start, stop, kwargs in ((100, 200, {}), (200, 300,
+                                                     dict(maxMemory=100))):
+            seqDict.addAll = True # LET IT ADD s5
+            msa = cnestedlist.NLMSA(filename, 'a', seqDict)
+            assert files('*.build') == [] # OPENED ON FIRST APPEND
+            for s in seqs:
+                msa += s
+            for src, dest in edges[start:stop]:
+                msa[src] += dest
+            assert 0 < len(files('*.build')) < len(msa.seqlist)
+            msa.build(**kwargs)
+        assert alignment_info(msa) == correct
+        deltaFiles = files('*.delta*')
+        assert deltaFiles == files('0.delta.2.*') # OLD VERSION WAS REMOVED
+        msa = cnestedlist.NLMSA(filename, 'r', seqDict)
+        assert alignment_info(msa) == correct
+        reader = cnestedlist.NLMSA(filename, 'r', seqDict) # OPENED BEFORE...
+        assert alignment_info(reader) == correct
+        lazyReader = cnestedlist.NLMSA(filename, 'r', seqDict)
+        assert msa.compact(background=True).join() > 0
+        assert files('*.delta*') == []
+        assert files('0.*idb') == [filename + '0.1.idb']
+        assert alignment_info(msa) == correct
+        assert alignment_info(reader) == correct # ...KEEPS ITS OPEN FILES
+        assert alignment_info(lazyReader) == correct # ...OR OPENS THE NEW ONES
+        reader.close()
+        lazyReader.close()
+        msa = cnestedlist.NLMSA(filename, 'r', seqDict)
+        assert alignment_info(msa) == correct
+        assert msa.compact() == 0 # NOTHING LEFT TO COMPACT
+        msa.close()
+        msa = cnestedlist.NLMSA(filename, 'a', seqDict) # LEAVE A DELTA...
+        for src, dest in edges[:10]:
+            msa[src] += dest
+        msa.build()
+        assert files('*.delta*') != []
+        msa = cnestedlist.NLMSA(filename, 'w', seqDict, # ...THEN REBUILD
+                                pairwiseMode=True)
+        for s in seqs:
+            msa += s
+        for src, dest in edges:
+            msa[src] += dest
+        msa.build()
+        assert files('*.delta*') == []
+        assert files('*.idb') == [filename + '%d.idb' % i
+                                  for i in range(len(msa.seqlist))]
+        msa = cnestedlist.NLMSA(filename, 'r', seqDict)
+        assert alignment_info(msa) == correct
+
+    def test_group_by(self):
+        "NLMSASlice groupByIntervals(), groupBySequences() match Python code"
+        tempdir = testutil.TempDir('nlmsa-test')
+        genomeUnion, mafFiles = testutil.make_maf_genomes(tempdir.path)
+        maf = cnestedlist.NLMSA(tempdir.subfile('maf'), 'w', genomeUnion,
+                                mafFiles=mafFiles)
+        rand = random.Random(13)
+        seqs = make_random_seqs(5, 1000, rand)
+        msa = cnestedlist.NLMSA('groupby', 'memory', pairwiseMode=True)
+        for s in seqs:
+            msa += s
+        for i in range(300): # GAPPED ALIGNMENTS, SOME OVERLAPPING
+            src = rand.choice(seqs)
+            s = rand.choice(seqs)
+            if rand.random() < 0.3:
+                s = -s
+            start = rand.randint(0, 800)
+            dest = rand.randint(0, 800)
+            for j in range(rand.randint(1, 4)):
+                length = rand.randint(1, 40)
+                msa[src[dest:dest + length]] += s[start:start + length]
+                start = start + length + rand.choice((0, 0, 1, 3, 20))
+                dest = dest + length + rand.choice((0, 0, 1, 2, 50))
+        msa.build()
+        mafFilter = [genomeUnion['sp%d.chr1' % i][500:2500] for i in range(4)]
+        msaFilter = [s[100:600] for s in seqs]
+        sp0 = genomeUnion['sp0.chr1']
+        slices = [(maf[sp0[i:i + 700]], mafFilter)
+                  for i in range(0, 4200, 700)] + \
+                 [(msa[s], msaFilter) for s in seqs] + \
+                 [(msa[s[300:500]], msaFilter) for s in seqs]
+
+        def outcome(f, *args, **kwargs): # RESULT, OR TYPE OF ERROR RAISED
+            try:
+                return f(*args, **kwargs)
+            except IndexError, e: # SOME CASES TRIGGER EMPTY SLICES ETC.
+                return e.__class__
+
+        def seq_info(l):
+            if not isinstance(l, list):
+                return l
+            return [(repr(t[0]), repr(t[1]), t[2]) if isinstance(t, tuple)
+                    else repr(t) for t in l]
+        nresult = nmerged = 0
+        for msaSlice, filterList in slices:
+            filterSeqs = sequence.SeqFilterDict(filterList)
+            for kwargs in (dict(), dict(mergeAll=False),
+                           dict(mergeAll=False, maxgap=2, maxinsert=3),
+                           dict(mergeAll=False, maxgap=20, maxinsert=20,
+                                mininsert=-5, maxsize=60),
+                           dict(mergeMost=True),
+                           dict(mergeMost=True, filterList=filterList),
+                           dict(mergeAll=False, maxgap=1,
+                                filterSeqs=filterSeqs),
+                           dict(mergeMost=True, minAlignSize=10,
+                                pIdentityMin=0.5)):
+                correct = outcome(group_by_intervals_py, msaSlice, **kwargs)
+                seqIntervals = outcome(msaSlice.groupByIntervals, **kwargs)
+                if not isinstance(correct, dict):
+                    assert seqIntervals == correct
+                    continue
+                assert seqIntervals.items() == correct.items()
+                for seqKwargs in (dict(), dict(sourceOnly=True),
+                                  dict(sourceOnly=True, indelCut=True),
+                                  dict(sourceOnly=True, minAligned=2),
+                                  dict(sourceOnly=True, pMinAligned=0.5),
+                                  dict(seqGroups=[seqIntervals.keys()[:2],
+                                                  seqIntervals.keys()[1:]],
+                                       sourceOnly=True, indelCut=True),
+                                  dict(seqGroups=[seqIntervals.keys()[1:]])):
+                    correct = outcome(msaSlice._groupBySequencesPy,
+                                      seqIntervals, **seqKwargs)
+                    l = outcome(msaSlice.groupBySequences, seqIntervals,
+                                **seqKwargs)
+                    assert seq_info(l) == seq_info(correct)
+                    if isinstance(l, list):
+                        nresult += len(l)
+                for l in seqIntervals.values():
+                    nmerged += len([m for m in l if m[4] is not None])
+        assert nresult > 0
+        assert nmerged > 0 # SHOULD EXERCISE MERGED 1:1 INTERVAL LISTS
+
+    def test_id_index(self):
+        "NLMSA binary .idIndex gives the same IDs as the shelves"
+        from pygr import classutil
+        rand = random.Random(17)
+        seqs = [sequence.Sequence('ACGT' * 50, 'seq%d' % i) for i in range(50)]
+        tempdir = testutil.TempDir('nlmsa-test')
+        filename = tempdir.subfile('idindex')
+        seqDict = seqdb.SeqPrefixUnionDict(addAll=True)
+        msa = cnestedlist.NLMSA(filename, 'w', seqDict, pairwiseMode=True)
+        for s in seqs:
+            msa += s
+        for i in range(200):
+            start = rand.randint(0, 150)
+            msa[rand.choice(seqs)[start:start + 40]] += \
+                  rand.choice(seqs)[start:start + 40]
+        msa.build()
+        assert os.path.exists(filename + '.idIndex')
+        seqIDdict = classutil.open_shelve(filename + '.seqIDdict', 'r')
+        IDdict = classutil.open_shelve(filename + '.idDict', 'r')
+        correct = sorted(seqIDdict.items())
+        correctIDs = sorted(IDdict.items())
+        seqIDdict.close()
+        IDdict.close()
+        assert len(correct) == len(seqs)
+        msa = cnestedlist.NLMSA(filename, 'r', seqDict)
+        assert isinstance(msa.seqs.seqIDdict, nlmsa_utils.SeqIDIndexDict)
+        assert sorted(msa.seqs.seqIDdict.items()) == correct
+        assert sorted(msa.seqs.IDdict.items()) == correctIDs
+        for seqID, t in correct:
+            assert msa.seqs.seqIDdict[seqID] == t
+            assert msa.seqs.IDdict[str(t[0])] == (seqID, t[1])
+        for k in ('noSuchSeq', 'seq', 'seq100'):
+            self.assertRaises(KeyError, msa.seqs.seqIDdict.__getitem__, k)
+        for k in ('-1', str(len(msa.seqlist) + 1000), 'foo'):
+            self.assertRaises(KeyError, msa.seqs.IDdict.__getitem__, k)
+        l = [sorted([(repr(a), repr(b)) for a, b in msa[s].matchIntervals()])
+             for s in seqs]
+        msa.close()
+        msa = cnestedlist.NLMSA(filename, 'a', seqDict) # REBUILD WITHOUT IT
+        msa.build(idIndex=False)
+        assert not os.path.exists(filename + '.idIndex')
+        msa = cnestedlist.NLMSA(filename, 'r', seqDict) # READS THE SHELVES
+        assert not isinstance(msa.seqs.seqIDdict, nlmsa_utils.SeqIDIndexDict)
+        assert sorted(msa.seqs.seqIDdict.items()) == correct
+        assert [sorted([(repr(a), repr(b)) for a, b
+                        in msa[s].matchIntervals()]) for s in seqs] == l
+        msa.close()
+        assert nlmsa_utils.write_id_index(filename) == len(seqs)
+        msa = cnestedlist.NLMSA(filename, 'r', seqDict)
+        assert isinstance(msa.seqs.seqIDdict, nlmsa_utils.SeqIDIndexDict)
+        assert [sorted([(repr(a), repr(b)) for a, b
+                        in msa[s].matchIntervals()]) for s in seqs] == l
+
+    def test_aligned_arrays(self):
+        "NLMSA.add_aligned_arrays matches per-pair nlmsa[s1] += s2"
+        rand = random.Random(23)
+        tempdir = testutil.TempDir('nlmsa-test')
+        fastafile = tempdir.subfile('arrays.fa')
+        ifile = open(fastafile, 'w')
+        for i in range(20):
+            ifile.write('>seq%d\n%s\n' % (i, 'ACGT' * 50))
+        ifile.close()
+        db = seqdb.SequenceFileDB(fastafile)
+        pairs = []
+        for i in range(300):
+            start = rand.randint(0, 150)
+            stop = start + rand.randint(1, 50)
+            if rand.random() < 0.3: # REVERSE STRAND INTERVALS
+                start, stop = -stop, -start
+            pairs.append(('seq%d' % rand.randint(0, 19), start, stop,
+                          'seq%d' % rand.randint(0, 19), start, stop))
+        columns = [list(c) for c in zip(*pairs)]
+
+        def per_pair(msa, pairs):
+            for srcID, start, stop, destID, dstart, dstop in pairs:
+                src = sequence.absoluteSlice(db[srcID], start, stop)
+                dest = sequence.absoluteSlice(db[destID], dstart, dstop)
+                msa += src
+                msa[src] += dest
+
+        def matches(msa):
+            return [sorted([(repr(a), repr(b)) for a, b
+                            in msa[db[k]].matchIntervals()])
+                    for k in sorted(db.keys())]
+
+        for kwargs in (dict(), dict(bidirectional=False),
+                       dict(maxlen=500)): # maxlen FORCES SEVERAL UNIONS
+            msa = cnestedlist.NLMSA('', 'memory', db, pairwiseMode=True,
+                                    **kwargs)
+            per_pair(msa, pairs)
+            msa2 = cnestedlist.NLMSA('', 'memory', db, pairwiseMode=True,
+                                     **kwargs)
+            assert msa2.add_aligned_arrays(*columns) == len(pairs)
+            assert [ns.buildList for ns in msa2.seqlist] == \
+                   [ns.buildList for ns in msa.seqlist]
+            msa.build()
+            msa2.build()
+            assert matches(msa2) == matches(msa)
+            l = []
+            for name, f in (('pairs', lambda m: per_pair(m, pairs[:200])),
+                            ('arrays', lambda m: m.add_aligned_arrays(
+                                 *[c[:200] for c in columns]))):
+                filename = tempdir.subfile(name)
+                msa = cnestedlist.NLMSA(filename, 'w', db, pairwiseMode=True,
+                                        **kwargs)
+                f(msa)
+                msa.build()
+                msa = cnestedlist.NLMSA(filename, 'a', db) # APPEND THE REST
+                msa.add_aligned_arrays(*[c[200:] for c in columns])
+                msa.build()
+                msa = cnestedlist.NLMSA(filename, 'r', db)
+                l.append((matches(msa), [(ns.id, ns.length, ns.is_union)
+                                         for ns in msa.seqlist]))
+                msa.close()
+            assert l[0] == l[1]
+            assert l[0][0] == matches(msa2)
+
+        msa = cnestedlist.NLMSA('', 'memory', db, pairwiseMode=True)
+        assert msa.add_aligned_arrays([], [], [], [], [], []) == 0
+        for bad in ((0, 201), (5, 5), (-201, -5), (-5, 5)):
+            self.assertRaises(ValueError, msa.add_aligned_arrays,
+                              ['seq0', 'seq1'], [0, bad[0]], [10, bad[1]],
+                              ['seq2', 'seq3'], [0, 0], [10, 10])
+        self.assertRaises(ValueError, msa.add_aligned_arrays,
+                          ['seq0'], [0, 5], [10, 15], ['seq1'], [0], [10])
+        self.assertRaises(KeyError, msa.add_aligned_arrays,
+                          ['noSuchSeq'], [0], [10], ['seq1'], [0], [10])
+        assert list(msa.seqs) == [] # REJECTED CALLS ADDED NO SEQUENCES
+
+    def test_slice_cache(self):
+        "NLMSA sliceCache reuses slice join results across opens"
+        tempdir = testutil.TempDir('nlmsa-test')
+        genomeUnion, mafFiles = testutil.make_maf_genomes(tempdir.path)
+        filename = tempdir.subfile('maf')
+        msa = cnestedlist.NLMSA(filename, 'w', genomeUnion, mafFiles=mafFiles)
+        msa.close()
+        self.assertRaises(ValueError, cnestedlist.NLMSA, filename, 'a',
+                          genomeUnion, sliceCache=tempdir.subfile('cache'))
+        rand = random.Random(24)
+        chr1 = genomeUnion['sp0.chr1']
+        ivals = []
+        for i in range(50):
+            start = rand.randint(0, 4900)
+            ival = chr1[start:start + rand.randint(1, 100)]
+            if rand.random() < 0.3:
+                ival = -ival
+            ivals.append(ival)
+
+        def slices(msa):
+            l = []
+            for ival in ivals:
+                try:
+                    sl = msa[ival]
+                except KeyError: # NOT ALIGNED
+                    l.append(None)
+                    continue
+                l.append((len(sl), sorted([(repr(a), repr(b)) for a, b
+                                           in sl.matchIntervals()])))
+            return l
+
+        msa = cnestedlist.NLMSA(filename, 'r', genomeUnion)
+        correct = slices(msa)
+        msa.close()
+        ivals0 = ivals
+        for lazySlices in (False, True):
+            cacheFile = tempdir.subfile('slicecache%d' % lazySlices)
+            msa = cnestedlist.NLMSA(filename, 'r', genomeUnion,
+                                    sliceCache=cacheFile,
+                                    lazySlices=lazySlices)
+            assert slices(msa) == correct
+            cache = msa.sliceCache
+            assert cache.hits == 0 and cache.misses == len(ivals)
+            msa.close()
+            assert msa.sliceCache is None
+            msa = cnestedlist.NLMSA(filename, 'r', genomeUnion,
+                                    sliceCache=cacheFile)
+            assert slices(msa) == correct
+            assert msa.sliceCache.hits == len(ivals) # NO JOINS THIS TIME
+            assert msa.sliceCache.misses == 0
+            if nlmsa_utils.fcntl is not None: # LOCKED UNTIL WE CLOSE IT
+                self.assertRaises(IOError, nlmsa_utils.SliceCache, cacheFile,
+                                  msa.buildID)
+            msa.close()
+
+        msa = cnestedlist.NLMSA(filename, 'r', genomeUnion, # TINY CACHE
+                                sliceCache=tempdir.subfile('tinycache'),
+                                sliceCacheBytes=2000)
+        assert slices(msa) == correct
+        assert int(msa.sliceCache.db['__bytes__']) <= 2000
+        ivals = ivals[-1:] # NEWEST ENTRY IS KEPT
+        assert slices(msa) == correct[-1:]
+        assert msa.sliceCache.hits == 1
+        msa.close()
+
+        msa = cnestedlist.NLMSA(filename, 'r', genomeUnion)
+        buildID = msa.buildID
+        assert len(buildID) == 32
+        msa.close()
+        ifile = file(filename + '.NLMSAindex') # KEPT IN THE OLD FORMAT
+        assert set([len(line.split('\t')) for line in ifile]) == set([4])
+        ifile.close()
+        os.rename(filename + '.buildID', filename + '.buildID.old')
+        msa = cnestedlist.NLMSA(filename, 'r', genomeUnion) # AS IF OLD PYGR
+        assert msa.buildID is None
+        msa.close()
+        self.assertRaises(ValueError, cnestedlist.NLMSA, filename, 'r',
+                          genomeUnion, sliceCache=cacheFile)
+        os.rename(filename + '.buildID.old', filename + '.buildID')
+        msa = cnestedlist.NLMSA(filename, 'w', genomeUnion, mafFiles=mafFiles)
+        msa.close()
+        ivals = ivals0
+        msa = cnestedlist.NLMSA(filename, 'r', genomeUnion,
+                                sliceCache=cacheFile)
+        assert msa.buildID != buildID
+        assert slices(msa) == correct
+        assert msa.sliceCache.hits == 0 # OLD ENTRIES WERE DROPPED
+        msa.close()
+
+    def test_summarize(self):
+        "NLMSA.summarize() bins match the slice's raw intervals"
+        tempdir = testutil.TempDir('nlmsa-test')
+        genomeUnion, mafFiles = testutil.make_maf_genomes(tempdir.path)
+        maf = cnestedlist.NLMSA(tempdir.subfile('maf'), 'w', genomeUnion,
+                                mafFiles=mafFiles)
+        rand = random.Random(25)
+        seqs = make_random_seqs(5, 1000, rand)
+        msa = cnestedlist.NLMSA('summarize', 'memory', pairwiseMode=True)
+        for s in seqs:
+            msa += s
+        for i in range(300):
+            src = rand.choice(seqs)
+            s = rand.choice(seqs)
+            if rand.random() < 0.3:
+                s = -s
+            start = rand.randint(0, 900)
+            stop = start + rand.randint(1, 100)
+            msa[src[start:stop]] += s[start:stop]
+        msa.build()
+
+        def correct(nlmsa, ival, binSize):
+            sl = nlmsa[ival]
+            if binSize is None:
+                binSize = ival.stop - ival.start
+            d = {}
+            for k, (start, end, targetID, tstart, tend) \
+                    in enumerate(sl.rawIvals()):
+                if nlmsa.seqlist.is_lpo(targetID):
+                    continue
+                seqID = nlmsa.seqlist.getSeqID(targetID)
+                for i in range(start, end): # COUNT EACH BASE IN ITS BIN
+                    b = (i - ival.start) / binSize
+                    t = d.setdefault((b, seqID), [0, set()])
+                    t[0] += 1
+                    t[1].add(k) # DUPLICATE INTERVALS ARE SEPARATE BLOCKS
+            return dict([(k, (t[0], len(t[1]))) for k, t in d.items()])
+
+        n = 0
+        for nlmsa, ivals in ((maf, [genomeUnion['sp0.chr1']]),
+                             (msa, seqs)):
+            for i in range(20):
+                seq = rand.choice(ivals)
+                start = rand.randint(0, len(seq) - 200)
+                ival = seq[start:start + rand.randint(1, 200)]
+                if i % 3 == 0:
+                    ival = -ival
+                for binSize in (None, 1, 7, 50, 1000):
+                    summary = nlmsa.summarize(ival, binSize)
+                    assert summary.start == ival.start
+                    assert summary.stop == ival.stop
+                    nbins = len(summary)
+                    if binSize is None:
+                        assert nbins == 1
+                    else:
+                        assert nbins == (len(ival) + binSize - 1) / binSize
+                    k = len(summary.seqIDs)
+                    d = {}
+                    for b in range(nbins):
+                        for j, seqID in enumerate(summary.seqIDs):
+                            t = (summary.seqBases[b * k + j],
+                                 summary.seqBlocks[b * k + j])
+                            if t != (0, 0):
+                                d[(b, seqID)] = t
+                        l = [t for (b2, seqID), t in d.items() if b2 == b]
+                        assert summary.nseqs[b] == len(l)
+                        assert summary.alignedBases[b] == \
+                               sum([t[0] for t in l])
+                    assert d == correct(nlmsa, ival, binSize)
+                    n += len(d)
+                    for seqID in summary.seqIDs:
+                        assert list(summary.seq_bases(seqID)) == \
+                               [d.get((b, seqID), (0, 0))[0]
+                                for b in range(nbins)]
+                summary = nlmsa[ival].summarize(10)
+                assert summary.seqIDs == nlmsa.summarize(ival, 10).seqIDs
+                assert summary.seqBases == nlmsa.summarize(ival, 10).seqBases
+        assert n > 1000 # NOT ALL EMPTY
+
+        unaligned = sequence.Sequence('ACGT' * 10, 'unaligned')
+        msa = cnestedlist.NLMSA('summarize', 'memory', pairwiseMode=True)
+        msa += seqs[0]
+        msa += unaligned
+        msa[seqs[0][:10]] += seqs[0][20:30]
+        msa.build()
+        for summary in (msa.summarize(unaligned[5:25], 10),
+                        msa[unaligned[5:25]].summarize(10)):
+            assert summary.seqIDs == [] and list(summary.nseqs) == [0, 0]
+            assert list(summary.alignedBases) == [0, 0]
+        self.assertRaises(ValueError, msa.summarize, seqs[0][:10], 0)
+        self.assertRaises(KeyError, msa.summarize, seqs[1][:10])
+
 
 class NLMSA_Test(unittest.TestCase):
 
@@ -387,6 +387,66 @@ def get_file_md5(fpath):
     return h
 
 
+def make_maf(path, nspecies=8, length=200000, seed=1234):
+    '''write a synthetic MAF alignment of nspecies genomes to directory
+    path: blocks of 20 - 300 columns with gaps, aligning almost all of
+    the first genome.  Returns (seqDir, [mafFile])'''
+    rand = random.Random(seed)
+    genomes = []
+    for i in range(nspecies):
+        prefix = 'sp%d' % i
+        s = ''.join([rand.choice('ACGT') for j in range(length)])
+        ofile = file(path_join(path, prefix), 'w')
+        ofile.write('>chr1\n')
+        for j in range(0, length, 60):
+            ofile.write(s[j:j + 60] + '\n')
+        ofile.close()
+        genomes.append((prefix, s))
+    mafFile = path_join(path, 'synthetic.maf')
+    ofile = file(mafFile, 'w')
+    ofile.write('##maf version=1\n')
+    pos = [0] * nspecies
+    while True:
+        ncol = rand.randint(20, 300)
+        rows = []
+        for i, (prefix, s) in enumerate(genomes):
+            if i > 0 and rand.random() < 0.1: # SPECIES MISSING FROM BLOCK
+                continue
+            text = []
+            for j in range(ncol):
+                if i > 0 and rand.random() < 0.05: # GAP
+                    text.append('-')
+                else:
+                    text.append('N') # FILLED IN BELOW
+            size = ncol - text.count('-')
+            if pos[i] + size > length:
+                break
+            letters = iter(s[pos[i]:pos[i] + size])
+            text = ''.join([c == '-' and c or letters.next() for c in text])
+            rows.append('s %s.chr1 %d %d + %d %s\n'
+                        % (prefix, pos[i], size, length, text))
+            pos[i] += size + rand.randint(0, 3)
+        else:
+            ofile.write('a score=0\n' + ''.join(rows) + '\n')
+            continue
+        break
+    ofile.close()
+    return path, [mafFile]
+
+
+def make_maf_genomes(path, nspecies=4, length=5000):
+    '''write a synthetic MAF alignment to directory path, as make_maf().
+    Returns (genomeUnion, mafFiles), genomeUnion a PrefixUnionDict of
+    its genomes'''
+    from pygr import seqdb
+    seqDir, mafFiles = make_maf(path, nspecies, length)
+    genomes = {}
+    for i in range(nspecies):
+        genomes['sp%d' % i] = \
+                seqdb.SequenceFileDB(path_join(seqDir, 'sp%d' % i))
+    return seqdb.PrefixUnionDict(genomes), mafFiles
+
+
 if __name__ == '__main__':
     t = TempDir('tempdir')
     t.reset()